@@ -125,8 +125,11 @@ def open(source, format=None):
     The supported format strings are:
 
        fps, fps.gz  - fingerprints are in FPS format
-    
-    The result is an FPSReader. Here's an example of printing the
+       fpb, fpb.gz  - fingerprints are in the binary fpb format
+
+    For FPS files the result is an FPSReader. For fpb files the result
+    is a FingerprintArena which, for uncompressed files, uses a
+    memory-mapped view of the file. Here's an example of printing the
     contents of the file::
     
         reader = open("example.fps.gz")
@@ -138,7 +141,7 @@ def open(source, format=None):
     :param format: The file format and optional compression.
     :type format: string, or None
 
-    :returns: an FPSReader
+    :returns: an FPSReader or FingerprintArena
     """
     from . import io
     format_name, compression = io.normalize_format(source, format)
@@ -148,7 +151,8 @@ def open(source, format=None):
         return fps_io.open_fps(source, format_name+compression)
 
     if format_name == "fpb":
-        raise NotImplementedError("fpb format support not implemented")
+        from . import fpb_io
+        return fpb_io.open_fpb(source, format_name+compression)
     if format is None:
         raise ValueError("Unable to determine fingerprint format type from %r" % (source,))
     else:
@@ -166,7 +170,10 @@ def load_fingerprints(reader, metadata=None, reorder=True, alignment=None):
     parsed with the 'chemfp.open' function. Otherwise it must support
     iteration returning (id, fingerprint) pairs. 'metadata' contains the
     metadata the arena. If not specified then 'reader.metadata' is used.
-    
+
+    Loading an fpb file does not parse or copy the fingerprints. The
+    arena uses the memory-mapped file contents directly.
+
     The loader may reorder the fingerprints for better search performance.
     To prevent ordering, use reorder=False.
 
@@ -190,10 +197,18 @@ def load_fingerprints(reader, metadata=None, reorder=True, alignment=None):
         reader = open(reader)
     elif hasattr(reader, "read"):
         reader = open(reader)
+
+    from . import arena
+    if (isinstance(reader, arena.FingerprintArena) and
+        (metadata is None or metadata is reader.metadata) and
+        (alignment is None or alignment == reader.alignment)):
+        # Already an arena, eg, from an fpb file. This only copies
+        # the fingerprints if they need to be reordered.
+        return reader.copy(reorder=reorder)
+
     if metadata is None:
         metadata = reader.metadata
 
-    from . import arena
     return arena.fps_to_arena(reader, metadata=metadata, reorder=reorder,
                               alignment=alignment)
 
@@ -715,8 +730,18 @@ class FingerprintReader(object):
                 break
             yield arena
 
-    def save(self, destination):
+    def save(self, destination, format=None):
+        """Save the fingerprints to a given destination and format
+
+        The default format is based on the destination filename,
+        or "fps" if that cannot be determined. Saving in "fpb"
+        format first loads the fingerprints into an arena.
+        """
         from . import io
+        format_name, compression = io.normalize_format(destination, format)
+        if format_name == "fpb":
+            load_fingerprints(self, self.metadata).save(destination, format)
+            return
         io.write_fps1_output(self, destination, self.metadata)
 
 
@@ -7,7 +7,9 @@ string, called the `arena`. Each fingerprint takes `storage_size`
 bytes, which may be larger than `num_bytes` if the fingerprints have a
 specific memory alignment. The bytes for fingerprint i are
   arena[i*storage_size:i*storage_size+num_bytes]
-Additional bytes must contain NUL bytes.
+Additional bytes must contain NUL bytes. The arena is usually a byte
+string, but FingerprintArena.from_buffer() can use any object which
+supports the buffer interface, like an mmap or a NumPy array.
 
 The lookup for `ids[i]` contains the id for fingerprint `i`.
 
@@ -23,12 +25,22 @@ from __future__ import absolute_import
 import ctypes
 from cStringIO import StringIO
 import array
+from itertools import izip
 
-from chemfp import FingerprintReader
+from chemfp import FingerprintReader, Metadata
 import _chemfp
 from chemfp import bitops, search
+from chemfp.id_table import IdIndex, IdTable, IdTableBuilder
 
 __all__ = []
+
+# The C search code uses int byte offsets into the arena
+MAX_ARENA_SIZE = 2**31 - 1
+
+def _check_arena_size(arena_size):
+    if arena_size > MAX_ARENA_SIZE:
+        raise ValueError("arena of %d bytes is larger than the 2 GB limit of %d bytes" %
+                         (arena_size, MAX_ARENA_SIZE))
     
 class FingerprintArena(FingerprintReader):
     """Stores fingerprints in a contiguous block of memory
@@ -48,6 +60,7 @@ class FingerprintArena(FingerprintReader):
             raise TypeError("Missing metadata num_bits information")
         if metadata.num_bytes is None:
             raise TypeError("Missing metadata num_bytes information")
+        _check_arena_size(len(arena))
         self.metadata = metadata
         self.alignment = alignment
         self.num_bits = metadata.num_bits
@@ -69,9 +82,106 @@ class FingerprintArena(FingerprintReader):
         else:
             self._ids = None
         self._id_lookup = id_lookup
+        self._contains_index = None
+        self._folded_prefilter = None
         assert end >= start
         self._range_check = xrange(end-start)
 
+    @classmethod
+    def from_buffer(cls, buf, num_bits, ids, popcount_indices=None,
+                    storage_size=None, metadata=None):
+        """Make an arena which uses the fingerprint bytes in `buf` without copying them
+
+        `buf` may be a string or any object which supports the buffer
+        interface, like a NumPy uint8 array, mmap, bytearray, or
+        memoryview, so long as its data is contiguous. Fingerprint i
+        is in the `storage_size` bytes starting at byte
+        i*storage_size. Bytes after the first (num_bits+7)//8 bytes
+        of each fingerprint must be NUL bytes. The default
+        storage_size is len(buf)//len(ids).
+
+        The arena keeps a reference to `buf`, which must not be
+        modified while the arena is in use. The search code uses int
+        byte offsets, so `buf` must not be larger than 2 GB
+        (`MAX_ARENA_SIZE` bytes). Split larger data sets into several
+        arenas.
+
+        `popcount_indices`, if given, must be a string or array of
+        num_bits+2 native integers, in the same format as
+        `FingerprintArena.popcount_indices`. If None, and the
+        fingerprints are already ordered by popcount, then the
+        indices are computed without copying the fingerprints.
+        Otherwise the arena is unordered. Use `copy(reorder=True)`
+        to make a reordered copy.
+
+        :param buf: the fingerprint data
+        :type buf: a string or object supporting the buffer interface
+        :param num_bits: the number of bits in each fingerprint
+        :type num_bits: positive integer
+        :param ids: the fingerprint identifiers, in the same order as the fingerprints
+        :type ids: a list or IdTable (other iterables are copied to a list)
+        :param popcount_indices: the popcount indices, or None to compute them if possible
+        :param storage_size: the number of bytes used to store each fingerprint
+        :type storage_size: positive integer, or None
+        :param metadata: the arena metadata, if more than num_bits is known
+        :type metadata: Metadata, or None
+        :returns: FingerprintArena
+        """
+        if metadata is None:
+            metadata = Metadata(num_bits=num_bits)
+        elif metadata.num_bits != num_bits:
+            raise ValueError("metadata num_bits of %r does not match num_bits of %r" %
+                             (metadata.num_bits, num_bits))
+        # Keep the compact storage of an IdTable
+        if not isinstance(ids, (list, IdTable)):
+            ids = list(ids)
+        num_bytes = metadata.num_bytes
+        num_fingerprints = len(ids)
+
+        # This gets a direct reference to the buffer's memory, and
+        # raises an exception if the memory isn't contiguous.
+        view = _chemfp.BufferView(buf)
+        if isinstance(buf, str):
+            arena = buf
+        else:
+            arena = buffer(view)
+        arena_size = len(view)
+        _check_arena_size(arena_size)
+
+        if storage_size is None:
+            if num_fingerprints:
+                storage_size = arena_size // num_fingerprints
+            else:
+                storage_size = num_bytes
+        if storage_size < num_bytes:
+            raise ValueError("storage_size of %d is too small for %d bytes per fingerprint" %
+                             (storage_size, num_bytes))
+        if num_fingerprints * storage_size > arena_size:
+            raise ValueError("buffer of %d bytes is too small for %d fingerprints of %d bytes each" %
+                             (arena_size, num_fingerprints, storage_size))
+        end_padding = arena_size - num_fingerprints * storage_size
+
+        # Use the memory as-is. The alignment is the largest power of two
+        # which evenly divides both the start address and the storage size.
+        alignment = view.alignment
+        while storage_size % alignment:
+            alignment //= 2
+
+        if popcount_indices is None:
+            indices = array.array("i", (0,)*(num_bits+2))
+            if _chemfp.make_popcount_indices(num_bits, 0, end_padding, storage_size,
+                                             arena, num_fingerprints, indices):
+                popcount_indices = indices.tostring()
+            else:
+                popcount_indices = ""
+        elif not isinstance(popcount_indices, str):
+            popcount_indices = buffer(_chemfp.BufferView(popcount_indices))[:]
+        if popcount_indices and len(popcount_indices) != (num_bits+2) * array.array("i").itemsize:
+            raise ValueError("popcount_indices must contain %d integers" % (num_bits+2,))
+
+        return cls(metadata, alignment, 0, end_padding, storage_size, arena,
+                   popcount_indices, ids, 0, num_fingerprints)
+
     def __len__(self):
         """Number of fingerprint records in the FingerprintArena"""
         return self.end - self.start
@@ -94,11 +204,13 @@ class FingerprintArena(FingerprintReader):
                 return FingerprintArena(self.metadata, self.alignment,
                                         0, 0, self.storage_size, "",
                                         "", [], 0, 0)
-            return FingerprintArena(self.metadata, self.alignment,
-                                    self.start_padding, self.end_padding,
-                                    self.storage_size, self.arena,
-                                    self.popcount_indices, self.arena_ids,
-                                    self.start+start, self.start+end)
+            subarena = FingerprintArena(self.metadata, self.alignment,
+                                        self.start_padding, self.end_padding,
+                                        self.storage_size, self.arena,
+                                        self.popcount_indices, self.arena_ids,
+                                        self.start+start, self.start+end)
+            subarena._folded_prefilter = self._folded_prefilter
+            return subarena
         try:
             i = self._range_check[i]
         except IndexError:
@@ -109,8 +221,13 @@ class FingerprintArena(FingerprintReader):
         return self.arena_ids[arena_i], self.arena[start_offset:end_offset]
 
     def _make_id_lookup(self):
-        d = dict((id, i) for (i, id) in enumerate(self.ids))
-        self._id_lookup = d.get
+        # The hash table in IdIndex uses much less memory than a
+        # dictionary. Fall back to a dictionary for unusual ids.
+        try:
+            self._id_lookup = IdIndex.from_ids(self.ids).get
+        except ValueError:
+            d = dict((id, i) for (i, id) in enumerate(self.ids))
+            self._id_lookup = d.get
         return self._id_lookup
         
     def get_by_id(self, id):
@@ -146,9 +263,23 @@ class FingerprintArena(FingerprintReader):
         end_offset = start_offset + self.metadata.num_bytes
         return self.arena[start_offset:end_offset]
 
-    def save(self, destination):
-        """Save the arena contents to the given filename or file object"""
+    def save(self, destination, format=None):
+        """Save the arena contents to the given filename or file object
+
+        The default format is based on the destination filename, or
+        "fps" if that cannot be determined. Use "fpb" to save the arena
+        in the binary fpb format, which can be memory-mapped by
+        `chemfp.load_fingerprints`.
+        """
         from . import io
+        format_name, compression = io.normalize_format(destination, format)
+        if format_name == "fpb":
+            if compression:
+                raise ValueError("fpb output does not support compression")
+            from . import fpb_io
+            fpb_io.write_fpb(self, destination)
+            return
+
         need_close = False
         if isinstance(destination, basestring):
             need_close = True
@@ -179,7 +310,7 @@ class FingerprintArena(FingerprintReader):
             return
         target_fp_size = self.metadata.num_bytes
         arena = self.arena
-        for id, start_offset in zip(self.arena_ids[self.start:self.end],
+        for id, start_offset in izip(self.arena_ids[self.start:self.end],
                                     xrange(self.start*storage_size+self.start_padding,
                                            self.end*storage_size+self.start_padding,
                                            storage_size)):
@@ -210,10 +341,12 @@ class FingerprintArena(FingerprintReader):
             end = start+arena_size
             if end > self.end:
                 end = self.end
-            yield FingerprintArena(self.metadata, self.alignment,
-                                   self.start_padding, self.end_padding,
-                                   storage_size, self.arena,
-                                   self.popcount_indices, self.arena_ids, start, end)
+            subarena = FingerprintArena(self.metadata, self.alignment,
+                                        self.start_padding, self.end_padding,
+                                        storage_size, self.arena,
+                                        self.popcount_indices, self.arena_ids, start, end)
+            subarena._folded_prefilter = self._folded_prefilter
+            yield subarena
             start = end
 
     def count_tanimoto_hits_fp(self, query_fp, threshold=0.7):
@@ -337,6 +470,115 @@ class FingerprintArena(FingerprintReader):
         """
         return search.knearest_tanimoto_search_arena(queries, self, k, threshold)
 
+    def count_contains_hits_fp(self, query_fp):
+        """Count the fingerprints which contain all of the bits in the query fingerprint
+
+        This is the same as `chemfp.search.count_contains_hits_fp`_.
+
+        :param query_fp: query fingerprint
+        :type query_fp: byte string
+        :returns: integer count
+        """
+        return search.count_contains_hits_fp(query_fp, self)
+
+    def count_contains_hits_arena(self, queries):
+        """Count the fingerprints which contain all of the bits in each query fingerprint
+
+        This is the same as `chemfp.search.count_contains_hits_arena`_.
+
+        :param queries: query fingerprints
+        :type queries: FingerprintArena
+        :returns: an array of counts, one for each query
+        """
+        return search.count_contains_hits_arena(queries, self)
+
+    def contains_search_fp(self, query_fp):
+        """Find the fingerprints which contain all of the bits in the query fingerprint
+
+        This is a substructure screen. The hits are in index order
+        and have a score of 0.0. This is the same as
+        `chemfp.search.contains_search_fp`_.
+
+        :param query_fp: query fingerprint
+        :type query_fp: byte string
+        :returns: SearchResult
+        """
+        return search.contains_search_fp(query_fp, self)
+
+    def contains_search_arena(self, queries):
+        """Find the fingerprints which contain all of the bits in each of the query fingerprints
+
+        This is a substructure screen. The hits are in index order
+        and have a score of 0.0. This is the same as
+        `chemfp.search.contains_search_arena`_.
+
+        :param queries: query fingerprints
+        :type queries: FingerprintArena
+        :returns: SearchResults
+        """
+        return search.contains_search_arena(queries, self)
+
+    def __getstate__(self):
+        # Don't pickle the contains index or the folded prefilter.
+        # They can be remade, and ctypes arrays can't be pickled.
+        state = self.__dict__.copy()
+        state["_contains_index"] = None
+        state["_folded_prefilter"] = None
+        return state
+
+    @property
+    def folded_prefilter(self):
+        """The `FoldedPrefilter` for the arena, or None
+
+        Use `make_folded_prefilter` to make it.
+        """
+        return self._folded_prefilter
+
+    def make_folded_prefilter(self, num_bits=256):
+        """Make a folded copy of the fingerprints, to speed up the Tanimoto arena searches
+
+        Each fingerprint is folded to `num_bits` bits by ORing its
+        `num_bits` sections together. The count, threshold and
+        k-nearest Tanimoto arena searches against this arena, or
+        against an arena made from it by slicing or `iter_arenas`,
+        compare the folded fingerprints first. This gives an upper
+        bound on the score, and the full comparison is skipped if the
+        bound is too low. The results are unchanged.
+
+        The prefilter is only used for a single threshold greater
+        than 0.0, with no `max_score` or `interval`, and when the
+        arena is ordered by popcount. It works best with long, sparse
+        fingerprints and high thresholds. Its `num_candidates` and
+        `num_pruned` attributes show how well it works.
+
+        :param num_bits: the number of bits in the folded fingerprints
+        :type num_bits: a multiple of 64, from 64 to 1024, and less than the arena's num_bits
+        :returns: the `FoldedPrefilter`
+        """
+        num_fingerprints = (len(self.arena) - self.start_padding - self.end_padding) // self.storage_size
+        folded_arena = (ctypes.c_uint64 * (num_fingerprints * (num_bits // 64)))()
+        lost_bits = (ctypes.c_int * num_fingerprints)()
+        _chemfp.fold_arena(self.num_bits, self.start_padding, self.end_padding,
+                           self.storage_size, self.arena, 0, num_fingerprints,
+                           num_bits, folded_arena, lost_bits)
+        self._folded_prefilter = FoldedPrefilter(num_bits, folded_arena, lost_bits)
+        return self._folded_prefilter
+
+    def _get_contains_index(self):
+        # The bit-sliced index used by the substructure screens. It
+        # uses about as much memory as the fingerprints, so it's only
+        # made when needed.
+        if self._contains_index is None:
+            num_bits = self.num_bits
+            num_words = _chemfp.get_contains_index_num_words(self.end - self.start)
+            postings = (ctypes.c_uint64 * (num_bits * num_words))()
+            bit_counts = (ctypes.c_int * num_bits)()
+            _chemfp.make_contains_index(num_bits, self.start_padding, self.end_padding,
+                                        self.storage_size, self.arena, self.start, self.end,
+                                        postings, bit_counts)
+            self._contains_index = (postings, bit_counts)
+        return self._contains_index
+
     def copy(self, indices=None, reorder=None):
         """Create a new arena using either all or some of the fingerprints in this arena
 
@@ -412,7 +654,7 @@ class FingerprintArena(FingerprintReader):
                 self.metadata.num_bits, self.storage_size, arena, len(current_ids),
                 ordering, popcounts, self.alignment)
 
-            reordered_ids = [current_ids[item.index] for item in ordering]
+            reordered_ids = _reorder_ids(current_ids, ordering)
             return FingerprintArena(self.metadata, self.alignment,
                                     start_padding, end_padding, self.storage_size,
                                     arena, popcounts.tostring(), reordered_ids)
@@ -446,12 +688,14 @@ class FingerprintArena(FingerprintReader):
 
         # Copy the fingerprints over to a new arena block
         unsorted_fps = []
-        new_ids = []
         for new_i in new_indices:
             start_offset = start_padding + new_i*storage_size
             end_offset = start_offset + storage_size
             unsorted_fps.append(arena[start_offset:end_offset])
-            new_ids.append(arena_ids[new_i])
+        if isinstance(arena_ids, IdTable):
+            new_ids = arena_ids.take(new_indices)
+        else:
+            new_ids = [arena_ids[new_i] for new_i in new_indices]
                 
         unsorted_arena = "".join(unsorted_fps)
         unsorted_fps = None   # regain some memory
@@ -471,21 +715,65 @@ class FingerprintArena(FingerprintReader):
             self.metadata.num_bits, storage_size, unsorted_arena, len(new_ids),
             ordering, popcounts, self.alignment)
 
-        reordered_ids = [new_ids[item.index] for item in ordering]
+        reordered_ids = _reorder_ids(new_ids, ordering)
         return FingerprintArena(self.metadata, self.alignment,
                                 start_padding, end_padding, storage_size,
                                 sorted_arena, popcounts.tostring(), reordered_ids)
         
 
+class FoldedPrefilter(object):
+    """The folded fingerprints used to prefilter the Tanimoto arena searches
+
+    Folded fingerprint i comes from fingerprint i of the arena, and
+    `lost_bits[i]` is the number of its bits which were lost because
+    two of them were folded to the same position.
+
+    The public attributes are:
+       num_bits
+           the number of bits in each folded fingerprint
+       num_candidates
+           the number of targets tested by the prefilter
+       num_pruned
+           the number of targets the prefilter skipped
+    """
+    def __init__(self, num_bits, folded_arena, lost_bits):
+        self.num_bits = num_bits
+        self.folded_arena = folded_arena
+        self.lost_bits = lost_bits
+        # The searches add to the number of candidates and pruned targets
+        self.stats = (ctypes.c_longlong * 2)()
+
+    @property
+    def num_candidates(self):
+        return self.stats[0]
+
+    @property
+    def num_pruned(self):
+        return self.stats[1]
+
+    def reset_stats(self):
+        """Set `num_candidates` and `num_pruned` to 0"""
+        self.stats[0] = self.stats[1] = 0
+
 # TODO: push more of this malloc-management down into C
 class ChemFPOrderedPopcount(ctypes.Structure):
     _fields_ = [("popcount", ctypes.c_int),
                 ("index", ctypes.c_int)]
 
+def _reorder_ids(ids, ordering):
+    if isinstance(ids, IdTable):
+        # Get the index fields without making a Python object for each one
+        indices = array.array("i")
+        indices.fromstring(buffer(ordering))
+        return ids.take(indices[1::2])
+    return [ids[item.index] for item in ordering]
+
 
 _methods = bitops.get_methods()
 _has_popcnt = "POPCNT" in _methods
 _has_ssse3 = "ssse3" in _methods
+_has_avx2 = "avx2" in _methods
+_has_avx512 = "avx512" in _methods
 
 def get_optimal_alignment(num_bits):
     if num_bits <= 32:
@@ -501,6 +789,14 @@ def get_optimal_alignment(num_bits):
     if num_bits <= 224:
         return 8
 
+    # The AVX methods are only used if they were faster than the
+    # 8-byte methods (or were selected by hand). They need the
+    # fingerprints padded to 64 bytes for AVX-512 and 32 for AVX2.
+    if _has_avx512 and bitops.get_alignment_method("align-avx512") == "avx512":
+        return 64
+    if _has_avx2 and bitops.get_alignment_method("align-avx2") == "avx2":
+        return 32
+
     # If you have POPCNT (and you're using it) then there's no reason
     # to use a larger alignment
     if _has_popcnt:
@@ -526,6 +822,23 @@ def get_optimal_alignment(num_bits):
     return 64
 
 
+def _load_fps_blocks(fps_reader, num_bits, num_bytes, storage_size, alignment,
+                     popcount_indices):
+    # Decode the blocks from an FPSReader directly into a new aligned
+    # arena, which grows as needed. The C code also computes the
+    # popcounts and builds the id block for an IdTable. If
+    # popcount_indices is not empty then the fingerprints are sorted in
+    # place. Returns the start and end padding, the arena, the
+    # ChemFPOrderedPopcount data if the fingerprints were reordered or
+    # None, and the IdTable in the original order.
+    from .fps_io import FPSParseError
+    (err, num_lines, start_padding, end_padding, arena, ordering, id_block,
+     offsets) = _chemfp.fps_load_arena(num_bits, num_bytes, storage_size, alignment,
+                                       fps_reader.iter_blocks(), popcount_indices)
+    if err:
+        raise FPSParseError(err, fps_reader._first_fp_lineno + num_lines, fps_reader._filename)
+    return start_padding, end_padding, arena, ordering, IdTable(id_block, offsets)
+
 def fps_to_arena(fps_reader, metadata=None, reorder=True, alignment=None):
     if metadata is None:
         metadata = fps_reader.metadata
@@ -549,7 +862,23 @@ def fps_to_arena(fps_reader, metadata=None, reorder=True, alignment=None):
     else:
         end_padding = None
 
-    ids = []
+    from .fps_io import FPSReader
+    if (isinstance(fps_reader, FPSReader) and num_bytes and
+        fps_reader.metadata.num_bytes == num_bytes):
+        # Decode the FPS blocks in C, without a Python object for each record
+        if not reorder or not metadata.num_bits:
+            popcounts = array.array("i")
+        else:
+            popcounts = array.array("i", (0,)*(metadata.num_bits+2))
+        start_padding, end_padding, arena, ordering, ids = _load_fps_blocks(
+            fps_reader, num_bits, num_bytes, storage_size, alignment, popcounts)
+        if ordering is not None:
+            ids = _reorder_ids(ids, ordering)
+        return FingerprintArena(metadata, alignment, start_padding, end_padding, storage_size,
+                                arena, popcounts.tostring(), ids)
+
+    # Store the ids in an IdTable, unless there are unusual ids
+    id_builder = IdTableBuilder()
     unsorted_fps = StringIO()
     for (id, fp) in fps_reader:
         if len(fp) != num_bytes:
@@ -558,7 +887,9 @@ def fps_to_arena(fps_reader, metadata=None, reorder=True, alignment=None):
         unsorted_fps.write(fp)
         if end_padding:
             unsorted_fps.write(end_padding)
-        ids.append(id)
+        id_builder.append(id)
+    ids = id_builder.get_ids()
+    id_builder = None
 
     unsorted_arena = unsorted_fps.getvalue()
     unsorted_fps.close()
@@ -580,7 +911,7 @@ def fps_to_arena(fps_reader, metadata=None, reorder=True, alignment=None):
         num_bits, storage_size, unsorted_arena, len(ids),
         ordering, popcounts, alignment)
 
-    new_ids = [ids[item.index] for item in ordering]
+    new_ids = _reorder_ids(ids, ordering)
     return FingerprintArena(metadata, alignment,
                             start_padding, end_padding, storage_size,
                             unsorted_arena, popcounts.tostring(), new_ids)
@@ -4,18 +4,19 @@ import os
 import sys
 import _chemfp
 from _chemfp import (hex_isvalid, hex_popcount, hex_intersect_popcount,
-                     hex_tanimoto, hex_contains)
+                     hex_tanimoto, hex_tversky, hex_contains)
 
 from _chemfp import (byte_popcount, byte_intersect_popcount,
-                     byte_tanimoto, byte_contains,
+                     byte_tanimoto, byte_tversky, byte_contains,
                      byte_intersect, byte_union, byte_difference)
 
 __all__ = ["byte_popcount", "byte_intersect_popcount",
-           "byte_tanimoto", "byte_contains",
+           "byte_tanimoto", "byte_tversky", "byte_contains",
            "hex_isvalid", "hex_popcount", "hex_intersect_popcount", 
-           "hex_tanimoto", "hex_contains",
+           "hex_tanimoto", "hex_tversky", "hex_contains",
            "get_methods", "get_alignments",
-           "get_alignment_methods", "set_alignment_method", "select_fastest_method"]
+           "get_alignment_methods", "set_alignment_method", "select_fastest_method",
+           "get_calibration_key", "save_calibration", "load_calibration"]
 
 
 def get_methods():
@@ -65,7 +66,7 @@ def get_options():
     return [_chemfp.get_option_name(i) for i in range(_chemfp.get_num_options())]
 
 def get_option(option):
-    _chemfp.get_option(option)
+    return _chemfp.get_option(option)
 
 def set_option(option, value):
     _chemfp.set_option(option, value)
@@ -87,6 +88,19 @@ def use_environment_variables(environ=None):
         environ = os.environ
 
     known = set()
+
+    # Load the calibration first, so CHEMFP-ALIGN* can override it
+    known.add("CHEMFP-CALIBRATION")
+    filename = environ.get("CHEMFP-CALIBRATION", None)
+    if filename:
+        try:
+            if not load_calibration(filename):
+                print >>sys.stderr, "WARNING: No calibration for this machine in $CHEMFP-CALIBRATION = %r" % (
+                    filename,)
+        except (IOError, ValueError), err:
+            print >>sys.stderr, "WARNING: Unable to use $CHEMFP-CALIBRATION = %r: %s" % (
+                filename, err)
+
     for alignment in get_alignments():
         name = "CHEMFP-" + alignment.upper()
         known.add(name)
@@ -133,3 +147,117 @@ def use_environment_variables(environ=None):
             continue
         if k not in known:
             print >>sys.stderr, "WARNING: Unknown chemfp environment variable %r" % (k,)
+
+
+#### Save and load the fastest methods
+
+# select_fastest_method() takes a few seconds, which is too slow to
+# do every time a program or worker process starts. Instead, save the
+# results to a calibration file, which is loaded when this module is
+# imported. The file is keyed by the chemfp version and the CPU, so
+# machines which share a home directory each get their own settings.
+
+def get_default_calibration_filename():
+    return os.path.join(os.path.expanduser("~"), ".chemfp", "calibration.json")
+
+def _get_cpu_model():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except IOError:
+        pass
+    import platform
+    return platform.processor()
+
+def get_calibration_key():
+    """The calibration key for this machine and version of chemfp
+
+    This includes the chemfp version, the CPU architecture and model,
+    and the available popcount methods, which depend on the CPU flags.
+    """
+    import platform
+    from . import SOFTWARE
+    return "%s %s %s [%s]" % (SOFTWARE, platform.machine(), _get_cpu_model(),
+                              " ".join(get_methods()))
+
+def _read_calibration(filename):
+    import json
+    try:
+        f = open(filename)
+    except IOError:
+        if not os.path.exists(filename):
+            return {}
+        raise
+    with f:
+        try:
+            calibration = json.load(f)
+        except ValueError, err:
+            raise ValueError("Cannot parse calibration file %r: %s" % (filename, err))
+    if not isinstance(calibration, dict):
+        raise ValueError("Calibration file %r must contain a JSON object" % (filename,))
+    return calibration
+
+def save_calibration(filename=None):
+    """Save the current alignment methods to a calibration file
+
+    Call this after select_fastest_method(). The settings are saved
+    under get_calibration_key(). Settings for other machines or chemfp
+    versions in the same file are kept. The default filename is
+    ~/.chemfp/calibration.json .
+
+    Only the method for each alignment is saved. The popcount
+    functions are chosen by alignment, not by fingerprint size, so
+    the only size split is between the "align8-small" and
+    "align8-large" (96 bytes or more) alignments.
+    """
+    import json
+    if filename is None:
+        filename = get_default_calibration_filename()
+    calibration = _read_calibration(filename)
+    calibration[get_calibration_key()] = get_alignment_methods()
+
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    # Write to a temporary file then rename it, so another process
+    # never sees a partially written file.
+    tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp_filename, "w") as f:
+        json.dump(calibration, f, indent=1, sort_keys=True, separators=(",", ": "))
+        f.write("\n")
+    os.rename(tmp_filename, filename)
+
+def load_calibration(filename=None):
+    """Use the alignment methods saved by save_calibration()
+
+    Returns True if the file has settings for this machine and chemfp
+    version, and False if it does not or if the file does not exist.
+    Raises a ValueError if the file cannot be parsed or if it has an
+    unknown alignment or method name.
+    """
+    if filename is None:
+        filename = get_default_calibration_filename()
+    settings = _read_calibration(filename).get(get_calibration_key(), None)
+    if settings is None:
+        return False
+    alignments = get_alignments()
+    methods = get_methods()
+    for alignment, method in settings.items():
+        if alignment not in alignments:
+            raise ValueError("Unknown alignment %r in calibration file %r" % (alignment, filename))
+        if method not in methods:
+            raise ValueError("Unknown method %r in calibration file %r" % (method, filename))
+    for alignment, method in settings.items():
+        set_alignment_method(str(alignment), str(method))
+    return True
+
+def _load_default_calibration():
+    # Don't let a bad calibration file prevent chemfp from working
+    try:
+        load_calibration()
+    except (IOError, OSError, ValueError), err:
+        print >>sys.stderr, "WARNING: Unable to use the chemfp calibration file: %s" % (err,)
+
+_load_default_calibration()
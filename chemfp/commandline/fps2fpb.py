@@ -0,0 +1,47 @@
+from __future__ import absolute_import
+import sys
+
+import chemfp
+from .. import argparse
+
+parser = argparse.ArgumentParser(
+    description="Convert an FPS file into the binary fpb format",
+    )
+parser.add_argument(
+    "-o", "--output", metavar="FILENAME", required=True,
+    help="save the fingerprints to FILENAME")
+parser.add_argument(
+    "--alignment", metavar="BYTES", type=int, default=None,
+    help="fingerprint alignment and storage padding (default: based on the fingerprint size)")
+parser.add_argument(
+    "--no-reorder", action="store_true",
+    help="do not reorder the fingerprints by popcount (searches will be slower)")
+parser.add_argument("filename", nargs="?", help="input FPS filename (default=stdin)", default=None)
+
+def main(args=None):
+    args = parser.parse_args(args)
+
+    if args.alignment is not None and args.alignment not in (1, 2, 4, 8, 16, 32, 64):
+        parser.error("--alignment must be a power of two between 1 and 64")
+
+    try:
+        reader = chemfp.open(args.filename)
+    except (IOError, ValueError, chemfp.ChemFPError), err:
+        sys.stderr.write("Cannot open fingerprint file: %s\n" % (err,))
+        raise SystemExit(1)
+
+    try:
+        arena = chemfp.load_fingerprints(reader, reorder=not args.no_reorder,
+                                         alignment=args.alignment)
+    except (IOError, ValueError, chemfp.ChemFPError), err:
+        sys.stderr.write("Cannot read fingerprints: %s\n" % (err,))
+        raise SystemExit(1)
+
+    try:
+        arena.save(args.output, "fpb")
+    except (IOError, ValueError), err:
+        sys.stderr.write("Cannot save fpb file: %s\n" % (err,))
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+"""Read and write fingerprints in the binary "fpb" format
+
+NOTE: This module should not be used directly. Use `chemfp.open`,
+`chemfp.load_fingerprints` or `FingerprintArena.save` instead.
+
+The FPS format is easy to read and write, but every load has to
+hex-decode each fingerprint, sort everything by popcount, and build
+the arena. For large data sets that takes a long time and needs twice
+the memory. The fpb format stores the arena in the same layout as it
+is in memory, so loading is an mmap and some header parsing, and the
+search code works directly on the mapped pages.
+
+The file starts with the 8 byte signature "FPB1\\r\\n\\0\\0". This is
+followed by a sequence of chunks. Each chunk starts with an 8 byte
+little-endian length and a 4 byte chunk name, followed by the chunk
+contents. The chunks are, in order:
+
+  META - the fingerprint metadata, as FPS header lines
+  POPC - the popcount_indices table, as (num_bits+2) little-endian
+         32-bit integers. Only present if the arena is popcount sorted.
+  AREN - the 32-bit storage size and alignment, a 1 byte spacer length,
+         that many NUL bytes, then the fingerprint data. The spacer
+         places the fingerprint data at a file offset which is a
+         multiple of the alignment.
+  FPID - the 64-bit number of ids and the 64-bit size of the id block,
+         the id block (each id followed by a newline), NUL padding to
+         a 4 byte boundary, then (num_ids+1) 32-bit offsets where
+         offsets[i] is the start of id i in the id block.
+  IDIX - (optional) the 32-bit hash function version, the 32-bit
+         number of table slots, then the slots of the id hash table
+         as 32-bit integers. See chemfp.id_table for details.
+  FEND - end of the chunks. Anything after this is ignored.
+
+Unknown chunks are skipped.
+"""
+
+from __future__ import absolute_import
+
+import sys
+import os
+import mmap
+import array
+import struct
+import copy
+from cStringIO import StringIO
+from __builtin__ import open as _builtin_open
+
+from . import ParseError
+from . import io
+from .id_table import make_id_block, IdIndex, IdTable
+
+__all__ = []
+
+FPB_MAGIC = "FPB1\r\n\0\0"
+
+_chunk_header = struct.Struct("<Q4s")
+_arena_header = struct.Struct("<IIB")
+_id_header = struct.Struct("<QQ")
+_id_index_header = struct.Struct("<II")
+
+# The version number of the hash function in the IDIX chunk
+ID_INDEX_VERSION = 1
+
+def _native_to_le32(native_str):
+    values = array.array("i", native_str)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tostring()
+
+def _le32_to_native(le_str):
+    values = array.array("i", le_str)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+class _CountingWriter(object):
+    # Keep track of the file position so the arena data can be aligned
+    # without needing a seekable output file.
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.pos = 0
+    def write(self, s):
+        self.outfile.write(s)
+        self.pos += len(s)
+    def write_chunk_header(self, name, size):
+        self.write(_chunk_header.pack(size, name))
+
+def _get_id_table(ids):
+    if isinstance(ids, IdTable):
+        id_block, offsets = ids.get_id_block()
+        id_block = str(buffer(id_block))
+        if id_block[:1] == "\n" or "\n\n" in id_block:
+            raise ValueError("Fingerprint ids must not be the empty string")
+        offsets = array.array("I", str(buffer(offsets)))
+    else:
+        byte_ids = []
+        for i, id in enumerate(ids):
+            if not id:
+                raise ValueError("Fingerprint ids must not be the empty string in record %d" %
+                                 (i+1,))
+            if isinstance(id, unicode):
+                try:
+                    id = id.encode("ascii")
+                except UnicodeError:
+                    raise ValueError("Fingerprint ids must be ASCII or byte strings")
+            byte_ids.append(id)
+        id_block, offsets = make_id_block(byte_ids)
+    index = IdIndex.from_id_block(len(offsets)-1, id_block, offsets)
+    if sys.byteorder == "big":
+        offsets.byteswap()
+        index.table.byteswap()
+    return id_block, offsets.tostring(), index.table.tostring()
+
+def write_fpb(arena, destination):
+    """Save a FingerprintArena to an fpb file or file object"""
+    if arena.start != 0 or (arena.start_padding + arena.end*arena.storage_size +
+                            arena.end_padding != len(arena.arena)):
+        # This is a subarena. Make a new arena with only the selected
+        # fingerprints, and new popcount_indices if needed.
+        arena = arena.copy()
+
+    id_table = _get_id_table(arena.ids)
+
+    if isinstance(destination, basestring):
+        need_close = True
+        outfile = _builtin_open(destination, "wb")
+    else:
+        need_close = False
+        outfile = destination
+
+    try:
+        output = _CountingWriter(outfile)
+        output.write(FPB_MAGIC)
+
+        metadata = arena.metadata
+        if not metadata.num_bits:
+            # The header parser rejects "num_bits=0". Leave it out and
+            # let the reader use its default of 0.
+            metadata = copy.copy(metadata)
+            metadata.num_bits = None
+        meta = StringIO()
+        io.write_fps1_header(meta, metadata)
+        meta = meta.getvalue()
+        output.write_chunk_header("META", len(meta))
+        output.write(meta)
+
+        if arena.popcount_indices:
+            popc = _native_to_le32(arena.popcount_indices)
+            output.write_chunk_header("POPC", len(popc))
+            output.write(popc)
+
+        alignment = arena.alignment
+        arena_size = len(arena) * arena.storage_size
+        data_pos = output.pos + _chunk_header.size + _arena_header.size
+        spacer = (alignment - data_pos % alignment) % alignment
+        output.write_chunk_header("AREN", _arena_header.size + spacer + arena_size)
+        output.write(_arena_header.pack(arena.storage_size, alignment, spacer))
+        output.write("\0" * spacer)
+        output.write(buffer(arena.arena, arena.start_padding, arena_size))
+
+        _write_id_chunks(output, len(arena), id_table)
+
+        output.write_chunk_header("FEND", 0)
+    finally:
+        if need_close:
+            outfile.close()
+
+def _write_id_chunks(output, num_ids, id_table):
+    # Write the FPID and IDIX chunks. These are also used in the .fpsidx format.
+    id_block, offsets, id_index_table = id_table
+    padding = "\0" * (-len(id_block) % 4)
+    output.write_chunk_header("FPID", _id_header.size + len(id_block) +
+                              len(padding) + len(offsets))
+    output.write(_id_header.pack(num_ids, len(id_block)))
+    output.write(id_block)
+    output.write(padding)
+    output.write(offsets)
+
+    output.write_chunk_header("IDIX", _id_index_header.size + len(id_index_table))
+    output.write(_id_index_header.pack(ID_INDEX_VERSION, len(id_index_table) // 4))
+    output.write(id_index_table)
+
+
+def _read_chunks(data, filename, magic=FPB_MAGIC, format_name="fpb"):
+    if data[:8] != magic:
+        raise ParseError("File does not start with the %s signature: %r" % (format_name, filename))
+    chunks = {}
+    pos = 8
+    data_size = len(data)
+    while 1:
+        if pos + _chunk_header.size > data_size:
+            raise ParseError("Missing FEND chunk in %s file %r" % (format_name, filename))
+        size, name = _chunk_header.unpack_from(data, pos)
+        pos += _chunk_header.size
+        if pos + size > data_size:
+            raise ParseError("The %r chunk in %s file %r extends past the end of the file" %
+                             (name, format_name, filename))
+        if name == "FEND":
+            return chunks
+        if name in chunks:
+            raise ParseError("Duplicate %r chunk in %s file %r" % (name, format_name, filename))
+        chunks[name] = (pos, pos+size)
+        pos += size
+
+
+def _get_chunk(chunks, name, filename, format_name="fpb"):
+    try:
+        return chunks[name]
+    except KeyError:
+        raise ParseError("Missing %r chunk in %s file %r" % (name, format_name, filename))
+
+def _parse_fpb(data, filename):
+    from .fps_io import read_header
+    from .arena import FingerprintArena
+
+    chunks = _read_chunks(data, filename)
+
+    start, end = _get_chunk(chunks, "META", filename)
+    metadata, lineno, block = read_header(StringIO(data[start:end]), filename)
+    if block is not None:
+        raise ParseError("Unexpected fingerprint data in the META chunk of fpb file %r" %
+                         (filename,))
+    num_bits = metadata.num_bits
+
+    if "POPC" in chunks:
+        start, end = chunks["POPC"]
+        if end - start != (num_bits+2)*4:
+            raise ParseError("POPC chunk in fpb file %r has the wrong size for %d bits" %
+                             (filename, num_bits))
+        popcount_indices = _le32_to_native(data[start:end]).tostring()
+    else:
+        popcount_indices = ""
+
+    start, end = _get_chunk(chunks, "AREN", filename)
+    storage_size, alignment, spacer = _arena_header.unpack_from(data, start)
+    arena_start = start + _arena_header.size + spacer
+    if arena_start > end:
+        raise ParseError("AREN chunk in fpb file %r is too small" % (filename,))
+    if storage_size == 0:
+        if end != arena_start:
+            raise ParseError("AREN chunk in fpb file %r has an invalid storage size" % (filename,))
+        num_fingerprints = 0
+    else:
+        if storage_size < metadata.num_bytes or (end - arena_start) % storage_size != 0:
+            raise ParseError("AREN chunk in fpb file %r has an invalid storage size" % (filename,))
+        num_fingerprints = (end - arena_start) // storage_size
+
+    ids, id_lookup = _parse_id_chunks(data, chunks, filename)
+    if len(ids) != num_fingerprints:
+        raise ParseError("fpb file %r has %d fingerprints but %d ids" %
+                         (filename, num_fingerprints, len(ids)))
+
+    return FingerprintArena(metadata, alignment,
+                            arena_start, len(data) - arena_start - num_fingerprints*storage_size,
+                            storage_size, data, popcount_indices, ids,
+                            id_lookup=id_lookup)
+
+def _parse_id_chunks(data, chunks, filename, format_name="fpb"):
+    # Return the IdTable from the FPID chunk, and the id lookup
+    # function from the IDIX chunk, or None if there is no IDIX chunk.
+    start, end = _get_chunk(chunks, "FPID", filename, format_name)
+    num_ids, id_block_size = _id_header.unpack_from(data, start)
+    id_start = start + _id_header.size
+    offsets_size = (num_ids+1)*4
+    offsets_start = end - offsets_size
+    if id_start + id_block_size > offsets_start:
+        raise ParseError("FPID chunk in %s file %r is too small" % (format_name, filename))
+
+    # The ids are used directly from the file contents
+    id_block = buffer(data, id_start, id_block_size)
+    if sys.byteorder == "big":
+        offsets = _le32_to_native(data[offsets_start:end]).tostring()
+    else:
+        offsets = buffer(data, offsets_start, offsets_size)
+    ids = IdTable(id_block, offsets)
+    if ids._get_offset(0) != 0 or ids._get_offset(num_ids) != id_block_size:
+        raise ParseError("FPID chunk in %s file %r has invalid offsets" % (format_name, filename))
+
+    if "IDIX" not in chunks:
+        return ids, None
+
+    start, end = chunks["IDIX"]
+    version, table_size = _id_index_header.unpack_from(data, start)
+    if version != ID_INDEX_VERSION:
+        # Unknown hash function. Let the caller build its own index.
+        return ids, None
+    table_start = start + _id_index_header.size
+    if (table_size <= num_ids or table_size & (table_size-1) or
+        table_start + table_size*4 != end):
+        raise ParseError("IDIX chunk in %s file %r has an invalid table size" %
+                         (format_name, filename))
+
+    if sys.byteorder == "big":
+        table = _le32_to_native(data[table_start:end])
+    else:
+        # Use the file contents directly
+        table = buffer(data, table_start, table_size*4)
+    return ids, IdIndex(num_ids, ids.id_block, ids.offsets, table).get
+
+
+def open_fpb(source, format=None):
+    """Open an fpb file and return it as a FingerprintArena
+
+    If possible the file is memory-mapped, and the arena's fingerprint
+    data refers directly to the mapped pages. Compressed fpb files and
+    file-like objects without a file descriptor are read into memory.
+    """
+    format_name, compression = io.normalize_format(source, format, default=("fpb", ""))
+    if format_name != "fpb":
+        raise ValueError("Unknown format %r" % (format_name,))
+    filename = io.get_filename(source)
+
+    if compression:
+        infile = io.open_compressed_input_universal(source, compression)
+        try:
+            data = infile.read()
+        finally:
+            if infile is not source:
+                infile.close()
+        return _parse_fpb(data, filename)
+
+    if source is None:
+        raise ValueError("Cannot read an fpb file from stdin")
+    if isinstance(source, basestring):
+        infile = _builtin_open(source, "rb")
+    else:
+        infile = source
+    try:
+        try:
+            fileno = infile.fileno()
+        except (AttributeError, IOError):
+            data = infile.read()
+        else:
+            size = os.fstat(fileno).st_size
+            if size == 0:
+                raise ParseError("fpb file %r is empty" % (filename,))
+            data = mmap.mmap(fileno, size, access=mmap.ACCESS_READ)
+    finally:
+        if infile is not source:
+            infile.close()
+    return _parse_fpb(data, filename)
@@ -0,0 +1,416 @@
+"""Random access to FPS files using an ".fpsidx" sidecar index
+
+NOTE: This module should not be used directly. Use `build_fps_index`
+to make the index, then `chemfp.open` will use it automatically.
+
+An FPS file can only be read from start to end. The index for
+"filename.fps" is stored in "filename.fps.fpsidx". It contains the
+byte offset of each record and the record ids, along with an id hash
+table, so an `FPSReader` can look up a record by id, seek to a given
+record number, and iterate over a range of records, without reading
+the whole file.
+
+For gzip-compressed FPS files the offsets are positions in the
+uncompressed data. A gzip stream cannot be decompressed starting from
+an arbitrary position, but each member of a multi-member gzip file
+(like those made by "bgzip", or by concatenating gzip files) can. The
+index stores the start of a member about every `restart_interval`
+uncompressed bytes, and a seek starts from the closest one. Python's
+zlib module can't save and restore the decompression window, so there
+are no restart points inside of a member. Instead, `build_fps_index`
+rejects a gzip file with a member larger than `restart_interval`,
+since a seek might have to decompress all of it. Recompress a large
+single-member file with "bgzip", or index the uncompressed file.
+
+The index uses the same chunk layout as the fpb format, with the
+signature "FPSIDX1\\0". The chunks are:
+
+  FPSI - the 64-bit size and the 64-bit float modification time of the
+         FPS file, the 64-bit number of records, the 64-bit line number
+         of the first record, and the compression suffix ("" or ".gz")
+         as 8 NUL-padded bytes.
+  ROFF - (num_records+1) 64-bit offsets. offsets[i] is the start of
+         record i and offsets[num_records] is the end of the data.
+  GZRP - (optional) pairs of 64-bit (compressed, uncompressed) offsets
+         for the gzip restart points.
+  FPID - the ids, as in the fpb format
+  IDIX - the id hash table, as in the fpb format
+  FEND - end of the chunks
+
+If the size or modification time of the FPS file doesn't match then
+the index is out of date, and `chemfp.open` ignores it.
+"""
+
+from __future__ import absolute_import
+
+import os
+import sys
+import mmap
+import array
+import struct
+import zlib
+import gzip
+import bisect
+from __builtin__ import open as _builtin_open
+
+import _chemfp
+from . import ParseError
+from . import io
+from . import fpb_io
+from .id_table import IdTableBuilder, IdIndex
+
+__all__ = ["build_fps_index", "open_fps_index", "get_fps_index_filename"]
+
+FPSIDX_MAGIC = "FPSIDX1\0"
+
+_info_header = struct.Struct("<QdQQ8s")
+_uint64 = struct.Struct("<Q")
+_restart_point = struct.Struct("<QQ")
+
+# Read this many bytes at a time when building the index
+_READ_SIZE = 1024*1024
+
+# Store file offsets in an array of 64-bit integers if possible. A
+# double is exact for any file offset up to 2**53.
+if array.array("L").itemsize == 8:
+    _OFFSET_TYPECODE = "L"
+else:
+    _OFFSET_TYPECODE = "d"
+
+
+def get_fps_index_filename(fps_filename):
+    """Return the name of the sidecar index for `fps_filename`"""
+    return fps_filename + ".fpsidx"
+
+
+def _get_compression(fps_filename):
+    format_name, compression = io.normalize_format(fps_filename, None)
+    if format_name != "fps":
+        raise ValueError("Can only index FPS files, not %r" % (fps_filename,))
+    if compression not in ("", ".gz"):
+        raise ValueError("Can only index uncompressed or gzip-compressed FPS files, not %r" %
+                         (fps_filename,))
+    return compression
+
+
+#### Build the index
+
+def _iter_plain_data(infile, restart_points, restart_interval):
+    while 1:
+        data = infile.read(_READ_SIZE)
+        if not data:
+            break
+        yield data
+
+def _check_member_size(filename, compressed_pos, member_size, restart_interval):
+    if member_size > restart_interval:
+        raise ValueError(
+            "Cannot index %r: the gzip member at byte %d decompresses to more than "
+            "the restart interval of %d bytes. Use 'bgzip' to recompress it, or "
+            "index the uncompressed file" % (filename, compressed_pos, restart_interval))
+
+def _iter_gzip_data(infile, restart_points, restart_interval):
+    # Decompress each gzip member in turn, and record where each member
+    # starts. Python's zlib doesn't have an end-of-stream flag, but once
+    # a stream is finished, any more input goes to 'unused_data'.
+    filename = getattr(infile, "name", "<unknown>")
+    compressed_pos = 0
+    uncompressed_pos = 0
+    member_start = (0, 0)
+    last_restart = None
+    decompressor = None
+    data = ""
+    while 1:
+        if not data:
+            data = infile.read(_READ_SIZE)
+            if not data:
+                break
+        if decompressor is None:
+            if not data.strip("\0"):
+                # Ignore NUL padding after the last member
+                compressed_pos += len(data)
+                data = ""
+                continue
+            if last_restart is None or uncompressed_pos - last_restart >= restart_interval:
+                restart_points.append((compressed_pos, uncompressed_pos))
+                last_restart = uncompressed_pos
+            member_start = (compressed_pos, uncompressed_pos)
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            text = decompressor.decompress(data)
+        except zlib.error, err:
+            raise ParseError("Cannot decompress gzip data: %s" % (err,))
+        unused = decompressor.unused_data
+        compressed_pos += len(data) - len(unused)
+        data = unused
+        if unused:
+            # The member ended. Anything else is the start of a new member.
+            text += decompressor.flush()
+            decompressor = None
+        uncompressed_pos += len(text)
+        _check_member_size(filename, member_start[0], uncompressed_pos - member_start[1],
+                           restart_interval)
+        if text:
+            yield text
+    if decompressor is not None:
+        text = decompressor.flush()
+        uncompressed_pos += len(text)
+        _check_member_size(filename, member_start[0], uncompressed_pos - member_start[1],
+                           restart_interval)
+        if text:
+            yield text
+
+def _iter_lines(blocks):
+    # Yield (offset, line) for each line in the stream of blocks
+    pos = 0
+    partial = ""
+    for block in blocks:
+        if partial:
+            block = partial + block
+        lines = block.splitlines(True)
+        if lines[-1][-1:] != "\n":
+            partial = lines.pop()
+        else:
+            partial = ""
+        for line in lines:
+            yield pos, line
+            pos += len(line)
+    if partial:
+        yield pos, partial
+
+
+def build_fps_index(source, destination=None, restart_interval=16*1024*1024):
+    """Make an .fpsidx index for the FPS file `source`
+
+    The default `destination` is `get_fps_index_filename(source)`,
+    which is where `chemfp.open` looks for it. `restart_interval` is
+    the minimum number of uncompressed bytes between gzip restart
+    points. Each gzip member must decompress to at most
+    `restart_interval` bytes, or this raises a ValueError, because
+    restart points can only be at the start of a member.
+
+    :param source: the name of an uncompressed or gzip-compressed FPS file
+    :type source: string
+    :param destination: the name of the index file
+    :type destination: string, or None to use the default name
+    :param restart_interval: the minimum number of bytes between gzip restart points
+    :type restart_interval: positive integer
+    :returns: the name of the index file
+    """
+    from .fps_io import read_header, FPSParseError
+
+    compression = _get_compression(source)
+    if destination is None:
+        destination = get_fps_index_filename(source)
+
+    # Use the regular header parser to get the fingerprint size
+    infile = io.open_compressed_input_universal(source, compression)
+    try:
+        metadata, first_lineno, block = read_header(infile, source)
+    finally:
+        infile.close()
+    expected_hex_len = 2*metadata.num_bytes
+
+    st = os.stat(source)
+    offsets = array.array(_OFFSET_TYPECODE)
+    id_builder = IdTableBuilder()
+    restart_points = []
+
+    infile = _builtin_open(source, "rb")
+    try:
+        if compression == ".gz":
+            blocks = _iter_gzip_data(infile, restart_points, restart_interval)
+        else:
+            blocks = _iter_plain_data(infile, restart_points, restart_interval)
+
+        # Use the same line numbers as the reader for error messages
+        lineno = first_lineno
+        in_header = True
+        end = 0
+        fps_line_validate = _chemfp.fps_line_validate
+        for pos, line in _iter_lines(blocks):
+            end = pos + len(line)
+            if in_header:
+                if line[:1] == "#":
+                    continue
+                in_header = False
+            if line[-2:] == "\r\n":
+                line = line[:-2] + "\n"
+            err = fps_line_validate(expected_hex_len, line)
+            if err:
+                raise FPSParseError(err, lineno, source)
+            offsets.append(pos)
+            id_builder.append(line.rstrip("\n").split("\t", 2)[1])
+            lineno += 1
+        offsets.append(end)
+    finally:
+        infile.close()
+
+    ids = id_builder.get_ids()
+    id_table = fpb_io._get_id_table(ids)
+    if _OFFSET_TYPECODE == "L" and sys.byteorder == "little":
+        offsets = offsets.tostring()
+    else:
+        offsets = "".join(_uint64.pack(int(offset)) for offset in offsets)
+
+    outfile = _builtin_open(destination, "wb")
+    try:
+        output = fpb_io._CountingWriter(outfile)
+        output.write(FPSIDX_MAGIC)
+        output.write_chunk_header("FPSI", _info_header.size)
+        output.write(_info_header.pack(st.st_size, st.st_mtime, len(ids),
+                                       first_lineno, compression))
+        output.write_chunk_header("ROFF", len(offsets))
+        output.write(offsets)
+        if compression:
+            output.write_chunk_header("GZRP", _restart_point.size * len(restart_points))
+            for restart_point in restart_points:
+                output.write(_restart_point.pack(*restart_point))
+        fpb_io._write_id_chunks(output, len(ids), id_table)
+        output.write_chunk_header("FEND", 0)
+    finally:
+        outfile.close()
+    return destination
+
+
+#### Use the index
+
+class FPSIndex(object):
+    """The contents of an .fpsidx file
+
+    The public attributes are:
+       fps_filename
+           the name of the indexed FPS file
+       num_records
+           the number of fingerprint records
+       first_lineno
+           the line number of the first fingerprint record
+       ids
+           an IdTable with the record ids
+    """
+    def __init__(self, fps_filename, compression, data, num_records, first_lineno,
+                 offsets_start, restart_points, ids, id_lookup):
+        self.fps_filename = fps_filename
+        self.compression = compression
+        self._data = data
+        self.num_records = num_records
+        self.first_lineno = first_lineno
+        self._offsets_start = offsets_start
+        self._restart_points = restart_points
+        self._restart_offsets = [uncompressed for (compressed, uncompressed) in restart_points]
+        self.ids = ids
+        if id_lookup is None:
+            id_lookup = IdIndex.from_ids(ids).get
+        self._id_lookup = id_lookup
+
+    def get_offset(self, record_no):
+        """Return the offset of record `record_no` in the (uncompressed) FPS data"""
+        if not (0 <= record_no <= self.num_records):
+            raise IndexError("FPS record number out of range")
+        return _uint64.unpack_from(self._data, self._offsets_start + 8*record_no)[0]
+
+    def get_index_by_id(self, id):
+        """Return the record number for `id`, or None if it is not present"""
+        return self._id_lookup(id)
+
+    def open_at(self, record_no):
+        """Return a file object for the FPS data starting at record `record_no`"""
+        offset = self.get_offset(record_no)
+        if not self.compression:
+            infile = _builtin_open(self.fps_filename, "rU")
+            infile.seek(offset)
+            return infile
+
+        # Start from the closest gzip member which starts before the record
+        restart_points = self._restart_points
+        i = bisect.bisect_right(self._restart_offsets, offset)
+        i = max(i-1, 0)
+        compressed_offset, uncompressed_offset = restart_points[i]
+        rawfile = _builtin_open(self.fps_filename, "rb")
+        rawfile.seek(compressed_offset)
+        infile = gzip.GzipFile(fileobj=rawfile)
+        # Have the GzipFile close the raw file when it's closed
+        infile.myfileobj = rawfile
+        skip = offset - uncompressed_offset
+        while skip > 0:
+            n = len(infile.read(min(skip, _READ_SIZE)))
+            if n == 0:
+                break
+            skip -= n
+        return infile
+
+    def read_record(self, record_no):
+        """Return the FPS line for record `record_no`"""
+        if not (0 <= record_no < self.num_records):
+            raise IndexError("FPS record number out of range")
+        infile = self.open_at(record_no)
+        try:
+            return infile.readline()
+        finally:
+            infile.close()
+
+
+def open_fps_index(filename, fps_filename=None):
+    """Open the .fpsidx file `filename` and return an FPSIndex
+
+    If `fps_filename` is None, the FPS filename is `filename` without
+    the ".fpsidx" extension. Raises a ValueError if the index is out
+    of date.
+    """
+    if fps_filename is None:
+        if not filename.endswith(".fpsidx"):
+            raise ValueError("Cannot determine the FPS filename for %r" % (filename,))
+        fps_filename = filename[:-7]
+    compression = _get_compression(fps_filename)
+    st = os.stat(fps_filename)
+
+    infile = _builtin_open(filename, "rb")
+    try:
+        size = os.fstat(infile.fileno()).st_size
+        if size == 0:
+            raise ParseError("fpsidx file %r is empty" % (filename,))
+        data = mmap.mmap(infile.fileno(), size, access=mmap.ACCESS_READ)
+    finally:
+        infile.close()
+
+    chunks = fpb_io._read_chunks(data, filename, FPSIDX_MAGIC, "fpsidx")
+    start, end = fpb_io._get_chunk(chunks, "FPSI", filename, "fpsidx")
+    if end - start < _info_header.size:
+        raise ParseError("FPSI chunk in fpsidx file %r is too small" % (filename,))
+    (file_size, mtime, num_records, first_lineno,
+     saved_compression) = _info_header.unpack_from(data, start)
+    if (file_size != st.st_size or mtime != st.st_mtime or
+        saved_compression.rstrip("\0") != compression):
+        raise ValueError("fpsidx file %r is out of date for %r" % (filename, fps_filename))
+
+    offsets_start, end = fpb_io._get_chunk(chunks, "ROFF", filename, "fpsidx")
+    if end - offsets_start != 8*(num_records+1):
+        raise ParseError("ROFF chunk in fpsidx file %r has the wrong size" % (filename,))
+
+    restart_points = [(0, 0)]
+    if "GZRP" in chunks:
+        start, end = chunks["GZRP"]
+        restart_points = [_restart_point.unpack_from(data, pos)
+                              for pos in xrange(start, end - _restart_point.size + 1,
+                                                _restart_point.size)]
+        if not restart_points:
+            restart_points = [(0, 0)]
+
+    ids, id_lookup = fpb_io._parse_id_chunks(data, chunks, filename, "fpsidx")
+    if len(ids) != num_records:
+        raise ParseError("fpsidx file %r has %d records but %d ids" %
+                         (filename, num_records, len(ids)))
+
+    return FPSIndex(fps_filename, compression, data, num_records, first_lineno,
+                    offsets_start, restart_points, ids, id_lookup)
+
+
+def find_fps_index(fps_filename):
+    """Return the FPSIndex for `fps_filename`, or None if there is no up-to-date index"""
+    filename = get_fps_index_filename(fps_filename)
+    if not os.path.exists(filename):
+        return None
+    try:
+        return open_fps_index(filename, fps_filename)
+    except ValueError:
+        return None
@@ -5,7 +5,11 @@ from __builtin__ import open as _builtin_open
 import binascii
 import _chemfp
 import re
+import os
+import stat
 import sys
+import threading
+import Queue
 import heapq
 import itertools
 import ctypes
@@ -20,6 +24,15 @@ from . import io
 BLOCKSIZE=11400
 # (BTW, the compressed time took 1.3x the uncompressed time)
 
+# The blocks for iter_blocks() are read in a background thread, so
+# reading and decompression overlap with the search. The thread stays
+# up to PREFETCH_BLOCKS blocks ahead. Larger blocks reduce the
+# per-block overhead of the queue. These are the defaults for the
+# FPSReader 'block_size' and 'prefetch_blocks' attributes. Use
+# prefetch_blocks = 0 to read in the same thread as the search.
+PREFETCH_BLOCKSIZE = 256*1024
+PREFETCH_BLOCKS = 4
+
 class FPSParseError(ParseError):
     def __init__(self, errcode, lineno, filename):
         self.errcode = errcode
@@ -44,13 +57,19 @@ def open_fps(source, format=None):
     filename = io.get_filename(source)
 
     metadata, lineno, block = read_header(infile, filename)
-    return FPSReader(infile, metadata, lineno, block)
+
+    # Use the ".fpsidx" sidecar index, if there is an up-to-date one
+    index = None
+    if isinstance(source, basestring) and compression in ("", ".gz"):
+        from . import fps_index
+        index = fps_index.find_fps_index(source)
+    return FPSReader(infile, metadata, lineno, block, index)
 
 
 # This never buffers
-def _read_blocks(infile):
+def _read_blocks(infile, blocksize=BLOCKSIZE):
     while 1:
-        block = infile.read(BLOCKSIZE)
+        block = infile.read(blocksize)
         if not block:
             break
         if block[-1:] == "\n":
@@ -63,11 +82,76 @@ def _read_blocks(infile):
             break
         yield block + line
 
-            
+
+_END_OF_BLOCKS = object()
+
+def _prefetch_blocks(block_stream, queue_size, thread_name="chemfp-fps-prefetch"):
+    # Read from block_stream in a background thread and yield the
+    # blocks. Exceptions are raised in the consumer's thread.
+    # chemfp.search also uses this to search ahead of the caller.
+    queue = Queue.Queue(queue_size)
+    stop = threading.Event()
+
+    def read_ahead():
+        try:
+            for block in block_stream:
+                queue.put((block, None))
+                if stop.isSet():
+                    return
+            queue.put((_END_OF_BLOCKS, None))
+        except Exception:
+            queue.put((_END_OF_BLOCKS, sys.exc_info()))
+
+    thread = threading.Thread(target=read_ahead, name=thread_name)
+    thread.daemon = True
+    thread.start()
+    try:
+        while 1:
+            block, exc_info = queue.get()
+            if block is _END_OF_BLOCKS:
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                break
+            yield block
+    finally:
+        # If the consumer stopped early, make room in the queue so the
+        # thread can finish its current put() and see the stop flag.
+        # Wait for it, so the caller can close the underlying file.
+        stop.set()
+        while 1:
+            try:
+                queue.get_nowait()
+            except Queue.Empty:
+                break
+        thread.join()
+
+def _read_range_blocks(filename, start, end, blocksize=BLOCKSIZE):
+    # Read the newline-aligned byte range [start, end) of an FPS file.
+    # The range is read in binary mode, so translate the newlines the
+    # same way as universal newline mode.
+    infile = _builtin_open(filename, "rb")
+    try:
+        infile.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = infile.read(min(blocksize, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            if block[-1:] != "\n" and remaining > 0:
+                line = infile.readline(remaining)
+                remaining -= len(line)
+                block += line
+            if "\r" in block:
+                block = block.replace("\r\n", "\n").replace("\r", "\n")
+            yield block
+    finally:
+        infile.close()
+
 
 class FPSReader(FingerprintReader):
     _search = fps_search
-    def __init__(self, infile, metadata, first_fp_lineno, first_fp_block):
+    def __init__(self, infile, metadata, first_fp_lineno, first_fp_block, index=None):
         self._infile = infile
         self._filename = getattr(infile, "name", "<unknown>")
         self.metadata = metadata
@@ -79,6 +163,10 @@ class FPSReader(FingerprintReader):
         self._at_start = True
         self._it = None
         self._block_reader = None
+        self._index = index
+
+        self.block_size = PREFETCH_BLOCKSIZE
+        self.prefetch_blocks = PREFETCH_BLOCKS
 
 # Not sure if this is complete. Also, should have a context manager
 #    def close(self):
@@ -98,7 +186,9 @@ class FPSReader(FingerprintReader):
         if self._first_fp_block is None:
             return
         
-        block_stream = _read_blocks(self._infile)
+        block_stream = _read_blocks(self._infile, self.block_size)
+        if self.prefetch_blocks > 0:
+            block_stream = _prefetch_blocks(block_stream, self.prefetch_blocks)
         yield self._first_fp_block
         for block in block_stream:
             yield block
@@ -128,6 +218,142 @@ class FPSReader(FingerprintReader):
                 yield id_fp
                 lineno += 1
 
+    def _split_byte_ranges(self, max_ranges, min_range_size):
+        # Return a list of block iterators, one for the first block and
+        # one for each newline-aligned byte range in the rest of the
+        # file, so the ranges can be searched in parallel. This uses up
+        # the reader. Return None if the reader isn't at the start of a
+        # large enough uncompressed file.
+        if not self._at_start or self._first_fp_block is None:
+            return None
+        infile = self._infile
+        if not isinstance(infile, file):
+            return None
+        filename = infile.name
+        try:
+            start = infile.tell()
+            st = os.fstat(infile.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                return None
+            # Make sure the filename still refers to the same file
+            named_st = os.stat(filename)
+            if (named_st.st_dev, named_st.st_ino) != (st.st_dev, st.st_ino):
+                return None
+        except (IOError, OSError, TypeError, ValueError):
+            return None
+
+        end = st.st_size
+        num_ranges = min(max_ranges, (end - start) // min_range_size)
+        if num_ranges < 2:
+            return None
+
+        rawfile = _builtin_open(filename, "rb")
+        try:
+            if start > 0:
+                # Universal newline mode might have stopped between a '\r' and a '\n'
+                rawfile.seek(start-1)
+                if rawfile.read(2) == "\r\n":
+                    start += 1
+            boundaries = [start]
+            for i in xrange(1, num_ranges):
+                pos = start + (end - start) * i // num_ranges
+                if pos <= boundaries[-1]:
+                    continue
+                # Move to the start of the next line
+                rawfile.seek(pos-1)
+                rawfile.readline()
+                pos = rawfile.tell()
+                if pos >= end:
+                    break
+                boundaries.append(pos)
+            boundaries.append(end)
+        finally:
+            rawfile.close()
+
+        block_sources = [[self._first_fp_block]]
+        for range_start, range_end in zip(boundaries[:-1], boundaries[1:]):
+            block_sources.append(_read_range_blocks(filename, range_start, range_end,
+                                                    self.block_size))
+
+        self._at_start = False
+        self._block_reader = iter(())
+        return block_sources
+
+    #### Random access, if there is an ".fpsidx" index
+
+    def _get_index(self):
+        if self._index is None:
+            raise TypeError("FPS file %r does not have an up-to-date .fpsidx index" %
+                            (self._filename,))
+        return self._index
+
+    def get_index_by_id(self, id):
+        """Return the record number for the fingerprint with the given `id`, or None"""
+        return self._get_index().get_index_by_id(id)
+
+    def get_by_id(self, id):
+        """Return the (id, fingerprint) pair for the given `id`, or None if not present
+
+        This uses its own file handle, so it does not change the
+        current position of the reader.
+        """
+        index = self._get_index()
+        record_no = index.get_index_by_id(id)
+        if record_no is None:
+            return None
+        line = index.read_record(record_no)
+        err, id_fp = _chemfp.fps_parse_id_fp(self._expected_hex_len, line)
+        if err:
+            raise FPSParseError(err, index.first_lineno + record_no, self._filename)
+        return id_fp
+
+    def get_fingerprint_by_id(self, id):
+        """Return the fingerprint for the given `id`, or None if not present"""
+        id_fp = self.get_by_id(id)
+        if id_fp is None:
+            return None
+        return id_fp[1]
+
+    def seek(self, record_no):
+        """Move the reader to record `record_no`
+
+        The next fingerprint from iteration, or the first fingerprint
+        used by a search, is record `record_no`. Record numbers start
+        at 0. Requires an ".fpsidx" index.
+        """
+        index = self._get_index()
+        if not (0 <= record_no <= index.num_records):
+            raise IndexError("FPS record number out of range")
+        infile = index.open_at(record_no)
+        first_fp_block = next(_read_blocks(infile), None)
+        # Stop any prefetch thread before closing the file it reads
+        if self._block_reader is not None:
+            self._block_reader.close()
+        self._infile.close()
+        self._infile = infile
+        self._first_fp_block = first_fp_block
+        self._first_fp_lineno = index.first_lineno + record_no
+        self._at_start = True
+        self._block_reader = None
+
+    def reset(self):
+        """Move the reader back to the first record, if there is an ".fpsidx" index"""
+        if self._index is None:
+            return FingerprintReader.reset(self)
+        self.seek(0)
+
+    def iter_range(self, start, end=None):
+        """Iterate over the (id, fingerprint) pairs from record `start` up to `end`
+
+        This moves the reader to `start`. If `end` is None then iterate
+        to the end of the file.
+        """
+        index = self._get_index()
+        if end is None or end > index.num_records:
+            end = index.num_records
+        self.seek(start)
+        return itertools.islice(iter(self), max(end - start, 0))
+
     def _check_at_start(self):
         if not self._at_start:
             raise TypeError("FPS file is not at the start of the file; cannot search")
@@ -157,6 +383,30 @@ class FPSReader(FingerprintReader):
         self._check_at_start()
         return fps_search.knearest_tanimoto_search_arena(queries, self, k, threshold)
 
+    def count_tversky_hits_fp(self, query_fp, threshold=0.7, alpha=1.0, beta=1.0):
+        self._check_at_start()
+        return fps_search.count_tversky_hits_fp(query_fp, self, threshold, alpha, beta)
+
+    def count_tversky_hits_arena(self, queries, threshold=0.7, alpha=1.0, beta=1.0):
+        self._check_at_start()
+        return fps_search.count_tversky_hits_arena(queries, self, threshold, alpha, beta)
+
+    def threshold_tversky_search_fp(self, query_fp, threshold=0.7, alpha=1.0, beta=1.0):
+        self._check_at_start()
+        return fps_search.threshold_tversky_search_fp(query_fp, self, threshold, alpha, beta)
+
+    def threshold_tversky_search_arena(self, queries, threshold=0.7, alpha=1.0, beta=1.0):
+        self._check_at_start()
+        return fps_search.threshold_tversky_search_arena(queries, self, threshold, alpha, beta)
+
+    def knearest_tversky_search_fp(self, query_fp, k=3, threshold=0.7, alpha=1.0, beta=1.0):
+        self._check_at_start()
+        return fps_search.knearest_tversky_search_fp(query_fp, self, k, threshold, alpha, beta)
+
+    def knearest_tversky_search_arena(self, queries, k=3, threshold=0.7, alpha=1.0, beta=1.0):
+        self._check_at_start()
+        return fps_search.knearest_tversky_search_arena(queries, self, k, threshold, alpha, beta)
+
 def _where(filename, lineno):
     if filename is None:
         return "line %d" % (lineno,)
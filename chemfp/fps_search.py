@@ -1,5 +1,5 @@
 # Internal module to help with FPS-based searches
-from __future__ import absolute_import
+from __future__ import absolute_import, with_statement
 
 import ctypes
 import itertools
@@ -52,6 +52,40 @@ def report_errors(problem_report):
             raise TypeError(msg_template % dict(metadata1 = "query",
                                                 metadata2 = "target"))
 
+######## Parallel scans #########
+
+# An uncompressed FPS file is split into newline-aligned byte ranges of
+# at least this size, which are searched in a thread pool. The C search
+# functions release the GIL. Smaller files are searched serially.
+MIN_SCAN_RANGE_SIZE = 1024*1024
+
+def _scan(target_reader, search_range):
+    # search_range(blocks) returns (err, num_lines, result) for a range
+    # of blocks. Return the results for each range, in file order.
+    num_threads = _chemfp.get_num_threads()
+    block_sources = None
+    if num_threads > 1:
+        # Use more ranges than threads to balance the load
+        block_sources = target_reader._split_byte_ranges(num_threads*4, MIN_SCAN_RANGE_SIZE)
+
+    if block_sources is None:
+        outcomes = [search_range(target_reader.iter_blocks())]
+    else:
+        from .futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            jobs = [executor.submit(search_range, blocks) for blocks in block_sources]
+            outcomes = [job.result() for job in jobs]
+
+    # Report the first error in the file, using the line counts of the earlier ranges
+    lineno = target_reader._first_fp_lineno
+    results = []
+    for err, num_lines, result in outcomes:
+        lineno += num_lines
+        if err:
+            raise _chemfp_error(err, lineno, target_reader._filename)
+        results.append(result)
+    return results
+
 ######## count Tanimoto search #########
 
 def _fp_to_arena(query_fp, metadata):
@@ -63,23 +97,40 @@ def count_tanimoto_hits_fp(query_fp, target_reader, threshold):
     return count_tanimoto_hits_arena(_fp_to_arena(query_fp, target_reader.metadata), target_reader, threshold)[0]
 
 def count_tanimoto_hits_arena(query_arena, target_reader, threshold):
-    require_matching_sizes(query_arena, target_reader)
-    counts = array.array("i", (0 for i in xrange(len(query_arena))))
+    return _count_hits_arena(query_arena, target_reader, threshold, None)
 
-    lineno = target_reader._first_fp_lineno
-
-    for block in target_reader.iter_blocks():
-        err, num_lines = _chemfp.fps_count_tanimoto_hits(
-            query_arena.metadata.num_bits,
-            query_arena.start_padding, query_arena.end_padding,
-            query_arena.storage_size, query_arena.arena, 0, -1,
-            block, 0, -1,
-            threshold, counts)
-        lineno += num_lines
-        if err:
-            raise _chemfp_error(err, lineno, target_reader._filename)
+def _count_hits_arena(query_arena, target_reader, threshold, weights):
+    # weights is None for a Tanimoto search, else the Tversky (alpha, beta)
+    require_matching_sizes(query_arena, target_reader)
 
-    return list(counts)
+    def count_range(blocks):
+        counts = array.array("i", (0 for i in xrange(len(query_arena))))
+        num_lines = 0
+        for block in blocks:
+            if weights is None:
+                err, block_num_lines = _chemfp.fps_count_tanimoto_hits(
+                    query_arena.metadata.num_bits,
+                    query_arena.start_padding, query_arena.end_padding,
+                    query_arena.storage_size, query_arena.arena, 0, -1,
+                    block, 0, -1,
+                    threshold, counts)
+            else:
+                err, block_num_lines = _chemfp.fps_count_tversky_hits(
+                    query_arena.metadata.num_bits,
+                    query_arena.start_padding, query_arena.end_padding,
+                    query_arena.storage_size, query_arena.arena, 0, -1,
+                    block, 0, -1,
+                    weights[0], weights[1], threshold, counts)
+            num_lines += block_num_lines
+            if err:
+                return err, num_lines, None
+        return 0, num_lines, counts
+
+    counts = [0] * len(query_arena)
+    for range_counts in _scan(target_reader, count_range):
+        for i, count in enumerate(range_counts):
+            counts[i] += count
+    return counts
     
 
 
@@ -93,39 +144,68 @@ class TanimotoCell(ctypes.Structure):
                 ("id_end", ctypes.c_int)]
 
 
+def _threshold_search_range(num_bits, start_padding, end_padding, storage_size, arena,
+                            num_queries, threshold, num_cells, weights=None):
+    # Return a function which searches a range of blocks. It returns the
+    # ids and scores for each query. weights is None for a Tanimoto
+    # search, else the Tversky (alpha, beta).
+    def threshold_range(blocks):
+        ids = [[] for i in xrange(num_queries)]
+        scores = [[] for i in xrange(num_queries)]
+        cells = (TanimotoCell*num_cells)()
+        num_lines = 0
+        for block in blocks:
+            start = 0
+            end = len(block)
+            while 1:
+                if weights is None:
+                    err, start, block_num_lines, num_cells_used = _chemfp.fps_threshold_tanimoto_search(
+                        num_bits, start_padding, end_padding, storage_size, arena, 0, -1,
+                        block, start, end,
+                        threshold, cells)
+                else:
+                    err, start, block_num_lines, num_cells_used = _chemfp.fps_threshold_tversky_search(
+                        num_bits, start_padding, end_padding, storage_size, arena, 0, -1,
+                        block, start, end,
+                        weights[0], weights[1], threshold, cells)
+                num_lines += block_num_lines
+                if err:
+                    return err, num_lines, None
+
+                for cell in itertools.islice(cells, 0, num_cells_used):
+                    query_index = cell.query_index
+                    ids[query_index].append(block[cell.id_start:cell.id_end])
+                    scores[query_index].append(cell.score)
+                if start == end:
+                    break
+        return 0, num_lines, (ids, scores)
+    return threshold_range
+
+def _merge_threshold_results(num_queries, range_results):
+    # The ranges are in file order, so the hits are in the same order
+    # as a serial scan.
+    results = [FPSSearchResult([], []) for i in xrange(num_queries)]
+    for ids, scores in range_results:
+        for result, range_ids, range_scores in zip(results, ids, scores):
+            result.ids.extend(range_ids)
+            result.scores.extend(range_scores)
+    return results
+
 def threshold_tanimoto_search_fp(query_fp, target_reader, threshold):
     """Find matches in the target reader which are at least threshold similar to the query fingerprint
 
     The results is an FPSSearchResults instance contain the result.
     """
-    ids = []
-    scores = []
+    return _threshold_search_fp(query_fp, target_reader, threshold, None)
+
+def _threshold_search_fp(query_fp, target_reader, threshold, weights):
     fp_size = len(query_fp)
     num_bits = fp_size * 8
         
     NUM_CELLS = 1000
-    cells = (TanimotoCell*NUM_CELLS)()
-
-    lineno = target_reader._first_fp_lineno
-    
-    for block in target_reader.iter_blocks():
-        start = 0
-        end = len(block)
-        while 1:
-            err, start, num_lines, num_cells = _chemfp.fps_threshold_tanimoto_search(
-                num_bits, 0, 0, fp_size, query_fp, 0, -1,
-                block, start, end,
-                threshold, cells)
-            lineno += num_lines
-            if err:
-                raise _chemfp_error(err, lineno, target_reader._filename)
-                
-            for cell in itertools.islice(cells, 0, num_cells):
-                    ids.append(block[cell.id_start:cell.id_end])
-                    scores.append(cell.score)
-            if start == end:
-                break
-    return FPSSearchResult(ids, scores)
+    threshold_range = _threshold_search_range(num_bits, 0, 0, fp_size, query_fp,
+                                              1, threshold, NUM_CELLS, weights)
+    return _merge_threshold_results(1, _scan(target_reader, threshold_range))[0]
 
 def threshold_tanimoto_search_arena(query_arena, target_reader, threshold):
     """Find matches in the target reader which are at least threshold similar to the query arena fingerprints
@@ -133,44 +213,25 @@ def threshold_tanimoto_search_arena(query_arena, target_reader, threshold):
     The results are a list in the form [search_results1, search_results2, ...]
     where search_results are in the same order as the fingerprints in the query_arena.
     """
-    
+    return _threshold_search_arena(query_arena, target_reader, threshold, None)
+
+def _threshold_search_arena(query_arena, target_reader, threshold, weights):
     require_matching_sizes(query_arena, target_reader)
 
     if not query_arena:
         return FPSSearchResults([])
-    results = [FPSSearchResult([], []) for i in xrange(len(query_arena))]
     
     # Compute at least 100 tanimotos per query, but at most 10,000 at a time
     # (That's about 200K of memory)
     NUM_CELLS = max(10000, len(query_arena) * 100)
-    cells = (TanimotoCell*NUM_CELLS)()
-
-    lineno = target_reader._first_fp_lineno
-
-    for block in target_reader.iter_blocks():
-        start = 0
-        end = len(block)
-        while 1:
-            err, start, num_lines, num_cells = _chemfp.fps_threshold_tanimoto_search(
-                query_arena.metadata.num_bits,
-                query_arena.start_padding, query_arena.end_padding,
-                query_arena.storage_size, query_arena.arena, 0, -1,
-                block, start, end,
-                threshold, cells)
-            lineno += num_lines
-            if err:
-                raise _chemfp_error(err, lineno, target_reader._filename)
-                
-            for cell in itertools.islice(cells, 0, num_cells):
-                id = block[cell.id_start:cell.id_end]
-                result = results[cell.query_index]
-                result.ids.append(id)
-                result.scores.append(cell.score)
-                
-            if start == end:
-                break
+    threshold_range = _threshold_search_range(
+        query_arena.metadata.num_bits,
+        query_arena.start_padding, query_arena.end_padding,
+        query_arena.storage_size, query_arena.arena,
+        len(query_arena), threshold, NUM_CELLS, weights)
 
-    return FPSSearchResults(results)
+    return FPSSearchResults(_merge_threshold_results(len(query_arena),
+                                                     _scan(target_reader, threshold_range)))
             
 ######### k-nearest Tanimoto search, with threshold
 
@@ -210,42 +271,102 @@ def knearest_tanimoto_search_fp(query_fp, target_reader, k, threshold):
     return knearest_tanimoto_search_arena(query_arena, target_reader, k, threshold)[0]
 
 def knearest_tanimoto_search_arena(query_arena, target_reader, k, threshold):
+    return _knearest_search_arena(query_arena, target_reader, k, threshold, None)
+
+def _knearest_search_arena(query_arena, target_reader, k, threshold, weights):
     require_matching_sizes(query_arena, target_reader)
     if k < 0:
         raise ValueError("k must be non-negative")
 
     num_queries = len(query_arena)
-    search = _make_knearest_search(num_queries, k)
 
-    _chemfp.fps_knearest_search_init(
-        search,
-        query_arena.metadata.num_bits,
-        query_arena.start_padding, query_arena.end_padding,
-        query_arena.storage_size, query_arena.arena, 0, -1,
-        k, threshold)
+    def knearest_range(blocks):
+        search = _make_knearest_search(num_queries, k)
+        _chemfp.fps_knearest_search_init(
+            search,
+            query_arena.metadata.num_bits,
+            query_arena.start_padding, query_arena.end_padding,
+            query_arena.storage_size, query_arena.arena, 0, -1,
+            k, threshold)
+        try:
+            for block in blocks:
+                if weights is None:
+                    err = _chemfp.fps_knearest_tanimoto_search_feed(search, block, 0, -1)
+                else:
+                    err = _chemfp.fps_knearest_tversky_search_feed(
+                        search, weights[0], weights[1], block, 0, -1)
+                if err:
+                    return err, search.num_targets_processed, None
+
+            _chemfp.fps_knearest_search_finish(search)
+
+            results = []
+            for query_index in xrange(num_queries):
+                heap = search.heaps[0][query_index]
+                ids = []
+                for i in xrange(heap.size):
+                    id = ctypes.string_at(heap.ids[0][i])
+                    ids.append(id)
+                scores = heap.scores[0][:heap.size]
+                results.append((ids, scores))
+            return 0, search.num_targets_processed, results
+        finally:
+            _chemfp.fps_knearest_search_free(search)
+
+    range_results = _scan(target_reader, knearest_range)
+    if len(range_results) == 1:
+        return FPSSearchResults([FPSSearchResult(ids, scores)
+                                     for (ids, scores) in range_results[0]])
+
+    # Merge the k-nearest hits from each range. As with a serial scan,
+    # the earliest of the tied hits are kept, since each heap keeps the
+    # earliest hits in its range and the sort is stable.
+    results = []
+    for query_index in xrange(num_queries):
+        hits = []
+        for range_result in range_results:
+            ids, scores = range_result[query_index]
+            hits.extend(zip(scores, ids))
+        hits.sort(key=lambda hit: -hit[0])
+        del hits[k:]
+        results.append(FPSSearchResult([id for (score, id) in hits],
+                                       [score for (score, id) in hits]))
+    return FPSSearchResults(results)
+
+######### Tversky searches
+
+# These use the same scanning code as the Tanimoto searches, with the
+# Tversky (alpha, beta) weights passed to the C search functions.
+# There are no symmetric FPS searches.
+
+def count_tversky_hits_fp(query_fp, target_reader, threshold, alpha, beta):
+    return count_tversky_hits_arena(_fp_to_arena(query_fp, target_reader.metadata), target_reader,
+                                    threshold, alpha, beta)[0]
+
+def count_tversky_hits_arena(query_arena, target_reader, threshold, alpha, beta):
+    return _count_hits_arena(query_arena, target_reader, threshold, (alpha, beta))
+
+def threshold_tversky_search_fp(query_fp, target_reader, threshold, alpha, beta):
+    """Find matches in the target reader which are at least threshold Tversky similar to the query fingerprint
+
+    The results is an FPSSearchResults instance contain the result.
+    """
+    return _threshold_search_fp(query_fp, target_reader, threshold, (alpha, beta))
+
+def threshold_tversky_search_arena(query_arena, target_reader, threshold, alpha, beta):
+    """Find matches in the target reader which are at least threshold Tversky similar to the query arena fingerprints
+    """
+    return _threshold_search_arena(query_arena, target_reader, threshold, (alpha, beta))
+
+def knearest_tversky_search_fp(query_fp, target_reader, k, threshold, alpha, beta):
+    """Find k matches in the target reader which are at least threshold Tversky similar to the query fingerprint
+    """
+    query_arena = _fp_to_arena(query_fp, target_reader.metadata)
+    return knearest_tversky_search_arena(query_arena, target_reader, k, threshold, alpha, beta)[0]
+
+def knearest_tversky_search_arena(query_arena, target_reader, k, threshold, alpha, beta):
+    return _knearest_search_arena(query_arena, target_reader, k, threshold, (alpha, beta))
 
-    try:
-        for block in target_reader.iter_blocks():
-            err = _chemfp.fps_knearest_tanimoto_search_feed(search, block, 0, -1)
-            if err:
-                lineno = target_reader._first_fp_lineno + search.num_targets_processed
-                raise _chemfp_error(err, lineno, target_reader._filename)
-
-        _chemfp.fps_knearest_search_finish(search)
-
-        results = []
-        for query_index in xrange(num_queries):
-            heap = search.heaps[0][query_index]
-            ids = []
-            for i in xrange(heap.size):
-                id = ctypes.string_at(heap.ids[0][i])
-                ids.append(id)
-            scores = heap.scores[0][:heap.size]
-            results.append(FPSSearchResult(ids, scores))
-        return FPSSearchResults(results)
-
-    finally:
-        _chemfp.fps_knearest_search_free(search)
 
 def _reorder_row(ids, scores, name):
     indices = range(len(ids))
@@ -0,0 +1,264 @@
+"""Compact data structures for fingerprint identifiers
+
+NOTE: This module should not be used directly.
+
+An "id block" stores all of the identifiers in a single byte string,
+each followed by a newline, along with an array of (num_ids+1)
+unsigned 32-bit offsets, where offsets[i] is the start of id i and
+offsets[num_ids] is the end of the block. This is the same layout as
+the FPID chunk of an fpb file.
+
+An `IdTable` is a read-only sequence of ids stored in an id block. It
+has the same sequence behavior as a list of ids, but uses only the
+bytes of each id plus 4 bytes for the offset, instead of a Python
+string object for each id. Slices share the same id block.
+
+An `IdIndex` is an open-addressing hash table, built in C, which maps
+an identifier to its index in the id block. The table is a flat array
+of integers, so it can be saved in an fpb file and memory-mapped back
+in. It uses a few bytes per id instead of the Python objects in a
+dictionary.
+"""
+
+from __future__ import absolute_import
+
+import array
+from cStringIO import StringIO
+
+import _chemfp
+
+__all__ = []
+
+
+def make_id_block(ids):
+    """Return the (id_block, offsets) for a list of ids
+
+    The offsets are an array of native unsigned 32-bit integers.
+    Raises a ValueError if an id contains a newline or isn't a byte
+    string, or if the id block would be larger than 4GB.
+    """
+    offsets = array.array("I")
+    pos = 0
+    for i, id in enumerate(ids):
+        if not isinstance(id, str):
+            raise ValueError("Fingerprint ids must be byte strings: %r in record %d" %
+                             (id, i+1))
+        if "\n" in id:
+            raise ValueError("Fingerprint ids must not contain a newline: %r in record %d" %
+                             (id, i+1))
+        offsets.append(pos)
+        pos += len(id) + 1
+    if pos >= 2**32:
+        raise ValueError("Fingerprint ids take more than 4GB")
+    offsets.append(pos)
+    if ids:
+        id_block = "\n".join(ids) + "\n"
+    else:
+        id_block = ""
+    return id_block, offsets
+
+
+def _is_valid_id(id):
+    return type(id) is str and "\n" not in id
+
+
+class IdTable(object):
+    """A read-only list of ids, stored in a single id block
+
+    `id_block` and `offsets` may be strings, arrays or other buffers,
+    including memory-mapped file contents. The offsets are native
+    unsigned 32-bit integers, and there must be num_ids+1 of them.
+    They are positions in the id block, which need not start at 0.
+    """
+    def __init__(self, id_block, offsets):
+        self.id_block = id_block
+        self.offsets = offsets
+        self._num_ids = len(buffer(offsets)) // 4 - 1
+        if self._num_ids < 0:
+            raise ValueError("offsets must contain at least one value")
+
+    @classmethod
+    def from_ids(cls, ids):
+        """Make an IdTable from a list of ids
+
+        Raises a ValueError if an id contains a newline or isn't a byte
+        string.
+        """
+        id_block, offsets = make_id_block(ids)
+        return cls(id_block, offsets.tostring())
+
+    def __len__(self):
+        return self._num_ids
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, end, step = i.indices(self._num_ids)
+            if step != 1:
+                return [self[j] for j in xrange(start, end, step)]
+            if end < start:
+                end = start
+            # The new offsets still refer to the same id block
+            return IdTable(self.id_block, buffer(self.offsets, start*4, (end-start+1)*4))
+        if i < 0:
+            i += self._num_ids
+        return _chemfp.get_id_table_item(self.id_block, self.offsets, i)
+
+    def __iter__(self):
+        get_item = _chemfp.get_id_table_item
+        id_block = self.id_block
+        offsets = self.offsets
+        for i in xrange(self._num_ids):
+            yield get_item(id_block, offsets, i)
+
+    def __contains__(self, id):
+        for x in self:
+            if x == id:
+                return True
+        return False
+
+    def index(self, id):
+        for i, x in enumerate(self):
+            if x == id:
+                return i
+        raise ValueError("%r is not in the id table" % (id,))
+
+    def count(self, id):
+        return sum(1 for x in self if x == id)
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, IdTable)):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        for x, y in zip(self, other):
+            if x != y:
+                return False
+        return True
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "IdTable(%r)" % (list(self),)
+
+    def __reduce__(self):
+        id_block, offsets = self.get_id_block()
+        return (IdTable, (str(buffer(id_block)), str(buffer(offsets))))
+
+    def take(self, indices):
+        """Return a new IdTable with the ids at the given indices, in order"""
+        if not isinstance(indices, array.array) or indices.typecode != "i":
+            indices = array.array("i", indices)
+        new_offsets = array.array("I", (0,)) * (len(indices)+1)
+        new_id_block = _chemfp.take_id_table_items(self.id_block, self.offsets,
+                                                   indices, new_offsets)
+        return IdTable(new_id_block, new_offsets.tostring())
+
+    def _get_offset(self, i):
+        return array.array("I", str(buffer(self.offsets, i*4, 4)))[0]
+
+    def get_id_block(self):
+        """Return the (id_block, offsets) where the offsets start at 0
+
+        The offsets contain native unsigned 32-bit integers. If the
+        IdTable uses all of its id block then the id block and offsets
+        are returned as-is, otherwise they are copied.
+        """
+        if (self._get_offset(0) == 0 and
+            self._get_offset(self._num_ids) == len(buffer(self.id_block))):
+            return self.id_block, self.offsets
+        new_table = self.take(xrange(self._num_ids))
+        return new_table.id_block, new_table.offsets
+
+
+class IdTableBuilder(object):
+    """Build an IdTable one id at a time
+
+    If an id cannot be stored in an id block then the builder switches
+    to a list of ids.
+    """
+    def __init__(self):
+        self._id_block = StringIO()
+        self._offsets = array.array("I", [0])
+        self._pos = 0
+        self._ids = None
+
+    def append(self, id):
+        if self._ids is not None:
+            self._ids.append(id)
+        elif _is_valid_id(id) and self._pos + len(id) + 1 < 2**32:
+            self._id_block.write(id)
+            self._id_block.write("\n")
+            self._pos += len(id) + 1
+            self._offsets.append(self._pos)
+        else:
+            self._ids = list(self._make_table())
+            self._ids.append(id)
+
+    def _make_table(self):
+        return IdTable(self._id_block.getvalue(), self._offsets.tostring())
+
+    def get_ids(self):
+        """Return an IdTable if possible, otherwise a list of ids"""
+        if self._ids is not None:
+            return self._ids
+        return self._make_table()
+
+
+class IdIndex(object):
+    """Look up the index of an identifier using a hash table
+
+    The `id_block`, `offsets` and `table` may be strings, arrays or
+    other buffers, including memory-mapped file contents. If an id
+    occurs more than once, the index of the last occurrence is used.
+    """
+    def __init__(self, num_ids, id_block, offsets, table):
+        self.num_ids = num_ids
+        self.id_block = id_block
+        self.offsets = offsets
+        self.table = table
+
+    @classmethod
+    def from_id_block(cls, num_ids, id_block, offsets):
+        """Build the hash table for the ids in an id block"""
+        table = array.array("I", (0,)) * _chemfp.get_id_index_size(num_ids)
+        _chemfp.make_id_index(num_ids, id_block, offsets, table)
+        return cls(num_ids, id_block, offsets, table)
+
+    @classmethod
+    def from_ids(cls, ids):
+        """Build the hash table for a list of ids or an IdTable
+
+        Raises a ValueError if the ids cannot be stored in an id block.
+        """
+        if isinstance(ids, IdTable):
+            return cls.from_id_block(len(ids), ids.id_block, ids.offsets)
+        id_block, offsets = make_id_block(ids)
+        return cls.from_id_block(len(ids), id_block, offsets)
+
+    def __len__(self):
+        return self.num_ids
+
+    def get(self, id, default=None):
+        """Return the index of `id`, or `default` if it is not present"""
+        if not isinstance(id, str):
+            if not isinstance(id, unicode):
+                return default
+            # Match the behavior of a dictionary with byte string keys
+            try:
+                id = id.encode("ascii")
+            except UnicodeError:
+                return default
+        i = _chemfp.id_index_lookup(self.num_ids, self.id_block, self.offsets,
+                                    self.table, id)
+        if i == -1:
+            return default
+        return i
+
+    def __contains__(self, id):
+        return self.get(id) is not None
@@ -0,0 +1,282 @@
+"""Approximate k-nearest Tanimoto search using MinHash and banded LSH
+
+An exact k-nearest search has to look at every target whose popcount
+could give a good enough score. For very large arenas that can take
+too long for interactive use. An `LSHIndex` finds most of the nearest
+neighbors while only looking at a small number of candidates.
+
+Each fingerprint gets a MinHash signature of num_bands*rows_per_band
+values. The signature is split into num_bands bands and each band is
+hashed to a key. Fingerprints with a high Tanimoto similarity are
+likely to have the same key in at least one band. The index has a
+table for each band, and a search looks up the query's key in each
+table to get a set of candidates. The candidates are scored with the
+exact Tanimoto, so the scores are always correct, but some of the true
+nearest neighbors may be missed.
+
+More bands find more of the nearest neighbors, at the cost of memory
+(8 bytes per band per fingerprint) and search time. More rows per band
+give fewer, more similar candidates. The `num_probe_bands` search
+parameter uses only the first `num_probe_bands` tables, which trades
+recall for speed without rebuilding the index.
+
+Use `build_lsh_index` to make an index for an arena, `LSHIndex.save`
+to save it, usually to `get_lsh_index_filename(arena_filename)`, and
+`load_lsh_index` to load it again for the same arena.
+
+The index file uses the same chunk layout as the fpb format, with the
+signature "FPLSH1\\0\\0". The chunks are:
+
+  LSHI - the 32-bit num_bits, number of fingerprints, num_bands,
+         rows_per_band and hash seed, and the 32-bit CRC of a sample
+         of the fingerprints, to check that the index is for the arena.
+  LSHT - a 1 byte spacer length, that many NUL bytes, then the tables.
+         Each table has an entry for each fingerprint, sorted by key.
+         An entry is the 32-bit key and the 32-bit fingerprint index.
+         The spacer places the tables at a file offset which is a
+         multiple of 8.
+  FEND - end of the chunks
+"""
+
+from __future__ import absolute_import
+
+import os
+import sys
+import mmap
+import array
+import ctypes
+import struct
+import zlib
+from __builtin__ import open as _builtin_open
+
+import _chemfp
+from . import ParseError
+from . import fpb_io
+from . import search
+
+__all__ = ["LSHIndex", "build_lsh_index", "load_lsh_index", "get_lsh_index_filename"]
+
+LSH_MAGIC = "FPLSH1\0\0"
+
+_info_header = struct.Struct("<IIIIIi")
+
+# Use at most this many fingerprints for the arena checksum
+_CHECKSUM_SAMPLE_SIZE = 1024
+
+
+def get_lsh_index_filename(arena_filename):
+    """Return the usual name of the LSH index for the arena in `arena_filename`"""
+    return arena_filename + ".lsh"
+
+def _get_arena_checksum(arena):
+    # Checking every fingerprint would take too long for a large arena
+    n = len(arena)
+    step = max(1, n // _CHECKSUM_SAMPLE_SIZE)
+    crc = zlib.crc32(str(n))
+    for i in xrange(0, n, step):
+        crc = zlib.crc32(arena[i][1], crc)
+    return crc
+
+def _check_arena(arena):
+    if arena.metadata.num_bits is None:
+        raise ValueError("The arena must define num_bits")
+
+
+class LSHIndex(object):
+    """A MinHash LSH index for approximate k-nearest searches of an arena
+
+    The public attributes are:
+       arena
+           the indexed `FingerprintArena`
+       num_bands
+           the number of LSH tables
+       rows_per_band
+           the number of MinHash values in each band
+       seed
+           the seed for the MinHash hash functions
+    """
+    def __init__(self, arena, num_bands, rows_per_band, seed, entries):
+        self.arena = arena
+        self.num_bands = num_bands
+        self.rows_per_band = rows_per_band
+        self.seed = seed
+        self._entries = entries
+
+    def __len__(self):
+        return len(self.arena)
+
+    def _get_num_probe_bands(self, num_probe_bands):
+        if num_probe_bands is None:
+            return self.num_bands
+        if not (1 <= num_probe_bands <= self.num_bands):
+            raise ValueError("num_probe_bands must be between 1 and %d" % (self.num_bands,))
+        return num_probe_bands
+
+    def knearest_tanimoto_search_fp(self, query_fp, k=3, threshold=0.7, num_probe_bands=None):
+        """Find approximately the `k` nearest fingerprints at least `threshold` similar to `query_fp`
+
+        The hits in the `SearchResult` are ordered by decreasing
+        similarity score. The scores are exact, but some of the
+        nearest neighbors may be missing.
+
+        :param query_fp: the query fingerprint
+        :type query_fp: a byte string
+        :param k: the number of nearest neighbors to find.
+        :type k: positive integer
+        :param threshold: The minimum score threshold.
+        :type threshold: float between 0.0 and 1.0, inclusive
+        :param num_probe_bands: the number of tables to use (default: all of them)
+        :type num_probe_bands: integer between 1 and num_bands, or None
+        :returns: a SearchResult
+        """
+        arena = self.arena
+        search._require_matching_fp_size(query_fp, arena)
+        query_start_padding, query_end_padding, query_fp = _chemfp.align_fingerprint(
+            query_fp, arena.alignment, arena.storage_size)
+        results = search.SearchResults(1, arena.arena_ids)
+        _chemfp.knearest_tanimoto_lsh_arena(
+            k, threshold, arena.num_bits,
+            query_start_padding, query_end_padding, arena.storage_size, query_fp, 0, 1,
+            arena.start_padding, arena.end_padding,
+            arena.storage_size, arena.arena, arena.start, arena.end,
+            self.num_bands, self.rows_per_band, self.seed, self._entries,
+            self._get_num_probe_bands(num_probe_bands),
+            results, 0)
+        return results[0]
+
+    def knearest_tanimoto_search_arena(self, queries, k=3, threshold=0.7, num_probe_bands=None):
+        """Find approximately the `k` nearest fingerprints at least `threshold` similar to each query
+
+        The hits in each `SearchResult` are ordered by decreasing
+        similarity score. The scores are exact, but some of the
+        nearest neighbors may be missing.
+
+        :param queries: the query fingerprints
+        :type queries: a FingerprintArena
+        :param k: the number of nearest neighbors to find.
+        :type k: positive integer
+        :param threshold: The minimum score threshold.
+        :type threshold: float between 0.0 and 1.0, inclusive
+        :param num_probe_bands: the number of tables to use (default: all of them)
+        :type num_probe_bands: integer between 1 and num_bands, or None
+        :returns: a SearchResults instance
+        """
+        arena = self.arena
+        search._require_matching_sizes(queries, arena)
+        num_probe_bands = self._get_num_probe_bands(num_probe_bands)
+        results = search.SearchResults(len(queries), arena.arena_ids)
+        if len(queries):
+            _chemfp.knearest_tanimoto_lsh_arena(
+                k, threshold, arena.num_bits,
+                queries.start_padding, queries.end_padding,
+                queries.storage_size, queries.arena, queries.start, queries.end,
+                arena.start_padding, arena.end_padding,
+                arena.storage_size, arena.arena, arena.start, arena.end,
+                self.num_bands, self.rows_per_band, self.seed, self._entries,
+                num_probe_bands,
+                results, 0)
+        return results
+
+    def save(self, destination):
+        """Save the index to the file named `destination`"""
+        tables = buffer(self._entries)
+        if sys.byteorder == "big":
+            tables = array.array("I", tables)
+            tables.byteswap()
+            tables = tables.tostring()
+        outfile = _builtin_open(destination, "wb")
+        try:
+            output = fpb_io._CountingWriter(outfile)
+            output.write(LSH_MAGIC)
+            output.write_chunk_header("LSHI", _info_header.size)
+            output.write(_info_header.pack(self.arena.num_bits, len(self.arena),
+                                           self.num_bands, self.rows_per_band, self.seed,
+                                           _get_arena_checksum(self.arena)))
+            # The tables start after the chunk header and the spacer length byte
+            spacer = -(output.pos + fpb_io._chunk_header.size + 1) % 8
+            output.write_chunk_header("LSHT", 1 + spacer + len(tables))
+            output.write(chr(spacer) + "\0" * spacer)
+            output.write(tables)
+            output.write_chunk_header("FEND", 0)
+        finally:
+            outfile.close()
+
+
+def build_lsh_index(arena, num_bands=32, rows_per_band=4, seed=0):
+    """Make an `LSHIndex` for the fingerprints in `arena`
+
+    The index uses 8*num_bands bytes per fingerprint, which may be
+    more than the 2 GB limit for the arena itself. The work is
+    split over chemfp.get_num_threads() threads. The defaults are
+    tuned for k-nearest searches where the neighbors have a Tanimoto
+    similarity of about 0.5 or more.
+
+    :param arena: the fingerprints to index
+    :type arena: a FingerprintArena
+    :param num_bands: the number of LSH tables
+    :type num_bands: integer between 1 and 1024
+    :param rows_per_band: the number of MinHash values in each band
+    :type rows_per_band: integer between 1 and 64
+    :param seed: the seed for the MinHash hash functions
+    :type seed: non-negative integer
+    :returns: an LSHIndex
+    """
+    _check_arena(arena)
+    if not (0 <= seed < 2**32):
+        raise ValueError("seed must be a non-negative 32-bit integer")
+    entries = (ctypes.c_uint32 * (2 * num_bands * len(arena)))()
+    _chemfp.make_lsh_index(arena.num_bits, arena.start_padding, arena.end_padding,
+                           arena.storage_size, arena.arena, arena.start, arena.end,
+                           num_bands, rows_per_band, seed, entries)
+    return LSHIndex(arena, num_bands, rows_per_band, seed, entries)
+
+
+def load_lsh_index(source, arena):
+    """Load the `LSHIndex` for `arena` from the file named `source`
+
+    The file is memory-mapped. Raises a ValueError if the index was
+    made for a different arena.
+
+    :param source: the index filename
+    :type source: string
+    :param arena: the fingerprints which were indexed
+    :type arena: a FingerprintArena
+    :returns: an LSHIndex
+    """
+    _check_arena(arena)
+    infile = _builtin_open(source, "rb")
+    try:
+        size = os.fstat(infile.fileno()).st_size
+        if size == 0:
+            raise ParseError("LSH index file %r is empty" % (source,))
+        data = mmap.mmap(infile.fileno(), size, access=mmap.ACCESS_READ)
+    finally:
+        infile.close()
+
+    chunks = fpb_io._read_chunks(data, source, LSH_MAGIC, "LSH index")
+    start, end = fpb_io._get_chunk(chunks, "LSHI", source, "LSH index")
+    if end - start < _info_header.size:
+        raise ParseError("LSHI chunk in LSH index file %r is too small" % (source,))
+    (num_bits, num_fingerprints, num_bands, rows_per_band, seed,
+     checksum) = _info_header.unpack_from(data, start)
+    if num_bits != arena.num_bits:
+        raise ValueError("LSH index file %r is for %d bit fingerprints, not %d" %
+                         (source, num_bits, arena.num_bits))
+    if num_fingerprints != len(arena):
+        raise ValueError("LSH index file %r is for %d fingerprints, not %d" %
+                         (source, num_fingerprints, len(arena)))
+    if checksum != _get_arena_checksum(arena):
+        raise ValueError("LSH index file %r is for a different arena" % (source,))
+
+    start, end = fpb_io._get_chunk(chunks, "LSHT", source, "LSH index")
+    if start == end:
+        raise ParseError("LSHT chunk in LSH index file %r is empty" % (source,))
+    start += 1 + ord(data[start])
+    if end - start != 8 * num_bands * num_fingerprints:
+        raise ParseError("LSHT chunk in LSH index file %r has the wrong size" % (source,))
+    if sys.byteorder == "big":
+        entries = array.array("I", data[start:end])
+        entries.byteswap()
+    else:
+        entries = buffer(data, start, end - start)
+    return LSHIndex(arena, num_bands, rows_per_band, seed, entries)
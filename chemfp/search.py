@@ -12,9 +12,13 @@ This module implements the different ways to search a
   Find all hits at or above a given threshold, sorted arbitrarily:
     threshold_tanimoto_search_fp - search an arena using a single fingerprint
     threshold_tanimoto_search_arena - search an arena using an arena
+    iter_threshold_tanimoto_search_arena - search an arena using an arena,
+      and yield the results a block of queries at a time
     threshold_tanimoto_search_symmetric - search an arena using itself
     partial_threshold_tanimoto_search_symmetric - (advanced use; see the doc string)
     fill_lower_triangle - copy the upper triangle terms to the lower triangle
+    threshold_tanimoto_search_symmetric_csr - search an arena using itself,
+      and return the hits as a sparse matrix in CSR format
 
   Find the k-nearest hits at or above a given threshold, sorted by
   decreasing similarity:
@@ -22,9 +26,40 @@ This module implements the different ways to search a
     knearest_tanimoto_search_arena - search an arena using an arena
     knearest_tanimoto_search_symmetric - search an arena using itself
 
+  Each of the count, threshold, and k-nearest searches (except the
+  partial_* functions) has a Tversky counterpart which takes
+  additional `alpha` and `beta` weights:
+    count_tversky_hits_fp, count_tversky_hits_arena, count_tversky_hits_symmetric
+    threshold_tversky_search_fp, threshold_tversky_search_arena,
+      threshold_tversky_search_symmetric
+    knearest_tversky_search_fp, knearest_tversky_search_arena,
+      knearest_tversky_search_symmetric
+
+  The metric searches take a `metric`, which is either a metric name
+  or a `Metric`. The names are "tanimoto", "tversky", "dice",
+  "cosine", "hamming" and "euclidean". The last two are distances, so
+  the threshold is a maximum distance and the k-nearest hits are
+  sorted by increasing distance:
+    count_hits_fp, count_hits_arena, count_hits_symmetric
+    threshold_search_fp, threshold_search_arena, threshold_search_symmetric
+    knearest_search_fp, knearest_search_arena, knearest_search_symmetric
+
+  The Tanimoto, Tversky and similarity metric searches also take a
+  `max_score` and an `interval`, which works like the `interval` of
+  `SearchResult.count`. A hit must have a score between `threshold`
+  and `max_score`. Use max_score=1.0 and interval="[)" to exclude
+  identical fingerprints from the hits.
+
+  Find the targets which contain all of the bits in the query, as a
+  substructure screen:
+    count_contains_hits_fp, count_contains_hits_arena
+    contains_search_fp, contains_search_arena
+
 The threshold and k-nearest search results use a `SearchResult` when
 a fingerprint is used as a query, or a `SearchResults` when an arena
 is used as a query. These internally use a compressed sparse row format.
+`threshold_tanimoto_search_symmetric_csr` returns a `CSRSearchResults`,
+which exposes its CSR arrays directly.
 """
 
 import _chemfp
@@ -37,11 +72,28 @@ __all__ = ["SearchResult", "SearchResults",
            "count_tanimoto_hits_symmetric", "partial_count_tanimoto_hits_symmetric",
 
            "threshold_tanimoto_search_fp", "threshold_tanimoto_search_arena",
+           "iter_threshold_tanimoto_search_arena",
            "threshold_tanimoto_search_symmetric", "partial_threshold_tanimoto_search_symmetric",
            "fill_lower_triangle",
+           "CSRSearchResults", "threshold_tanimoto_search_symmetric_csr",
 
            "knearest_tanimoto_search_fp", "knearest_tanimoto_search_arena",
-           "knearest_tanimoto_search_symmetric"
+           "knearest_tanimoto_search_symmetric",
+
+           "count_tversky_hits_fp", "count_tversky_hits_arena",
+           "count_tversky_hits_symmetric",
+           "threshold_tversky_search_fp", "threshold_tversky_search_arena",
+           "threshold_tversky_search_symmetric",
+           "knearest_tversky_search_fp", "knearest_tversky_search_arena",
+           "knearest_tversky_search_symmetric",
+
+           "Metric", "get_metric_names",
+           "count_hits_fp", "count_hits_arena", "count_hits_symmetric",
+           "threshold_search_fp", "threshold_search_arena", "threshold_search_symmetric",
+           "knearest_search_fp", "knearest_search_arena", "knearest_search_symmetric",
+
+           "count_contains_hits_fp", "count_contains_hits_arena",
+           "contains_search_fp", "contains_search_arena",
            ]
            
 
@@ -84,6 +136,29 @@ class SearchResult(object):
         """The list of target scores, in the current ordering"""
         return self._search_results._get_scores(self._row)
         
+    def get_indices_view(self):
+        """A read-only buffer view of the target indices, in the current ordering
+
+        The view uses the result's own memory instead of making a copy.
+        It supports the buffer interface, with 'i' (C int) items, so
+        numpy.frombuffer(view, numpy.intc) gives a NumPy array of the
+        indices without a copy. The view keeps the SearchResults alive.
+        Hits can't be added or cleared while a view exists; that raises
+        a BufferError. Reordering is allowed, and the view sees the new
+        order.
+        """
+        return self._search_results._get_indices_view(self._row)
+
+    def get_scores_view(self):
+        """A read-only buffer view of the stored scores, in the current ordering
+
+        This works like `get_indices_view`. The items are the scores as
+        they are stored, which depends on the SearchResults score_type.
+        The view's format is 'd' for "double", 'f' for "float" and 'H'
+        for "uint16". Divide a uint16 value by 65535 to get the score.
+        """
+        return self._search_results._get_scores_view(self._row)
+
     def get_ids_and_scores(self):
         """The list of (target identifier, target score) pairs, in the current ordering
 
@@ -187,13 +262,20 @@ class SearchResults(_chemfp.SearchResults):
     lists, sort the list contents, and more.
     
     """
-    def __init__(self, n, arena_ids=None):
+    def __init__(self, n, arena_ids=None, score_type="double"):
         """`n` is the number of SearchResult instances and `arena_ids` the target arena ids
 
         There is one SearchResult for each query fingerprint. The `arena_ids`
         are used to map the hit index back to the hit id.
+
+        The `score_type` says how to store the scores. A "double" uses
+        8 bytes per score. A "float" uses 4 bytes, and a "uint16" uses
+        2 bytes by storing round(score*65535), so it only works for
+        scores between 0.0 and 1.0. The accessors always return the
+        stored scores as Python floats, and the score limits for count()
+        and cumulative_score() are rounded the same way as the scores.
         """
-        super(SearchResults, self).__init__(n, arena_ids)
+        super(SearchResults, self).__init__(n, arena_ids, score_type)
         self._results = [SearchResult(self, i) for i in xrange(n)]
 
     def __iter__(self):
@@ -316,6 +398,105 @@ class SearchResults(_chemfp.SearchResults):
         """
         return super(SearchResults, self).reorder_all(order)
 
+    def get_flat_views(self):
+        """Return the hits of all of the rows as (offsets, indices, scores) buffer views
+
+        The indices and scores are the concatenation of each row's
+        target indices and stored scores, in the current ordering. The
+        hits for row i are in indices[offsets[i]:offsets[i+1]], and the
+        same range of scores. This is the compressed sparse row layout.
+
+        The offsets are 64-bit integers (format 'q'), the indices are C
+        ints (format 'i'), and the scores format depends on the
+        score_type, as described in `SearchResult.get_scores_view`.
+        Each row is stored separately, so the arrays are made with one
+        copy per row in C, but no Python objects are created for the
+        hits. The views own their memory, so they don't change if the
+        hits change. For example, to get NumPy arrays::
+
+            offsets, indices, scores = results.get_flat_views()
+            offsets = numpy.frombuffer(offsets, offsets.format)
+            indices = numpy.frombuffer(indices, indices.format)
+            scores = numpy.frombuffer(scores, scores.format)
+
+        :returns: a 3-element tuple of read-only buffer views
+        """
+        return super(SearchResults, self).get_flat_views()
+
+
+
+class CSRSearchResults(object):
+    """Symmetric threshold search results as a sparse matrix in CSR format
+
+    The hits for row i are in indices[indptr[i]:indptr[i+1]] and
+    scores[indptr[i]:indptr[i+1]], in increasing column order. The
+    public attributes are:
+       indptr
+           the row offsets, as a ctypes array of n+1 64-bit integers
+       indices
+           the column index of each hit, as a ctypes array of 32-bit integers
+       scores
+           the score of each hit, as a ctypes array of 32-bit floats
+       shape
+           the matrix shape, (n, n)
+       target_ids
+           the arena ids, to map a column index back to its id
+
+    The arrays support the buffer protocol, so they can be used
+    without a copy. For example, to make a SciPy sparse matrix::
+
+        import numpy, scipy.sparse
+        matrix = scipy.sparse.csr_matrix(
+            (numpy.frombuffer(results.scores, numpy.float32),
+             numpy.frombuffer(results.indices, numpy.int32),
+             numpy.frombuffer(results.indptr, numpy.int64)),
+            shape=results.shape)
+    """
+    def __init__(self, indptr, indices, scores, target_ids=None):
+        self.indptr = indptr
+        self.indices = indices
+        self.scores = scores
+        n = len(indptr) - 1
+        self.shape = (n, n)
+        self.target_ids = target_ids
+
+    def __len__(self):
+        """The number of rows"""
+        return self.shape[0]
+
+    @property
+    def nnz(self):
+        """The total number of hits"""
+        return len(self.indices)
+
+    def _get_range(self, row):
+        if not (0 <= row < self.shape[0]):
+            raise IndexError("row index is out of range")
+        return self.indptr[row], self.indptr[row+1]
+
+    def get_indices(self, row):
+        """The list of column indices for the hits in `row`"""
+        start, end = self._get_range(row)
+        return self.indices[start:end]
+
+    def get_ids(self, row):
+        """The list of target identifiers for the hits in `row`"""
+        ids = self.target_ids
+        return [ids[i] for i in self.get_indices(row)]
+
+    def get_scores(self, row):
+        """The list of scores for the hits in `row`"""
+        start, end = self._get_range(row)
+        return self.scores[start:end]
+
+    def get_indices_and_scores(self, row):
+        """The list of (column index, score) pairs for the hits in `row`"""
+        return zip(self.get_indices(row), self.get_scores(row))
+
+    def iter_indices_and_scores(self):
+        """For each row, yield the list of (column index, score) pairs"""
+        for row in xrange(self.shape[0]):
+            yield self.get_indices_and_scores(row)
 
         
 def _require_matching_fp_size(query_fp, target_arena):
@@ -323,6 +504,17 @@ def _require_matching_fp_size(query_fp, target_arena):
         raise ValueError("query_fp uses %d bytes while target_arena uses %d bytes" % (
             len(query_fp), target_arena.metadata.num_bytes))
 
+def _get_per_query_values(name, values, typecode, num_queries):
+    # A single number is used for every query. Otherwise there must be
+    # one value for each query, which is passed to C as an array.
+    if isinstance(values, (int, long, float)):
+        return None
+    values = array.array(typecode, values)
+    if len(values) != num_queries:
+        raise ValueError("%s has %d values but there are %d queries" % (
+            name, len(values), num_queries))
+    return values
+
 def _require_matching_sizes(query_arena, target_arena):
     assert query_arena.metadata.num_bits is not None, "arenas must define num_bits"
     assert target_arena.metadata.num_bits is not None, "arenas must define num_bits"
@@ -336,7 +528,8 @@ def _require_matching_sizes(query_arena, target_arena):
 
 
 
-def count_tanimoto_hits_fp(query_fp, target_arena, threshold=0.7):
+def count_tanimoto_hits_fp(query_fp, target_arena, threshold=0.7,
+                           max_score=None, interval="[]"):
     """Count the number of hits in `target_arena` at least `threshold` similar to the `query_fp`
 
     Example::
@@ -352,8 +545,16 @@ def count_tanimoto_hits_fp(query_fp, target_arena, threshold=0.7):
     :type target_fp: a FingerprintArena
     :param threshold: The minimum score threshold.
     :type threshold: float between 0.0 and 1.0, inclusive
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
     :returns: an integer count
     """
+    if max_score is not None or interval != "[]":
+        # The Tanimoto kernels only support a minimum score
+        return count_hits_fp(query_fp, target_arena, threshold, "tanimoto", max_score, interval)
+
     _require_matching_fp_size(query_fp, target_arena)
     # Improve the alignment so the faster algorithms can be used
     query_start_padding, query_end_padding, query_fp = _chemfp.align_fingerprint(
@@ -371,7 +572,8 @@ def count_tanimoto_hits_fp(query_fp, target_arena, threshold=0.7):
     return counts[0]
 
 
-def count_tanimoto_hits_arena(query_arena, target_arena, threshold=0.7):
+def count_tanimoto_hits_arena(query_arena, target_arena, threshold=0.7,
+                              max_score=None, interval="[]"):
     """For each fingerprint in `query_arena`, count the number of hits in `target_arena` at least `threshold` similar to it
     
     Example::
@@ -386,16 +588,56 @@ def count_tanimoto_hits_arena(query_arena, target_arena, threshold=0.7):
     count. Currently it's a ctype array of longs, but it could be an
     array.array or Python list in the future.
 
+    The `threshold` may be a sequence with one threshold for each
+    query, so queries with different thresholds can be searched in a
+    single call.
+
     :param query_arena: The query fingerprints.
     :type query_arena: a FingerprintArena
     :param target_arena: The target fingerprints.
-    :param threshold: The minimum score threshold.
-    :type threshold: float between 0.0 and 1.0, inclusive
+    :param threshold: The minimum score threshold, or one threshold for each query.
+    :type threshold: float between 0.0 and 1.0, inclusive, or a sequence of them
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
     :returns: an array of counts
     """
+    thresholds = _get_per_query_values("threshold", threshold, "d", len(query_arena))
+    if max_score is not None or interval != "[]":
+        if thresholds is not None:
+            raise ValueError("per-query thresholds cannot be used with max_score or interval")
+        # The Tanimoto kernels only support a minimum score
+        return count_hits_arena(query_arena, target_arena, threshold, "tanimoto",
+                                max_score, interval)
+
     _require_matching_sizes(query_arena, target_arena)
 
     counts = (ctypes.c_int*len(query_arena))()
+    if thresholds is not None:
+        _chemfp.count_tanimoto_arena_per_query(
+            thresholds, target_arena.num_bits,
+            query_arena.start_padding, query_arena.end_padding,
+            query_arena.storage_size, query_arena.arena, query_arena.start, query_arena.end,
+            target_arena.start_padding, target_arena.end_padding,
+            target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
+            target_arena.popcount_indices,
+            counts)
+        return counts
+
+    prefilter = target_arena.folded_prefilter
+    if prefilter is not None:
+        _chemfp.count_tanimoto_arena_folded(
+            threshold, target_arena.num_bits,
+            query_arena.start_padding, query_arena.end_padding,
+            query_arena.storage_size, query_arena.arena, query_arena.start, query_arena.end,
+            target_arena.start_padding, target_arena.end_padding,
+            target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
+            target_arena.popcount_indices,
+            prefilter.num_bits, prefilter.folded_arena, prefilter.lost_bits, prefilter.stats,
+            counts)
+        return counts
+
     _chemfp.count_tanimoto_arena(threshold, target_arena.num_bits,
                                  query_arena.start_padding, query_arena.end_padding,
                                  query_arena.storage_size,
@@ -407,14 +649,15 @@ def count_tanimoto_hits_arena(query_arena, target_arena, threshold=0.7):
                                  counts)
     return counts    
 
-def count_tanimoto_hits_symmetric(arena, threshold=0.7, batch_size=100):
+def count_tanimoto_hits_symmetric(arena, threshold=0.7, batch_size=100,
+                                  max_score=None, interval="[]"):
     """For each fingerprint in the `arena`, count the number of other fingerprints at least `threshold` similar to it
 
     A fingerprint never matches itself.
 
-    The computation can take a long time. Python won't check check for
-    a ^C until the function finishes. This can be irritating. Instead,
-    process only `batch_size` rows at a time before checking for a ^C.
+    The computation can take a long time. The whole search runs in one
+    parallel call, which checks for a ^C while it runs. The `batch_size`
+    is no longer used, and is only checked for backwards compatibility.
 
     Example::
 
@@ -431,38 +674,33 @@ def count_tanimoto_hits_symmetric(arena, threshold=0.7, batch_size=100):
     :type arena: a FingerprintArena
     :param threshold: The minimum score threshold.
     :type threshold: float between 0.0 and 1.0, inclusive
-    :param batch_size: the number of rows to process before checking for a ^C
-    :type batch_size: integer
+    :param batch_size: not used
+    :type batch_size: positive integer
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
     :returns: an array of counts
     """
+    if max_score is not None or interval != "[]":
+        # The Tanimoto kernels only support a minimum score
+        return count_hits_symmetric(arena, threshold, "tanimoto", batch_size, max_score, interval)
+
     N = len(arena)
     counts = (ctypes.c_int * N)()
 
-    # This spends the entire time in C, which means ^C won't work until it finishes.
-    # While it's theoretically slightly higher performance, I can't measure the
-    # difference, and it's much better to let people be able to interrupt the program.
-    #    _chemfp.count_tanimoto_hits_arena_symmetric(
-    #        threshold, arena.num_bits,
-    #        arena.start_padding, arena.end_padding, arena.storage_size, arena.arena,
-    #        0, N, 0, N,
-    #        arena.popcount_indices,
-    #        counts)
     if batch_size <= 0:
         raise ValueError("batch_size must be positive")
 
-    # Process N rows at a time, which lets Python handle ^C at times.
-    # Since the code processes a triangle, this means that early
-    # on there will be more time between ^C checks than later.
-    # I'm not able to detect the Python overhead, so I'm not going
-    # to make it more "efficient".
-    for query_start in xrange(0, N, batch_size):
-        query_end = min(query_start + batch_size, N)
-        _chemfp.count_tanimoto_hits_arena_symmetric(
-            threshold, arena.num_bits,
-            arena.start_padding, arena.end_padding, arena.storage_size, arena.arena,
-            query_start, query_end, 0, N,
-            arena.popcount_indices,
-            counts)
+    # The C code splits the upper triangle into tiles with about the
+    # same amount of work, so the threads stay busy until the end, and
+    # it checks for a ^C while it runs.
+    _chemfp.count_tanimoto_hits_arena_symmetric(
+        threshold, arena.num_bits,
+        arena.start_padding, arena.end_padding, arena.storage_size, arena.arena,
+        0, N, 0, N,
+        arena.popcount_indices,
+        counts)
 
     return counts
 
@@ -476,7 +714,8 @@ def partial_count_tanimoto_hits_symmetric(counts, arena, threshold=0.7,
     function!
     
     This function is only useful for thread-pool implementations. In
-    that case, set the number of OpenMP threads to 1.
+    that case, set the number of OpenMP threads to 1. For a process
+    pool, see `chemfp.shared_arena`.
 
     `counts` is a contiguous array of integers. It should be
     initialized to zeros, and reused for successive calls.
@@ -552,7 +791,8 @@ def partial_count_tanimoto_hits_symmetric(counts, arena, threshold=0.7,
 
 # These all return indices into the arena!
 
-def threshold_tanimoto_search_fp(query_fp, target_arena, threshold=0.7):
+def threshold_tanimoto_search_fp(query_fp, target_arena, threshold=0.7,
+                                 max_score=None, interval="[]", score_type="double"):
     """Search for fingerprint hits in `target_arena` which are at least `threshold` similar to `query_fp`
 
     The hits in the returned `SearchResult` are in arbitrary order.
@@ -569,8 +809,19 @@ def threshold_tanimoto_search_fp(query_fp, target_arena, threshold=0.7):
     :type target_fp: a FingerprintArena
     :param threshold: The minimum score threshold.
     :type threshold: float between 0.0 and 1.0, inclusive
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
     :returns: a SearchResult
     """
+    if max_score is not None or interval != "[]":
+        # The Tanimoto kernels only support a minimum score
+        return threshold_search_fp(query_fp, target_arena, threshold, "tanimoto",
+                                   max_score, interval, score_type)
+
     _require_matching_fp_size(query_fp, target_arena)
 
     # Improve the alignment so the faster algorithms can be used
@@ -578,7 +829,7 @@ def threshold_tanimoto_search_fp(query_fp, target_arena, threshold=0.7):
         query_fp, target_arena.alignment, target_arena.storage_size)
 
 
-    results = SearchResults(1, target_arena.arena_ids)
+    results = SearchResults(1, target_arena.arena_ids, score_type)
     _chemfp.threshold_tanimoto_arena(
         threshold, target_arena.num_bits,
         query_start_padding, query_end_padding, target_arena.storage_size, query_fp, 0, 1,
@@ -590,11 +841,16 @@ def threshold_tanimoto_search_fp(query_fp, target_arena, threshold=0.7):
     return results[0]
 
 
-def threshold_tanimoto_search_arena(query_arena, target_arena, threshold=0.7):
+def threshold_tanimoto_search_arena(query_arena, target_arena, threshold=0.7,
+                                    max_score=None, interval="[]", score_type="double"):
     """Search for the hits in the `target_arena` at least `threshold` similar to the fingerprints in `query_arena`
 
     The hits in the returned `SearchResults` are in arbitrary order.
 
+    The `threshold` may be a sequence with one threshold for each
+    query, so queries with different thresholds can be searched in a
+    single call.
+
     Example::
     
         queries = chemfp.load_fingerprints("queries.fps")
@@ -608,16 +864,50 @@ def threshold_tanimoto_search_arena(query_arena, target_arena, threshold=0.7):
     :type query_arena: a FingerprintArena
     :param target_arena: The target fingerprints.
     :type target_arena: a FingerprintArena
-    :param threshold: The minimum score threshold.
-    :type threshold: float between 0.0 and 1.0, inclusive
+    :param threshold: The minimum score threshold, or one threshold for each query.
+    :type threshold: float between 0.0 and 1.0, inclusive, or a sequence of them
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
     :returns: a SearchResults instance
     """
+    thresholds = _get_per_query_values("threshold", threshold, "d", len(query_arena))
+    if max_score is not None or interval != "[]":
+        if thresholds is not None:
+            raise ValueError("per-query thresholds cannot be used with max_score or interval")
+        # The Tanimoto kernels only support a minimum score
+        return threshold_search_arena(query_arena, target_arena, threshold, "tanimoto",
+                                      max_score, interval, score_type)
+
     _require_matching_sizes(query_arena, target_arena)
 
     num_queries = len(query_arena)
 
-    results = SearchResults(num_queries, target_arena.arena_ids)
-    if num_queries:
+    results = SearchResults(num_queries, target_arena.arena_ids, score_type)
+    if num_queries and thresholds is not None:
+        _chemfp.threshold_tanimoto_arena_per_query(
+            thresholds, target_arena.num_bits,
+            query_arena.start_padding, query_arena.end_padding,
+            query_arena.storage_size, query_arena.arena, query_arena.start, query_arena.end,
+            target_arena.start_padding, target_arena.end_padding,
+            target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
+            target_arena.popcount_indices,
+            results, 0)
+    elif num_queries and target_arena.folded_prefilter is not None:
+        prefilter = target_arena.folded_prefilter
+        _chemfp.threshold_tanimoto_arena_folded(
+            threshold, target_arena.num_bits,
+            query_arena.start_padding, query_arena.end_padding,
+            query_arena.storage_size, query_arena.arena, query_arena.start, query_arena.end,
+            target_arena.start_padding, target_arena.end_padding,
+            target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
+            target_arena.popcount_indices,
+            prefilter.num_bits, prefilter.folded_arena, prefilter.lost_bits, prefilter.stats,
+            results, 0)
+    elif num_queries:
         _chemfp.threshold_tanimoto_arena(
             threshold, target_arena.num_bits,
             query_arena.start_padding, query_arena.end_padding,
@@ -629,7 +919,80 @@ def threshold_tanimoto_search_arena(query_arena, target_arena, threshold=0.7):
     
     return results
 
-def threshold_tanimoto_search_symmetric(arena, threshold=0.7, include_lower_triangle=True, batch_size=100):
+def iter_threshold_tanimoto_search_arena(query_arena, target_arena, threshold=0.7, chunk_rows=100,
+                                         max_score=None, interval="[]", score_type="double",
+                                         prefetch_chunks=1):
+    """Search `target_arena` with `chunk_rows` queries at a time and yield each chunk's results
+
+    This is the same search as `threshold_tanimoto_search_arena`,
+    except that it doesn't keep all of the hits in memory at once.
+    It yields (start, results) pairs, where `results` is a
+    `SearchResults` for the queries query_arena[start:start+chunk_rows].
+    The last chunk may have fewer rows.
+
+    The next chunk is searched in a background thread while the caller
+    works on the current one. The search releases the GIL, so writing
+    the hits to a file overlaps with the search. The thread stays at
+    most `prefetch_chunks` chunks ahead, so at most prefetch_chunks+2
+    chunks are in memory. Use prefetch_chunks=0 to search each chunk
+    only when it's requested.
+
+    Example::
+
+        queries = chemfp.load_fingerprints("queries.fps")
+        targets = chemfp.load_fingerprints("targets.fps")
+        for start, results in chemfp.search.iter_threshold_tanimoto_search_arena(
+                queries, targets, threshold=0.5, chunk_rows=1000):
+            for query_id, query_hits in zip(queries.ids[start:], results):
+                for target_id, score in query_hits.get_ids_and_scores():
+                    outfile.write("%s\t%s\t%.4f\n" % (query_id, target_id, score))
+
+    :param query_arena: The query fingerprints.
+    :type query_arena: a FingerprintArena
+    :param target_arena: The target fingerprints.
+    :type target_arena: a FingerprintArena
+    :param threshold: The minimum score threshold, or one threshold for each query.
+    :type threshold: float between 0.0 and 1.0, inclusive, or a sequence of them
+    :param chunk_rows: the number of queries in each chunk
+    :type chunk_rows: positive integer
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
+    :param prefetch_chunks: the number of chunks to search ahead of the caller
+    :type prefetch_chunks: non-negative integer
+    :returns: an iterator of (start, SearchResults) pairs
+    """
+    # Check the parameters now instead of on the first next()
+    if chunk_rows < 1:
+        raise ValueError("chunk_rows must be positive")
+    if prefetch_chunks < 0:
+        raise ValueError("prefetch_chunks must not be negative")
+    thresholds = _get_per_query_values("threshold", threshold, "d", len(query_arena))
+    if thresholds is not None and (max_score is not None or interval != "[]"):
+        raise ValueError("per-query thresholds cannot be used with max_score or interval")
+    _require_matching_sizes(query_arena, target_arena)
+
+    chunks = _iter_threshold_chunks(query_arena, target_arena, threshold, thresholds,
+                                    chunk_rows, max_score, interval, score_type)
+    if prefetch_chunks > 0:
+        from .fps_io import _prefetch_blocks
+        chunks = _prefetch_blocks(chunks, prefetch_chunks, "chemfp-search-prefetch")
+    return chunks
+
+def _iter_threshold_chunks(query_arena, target_arena, threshold, thresholds,
+                           chunk_rows, max_score, interval, score_type):
+    for start in xrange(0, len(query_arena), chunk_rows):
+        end = start + chunk_rows
+        if thresholds is not None:
+            threshold = thresholds[start:end]
+        yield start, threshold_tanimoto_search_arena(
+            query_arena[start:end], target_arena, threshold, max_score, interval, score_type)
+
+def threshold_tanimoto_search_symmetric(arena, threshold=0.7, include_lower_triangle=True, batch_size=100,
+                                        max_score=None, interval="[]", score_type="double"):
     """Search for the hits in the `arena` at least `threshold` similar to the fingerprints in the arena
 
     When `include_lower_triangle` is True, compute the upper-triangle
@@ -637,9 +1000,9 @@ def threshold_tanimoto_search_symmetric(arena, threshold=0.7, include_lower_tria
     results. When `include_lower_triangle` is False, only compute the
     upper triangle.
 
-    The computation can take a long time. Python won't check check for
-    a ^C until the function finishes. This can be irritating. Instead,
-    process only `batch_size` rows at a time before checking for a ^C.
+    The computation can take a long time. The whole search runs in one
+    parallel call, which checks for a ^C while it runs. The `batch_size`
+    is no longer used, and is only checked for backwards compatibility.
 
     The hits in the returned `SearchResults` are in arbitrary order.
 
@@ -658,28 +1021,50 @@ def threshold_tanimoto_search_symmetric(arena, threshold=0.7, include_lower_tria
     :param include_lower_triangle:
         if False, compute only the upper triangle, otherwise use symmetry to compute the full matrix
     :type include_lower_triangle: boolean
-    :param batch_size: the number of rows to process before checking for a ^C
-    :type batch_size: integer
+    :param batch_size: not used
+    :type batch_size: positive integer
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
     :returns: a SearchResults instance
     """
     
     if batch_size <= 0:
         raise ValueError("batch_size must be positive")
     N = len(arena)
-    results = SearchResults(N, arena.arena_ids)
 
-    if N:
-        # Break it up into batch_size groups in order to let Python's
-        # interrupt handler check for a ^C, which is otherwise
-        # suppressed until the function finishes.
-        for query_start in xrange(0, N, batch_size):
-            query_end = min(query_start + batch_size, N)
-            _chemfp.threshold_tanimoto_arena_symmetric(
-                threshold, arena.num_bits,
+    if max_score is not None or interval != "[]":
+        # The Tanimoto kernels only support a minimum score
+        if include_lower_triangle:
+            return threshold_search_symmetric(arena, threshold, "tanimoto", batch_size,
+                                              max_score, interval, score_type)
+        # Only search the targets after each query to get the upper triangle
+        metric = Metric("tanimoto")
+        min_score, max_score, interval = _get_score_range(
+            metric, threshold, max_score, interval, arena.num_bits)
+        results = SearchResults(N, arena.arena_ids, score_type)
+        for query_index in xrange(N):
+            _chemfp.threshold_metric_arena_symmetric(
+                metric._metric_type, metric.alpha, metric.beta,
+                min_score, max_score, interval, arena.num_bits,
                 arena.start_padding, arena.end_padding, arena.storage_size, arena.arena,
-                query_start, query_end, 0, N,
+                query_index, query_index+1, query_index+1, N,
                 arena.popcount_indices,
                 results)
+        return results
+    
+    results = SearchResults(N, arena.arena_ids, score_type)
+
+    if N:
+        _chemfp.threshold_tanimoto_arena_symmetric(
+            threshold, arena.num_bits,
+            arena.start_padding, arena.end_padding, arena.storage_size, arena.arena,
+            0, N, 0, N,
+            arena.popcount_indices,
+            results, 0)
 
         if include_lower_triangle:
             _chemfp.fill_lower_triangle(results, N)
@@ -701,7 +1086,8 @@ def partial_threshold_tanimoto_search_symmetric(results, arena, threshold=0.7,
     function!
     
     This function is only useful for thread-pool implementations. In
-    that case, set the number of OpenMP threads to 1.
+    that case, set the number of OpenMP threads to 1. For a process
+    pool, see `chemfp.shared_arena`.
 
     `results` is a SearchResults instance which is at least as large
     as the arena. It should be reused for successive updates.
@@ -778,7 +1164,7 @@ def partial_threshold_tanimoto_search_symmetric(results, arena, threshold=0.7,
             arena.start_padding, arena.end_padding, arena.storage_size, arena.arena,
             query_start, query_end, target_start, target_end,
             arena.popcount_indices,
-            results)
+            results, query_start)
 
 
 def fill_lower_triangle(results):
@@ -790,10 +1176,64 @@ def fill_lower_triangle(results):
     _chemfp.fill_lower_triangle(results, len(results))
 
 
+def threshold_tanimoto_search_symmetric_csr(arena, threshold=0.7, batch_size=100):
+    """Search for the hits in the `arena` at least `threshold` similar to the fingerprints in the arena, as a CSR matrix
+
+    This finds the same hits as `threshold_tanimoto_search_symmetric`
+    with include_lower_triangle=True, but puts them directly into the
+    arrays of a compressed sparse row matrix. This uses two passes.
+    The first counts the hits in each row, to get the array sizes, and
+    the second fills in the upper triangle then copies it to the lower
+    triangle. The scores are stored as 32-bit floats, so each hit
+    takes 8 bytes instead of the 12 used by a SearchResults.
+
+    The computation can take a long time. Each pass runs in one
+    parallel call, which checks for a ^C while it runs. The
+    `batch_size` is no longer used, and is only checked for backwards
+    compatibility.
+
+    Example::
+
+        arena = chemfp.load_fingerprints("queries.fps")
+        matrix = chemfp.search.threshold_tanimoto_search_symmetric_csr(arena, threshold=0.2)
+        print matrix.nnz, "hits"
+        print matrix.get_indices_and_scores(0)
+
+    :param arena: the set of fingerprints
+    :type arena: a FingerprintArena
+    :param threshold: The minimum score threshold.
+    :type threshold: float between 0.0 and 1.0, inclusive
+    :param batch_size: not used
+    :type batch_size: positive integer
+    :returns: a CSRSearchResults instance
+    """
+    N = len(arena)
+    counts = count_tanimoto_hits_symmetric(arena, threshold, batch_size)
+
+    indptr = (ctypes.c_longlong * (N+1))()
+    num_hits = _chemfp.make_csr_indptr(counts, indptr)
+    indices = (ctypes.c_int * num_hits)()
+    scores = (ctypes.c_float * num_hits)()
+
+    # The counts aren't needed after making indptr, so reuse the
+    # array for the number of upper-triangle hits in each row.
+    upper_counts = counts
+    _chemfp.threshold_tanimoto_arena_symmetric_csr(
+        threshold, arena.num_bits,
+        arena.start_padding, arena.end_padding, arena.storage_size, arena.arena,
+        N, 0, N,
+        arena.popcount_indices,
+        indptr, upper_counts, indices, scores)
+
+    _chemfp.fill_csr_lower_triangle(N, indptr, upper_counts, indices, scores)
+    return CSRSearchResults(indptr, indices, scores, arena.arena_ids)
+
+
 
 # These all return indices into the arena!
 
-def knearest_tanimoto_search_fp(query_fp, target_arena, k=3, threshold=0.7):
+def knearest_tanimoto_search_fp(query_fp, target_arena, k=3, threshold=0.7,
+                                max_score=None, interval="[]", score_type="double"):
     """Search for `k`-nearest hits in `target_arena` which are at least `threshold` similar to `query_fp`
 
     The hits in the `SearchResults` are ordered by decreasing similarity score.
@@ -812,8 +1252,19 @@ def knearest_tanimoto_search_fp(query_fp, target_arena, k=3, threshold=0.7):
     :type k: positive integer
     :param threshold: The minimum score threshold.
     :type threshold: float between 0.0 and 1.0, inclusive
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
     :returns: a SearchResult
     """
+    if max_score is not None or interval != "[]":
+        # The Tanimoto kernels only support a minimum score
+        return knearest_search_fp(query_fp, target_arena, k, threshold, "tanimoto",
+                                  max_score, interval, score_type)
+
     _require_matching_fp_size(query_fp, target_arena)
     query_start_padding, query_end_padding, query_fp = _chemfp.align_fingerprint(
         query_fp, target_arena.alignment, target_arena.storage_size)
@@ -821,7 +1272,7 @@ def knearest_tanimoto_search_fp(query_fp, target_arena, k=3, threshold=0.7):
     if k < 0:
         raise ValueError("k must be non-negative")
 
-    results = SearchResults(1, target_arena.arena_ids)
+    results = SearchResults(1, target_arena.arena_ids, score_type)
     _chemfp.knearest_tanimoto_arena(
         k, threshold, target_arena.num_bits,
         query_start_padding, query_end_padding, target_arena.storage_size, query_fp, 0, 1,
@@ -833,11 +1284,16 @@ def knearest_tanimoto_search_fp(query_fp, target_arena, k=3, threshold=0.7):
 
     return results[0]
 
-def knearest_tanimoto_search_arena(query_arena, target_arena, k=3, threshold=0.7):
+def knearest_tanimoto_search_arena(query_arena, target_arena, k=3, threshold=0.7,
+                                   max_score=None, interval="[]", score_type="double"):
     """Search for the `k` nearest hits in the `target_arena` at least `threshold` similar to the fingerprints in `query_arena`
 
     The hits in the `SearchResults` are ordered by decreasing similarity score.
 
+    The `k` and `threshold` may each be a sequence with one value for
+    each query, so queries with different parameters can be searched
+    in a single call.
+
     Example::
     
         queries = chemfp.load_fingerprints("queries.fps")
@@ -851,38 +1307,78 @@ def knearest_tanimoto_search_arena(query_arena, target_arena, k=3, threshold=0.7
     :type query_arena: a FingerprintArena
     :param target_arena: The target fingerprints.
     :type target_arena: a FingerprintArena
-    :param k: the number of nearest neighbors to find.
-    :type k: positive integer
-    :param threshold: The minimum score threshold.
-    :type threshold: float between 0.0 and 1.0, inclusive
+    :param k: the number of nearest neighbors to find, or one k for each query.
+    :type k: positive integer, or a sequence of them
+    :param threshold: The minimum score threshold, or one threshold for each query.
+    :type threshold: float between 0.0 and 1.0, inclusive, or a sequence of them
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
     :returns: a SearchResults instance
     """
-    _require_matching_sizes(query_arena, target_arena)
-
     num_queries = len(query_arena)
+    ks = _get_per_query_values("k", k, "i", num_queries)
+    thresholds = _get_per_query_values("threshold", threshold, "d", num_queries)
+    if max_score is not None or interval != "[]":
+        if ks is not None or thresholds is not None:
+            raise ValueError("per-query k and thresholds cannot be used with max_score or interval")
+        # The Tanimoto kernels only support a minimum score
+        return knearest_search_arena(query_arena, target_arena, k, threshold, "tanimoto",
+                                     max_score, interval, score_type)
 
-    results = SearchResults(num_queries, target_arena.arena_ids)
+    _require_matching_sizes(query_arena, target_arena)
 
-    _chemfp.knearest_tanimoto_arena(
-        k, threshold, target_arena.num_bits,
-        query_arena.start_padding, query_arena.end_padding,
-        query_arena.storage_size, query_arena.arena, query_arena.start, query_arena.end,
-        target_arena.start_padding, target_arena.end_padding,
-        target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
-        target_arena.popcount_indices,
-        results, 0)
+    results = SearchResults(num_queries, target_arena.arena_ids, score_type)
+
+    if ks is None and thresholds is None and target_arena.folded_prefilter is not None:
+        prefilter = target_arena.folded_prefilter
+        _chemfp.knearest_tanimoto_arena_folded(
+            k, threshold, target_arena.num_bits,
+            query_arena.start_padding, query_arena.end_padding,
+            query_arena.storage_size, query_arena.arena, query_arena.start, query_arena.end,
+            target_arena.start_padding, target_arena.end_padding,
+            target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
+            target_arena.popcount_indices,
+            prefilter.num_bits, prefilter.folded_arena, prefilter.lost_bits, prefilter.stats,
+            results, 0)
+    elif ks is None and thresholds is None:
+        _chemfp.knearest_tanimoto_arena(
+            k, threshold, target_arena.num_bits,
+            query_arena.start_padding, query_arena.end_padding,
+            query_arena.storage_size, query_arena.arena, query_arena.start, query_arena.end,
+            target_arena.start_padding, target_arena.end_padding,
+            target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
+            target_arena.popcount_indices,
+            results, 0)
+    else:
+        if ks is None:
+            ks = array.array("i", [k]) * num_queries
+        if thresholds is None:
+            thresholds = array.array("d", [threshold]) * num_queries
+        _chemfp.knearest_tanimoto_arena_per_query(
+            ks, thresholds, target_arena.num_bits,
+            query_arena.start_padding, query_arena.end_padding,
+            query_arena.storage_size, query_arena.arena, query_arena.start, query_arena.end,
+            target_arena.start_padding, target_arena.end_padding,
+            target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
+            target_arena.popcount_indices,
+            results, 0)
     
     _chemfp.knearest_results_finalize(results, 0, num_queries)
     
     return results
 
 
-def knearest_tanimoto_search_symmetric(arena, k=3, threshold=0.7, batch_size=100):
+def knearest_tanimoto_search_symmetric(arena, k=3, threshold=0.7, batch_size=100,
+                                       max_score=None, interval="[]", score_type="double"):
     """Search for the `k`-nearest hits in the `arena` at least `threshold` similar to the fingerprints in the arena
 
-    The computation can take a long time. Python won't check check for
-    a ^C until the function finishes. This can be irritating. Instead,
-    process only `batch_size` rows at a time before checking for a ^C.
+    The computation can take a long time. The whole search runs in one
+    parallel call, which checks for a ^C while it runs. The `batch_size`
+    is no longer used, and is only checked for backwards compatibility.
 
     The hits in the `SearchResults` are ordered by decreasing similarity score.
 
@@ -902,28 +1398,1011 @@ def knearest_tanimoto_search_symmetric(arena, k=3, threshold=0.7, batch_size=100
     :param include_lower_triangle:
         if False, compute only the upper triangle, otherwise use symmetry to compute the full matrix
     :type include_lower_triangle: boolean
-    :param batch_size: the number of rows to process before checking for a ^C
-    :type batch_size: integer
+    :param batch_size: not used
+    :type batch_size: positive integer
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
     :returns: a SearchResults instance
     """
+    if max_score is not None or interval != "[]":
+        # The Tanimoto kernels only support a minimum score
+        return knearest_search_symmetric(arena, k, threshold, "tanimoto", batch_size,
+                                         max_score, interval, score_type)
+
     N = len(arena)
     if batch_size <= 0:
         raise ValueError("batch_size must be positive")
 
-    results = SearchResults(N, arena.arena_ids)
+    results = SearchResults(N, arena.arena_ids, score_type)
 
     if N:
-        # Break it up into batch_size groups in order to let Python's
-        # interrupt handler check for a ^C, which is otherwise
-        # suppressed until the function finishes.
-        for query_start in xrange(0, N, batch_size):
-            query_end = min(query_start + batch_size, N)            
-            _chemfp.knearest_tanimoto_arena_symmetric(
-                k, threshold, arena.num_bits,
-                arena.start_padding, arena.end_padding, arena.storage_size, arena.arena,
-                query_start, query_end, 0, N,
-                arena.popcount_indices,
-                results)
+        _chemfp.knearest_tanimoto_arena_symmetric(
+            k, threshold, arena.num_bits,
+            arena.start_padding, arena.end_padding, arena.storage_size, arena.arena,
+            0, N, 0, N,
+            arena.popcount_indices,
+            results)
         _chemfp.knearest_results_finalize(results, 0, N)
     
     return results
+
+
+#### Metric searches
+
+# The metric searches work like the Tanimoto searches, but take a
+# `metric` which says how to compare two fingerprints. For a
+# similarity metric, a hit has a score of at least `threshold`, and
+# the k-nearest hits have the highest scores. For a distance metric,
+# a hit has a distance of at most `threshold`, and the k-nearest hits
+# have the smallest distances.
+
+_metric_names = [_chemfp.get_metric_name(i) for i in range(_chemfp.get_num_metrics())]
+
+def get_metric_names():
+    """Return the list of metric names which can be used in the metric searches"""
+    return _metric_names[:]
+
+class Metric(object):
+    """A similarity or distance measure for the metric searches
+
+    In the following, a is the number of bits set in the query, b is
+    the number of bits set in the target, and c is the number of bits
+    they have in common. The metrics are:
+
+      tanimoto: c / (a + b - c)
+      tversky: c / (alpha*(a-c) + beta*(b-c) + c)
+      dice: 2*c / (a + b)
+      cosine: c / sqrt(a*b)
+      hamming: a + b - 2*c (a distance)
+      euclidean: sqrt(a + b - 2*c) (a distance)
+
+    Only the "tversky" metric uses `alpha` and `beta`.
+
+    Use `is_distance` to tell if smaller values are better.
+    """
+    def __init__(self, name, alpha=1.0, beta=1.0):
+        try:
+            self._metric_type = _metric_names.index(name)
+        except ValueError:
+            raise ValueError("Unknown metric %r" % (name,))
+        if alpha < 0.0 or beta < 0.0:
+            raise ValueError("alpha and beta must not be negative")
+        self.name = name
+        self.alpha = alpha
+        self.beta = beta
+        self.is_distance = _chemfp.metric_is_distance(self._metric_type)
+
+    def __repr__(self):
+        if self.name == "tversky":
+            return "Metric(%r, alpha=%r, beta=%r)" % (self.name, self.alpha, self.beta)
+        return "Metric(%r)" % (self.name,)
+
+def _get_metric(metric):
+    if isinstance(metric, Metric):
+        return metric
+    return Metric(metric)
+
+def _get_score_range(metric, threshold, max_score, interval, num_bits):
+    # Returns the (min_score, max_score, interval) used by the C code.
+    # The default threshold is 0.7 for a similarity, and no limit for
+    # a distance. For a distance the threshold is the maximum distance.
+    if metric.is_distance:
+        if max_score is not None or interval != "[]":
+            raise ValueError("max_score and interval are only supported for similarity metrics")
+        if threshold is None:
+            threshold = float(num_bits)
+        return 0.0, threshold, "[]"
+    if threshold is None:
+        threshold = 0.7
+    if max_score is None:
+        max_score = float("inf")
+    return threshold, max_score, interval
+
+
+def _check_score_type(metric, score_type):
+    # A uint16 score can only store values between 0.0 and 1.0
+    if score_type == "uint16" and metric.is_distance:
+        raise ValueError("uint16 scores are only supported for similarity metrics")
+
+
+def count_hits_fp(query_fp, target_arena, threshold=None, metric="tanimoto",
+                  max_score=None, interval="[]"):
+    """Count the number of hits in `target_arena` which are within `threshold` of the `query_fp`
+
+    Example::
+    
+        query_id, query_fp = chemfp.load_fingerprints("queries.fps")[0]
+        targets = chemfp.load_fingerprints("targets.fps")
+        print chemfp.search.count_hits_fp(query_fp, targets, threshold=4, metric="hamming")
+
+    :param query_fp: the query fingerprint
+    :type query_fp: a byte string
+    :param target_arena: the target arena
+    :type target_fp: a FingerprintArena
+    :param threshold: The minimum score or the maximum distance (default: 0.7 or no limit)
+    :type threshold: float
+    :param metric: the metric to use (default: "tanimoto")
+    :type metric: a metric name or a `Metric`
+    :param max_score: the maximum score, for a similarity metric (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :returns: an integer count
+    """
+    metric = _get_metric(metric)
+    min_score, max_score, interval = _get_score_range(
+        metric, threshold, max_score, interval, target_arena.num_bits)
+    _require_matching_fp_size(query_fp, target_arena)
+    query_start_padding, query_end_padding, query_fp = _chemfp.align_fingerprint(
+        query_fp, target_arena.alignment, target_arena.storage_size)
+
+    counts = array.array("i", [0])
+    _chemfp.count_metric_arena(metric._metric_type, metric.alpha, metric.beta,
+                               min_score, max_score, interval,
+                               target_arena.num_bits,
+                               query_start_padding, query_end_padding,
+                               target_arena.storage_size, query_fp, 0, 1,
+                               target_arena.start_padding, target_arena.end_padding,
+                               target_arena.storage_size, target_arena.arena,
+                               target_arena.start, target_arena.end,
+                               target_arena.popcount_indices,
+                               counts)
+    return counts[0]
+
+
+def count_hits_arena(query_arena, target_arena, threshold=None, metric="tanimoto",
+                     max_score=None, interval="[]"):
+    """For each fingerprint in `query_arena`, count the number of hits in `target_arena` within `threshold` of it
+
+    Example::
+    
+        queries = chemfp.load_fingerprints("queries.fps")
+        targets = chemfp.load_fingerprints("targets.fps")
+        counts = chemfp.search.count_hits_arena(queries, targets, threshold=0.5, metric="dice")
+        print counts[:10]
+
+    :param query_arena: The query fingerprints.
+    :type query_arena: a FingerprintArena
+    :param target_arena: The target fingerprints.
+    :type target_arena: a FingerprintArena
+    :param threshold: The minimum score or the maximum distance (default: 0.7 or no limit)
+    :type threshold: float
+    :param metric: the metric to use (default: "tanimoto")
+    :type metric: a metric name or a `Metric`
+    :param max_score: the maximum score, for a similarity metric (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :returns: an array of counts
+    """
+    metric = _get_metric(metric)
+    min_score, max_score, interval = _get_score_range(
+        metric, threshold, max_score, interval, target_arena.num_bits)
+    _require_matching_sizes(query_arena, target_arena)
+
+    counts = (ctypes.c_int*len(query_arena))()
+    _chemfp.count_metric_arena(metric._metric_type, metric.alpha, metric.beta,
+                               min_score, max_score, interval,
+                               target_arena.num_bits,
+                               query_arena.start_padding, query_arena.end_padding,
+                               query_arena.storage_size,
+                               query_arena.arena, query_arena.start, query_arena.end,
+                               target_arena.start_padding, target_arena.end_padding,
+                               target_arena.storage_size,
+                               target_arena.arena, target_arena.start, target_arena.end,
+                               target_arena.popcount_indices,
+                               counts)
+    return counts
+
+
+def count_hits_symmetric(arena, threshold=None, metric="tanimoto", batch_size=100,
+                         max_score=None, interval="[]"):
+    """For each fingerprint in the `arena`, count the number of other fingerprints within `threshold` of it
+
+    A fingerprint never matches itself. Row i uses fingerprint i as
+    the query, which matters for an asymmetric metric like Tversky.
+
+    The computation can take a long time. Python won't check check for
+    a ^C until the function finishes. This can be irritating. Instead,
+    process only `batch_size` rows at a time before checking for a ^C.
+
+    :param arena: the set of fingerprints
+    :type arena: a FingerprintArena
+    :param threshold: The minimum score or the maximum distance (default: 0.7 or no limit)
+    :type threshold: float
+    :param metric: the metric to use (default: "tanimoto")
+    :type metric: a metric name or a `Metric`
+    :param batch_size: the number of rows to process before checking for a ^C
+    :type batch_size: integer
+    :param max_score: the maximum score, for a similarity metric (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :returns: an array of counts
+    """
+    metric = _get_metric(metric)
+    min_score, max_score, interval = _get_score_range(
+        metric, threshold, max_score, interval, arena.num_bits)
+    if batch_size <= 0:
+        raise ValueError("batch_size must be positive")
+    N = len(arena)
+    counts = (ctypes.c_int * N)()
+
+    for query_start in xrange(0, N, batch_size):
+        query_end = min(query_start + batch_size, N)
+        _chemfp.count_metric_arena_symmetric(
+            metric._metric_type, metric.alpha, metric.beta,
+            min_score, max_score, interval, arena.num_bits,
+            arena.start_padding, arena.end_padding, arena.storage_size, arena.arena,
+            query_start, query_end, 0, N,
+            arena.popcount_indices,
+            counts)
+
+    return counts
+
+
+def threshold_search_fp(query_fp, target_arena, threshold=None, metric="tanimoto",
+                        max_score=None, interval="[]", score_type="double"):
+    """Search for fingerprint hits in `target_arena` which are within `threshold` of `query_fp`
+
+    The hits in the returned `SearchResult` are in arbitrary order. The
+    score of a hit is its similarity or distance.
+
+    :param query_fp: the query fingerprint
+    :type query_fp: a byte string
+    :param target_arena: the target arena
+    :type target_fp: a FingerprintArena
+    :param threshold: The minimum score or the maximum distance (default: 0.7 or no limit)
+    :type threshold: float
+    :param metric: the metric to use (default: "tanimoto")
+    :type metric: a metric name or a `Metric`
+    :param max_score: the maximum score, for a similarity metric (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
+    :returns: a SearchResult
+    """
+    metric = _get_metric(metric)
+    _check_score_type(metric, score_type)
+    min_score, max_score, interval = _get_score_range(
+        metric, threshold, max_score, interval, target_arena.num_bits)
+    _require_matching_fp_size(query_fp, target_arena)
+    query_start_padding, query_end_padding, query_fp = _chemfp.align_fingerprint(
+        query_fp, target_arena.alignment, target_arena.storage_size)
+
+    results = SearchResults(1, target_arena.arena_ids, score_type)
+    _chemfp.threshold_metric_arena(
+        metric._metric_type, metric.alpha, metric.beta,
+        min_score, max_score, interval, target_arena.num_bits,
+        query_start_padding, query_end_padding, target_arena.storage_size, query_fp, 0, 1,
+        target_arena.start_padding, target_arena.end_padding,
+        target_arena.storage_size, target_arena.arena,
+        target_arena.start, target_arena.end,
+        target_arena.popcount_indices,
+        results, 0)
+    return results[0]
+
+
+def threshold_search_arena(query_arena, target_arena, threshold=None, metric="tanimoto",
+                           max_score=None, interval="[]", score_type="double"):
+    """Search for the hits in the `target_arena` within `threshold` of the fingerprints in `query_arena`
+
+    The hits in the returned `SearchResults` are in arbitrary order.
+    The score of a hit is its similarity or distance.
+
+    Example::
+    
+        queries = chemfp.load_fingerprints("queries.fps")
+        targets = chemfp.load_fingerprints("targets.fps")
+        results = chemfp.search.threshold_search_arena(queries, targets, threshold=2,
+                                                       metric="hamming")
+        for query_id, query_hits in zip(queries.ids, results):
+            if len(query_hits) > 0:
+                print query_id, "->", ", ".join(query_hits.get_ids())
+
+    :param query_arena: The query fingerprints.
+    :type query_arena: a FingerprintArena
+    :param target_arena: The target fingerprints.
+    :type target_arena: a FingerprintArena
+    :param threshold: The minimum score or the maximum distance (default: 0.7 or no limit)
+    :type threshold: float
+    :param metric: the metric to use (default: "tanimoto")
+    :type metric: a metric name or a `Metric`
+    :param max_score: the maximum score, for a similarity metric (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
+    :returns: a SearchResults instance
+    """
+    metric = _get_metric(metric)
+    _check_score_type(metric, score_type)
+    min_score, max_score, interval = _get_score_range(
+        metric, threshold, max_score, interval, target_arena.num_bits)
+    _require_matching_sizes(query_arena, target_arena)
+
+    num_queries = len(query_arena)
+
+    results = SearchResults(num_queries, target_arena.arena_ids, score_type)
+    if num_queries:
+        _chemfp.threshold_metric_arena(
+            metric._metric_type, metric.alpha, metric.beta,
+            min_score, max_score, interval, target_arena.num_bits,
+            query_arena.start_padding, query_arena.end_padding,
+            query_arena.storage_size, query_arena.arena, query_arena.start, query_arena.end,
+            target_arena.start_padding, target_arena.end_padding,
+            target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
+            target_arena.popcount_indices,
+            results, 0)
+    
+    return results
+
+
+def threshold_search_symmetric(arena, threshold=None, metric="tanimoto", batch_size=100,
+                               max_score=None, interval="[]", score_type="double"):
+    """Search for the hits in the `arena` within `threshold` of the fingerprints in the arena
+
+    A fingerprint never matches itself. Row i contains the hits when
+    fingerprint i is the query. Not every metric is symmetric, so this
+    computes the full matrix directly.
+
+    The computation can take a long time. Python won't check check for
+    a ^C until the function finishes. This can be irritating. Instead,
+    process only `batch_size` rows at a time before checking for a ^C.
+
+    The hits in the returned `SearchResults` are in arbitrary order.
+
+    :param arena: the set of fingerprints
+    :type arena: a FingerprintArena
+    :param threshold: The minimum score or the maximum distance (default: 0.7 or no limit)
+    :type threshold: float
+    :param metric: the metric to use (default: "tanimoto")
+    :type metric: a metric name or a `Metric`
+    :param batch_size: the number of rows to process before checking for a ^C
+    :type batch_size: integer
+    :param max_score: the maximum score, for a similarity metric (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
+    :returns: a SearchResults instance
+    """
+    metric = _get_metric(metric)
+    _check_score_type(metric, score_type)
+    min_score, max_score, interval = _get_score_range(
+        metric, threshold, max_score, interval, arena.num_bits)
+    if batch_size <= 0:
+        raise ValueError("batch_size must be positive")
+    N = len(arena)
+    results = SearchResults(N, arena.arena_ids, score_type)
+
+    for query_start in xrange(0, N, batch_size):
+        query_end = min(query_start + batch_size, N)
+        _chemfp.threshold_metric_arena_symmetric(
+            metric._metric_type, metric.alpha, metric.beta,
+            min_score, max_score, interval, arena.num_bits,
+            arena.start_padding, arena.end_padding, arena.storage_size, arena.arena,
+            query_start, query_end, 0, N,
+            arena.popcount_indices,
+            results)
+
+    return results
+
+
+def knearest_search_fp(query_fp, target_arena, k=3, threshold=None, metric="tanimoto",
+                       max_score=None, interval="[]", score_type="double"):
+    """Search for the `k`-nearest hits in `target_arena` which are within `threshold` of `query_fp`
+
+    The hits in the `SearchResult` are ordered from best to worst,
+    which is by decreasing score for a similarity and by increasing
+    distance for a distance.
+
+    :param query_fp: the query fingerprint
+    :type query_fp: a byte string
+    :param target_arena: the target arena
+    :type target_fp: a FingerprintArena
+    :param k: the number of nearest neighbors to find.
+    :type k: positive integer
+    :param threshold: The minimum score or the maximum distance (default: 0.7 or no limit)
+    :type threshold: float
+    :param metric: the metric to use (default: "tanimoto")
+    :type metric: a metric name or a `Metric`
+    :param max_score: the maximum score, for a similarity metric (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
+    :returns: a SearchResult
+    """
+    metric = _get_metric(metric)
+    _check_score_type(metric, score_type)
+    min_score, max_score, interval = _get_score_range(
+        metric, threshold, max_score, interval, target_arena.num_bits)
+    _require_matching_fp_size(query_fp, target_arena)
+    query_start_padding, query_end_padding, query_fp = _chemfp.align_fingerprint(
+        query_fp, target_arena.alignment, target_arena.storage_size)
+    
+    if k < 0:
+        raise ValueError("k must be non-negative")
+
+    results = SearchResults(1, target_arena.arena_ids, score_type)
+    _chemfp.knearest_metric_arena(
+        k, metric._metric_type, metric.alpha, metric.beta,
+        min_score, max_score, interval, target_arena.num_bits,
+        query_start_padding, query_end_padding, target_arena.storage_size, query_fp, 0, 1,
+        target_arena.start_padding, target_arena.end_padding,
+        target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
+        target_arena.popcount_indices,
+        results, 0)
+
+    return results[0]
+
+
+def knearest_search_arena(query_arena, target_arena, k=3, threshold=None, metric="tanimoto",
+                          max_score=None, interval="[]", score_type="double"):
+    """Search for the `k` nearest hits in the `target_arena` within `threshold` of the fingerprints in `query_arena`
+
+    The hits in the `SearchResults` are ordered from best to worst,
+    which is by decreasing score for a similarity and by increasing
+    distance for a distance.
+
+    Example::
+    
+        queries = chemfp.load_fingerprints("queries.fps")
+        targets = chemfp.load_fingerprints("targets.fps")
+        results = chemfp.search.knearest_search_arena(queries, targets, k=3, metric="cosine")
+        for query_id, query_hits in zip(queries.ids, results):
+            print query_id, "->", ", ".join(query_hits.get_ids())
+
+    :param query_arena: The query fingerprints.
+    :type query_arena: a FingerprintArena
+    :param target_arena: The target fingerprints.
+    :type target_arena: a FingerprintArena
+    :param k: the number of nearest neighbors to find.
+    :type k: positive integer
+    :param threshold: The minimum score or the maximum distance (default: 0.7 or no limit)
+    :type threshold: float
+    :param metric: the metric to use (default: "tanimoto")
+    :type metric: a metric name or a `Metric`
+    :param max_score: the maximum score, for a similarity metric (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
+    :returns: a SearchResults instance
+    """
+    metric = _get_metric(metric)
+    _check_score_type(metric, score_type)
+    min_score, max_score, interval = _get_score_range(
+        metric, threshold, max_score, interval, target_arena.num_bits)
+    _require_matching_sizes(query_arena, target_arena)
+
+    num_queries = len(query_arena)
+
+    results = SearchResults(num_queries, target_arena.arena_ids, score_type)
+
+    _chemfp.knearest_metric_arena(
+        k, metric._metric_type, metric.alpha, metric.beta,
+        min_score, max_score, interval, target_arena.num_bits,
+        query_arena.start_padding, query_arena.end_padding,
+        query_arena.storage_size, query_arena.arena, query_arena.start, query_arena.end,
+        target_arena.start_padding, target_arena.end_padding,
+        target_arena.storage_size, target_arena.arena, target_arena.start, target_arena.end,
+        target_arena.popcount_indices,
+        results, 0)
+    
+    return results
+
+
+def knearest_search_symmetric(arena, k=3, threshold=None, metric="tanimoto", batch_size=100,
+                              max_score=None, interval="[]", score_type="double"):
+    """Search for the `k`-nearest hits in the `arena` within `threshold` of the fingerprints in the arena
+
+    A fingerprint never matches itself. Row i contains the hits when
+    fingerprint i is the query.
+
+    The computation can take a long time. Python won't check check for
+    a ^C until the function finishes. This can be irritating. Instead,
+    process only `batch_size` rows at a time before checking for a ^C.
+
+    The hits in the `SearchResults` are ordered from best to worst.
+
+    :param arena: the set of fingerprints
+    :type arena: a FingerprintArena
+    :param k: the number of nearest neighbors to find.
+    :type k: positive integer
+    :param threshold: The minimum score or the maximum distance (default: 0.7 or no limit)
+    :type threshold: float
+    :param metric: the metric to use (default: "tanimoto")
+    :type metric: a metric name or a `Metric`
+    :param batch_size: the number of rows to process before checking for a ^C
+    :type batch_size: integer
+    :param max_score: the maximum score, for a similarity metric (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
+    :returns: a SearchResults instance
+    """
+    metric = _get_metric(metric)
+    _check_score_type(metric, score_type)
+    min_score, max_score, interval = _get_score_range(
+        metric, threshold, max_score, interval, arena.num_bits)
+    if batch_size <= 0:
+        raise ValueError("batch_size must be positive")
+    N = len(arena)
+    results = SearchResults(N, arena.arena_ids, score_type)
+
+    for query_start in xrange(0, N, batch_size):
+        query_end = min(query_start + batch_size, N)
+        _chemfp.knearest_metric_arena_symmetric(
+            k, metric._metric_type, metric.alpha, metric.beta,
+            min_score, max_score, interval, arena.num_bits,
+            arena.start_padding, arena.end_padding, arena.storage_size, arena.arena,
+            query_start, query_end, 0, N,
+            arena.popcount_indices,
+            results)
+    
+    return results
+
+
+#### Tversky searches
+
+# The Tversky similarity between a query fingerprint A and a target
+# fingerprint B is
+#
+#     |A&B| / (alpha*|A-B| + beta*|B-A| + |A&B|)
+#
+# With alpha = beta = 1.0 this is the Tanimoto similarity, and with
+# alpha = beta = 0.5 it is the Dice similarity. Setting alpha=1.0 and
+# beta=0.0 (or very small) asks how much of the query is contained in
+# the target, which is useful for substructure-like and
+# scaffold-hopping queries. Unlike Tanimoto, the score is asymmetric
+# when alpha != beta, so the symmetric searches compute the full
+# matrix rather than the upper triangle. These are the metric searches
+# with a Tversky `Metric`.
+
+def count_tversky_hits_fp(query_fp, target_arena, threshold=0.7, alpha=1.0, beta=1.0,
+                          max_score=None, interval="[]"):
+    """Count the number of hits in `target_arena` at least `threshold` Tversky similar to the `query_fp`
+
+    Example::
+    
+        query_id, query_fp = chemfp.load_fingerprints("queries.fps")[0]
+        targets = chemfp.load_fingerprints("targets.fps")
+        print chemfp.search.count_tversky_hits_fp(query_fp, targets, threshold=0.1,
+                                                  alpha=0.9, beta=0.1)
+
+    :param query_fp: the query fingerprint
+    :type query_fp: a byte string
+    :param target_arena: the target arena
+    :type target_fp: a FingerprintArena
+    :param threshold: The minimum score threshold.
+    :type threshold: float between 0.0 and 1.0, inclusive
+    :param alpha: the weight of the query-only bits
+    :type alpha: non-negative float
+    :param beta: the weight of the target-only bits
+    :type beta: non-negative float
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :returns: an integer count
+    """
+    return count_hits_fp(query_fp, target_arena, threshold, Metric("tversky", alpha, beta),
+                         max_score, interval)
+
+
+def count_tversky_hits_arena(query_arena, target_arena, threshold=0.7, alpha=1.0, beta=1.0,
+                             max_score=None, interval="[]"):
+    """For each fingerprint in `query_arena`, count the number of hits in `target_arena` at least `threshold` Tversky similar to it
+
+    Example::
+    
+        queries = chemfp.load_fingerprints("queries.fps")
+        targets = chemfp.load_fingerprints("targets.fps")
+        counts = chemfp.search.count_tversky_hits_arena(queries, targets, threshold=0.1,
+                                                        alpha=0.9, beta=0.1)
+        print counts[:10]
+
+    :param query_arena: The query fingerprints.
+    :type query_arena: a FingerprintArena
+    :param target_arena: The target fingerprints.
+    :type target_arena: a FingerprintArena
+    :param threshold: The minimum score threshold.
+    :type threshold: float between 0.0 and 1.0, inclusive
+    :param alpha: the weight of the query-only bits
+    :type alpha: non-negative float
+    :param beta: the weight of the target-only bits
+    :type beta: non-negative float
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :returns: an array of counts
+    """
+    return count_hits_arena(query_arena, target_arena, threshold,
+                            Metric("tversky", alpha, beta), max_score, interval)
+
+
+def count_tversky_hits_symmetric(arena, threshold=0.7, alpha=1.0, beta=1.0, batch_size=100,
+                                 max_score=None, interval="[]"):
+    """For each fingerprint in the `arena`, count the number of other fingerprints at least `threshold` Tversky similar to it
+
+    A fingerprint never matches itself. Each fingerprint in turn is
+    used as the query, so when `alpha` != `beta` the count for row i
+    uses fingerprint i as the query and every other fingerprint as a
+    target.
+
+    The computation can take a long time. Python won't check check for
+    a ^C until the function finishes. This can be irritating. Instead,
+    process only `batch_size` rows at a time before checking for a ^C.
+
+    :param arena: the set of fingerprints
+    :type arena: a FingerprintArena
+    :param threshold: The minimum score threshold.
+    :type threshold: float between 0.0 and 1.0, inclusive
+    :param alpha: the weight of the query-only bits
+    :type alpha: non-negative float
+    :param beta: the weight of the target-only bits
+    :type beta: non-negative float
+    :param batch_size: the number of rows to process before checking for a ^C
+    :type batch_size: integer
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :returns: an array of counts
+    """
+    return count_hits_symmetric(arena, threshold, Metric("tversky", alpha, beta), batch_size,
+                                max_score, interval)
+
+
+def threshold_tversky_search_fp(query_fp, target_arena, threshold=0.7, alpha=1.0, beta=1.0,
+                                max_score=None, interval="[]", score_type="double"):
+    """Search for fingerprint hits in `target_arena` which are at least `threshold` Tversky similar to `query_fp`
+
+    The hits in the returned `SearchResult` are in arbitrary order.
+
+    :param query_fp: the query fingerprint
+    :type query_fp: a byte string
+    :param target_arena: the target arena
+    :type target_fp: a FingerprintArena
+    :param threshold: The minimum score threshold.
+    :type threshold: float between 0.0 and 1.0, inclusive
+    :param alpha: the weight of the query-only bits
+    :type alpha: non-negative float
+    :param beta: the weight of the target-only bits
+    :type beta: non-negative float
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
+    :returns: a SearchResult
+    """
+    return threshold_search_fp(query_fp, target_arena, threshold,
+                               Metric("tversky", alpha, beta), max_score, interval, score_type)
+
+
+def threshold_tversky_search_arena(query_arena, target_arena, threshold=0.7, alpha=1.0, beta=1.0,
+                                   max_score=None, interval="[]", score_type="double"):
+    """Search for the hits in the `target_arena` at least `threshold` Tversky similar to the fingerprints in `query_arena`
+
+    The hits in the returned `SearchResults` are in arbitrary order.
+
+    Example::
+    
+        queries = chemfp.load_fingerprints("queries.fps")
+        targets = chemfp.load_fingerprints("targets.fps")
+        results = chemfp.search.threshold_tversky_search_arena(
+                      queries, targets, threshold=0.8, alpha=1.0, beta=0.0)
+        for query_id, query_hits in zip(queries.ids, results):
+            if len(query_hits) > 0:
+                print query_id, "->", ", ".join(query_hits.get_ids())
+
+    :param query_arena: The query fingerprints.
+    :type query_arena: a FingerprintArena
+    :param target_arena: The target fingerprints.
+    :type target_arena: a FingerprintArena
+    :param threshold: The minimum score threshold.
+    :type threshold: float between 0.0 and 1.0, inclusive
+    :param alpha: the weight of the query-only bits
+    :type alpha: non-negative float
+    :param beta: the weight of the target-only bits
+    :type beta: non-negative float
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
+    :returns: a SearchResults instance
+    """
+    return threshold_search_arena(query_arena, target_arena, threshold,
+                                  Metric("tversky", alpha, beta), max_score, interval, score_type)
+
+
+def threshold_tversky_search_symmetric(arena, threshold=0.7, alpha=1.0, beta=1.0, batch_size=100,
+                                       max_score=None, interval="[]", score_type="double"):
+    """Search for the hits in the `arena` at least `threshold` Tversky similar to the fingerprints in the arena
+
+    A fingerprint never matches itself. Row i contains the hits when
+    fingerprint i is the query. Since the Tversky similarity is not
+    symmetric, this computes the full matrix directly.
+
+    The computation can take a long time. Python won't check check for
+    a ^C until the function finishes. This can be irritating. Instead,
+    process only `batch_size` rows at a time before checking for a ^C.
+
+    The hits in the returned `SearchResults` are in arbitrary order.
+
+    :param arena: the set of fingerprints
+    :type arena: a FingerprintArena
+    :param threshold: The minimum score threshold.
+    :type threshold: float between 0.0 and 1.0, inclusive
+    :param alpha: the weight of the query-only bits
+    :type alpha: non-negative float
+    :param beta: the weight of the target-only bits
+    :type beta: non-negative float
+    :param batch_size: the number of rows to process before checking for a ^C
+    :type batch_size: integer
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
+    :returns: a SearchResults instance
+    """
+    return threshold_search_symmetric(arena, threshold, Metric("tversky", alpha, beta),
+                                      batch_size, max_score, interval, score_type)
+
+
+def knearest_tversky_search_fp(query_fp, target_arena, k=3, threshold=0.7, alpha=1.0, beta=1.0,
+                               max_score=None, interval="[]", score_type="double"):
+    """Search for `k`-nearest hits in `target_arena` which are at least `threshold` Tversky similar to `query_fp`
+
+    The hits in the `SearchResults` are ordered by decreasing similarity score.
+
+    :param query_fp: the query fingerprint
+    :type query_fp: a byte string
+    :param target_arena: the target arena
+    :type target_fp: a FingerprintArena
+    :param k: the number of nearest neighbors to find.
+    :type k: positive integer
+    :param threshold: The minimum score threshold.
+    :type threshold: float between 0.0 and 1.0, inclusive
+    :param alpha: the weight of the query-only bits
+    :type alpha: non-negative float
+    :param beta: the weight of the target-only bits
+    :type beta: non-negative float
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
+    :returns: a SearchResult
+    """
+    return knearest_search_fp(query_fp, target_arena, k, threshold,
+                              Metric("tversky", alpha, beta), max_score, interval, score_type)
+
+
+def knearest_tversky_search_arena(query_arena, target_arena, k=3, threshold=0.7, alpha=1.0, beta=1.0,
+                                  max_score=None, interval="[]", score_type="double"):
+    """Search for the `k` nearest hits in the `target_arena` at least `threshold` Tversky similar to the fingerprints in `query_arena`
+
+    The hits in the `SearchResults` are ordered by decreasing similarity score.
+
+    :param query_arena: The query fingerprints.
+    :type query_arena: a FingerprintArena
+    :param target_arena: The target fingerprints.
+    :type target_arena: a FingerprintArena
+    :param k: the number of nearest neighbors to find.
+    :type k: positive integer
+    :param threshold: The minimum score threshold.
+    :type threshold: float between 0.0 and 1.0, inclusive
+    :param alpha: the weight of the query-only bits
+    :type alpha: non-negative float
+    :param beta: the weight of the target-only bits
+    :type beta: non-negative float
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
+    :returns: a SearchResults instance
+    """
+    return knearest_search_arena(query_arena, target_arena, k, threshold,
+                                 Metric("tversky", alpha, beta), max_score, interval, score_type)
+
+
+def knearest_tversky_search_symmetric(arena, k=3, threshold=0.7, alpha=1.0, beta=1.0, batch_size=100,
+                                      max_score=None, interval="[]", score_type="double"):
+    """Search for the `k`-nearest hits in the `arena` at least `threshold` Tversky similar to the fingerprints in the arena
+
+    A fingerprint never matches itself. Row i contains the hits when
+    fingerprint i is the query.
+
+    The computation can take a long time. Python won't check check for
+    a ^C until the function finishes. This can be irritating. Instead,
+    process only `batch_size` rows at a time before checking for a ^C.
+
+    The hits in the `SearchResults` are ordered by decreasing similarity score.
+
+    :param arena: the set of fingerprints
+    :type arena: a FingerprintArena
+    :param k: the number of nearest neighbors to find.
+    :type k: positive integer
+    :param threshold: The minimum score threshold.
+    :type threshold: float between 0.0 and 1.0, inclusive
+    :param alpha: the weight of the query-only bits
+    :type alpha: non-negative float
+    :param beta: the weight of the target-only bits
+    :type beta: non-negative float
+    :param batch_size: the number of rows to process before checking for a ^C
+    :type batch_size: integer
+    :param max_score: the maximum score (default: no limit)
+    :type max_score: float, or None
+    :param interval: which end points of [threshold, max_score] are included
+    :type interval: one of "[]", "()", "(]", "[)"
+    :param score_type: how to store the scores (default: "double")
+    :type score_type: one of "double", "float" or "uint16"
+    :returns: a SearchResults instance
+    """
+    return knearest_search_symmetric(arena, k, threshold, Metric("tversky", alpha, beta),
+                                     batch_size, max_score, interval, score_type)
+
+
+#### Substructure screening
+
+# A target passes the substructure screen for a query if every bit set
+# in the query fingerprint is also set in the target fingerprint. The
+# screen is a fast way to find the candidates before doing a full
+# substructure match with a chemistry toolkit.
+#
+# The screens use a bit-sliced index of the target arena, which is
+# made the first time the arena is screened. It takes about as much
+# memory as the fingerprints themselves. The hits are in increasing
+# target index order, and every score is 0.0.
+
+def count_contains_hits_fp(query_fp, target_arena):
+    """Count the number of fingerprints in `target_arena` which contain all of the bits in `query_fp`
+
+    Example::
+    
+        query_id, query_fp = chemfp.load_fingerprints("queries.fps")[0]
+        targets = chemfp.load_fingerprints("targets.fps")
+        print chemfp.search.count_contains_hits_fp(query_fp, targets)
+
+    :param query_fp: the query fingerprint
+    :type query_fp: a byte string
+    :param target_arena: the target arena
+    :type target_fp: a FingerprintArena
+    :returns: an integer count
+    """
+    _require_matching_fp_size(query_fp, target_arena)
+    postings, bit_counts = target_arena._get_contains_index()
+
+    counts = array.array("i", [0])
+    _chemfp.count_contains_arena(target_arena.num_bits,
+                                 0, 0, len(query_fp), query_fp, 0, 1,
+                                 target_arena.start, target_arena.end,
+                                 postings, bit_counts,
+                                 target_arena.popcount_indices,
+                                 counts)
+    return counts[0]
+
+
+def count_contains_hits_arena(query_arena, target_arena):
+    """For each fingerprint in `query_arena`, count the number of fingerprints in `target_arena` which contain all of its bits
+
+    Example::
+    
+        queries = chemfp.load_fingerprints("queries.fps")
+        targets = chemfp.load_fingerprints("targets.fps")
+        counts = chemfp.search.count_contains_hits_arena(queries, targets)
+        print counts[:10]
+
+    :param query_arena: The query fingerprints.
+    :type query_arena: a FingerprintArena
+    :param target_arena: The target fingerprints.
+    :type target_arena: a FingerprintArena
+    :returns: an array of counts
+    """
+    _require_matching_sizes(query_arena, target_arena)
+    postings, bit_counts = target_arena._get_contains_index()
+
+    counts = (ctypes.c_int*len(query_arena))()
+    _chemfp.count_contains_arena(target_arena.num_bits,
+                                 query_arena.start_padding, query_arena.end_padding,
+                                 query_arena.storage_size,
+                                 query_arena.arena, query_arena.start, query_arena.end,
+                                 target_arena.start, target_arena.end,
+                                 postings, bit_counts,
+                                 target_arena.popcount_indices,
+                                 counts)
+    return counts
+
+
+def contains_search_fp(query_fp, target_arena):
+    """Find the fingerprints in `target_arena` which contain all of the bits in `query_fp`
+
+    The hits in the returned `SearchResult` are in increasing target
+    index order, and have a score of 0.0.
+
+    Example::
+    
+        query_id, query_fp = chemfp.load_fingerprints("queries.fps")[0]
+        targets = chemfp.load_fingerprints("targets.fps")
+        for target_id in chemfp.search.contains_search_fp(query_fp, targets).get_ids():
+            print target_id
+
+    :param query_fp: the query fingerprint
+    :type query_fp: a byte string
+    :param target_arena: the target arena
+    :type target_fp: a FingerprintArena
+    :returns: a SearchResult
+    """
+    _require_matching_fp_size(query_fp, target_arena)
+    postings, bit_counts = target_arena._get_contains_index()
+
+    results = SearchResults(1, target_arena.arena_ids)
+    _chemfp.contains_arena(target_arena.num_bits,
+                           0, 0, len(query_fp), query_fp, 0, 1,
+                           target_arena.start, target_arena.end,
+                           postings, bit_counts,
+                           target_arena.popcount_indices,
+                           results, 0)
+    return results[0]
+
+
+def contains_search_arena(query_arena, target_arena):
+    """For each fingerprint in `query_arena`, find the fingerprints in `target_arena` which contain all of its bits
+
+    The hits in the returned `SearchResults` are in increasing target
+    index order, and have a score of 0.0.
+
+    Example::
+    
+        queries = chemfp.load_fingerprints("queries.fps")
+        targets = chemfp.load_fingerprints("targets.fps")
+        results = chemfp.search.contains_search_arena(queries, targets)
+        for query_id, query_hits in zip(queries.ids, results):
+            print query_id, "->", ", ".join(query_hits.get_ids())
+
+    :param query_arena: The query fingerprints.
+    :type query_arena: a FingerprintArena
+    :param target_arena: The target fingerprints.
+    :type target_arena: a FingerprintArena
+    :returns: a SearchResults instance
+    """
+    _require_matching_sizes(query_arena, target_arena)
+    postings, bit_counts = target_arena._get_contains_index()
+
+    num_queries = len(query_arena)
+    results = SearchResults(num_queries, target_arena.arena_ids)
+    if num_queries:
+        _chemfp.contains_arena(target_arena.num_bits,
+                               query_arena.start_padding, query_arena.end_padding,
+                               query_arena.storage_size,
+                               query_arena.arena, query_arena.start, query_arena.end,
+                               target_arena.start, target_arena.end,
+                               postings, bit_counts,
+                               target_arena.popcount_indices,
+                               results, 0)
+    return results
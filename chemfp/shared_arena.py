@@ -0,0 +1,317 @@
+"""Share a FingerprintArena between processes
+
+A process pool normally gives each worker its own copy of the arena.
+Instead, use `publish_arena` to save the arena as an fpb file in
+shared memory (under /dev/shm if it exists), and `attach_arena` to
+memory-map it. Every process which attaches to the same file uses the
+same physical pages for the fingerprint data, the popcount indices, and
+the ids.
+
+An attached arena is a `SharedFingerprintArena`. When it is pickled,
+only the filename is saved, and unpickling it attaches to the file
+again. This means it can be passed as an argument to a function
+submitted to a `chemfp.futures.ProcessPoolExecutor`. Each worker
+process attaches to a given file only once.
+
+The functions `count_tanimoto_hits_symmetric` and
+`threshold_tanimoto_search_symmetric` use an executor to split the
+symmetric searches in `chemfp.search` into blocks of rows, and merge
+the results from each block. A block of the threshold search only
+returns the hits for its own rows. A block of the count search also
+adds to the counts of later rows, so each worker keeps its counts in
+its own shared file of 4*len(arena) bytes, and those are added
+together at the end. Here's an example::
+
+    import os
+    import chemfp
+    from chemfp import futures, shared_arena
+
+    arena = chemfp.load_fingerprints("targets.fps")
+    filename = shared_arena.publish_arena(arena)
+    try:
+        arena = shared_arena.attach_arena(filename)
+        with futures.ProcessPoolExecutor(max_workers=16) as executor:
+            results = shared_arena.threshold_tanimoto_search_symmetric(
+                             executor, arena, threshold=0.8)
+    finally:
+        os.unlink(filename)
+
+The file must not be removed until all of the workers have attached
+to it. Once attached, the mapped memory stays valid until the arena
+is garbage collected, even if the file is removed.
+"""
+
+from __future__ import absolute_import
+
+import os
+import array
+import mmap
+import shutil
+import tempfile
+import thread
+
+import _chemfp
+from . import search
+from .arena import FingerprintArena
+from . import fpb_io
+
+__all__ = ["SharedFingerprintArena", "publish_arena", "attach_arena",
+           "count_tanimoto_hits_symmetric", "threshold_tanimoto_search_symmetric"]
+
+
+class SharedFingerprintArena(FingerprintArena):
+    """A FingerprintArena which is memory-mapped from a shared fpb file
+
+    The `filename` attribute is the name of the shared file. A
+    pickled SharedFingerprintArena only contains the filename.
+    Subarenas are ordinary FingerprintArena instances, and pickling
+    them makes a copy of the fingerprint data.
+    """
+    def __reduce__(self):
+        return (attach_arena, (self.filename,))
+
+
+def _get_default_dir():
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+def publish_arena(arena, filename=None):
+    """Save `arena` to a shared fpb file and return the filename
+
+    If `filename` is None then a new file is created under /dev/shm,
+    or in the system temporary directory if /dev/shm does not exist.
+    The caller is responsible for removing the file when it is no
+    longer needed.
+
+    :param arena: the fingerprints to share
+    :type arena: a FingerprintArena
+    :param filename: the name of the shared file
+    :type filename: a string, or None to make a new file
+    :returns: the filename
+    """
+    if filename is None:
+        fd, filename = tempfile.mkstemp(prefix="chemfp-", suffix=".fpb",
+                                        dir=_get_default_dir())
+        outfile = os.fdopen(fd, "wb")
+        try:
+            fpb_io.write_fpb(arena, outfile)
+        except:
+            outfile.close()
+            os.unlink(filename)
+            raise
+        outfile.close()
+    else:
+        fpb_io.write_fpb(arena, filename)
+    return filename
+
+
+# Attached arenas in this process, keyed by filename. The (st_dev,
+# st_ino) check detects if the filename now refers to a different file.
+_attached_arenas = {}
+
+def attach_arena(filename):
+    """Memory-map the shared fpb file `filename` and return a SharedFingerprintArena
+
+    Repeated calls with the same filename, in the same process, return
+    the same arena, unless the file was replaced. Like any arena, the
+    file must not be larger than 2 GB (`chemfp.arena.MAX_ARENA_SIZE`).
+
+    :param filename: the name of a file made by `publish_arena`
+    :type filename: string
+    :returns: a SharedFingerprintArena
+    """
+    st = os.stat(filename)
+    key = (st.st_dev, st.st_ino)
+    try:
+        attached_key, arena = _attached_arenas[filename]
+    except KeyError:
+        pass
+    else:
+        if attached_key == key:
+            return arena
+
+    a = fpb_io.open_fpb(filename, "fpb")
+    arena = SharedFingerprintArena(a.metadata, a.alignment, a.start_padding, a.end_padding,
+                                   a.storage_size, a.arena, a.popcount_indices, a.arena_ids,
+                                   id_lookup=a._id_lookup)
+    arena.filename = filename
+    _attached_arenas[filename] = (key, arena)
+    return arena
+
+
+#### Process-pool searches
+
+_INT_SIZE = array.array("i").itemsize
+
+# Only the worker processes should use a single OpenMP thread. Don't
+# change the parent's setting if a thread pool is used instead.
+def _use_one_thread(parent_pid):
+    if os.getpid() != parent_pid:
+        import chemfp
+        chemfp.set_num_threads(1)
+
+# Each worker thread adds its counts to its own shared file in the
+# search's directory. The open counts are kept by filename.
+_count_accumulators = {}
+
+def _release_count_accumulators(dirname=None):
+    # With no dirname, release the counts from searches which are done,
+    # since the parent removes the directory at the end of the search.
+    for filename in _count_accumulators.keys():
+        file_dirname = os.path.dirname(filename)
+        if file_dirname == dirname or (dirname is None and not os.path.isdir(file_dirname)):
+            counts = _count_accumulators.pop(filename, None)
+            if counts is not None:
+                counts.close()
+
+def _get_count_accumulator(dirname, num_bytes):
+    filename = os.path.join(dirname, "%d-%d.counts" % (os.getpid(), thread.get_ident()))
+    try:
+        return _count_accumulators[filename]
+    except KeyError:
+        pass
+    _release_count_accumulators()
+    outfile = open(filename, "w+b")
+    try:
+        outfile.truncate(num_bytes)
+        counts = mmap.mmap(outfile.fileno(), num_bytes)
+    finally:
+        outfile.close()
+    _count_accumulators[filename] = counts
+    return counts
+
+def _count_rows(parent_pid, arena, threshold, query_start, query_end, dirname):
+    _use_one_thread(parent_pid)
+    N = len(arena)
+    counts = _get_count_accumulator(dirname, N * _INT_SIZE)
+    _chemfp.count_tanimoto_hits_arena_symmetric(
+        threshold, arena.num_bits,
+        arena.start_padding, arena.end_padding, arena.storage_size, arena.arena,
+        query_start, query_end, 0, N,
+        arena.popcount_indices,
+        counts)
+
+def _add_worker_counts(counts, dirname):
+    for filename in os.listdir(dirname):
+        infile = open(os.path.join(dirname, filename), "rb")
+        try:
+            worker_counts = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            infile.close()
+        try:
+            _chemfp.add_counts(counts, worker_counts)
+        finally:
+            worker_counts.close()
+
+def _threshold_rows(parent_pid, arena, threshold, query_start, query_end):
+    _use_one_thread(parent_pid)
+    results = search.SearchResults(query_end - query_start)
+    _chemfp.threshold_tanimoto_arena_symmetric(
+        threshold, arena.num_bits,
+        arena.start_padding, arena.end_padding, arena.storage_size, arena.arena,
+        query_start, query_end, 0, len(arena),
+        arena.popcount_indices,
+        results, 0)
+    # Return the (offsets, indices, scores) as strings, which can be pickled
+    return tuple(str(buffer(view)) for view in results.get_flat_views())
+
+def _get_batch_size(N, batch_size):
+    if batch_size is None:
+        # Enough blocks to balance the work across a large pool, since
+        # the first rows of the upper triangle take the most time.
+        return max(100, (N + 255) // 256)
+    if batch_size <= 0:
+        raise ValueError("batch_size must be positive")
+    return batch_size
+
+def count_tanimoto_hits_symmetric(executor, arena, threshold=0.7, batch_size=None):
+    """Count the hits in `arena` at least `threshold` similar to each fingerprint in `arena`
+
+    This is the same as `chemfp.search.count_tanimoto_hits_symmetric`
+    except that blocks of `batch_size` rows are submitted to
+    `executor`. Use a SharedFingerprintArena with a process pool so
+    the workers don't each get a copy of the arena.
+
+    Each worker adds its counts to a file of 4*len(arena) bytes in a
+    new directory under /dev/shm, or in the system temporary directory
+    if /dev/shm does not exist. The directory is removed at the end.
+
+    :param executor: the executor used to run each block
+    :type executor: a chemfp.futures Executor
+    :param arena: the fingerprints
+    :type arena: a FingerprintArena, usually a SharedFingerprintArena
+    :param threshold: The minimum score threshold.
+    :type threshold: float between 0.0 and 1.0, inclusive
+    :param batch_size: the number of rows in each block, or None to choose a size
+    :type batch_size: positive integer, or None
+    :returns: an array of counts, one for each fingerprint
+    """
+    N = len(arena)
+    batch_size = _get_batch_size(N, batch_size)
+    parent_pid = os.getpid()
+
+    counts = array.array("i", (0,)) * N
+    if not N:
+        return counts
+
+    dirname = tempfile.mkdtemp(prefix="chemfp-counts-", dir=_get_default_dir())
+    try:
+        jobs = []
+        for query_start in xrange(0, N, batch_size):
+            query_end = min(query_start + batch_size, N)
+            jobs.append(executor.submit(_count_rows, parent_pid, arena, threshold,
+                                        query_start, query_end, dirname))
+        for job in jobs:
+            job.result()
+        _add_worker_counts(counts, dirname)
+    finally:
+        # A thread pool uses this process, so release its counts now.
+        # Worker processes release theirs in their next search.
+        _release_count_accumulators(dirname)
+        shutil.rmtree(dirname, ignore_errors=True)
+    return counts
+
+
+def threshold_tanimoto_search_symmetric(executor, arena, threshold=0.7,
+                                        include_lower_triangle=True, batch_size=None):
+    """Search for the hits in `arena` at least `threshold` similar to the fingerprints in `arena`
+
+    This is the same as `chemfp.search.threshold_tanimoto_search_symmetric`
+    except that blocks of `batch_size` rows are submitted to
+    `executor`. Use a SharedFingerprintArena with a process pool so
+    the workers don't each get a copy of the arena.
+
+    The hits in the returned `SearchResults` are in arbitrary order.
+
+    :param executor: the executor used to run each block
+    :type executor: a chemfp.futures Executor
+    :param arena: the fingerprints
+    :type arena: a FingerprintArena, usually a SharedFingerprintArena
+    :param threshold: The minimum score threshold.
+    :type threshold: float between 0.0 and 1.0, inclusive
+    :param include_lower_triangle:
+        if False, compute only the upper triangle, otherwise use symmetry to compute the full matrix
+    :type include_lower_triangle: boolean
+    :param batch_size: the number of rows in each block, or None to choose a size
+    :type batch_size: positive integer, or None
+    :returns: a SearchResults instance
+    """
+    N = len(arena)
+    batch_size = _get_batch_size(N, batch_size)
+    parent_pid = os.getpid()
+
+    jobs = []
+    for query_start in xrange(0, N, batch_size):
+        query_end = min(query_start + batch_size, N)
+        jobs.append((query_start, executor.submit(_threshold_rows, parent_pid, arena, threshold,
+                                                   query_start, query_end)))
+
+    results = search.SearchResults(N, arena.arena_ids)
+    for query_start, job in jobs:
+        offsets, indices, scores = job.result()
+        results._add_flat_hits(query_start, offsets, indices, scores)
+
+    if N and include_lower_triangle:
+        search.fill_lower_triangle(results)
+    return results
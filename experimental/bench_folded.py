@@ -0,0 +1,71 @@
+# Compare the Tanimoto arena searches with and without the
+# folded-fingerprint prefilter.
+#
+# The fingerprints are long and sparse, like circular fingerprints
+# folded to 4096 bits, which is where the prefilter helps the most.
+#
+# usage: python bench_folded.py [num_queries [num_targets [folded_num_bits ...]]]
+
+import sys
+import random
+
+import chemfp
+import chemfp.search
+
+from bench_tiles import best_time
+
+NUM_BITS = 4096
+NUM_BYTES = NUM_BITS // 8
+
+def make_arena(rng, n, prefix):
+    # Groups of similar fingerprints with 20-100 bits set
+    def records():
+        for i in xrange(n):
+            if i % 8 == 0:
+                bits = set(rng.randrange(NUM_BITS) for j in range(rng.randrange(20, 100)))
+            else:
+                bits = set(bits)
+                for j in range(rng.randrange(4)):
+                    bits.add(rng.randrange(NUM_BITS))
+            fp = bytearray(NUM_BYTES)
+            for bit in bits:
+                fp[bit//8] |= 1 << (bit % 8)
+            yield "%s%d" % (prefix, i), str(fp)
+    metadata = chemfp.Metadata(num_bits=NUM_BITS)
+    return chemfp.load_fingerprints(records(), metadata)
+
+def main(args):
+    num_queries = int(args[0]) if args else 200
+    num_targets = int(args[1]) if len(args) > 1 else 200000
+    folded_sizes = map(int, args[2:]) or [128, 256, 512]
+
+    rng = random.Random(12345)
+    queries = make_arena(rng, num_queries, "Q")
+    targets = make_arena(rng, num_targets, "T")
+    print "%d queries, %d targets, %d bits, %d thread(s)" % (
+        num_queries, num_targets, NUM_BITS, chemfp.get_num_threads())
+    print "%6s %-14s %9s %9s %8s" % ("folded", "search", "time", "pruned", "speedup")
+
+    searches = [
+        ("count 0.7", lambda arena: chemfp.search.count_tanimoto_hits_arena(queries, arena, 0.7)),
+        ("threshold 0.8", lambda arena: chemfp.search.threshold_tanimoto_search_arena(queries, arena, 0.8)),
+        ("knearest 10", lambda arena: chemfp.search.knearest_tanimoto_search_arena(queries, arena, 10, 0.5)),
+        ]
+    baseline = {}
+    for name, search in searches:
+        baseline[name] = best_time(lambda: search(targets))
+        print "%6s %-14s %9.3f %9s %8s" % ("-", name, baseline[name], "-", "-")
+
+    for folded_num_bits in folded_sizes:
+        folded = targets.copy()
+        prefilter = folded.make_folded_prefilter(folded_num_bits)
+        for name, search in searches:
+            prefilter.reset_stats()
+            search(folded)
+            pruned = float(prefilter.num_pruned) / max(prefilter.num_candidates, 1)
+            dt = best_time(lambda: search(folded))
+            print "%6d %-14s %9.3f %8.1f%% %7.2fx" % (
+                folded_num_bits, name, dt, 100*pruned, baseline[name] / dt)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,75 @@
+# Compare approximate k-nearest searches with an LSH index to the
+# exact k-nearest arena search. Reports the search time and the recall,
+# which is the fraction of the exact nearest neighbors which were found.
+#
+# usage: python bench_lsh.py [num_queries [num_targets [num_bands [rows_per_band]]]]
+
+import sys
+import time
+import random
+
+import chemfp
+import chemfp.search
+from chemfp import lsh
+
+from bench_tiles import best_time
+from bench_folded import make_arena, NUM_BITS
+
+K = 10
+THRESHOLD = 0.5
+
+def make_queries(rng, targets, n):
+    # Similar to randomly chosen targets, with a few bits changed
+    def records():
+        for i in xrange(n):
+            fp = bytearray(targets[rng.randrange(len(targets))][1])
+            for j in range(rng.randrange(1, 6)):
+                bit = rng.randrange(NUM_BITS)
+                fp[bit//8] ^= 1 << (bit % 8)
+            yield "Q%d" % (i,), str(fp)
+    metadata = chemfp.Metadata(num_bits=NUM_BITS)
+    return chemfp.load_fingerprints(records(), metadata)
+
+def recall(results, expected):
+    found = total = 0
+    for result, expected_result in zip(results, expected):
+        expected_ids = set(expected_result.get_ids())
+        found += len(expected_ids & set(result.get_ids()))
+        total += len(expected_ids)
+    return float(found) / max(total, 1)
+
+def main(args):
+    num_queries = int(args[0]) if args else 200
+    num_targets = int(args[1]) if len(args) > 1 else 200000
+    num_bands = int(args[2]) if len(args) > 2 else 32
+    rows_per_band = int(args[3]) if len(args) > 3 else 4
+
+    rng = random.Random(12345)
+    targets = make_arena(rng, num_targets, "T")
+    queries = make_queries(rng, targets, num_queries)
+    print "%d queries, %d targets, %d bits, %d thread(s)" % (
+        num_queries, num_targets, NUM_BITS, chemfp.get_num_threads())
+
+    t1 = time.time()
+    index = lsh.build_lsh_index(targets, num_bands, rows_per_band)
+    print "built %d bands of %d rows in %.2f seconds" % (
+        num_bands, rows_per_band, time.time() - t1)
+
+    expected = chemfp.search.knearest_tanimoto_search_arena(queries, targets, K, THRESHOLD)
+    exact_time = best_time(lambda: chemfp.search.knearest_tanimoto_search_arena(
+        queries, targets, K, THRESHOLD))
+    print "%-6s %9s %7s %8s" % ("bands", "time", "recall", "speedup")
+    print "%-6s %9.3f %7s %8s" % ("exact", exact_time, "1.000", "-")
+    num_probe_bands = 1
+    while True:
+        results = index.knearest_tanimoto_search_arena(queries, K, THRESHOLD, num_probe_bands)
+        dt = best_time(lambda: index.knearest_tanimoto_search_arena(
+            queries, K, THRESHOLD, num_probe_bands))
+        print "%-6d %9.3f %7.3f %7.2fx" % (num_probe_bands, dt, recall(results, expected),
+                                           exact_time / dt)
+        if num_probe_bands == num_bands:
+            break
+        num_probe_bands = min(2*num_probe_bands, num_bands)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
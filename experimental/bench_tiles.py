@@ -0,0 +1,87 @@
+# Compare the tiled and untiled Tanimoto arena searches.
+#
+# The tile size is the number of target bytes which a block of queries
+# searches at a time. A size of 0 uses the original query-at-a-time
+# search. The speedup only shows up once the target arena is larger
+# than the last-level cache.
+#
+# usage: python bench_tiles.py [num_queries [threshold [num_targets ...]]]
+
+import sys
+import os
+import random
+import time
+
+import chemfp
+import chemfp.search
+from chemfp import bitops
+
+NUM_BITS = 2048
+NUM_BYTES = NUM_BITS // 8
+TILE_SIZES = [0, 64*1024, 256*1024, 1024*1024]
+
+def make_pool(rng, size):
+    # Random fingerprints with a range of densities, so the popcount
+    # bins are spread out like they are for real fingerprints.
+    pool = []
+    for i in range(size):
+        value = int(os.urandom(NUM_BYTES).encode("hex"), 16)
+        for j in range(rng.randrange(4)):
+            value &= int(os.urandom(NUM_BYTES).encode("hex"), 16)
+        pool.append(("%0*x" % (NUM_BYTES*2, value)).decode("hex"))
+    return pool
+
+def make_arena(rng, pool, n, prefix):
+    # Perturb a fingerprint from the pool, so each record is different
+    # and there are similar fingerprints to find.
+    def records():
+        for i in xrange(n):
+            fp = rng.choice(pool)
+            offset = rng.randrange(NUM_BYTES - 8)
+            yield "%s%d" % (prefix, i), fp[:offset] + os.urandom(8) + fp[offset+8:]
+    metadata = chemfp.Metadata(num_bits=NUM_BITS)
+    return chemfp.load_fingerprints(records(), metadata)
+
+def best_time(func, repeat=3):
+    best = None
+    for i in range(repeat):
+        t1 = time.time()
+        func()
+        dt = time.time() - t1
+        if best is None or dt < best:
+            best = dt
+    return best
+
+def main(args):
+    num_queries = int(args[0]) if args else 500
+    threshold = float(args[1]) if len(args) > 1 else 0.8
+    sizes = map(int, args[2:]) or [100000, 500000, 1000000]
+
+    rng = random.Random(12345)
+    pool = make_pool(rng, 2000)
+    queries = make_arena(rng, pool, num_queries, "Q")
+    old_tile_size = bitops.get_option("tile-size")
+    print "%d queries, %d bits, threshold %.2f, %d thread(s)" % (
+        num_queries, NUM_BITS, threshold, chemfp.get_num_threads())
+    print "%9s %8s %10s %9s %9s %8s" % ("targets", "MB", "tile-size", "count", "threshold", "speedup")
+    try:
+        for size in sizes:
+            targets = make_arena(rng, pool, size, "T")
+            megabytes = len(targets) * targets.storage_size / (1024.0 * 1024.0)
+            untiled = None
+            for tile_size in TILE_SIZES:
+                bitops.set_option("tile-size", tile_size)
+                count_time = best_time(
+                    lambda: chemfp.search.count_tanimoto_hits_arena(queries, targets, threshold))
+                threshold_time = best_time(
+                    lambda: chemfp.search.threshold_tanimoto_search_arena(queries, targets, threshold))
+                if untiled is None:
+                    untiled = count_time + threshold_time
+                print "%9d %8.1f %10d %9.3f %9.3f %7.2fx" % (
+                    size, megabytes, tile_size, count_time, threshold_time,
+                    untiled / (count_time + threshold_time))
+    finally:
+        bitops.set_option("tile-size", old_tile_size)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -142,7 +142,7 @@ setup(name = "chemfp",
       
       packages = ["chemfp", "chemfp.commandline", "chemfp.futures", "chemfp.progressbar"],
       package_data = {"chemfp": ["rdmaccs.patterns", "substruct.patterns"]},
-      scripts = ["ob2fps", "oe2fps", "rdkit2fps", "sdf2fps", "simsearch"],
+      scripts = ["ob2fps", "oe2fps", "rdkit2fps", "sdf2fps", "simsearch", "fps2fpb"],
 
       ext_modules = [Extension("_chemfp",
                                ["src/bitops.c", "src/chemfp.c",
@@ -151,7 +151,10 @@ setup(name = "chemfp",
                                 "src/select_popcount.c", "src/popcount_popcnt.c",
                                 "src/popcount_lauradoux.c", "src/popcount_lut.c",
                                 "src/popcount_gillies.c", "src/popcount_SSSE3.c",
-                                "src/python_api.c", "src/pysearch_results.c"],
+                                "src/popcount_avx.c",
+                                "src/python_api.c", "src/pysearch_results.c",
+                                "src/pybuffer_view.c", "src/id_index.c",
+                                "src/contains.c", "src/lsh.c"],
                                )],
       cmdclass = {"build_ext": build_ext_subclass},
      )
@@ -92,6 +92,18 @@ int chemfp_hex_isvalid(int len, const char *sfp) {
   return (union_w < BIG) ? 1 : 0;
 }
 
+/* Decode a hex fingerprint into bytes and return the popcount. The
+   caller must check that it only contains hex characters. */
+int chemfp_hex_decode_popcount(int len, const char *shex_fp, unsigned char *fp) {
+  const unsigned char *hex_fp = (unsigned char *) shex_fp;
+  int i, popcount = 0;
+  for (i=0; i<len; i++, hex_fp += 2) {
+    fp[i] = (unsigned char)((hex_to_value[hex_fp[0]] << 4) | hex_to_value[hex_fp[1]]);
+    popcount += hex_to_popcount[hex_fp[0]] + hex_to_popcount[hex_fp[1]];
+  }
+  return popcount;
+}
+
 /* Return the population count of a hex fingerprint, otherwise return -1 */
 int chemfp_hex_popcount(int len, const char *sfp) {
   int i, union_w=0, popcount=0;
@@ -314,3 +326,89 @@ double chemfp_byte_hex_tanimoto(int size,
   }
   return (intersect_popcount + 0.0) / union_popcount;  /* +0.0 to coerce to double */
 }
+
+/***** Tversky similarity *****/
+
+/* The Tversky similarity is
+     c / (alpha*(a-c) + beta*(b-c) + c)
+   where a is the query popcount, b the target popcount, and c the
+   intersection popcount. The Tanimoto is the special case of
+   alpha = beta = 1.0, and the Dice is alpha = beta = 0.5.
+   As with the Tanimoto, 0/0 = 0.0. */
+static double tversky_score(int query_popcount, int target_popcount,
+                            int intersect_popcount, double alpha, double beta) {
+  double denominator = (alpha * (query_popcount - intersect_popcount) +
+                        beta * (target_popcount - intersect_popcount) +
+                        intersect_popcount);
+  if (denominator == 0.0) {
+    return 0.0;
+  }
+  return intersect_popcount / denominator;
+}
+
+/* Return the Tversky between two hex fingerprints, or -1.0 for invalid fingerprints */
+double chemfp_hex_tversky(int len, const char *sfp1, const char *sfp2,
+                          double alpha, double beta) {
+  int i, union_w=0;
+  int popcount1=0, popcount2=0, intersect_popcount=0;
+  int w1, w2;
+  const unsigned char *fp1 = (const unsigned char *) sfp1;
+  const unsigned char *fp2 = (const unsigned char *) sfp2;
+
+  for (i=0; i<len; i++) {
+    w1 = hex_to_value[fp1[i]];
+    w2 = hex_to_value[fp2[i]];
+    /* Check for illegal characters */
+    union_w |= (w1|w2);
+    popcount1 += _popcount[w1];
+    popcount2 += _popcount[w2];
+    intersect_popcount += _popcount[w1&w2];
+  }
+  if (union_w >= BIG) {
+    return -1.0;
+  }
+  return tversky_score(popcount1, popcount2, intersect_popcount, alpha, beta);
+}
+
+/* Return the Tversky between two byte fingerprints */
+double chemfp_byte_tversky(int len, const unsigned char *fp1,
+                           const unsigned char *fp2, double alpha, double beta) {
+  int i, popcount1=0, popcount2=0, intersect_popcount=0;
+  for (i=0; i<len; i++) {
+    popcount1 += byte_popcounts[fp1[i]];
+    popcount2 += byte_popcounts[fp2[i]];
+    intersect_popcount += byte_popcounts[fp1[i] & fp2[i]];
+  }
+  return tversky_score(popcount1, popcount2, intersect_popcount, alpha, beta);
+}
+
+/* Return the Tversky between a byte (query) fingerprint and a hex (target) fingerprint */
+/* The size is the number of bytes in the byte_fp */
+double chemfp_byte_hex_tversky(int size,
+                               const unsigned char *byte_fp,
+                               const char *shex_fp,
+                               double alpha, double beta) {
+  const unsigned char *hex_fp = (unsigned char *) shex_fp;
+  int union_w=0;
+  int byte_popcount=0, hex_popcount=0, intersect_popcount=0;
+  int w1, w2;
+  int byte;
+  unsigned char wc;
+
+  while (size > 0) {
+    w1 = hex_to_value[*hex_fp++];
+    w2 = hex_to_value[*hex_fp++];
+    /* Check for illegal characters */
+    union_w |= (w1|w2);
+    wc = (unsigned char)((w1<<4) | w2);
+    byte = *byte_fp++;
+    byte_popcount += byte_popcounts[byte];
+    hex_popcount += byte_popcounts[wc];
+    intersect_popcount += byte_popcounts[byte & wc];
+    size--;
+  }
+  if (union_w >= BIG) {
+    return -1.0;
+  }
+  return tversky_score(byte_popcount, hex_popcount, intersect_popcount, alpha, beta);
+}
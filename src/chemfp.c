@@ -25,6 +25,8 @@ const char *chemfp_strerror(int err) {
 
   case CHEMFP_UNKNOWN_ORDERING: return "Unknown sort order";
 
+  case CHEMFP_INTERRUPTED: return "Interrupted";
+
   default: return "Unknown error";
   }
 }
@@ -45,6 +47,7 @@ const chemfp_option_type chemfp_options[] = {
   {"report-popcount", chemfp_get_option_report_popcount, chemfp_set_option_report_popcount},
   {"report-intersect", chemfp_get_option_report_intersect_popcount,
    chemfp_set_option_report_intersect_popcount},
+  {"tile-size", chemfp_get_option_tile_size, chemfp_set_option_tile_size},
 };
 
 int
@@ -1,6 +1,8 @@
 #ifndef CHEMFP_H
 #define CHEMFP_H
 
+#include <stdint.h>
+
 /* Errors are always negative numbers. */
 enum chemfp_errors {
   CHEMFP_OK = 0,
@@ -21,7 +23,10 @@ enum chemfp_errors {
   CHEMFP_METHOD_MISMATCH = -50,
 
   /* Various other error messages */
-  CHEMFP_UNKNOWN_ORDERING = -60
+  CHEMFP_UNKNOWN_ORDERING = -60,
+
+  /* A search was stopped by its interrupt check */
+  CHEMFP_INTERRUPTED = -70
   
 };
 
@@ -85,11 +90,26 @@ typedef struct chemfp_hit_block {
 } chemfp_hit_block;
 
 
+/* How a chemfp_search_result stores its scores. A "uint16" score is
+   round(score*65535), which only works for scores between 0.0 and 1.0. */
+enum chemfp_score_types {
+  CHEMFP_SCORE_DOUBLE = 0,
+  CHEMFP_SCORE_FLOAT = 1,
+  CHEMFP_SCORE_UINT16 = 2
+};
+
+#define CHEMFP_UINT16_SCORE_SCALE 65535
+
+int chemfp_get_num_score_types(void);
+const char *chemfp_get_score_type_name(int score_type);
+int chemfp_get_score_type_size(int score_type);
+
 typedef struct chemfp_search_result {
   int num_hits;
   int num_allocated;
   int *indices;
-  double *scores;
+  void *scores;     /* an array of double, float, or uint16_t, depending on score_type */
+  int score_type;   /* one of the chemfp_score_types; use chemfp_get_hit_score() */
 } chemfp_search_result;
 
 chemfp_search_result *chemfp_alloc_search_results(int num_results);
@@ -121,6 +141,10 @@ double chemfp_hex_tanimoto(int len, const char *fp1, const char *fp2);
    or -1 for invalid fingerprints */
 int chemfp_hex_contains(int len, const char *query_fp, const char *target_fp);
 
+/* Decode a valid hex fingerprint of 2*len characters into len bytes,
+   and return its population count */
+int chemfp_hex_decode_popcount(int len, const char *hex_fp, unsigned char *fp);
+
 /**** Low-level operations directly on byte fingerprints ***/
 
 /* Return the population count of a byte fingerprint */
@@ -142,6 +166,26 @@ double chemfp_byte_hex_tanimoto(int size, const unsigned char *byte_fp,
 int chemfp_byte_contains(int len, const unsigned char *query_fp,
                          const unsigned char *target_fp);
 
+/**** Tversky similarity ***/
+
+/* The Tversky similarity is c / (alpha*(a-c) + beta*(b-c) + c) where a is
+   the popcount of the first (query) fingerprint, b the popcount of the second
+   (target) fingerprint, and c the popcount of their intersection. It is
+   0.0 if the denominator is 0. alpha = beta = 1.0 gives the Tanimoto. */
+
+/* Return the Tversky between two hex fingerprints, or -1.0 for invalid fingerprints */
+double chemfp_hex_tversky(int len, const char *fp1, const char *fp2,
+                          double alpha, double beta);
+
+/* Return the Tversky between two byte fingerprints */
+double chemfp_byte_tversky(int len, const unsigned char *fp1,
+                           const unsigned char *fp2, double alpha, double beta);
+
+/* Return the Tversky between a byte fingerprint and a hex fingerprint,
+   or -1.0 if the hex fingerprint is invalid */
+double chemfp_byte_hex_tversky(int size, const unsigned char *byte_fp,
+                               const char *hex_fp, double alpha, double beta);
+
 
 /**** Functions which work with data from an fps block ***/
 
@@ -172,6 +216,15 @@ int chemfp_fps_count_tanimoto_hits(
         double threshold,
         int *counts, int *num_lines_processed);
 
+/* The same, using the Tversky similarity with weights alpha and beta */
+int chemfp_fps_count_tversky_hits(
+        int num_bits,
+        int query_storage_size,
+        const unsigned char *query_arena, int query_start, int query_end,
+        const char *target_block, int target_block_end,
+        double alpha, double beta, double threshold,
+        int *counts, int *num_lines_processed);
+
 
 typedef struct {
   int size;           /* current heap size */
@@ -210,6 +263,12 @@ int chemfp_fps_knearest_tanimoto_search_feed(
         chemfp_fps_knearest_search *knearest_search,
         int target_block_len, const char *target_block);
 
+/* The same, using the Tversky similarity with weights alpha and beta */
+int chemfp_fps_knearest_tversky_search_feed(
+        chemfp_fps_knearest_search *knearest_search,
+        double alpha, double beta,
+        int target_block_len, const char *target_block);
+
 /* Call this after the last fps block, in order to convert the heap into an
    sorted array. */
 void chemfp_fps_knearest_search_finish(chemfp_fps_knearest_search *knearest_search);
@@ -217,6 +276,15 @@ void chemfp_fps_knearest_search_finish(chemfp_fps_knearest_search *knearest_sear
 void chemfp_fps_knearest_search_free(chemfp_fps_knearest_search *knearest_search);
 
 
+/* Decode the fingerprints and ids of an fps block into preallocated space */
+int chemfp_fps_load_block(
+        int num_bytes, int storage_size,
+        const char *block, int block_end,
+        int max_fingerprints, unsigned char *fps,
+        ChemFPOrderedPopcount *ordering, int first_index,
+        int id_block_size, char *id_block, int *id_pos, unsigned int *offsets,
+        int *num_lines_processed);
+
 int chemfp_fps_threshold_tanimoto_search(
         int num_bits,
         int query_storage_size,
@@ -227,6 +295,16 @@ int chemfp_fps_threshold_tanimoto_search(
         int num_cells, chemfp_tanimoto_cell *cells,
         const char ** stopped_at, int *num_lines_processed, int *num_cells_processed);
 
+/* The same, using the Tversky similarity with weights alpha and beta */
+int chemfp_fps_threshold_tversky_search(
+        int num_bits,
+        int query_storage_size,
+        const unsigned char *query_arena, int query_start, int query_end,
+        const char *target_block, int target_block_end,
+        double alpha, double beta, double threshold,
+        int num_cells, chemfp_tanimoto_cell *cells,
+        const char ** stopped_at, int *num_lines_processed, int *num_cells_processed);
+
 
 /***** The byte-oriented algorithms  ********/
 
@@ -334,6 +412,48 @@ int chemfp_knearest_tanimoto_arena(
 
 
 
+/* The same as the above, but with one threshold (and k) for each */
+/* query, starting with the query at query_start */
+
+int chemfp_count_tanimoto_arena_per_query(
+        const double *thresholds,
+        int num_bits,
+        int query_storage_size,
+        const unsigned char *query_arena, int query_start, int query_end,
+        int target_storage_size,
+        const unsigned char *target_arena, int target_start, int target_end,
+        int *target_popcount_indices,
+        int *result_counts);
+
+int chemfp_threshold_tanimoto_arena_per_query(
+        const double *thresholds,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results);
+
+int chemfp_knearest_tanimoto_arena_per_query(
+        const int *ks, const double *thresholds,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results);
+
+
+/* The symmetric Tanimoto searches go through all of the rows in one
+   parallel region, which can take a long time. If check_interrupt is
+   not NULL then the thread which called the search function calls
+   check_interrupt(interrupt_data) every so often. If it returns
+   non-zero then the search stops early and returns CHEMFP_INTERRUPTED,
+   and the results are incomplete. */
+typedef int (*chemfp_check_interrupt_f)(void *interrupt_data);
+
 int chemfp_count_tanimoto_hits_arena_symmetric(
         /* Count all matches within the given threshold */
         double threshold,
@@ -354,7 +474,10 @@ int chemfp_count_tanimoto_hits_arena_symmetric(
         int *popcount_indices,
 
         /* Results _increment_ existing values in the array - remember to initialize! */
-        int *result_counts);
+        int *result_counts,
+
+        /* Called to check if the search should stop (may be NULL) */
+        chemfp_check_interrupt_f check_interrupt, void *interrupt_data);
 
 int chemfp_threshold_tanimoto_arena_symmetric(
         /* Within the given threshold */
@@ -376,7 +499,10 @@ int chemfp_threshold_tanimoto_arena_symmetric(
 
         /* Results go here */
         /* NOTE: This must have enough space for all of the fingerprints! */
-        chemfp_search_result *results);
+        chemfp_search_result *results,
+
+        /* Called to check if the search should stop (may be NULL) */
+        chemfp_check_interrupt_f check_interrupt, void *interrupt_data);
 
 int chemfp_knearest_tanimoto_arena_symmetric(
         /* Find the 'k' nearest items */
@@ -400,6 +526,181 @@ int chemfp_knearest_tanimoto_arena_symmetric(
 
         /* Results go here */
         /* NOTE: This must have enough space for all of the fingerprints! */
+        chemfp_search_result *results,
+
+        /* Called to check if the search should stop (may be NULL) */
+        chemfp_check_interrupt_f check_interrupt, void *interrupt_data);
+
+/***** Metric searches *****/
+
+/* The metric searches support several similarity and distance measures.
+   In the following, a is the query popcount, b is the target popcount,
+   and c is the popcount of their intersection. */
+enum chemfp_metric_types {
+  CHEMFP_METRIC_TANIMOTO = 0, /* c / (a + b - c) */
+  CHEMFP_METRIC_TVERSKY,      /* c / (alpha*(a-c) + beta*(b-c) + c) */
+  CHEMFP_METRIC_DICE,         /* 2*c / (a + b) */
+  CHEMFP_METRIC_COSINE,       /* c / sqrt(a*b) */
+  CHEMFP_METRIC_HAMMING,      /* a + b - 2*c (a distance) */
+  CHEMFP_METRIC_EUCLIDEAN,    /* sqrt(a + b - 2*c) (a distance) */
+  CHEMFP_NUM_METRICS
+};
+
+typedef struct {
+  int type;       /* one of the chemfp_metric_types */
+  double alpha;   /* Tversky weights; ignored by the other metrics */
+  double beta;
+} chemfp_metric;
+
+int chemfp_get_num_metrics(void);
+const char *chemfp_get_metric_name(int metric_type);
+/* Return 1 if smaller values are better, 0 for a similarity, or -1 if unknown */
+int chemfp_metric_is_distance(int metric_type);
+
+/* The range of scores (or distances) which are hits. A hit has
+     min_score <= score <= max_score
+   where each '<=' is a '<' if that end of the interval is not included.
+   Use HUGE_VAL for no upper limit. */
+typedef struct {
+  double min_score;
+  double max_score;
+  int include_min;
+  int include_max;
+} chemfp_interval;
+
+/* For a similarity metric, the interval minimum is the usual threshold
+   (0.0 to 1.0), and a max_score of 1.0 with include_max = 0 excludes the
+   identical fingerprints. For a distance metric the interval is the
+   range of distances, so the maximum is the usual threshold and the
+   k-nearest hits are the ones with the smallest distances. The k-nearest
+   searches return the best k hits inside the interval. Each metric uses
+   its own popcount bounds to limit the search. The popcount indices may
+   be NULL.
+
+   Unlike the Tanimoto k-nearest searches, the metric k-nearest searches
+   sort the hits of each query, from best to worst. Do not call
+   chemfp_knearest_results_finalize() on those results. */
+
+int chemfp_count_metric_arena(
+        const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        int *result_counts);
+
+int chemfp_threshold_metric_arena(
+        const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results);
+
+int chemfp_knearest_metric_arena(
+        int k, const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results);
+
+/* Not every metric is symmetric, so the symmetric versions search each
+   row in query_start:query_end against the columns in
+   target_start:target_end, except for the diagonal. The results are
+   indexed by row. The counts are incremented - remember to initialize! */
+
+int chemfp_count_metric_arena_symmetric(
+        const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int query_start, int query_end,
+        int target_start, int target_end,
+        int *popcount_indices,
+        int *result_counts);
+
+int chemfp_threshold_metric_arena_symmetric(
+        const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int query_start, int query_end,
+        int target_start, int target_end,
+        int *popcount_indices,
+        chemfp_search_result *results);
+
+int chemfp_knearest_metric_arena_symmetric(
+        int k, const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int query_start, int query_end,
+        int target_start, int target_end,
+        int *popcount_indices,
+        chemfp_search_result *results);
+
+/* The Tversky versions of the metric searches, with weights alpha and
+   beta for the bits unique to the query and to the target, respectively */
+
+int chemfp_count_tversky_arena(
+        double alpha, double beta, double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        int *result_counts);
+
+int chemfp_threshold_tversky_arena(
+        double alpha, double beta, double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results);
+
+int chemfp_knearest_tversky_arena(
+        int k, double alpha, double beta, double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results);
+
+int chemfp_count_tversky_hits_arena_symmetric(
+        double alpha, double beta, double threshold,
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int query_start, int query_end,
+        int target_start, int target_end,
+        int *popcount_indices,
+        int *result_counts);
+
+int chemfp_threshold_tversky_arena_symmetric(
+        double alpha, double beta, double threshold,
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int query_start, int query_end,
+        int target_start, int target_end,
+        int *popcount_indices,
+        chemfp_search_result *results);
+
+int chemfp_knearest_tversky_arena_symmetric(
+        int k, double alpha, double beta, double threshold,
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int query_start, int query_end,
+        int target_start, int target_end,
+        int *popcount_indices,
         chemfp_search_result *results);
 
 void chemfp_knearest_results_finalize(chemfp_search_result *results_start,
@@ -407,6 +708,26 @@ void chemfp_knearest_results_finalize(chemfp_search_result *results_start,
 
 int chemfp_fill_lower_triangle(int n, chemfp_search_result *results);
 
+/* Symmetric Tanimoto threshold search results as a sparse matrix in */
+/* CSR format. Count the hits with chemfp_count_tanimoto_hits_arena_symmetric(), */
+/* make the row offsets with chemfp_make_csr_indptr(), fill in the upper */
+/* triangle, then copy it to the lower triangle. */
+long long chemfp_make_csr_indptr(int n, const int *counts, long long *indptr);
+
+int chemfp_threshold_tanimoto_arena_symmetric_csr(
+        double threshold,
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int num_fingerprints, int query_start, int query_end,
+        int *popcount_indices,
+        const long long *indptr,
+        int *upper_counts,
+        int *indices, float *scores,
+        chemfp_check_interrupt_f check_interrupt, void *interrupt_data);
+
+int chemfp_fill_csr_lower_triangle(int n, const long long *indptr, const int *upper_counts,
+                                   int *indices, float *scores);
+
 
 typedef int (*chemfp_popcount_f)(int len, const unsigned char *p1);
 typedef int (*chemfp_intersect_popcount_f)(int len, const unsigned char *p1,
@@ -422,6 +743,169 @@ chemfp_select_intersect_popcount(int num_bits,
                                  int storage_len2, const unsigned char *arena2);
 
 
+/* Identifier hash index */
+
+int chemfp_get_id_index_size(int num_ids);
+
+int chemfp_make_id_index(int num_ids, int id_block_size, const char *id_block,
+                         const unsigned int *offsets,
+                         int table_size, unsigned int *table);
+
+int chemfp_id_index_lookup(int num_ids, int id_block_size, const char *id_block,
+                           const unsigned int *offsets,
+                           int table_size, const unsigned int *table,
+                           int id_len, const char *id);
+
+
+/* Substructure screening */
+
+/* A target passes the screen for a query if it contains every bit */
+/* set in the query. The screens use a bit-sliced "contains index" */
+/* of the targets in [start, end), which has num_bits postings of */
+/* num_words 64-bit words each, and the number of targets with each */
+/* bit set. Use chemfp_get_contains_index_num_words() to get num_words. */
+/* The hits are reported in increasing target index order, with a */
+/* score of 0.0. */
+
+int chemfp_get_contains_index_num_words(int num_fingerprints);
+
+int chemfp_make_contains_index(int num_bits, int storage_size, const unsigned char *arena,
+                               int start, int end,
+                               int num_words, uint64_t *postings, int *bit_counts);
+
+int chemfp_count_contains_arena(
+        /* Size of the fingerprints */
+        int num_bits,
+
+        /* Query arena, start and end indices */
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+
+        /* Contains index for the targets in [target_start, target_end) */
+        int target_start, int target_end,
+        int num_words, const uint64_t *postings, const int *bit_counts,
+
+        /* Target popcount distribution information, or NULL */
+        int *target_popcount_indices,
+
+        /* Results go into these arrays  */
+        int *result_counts);
+
+int chemfp_contains_arena(
+        /* Size of the fingerprints */
+        int num_bits,
+
+        /* Query arena, start and end indices */
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+
+        /* Contains index for the targets in [target_start, target_end) */
+        int target_start, int target_end,
+        int num_words, const uint64_t *postings, const int *bit_counts,
+
+        /* Target popcount distribution information, or NULL */
+        int *target_popcount_indices,
+
+        /* Results go here */
+        chemfp_search_result *results);
+
+
+/* Folded-fingerprint prefilter */
+
+/* A folded fingerprint ORs every folded_num_bits-bit section of the */
+/* fingerprint together. The popcount of the folded intersection plus */
+/* the smaller of the bits "lost" by folding the query and the target, */
+/* where lost = popcount(fp) - popcount(folded fp), is an upper bound */
+/* on the full intersection popcount. The folded searches use that */
+/* bound to skip the full intersection when the target can't be a hit. */
+/* Fingerprint i of the folded arena is the fold of fingerprint i of */
+/* the target arena, so the folded arena covers the entire target */
+/* arena, not only [target_start, target_end). */
+
+typedef struct {
+  int num_bits;                 /* a multiple of 64, from 64 to 1024 */
+  const unsigned char *arena;   /* num_bits/8 bytes per fingerprint */
+  const int *lost_bits;         /* one for each fingerprint */
+  long long num_candidates;     /* incremented by the number of targets tested */
+  long long num_pruned;         /* incremented by the number of targets skipped */
+} chemfp_folded_arena;
+
+int chemfp_fold_arena(int num_bits, int storage_size, const unsigned char *arena,
+                      int start, int end,
+                      int folded_num_bits, unsigned char *folded_arena, int *lost_bits);
+
+/* These require the target popcount indices. They use the unfolded */
+/* search when there are none, or the threshold is not in (0.0, 1.0]. */
+
+int chemfp_count_tanimoto_arena_folded(
+        double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_folded_arena *folded,
+        int *result_counts);
+
+int chemfp_threshold_tanimoto_arena_folded(
+        double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_folded_arena *folded,
+        chemfp_search_result *results);
+
+int chemfp_knearest_tanimoto_arena_folded(
+        int k, double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_folded_arena *folded,
+        chemfp_search_result *results);
+
+
+/* Approximate k-nearest search using MinHash and banded LSH */
+
+/* The index has num_bands tables of (end-start) entries each. The */
+/* entries of a table are sorted by key, and the index is the offset */
+/* of the fingerprint from 'start'. See lsh.c for details. The search */
+/* only probes the first num_probe_bands tables. The hits for each */
+/* query are added in decreasing score order. */
+
+#define CHEMFP_LSH_MAX_BANDS 1024
+#define CHEMFP_LSH_MAX_ROWS_PER_BAND 64
+
+typedef struct {
+  uint32_t key;
+  int index;
+} chemfp_lsh_entry;
+
+int chemfp_check_lsh_parameters(int num_bands, int rows_per_band);
+
+int chemfp_make_lsh_index(int num_bits, int storage_size, const unsigned char *arena,
+                          int start, int end,
+                          int num_bands, int rows_per_band, unsigned int seed,
+                          chemfp_lsh_entry *entries);
+
+int chemfp_knearest_tanimoto_lsh_arena(
+        int k, double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int num_bands, int rows_per_band, unsigned int seed,
+        const chemfp_lsh_entry *entries, int num_probe_bands,
+        chemfp_search_result *results);
+
+
 /* OpenMP interface */
 
 int chemfp_get_num_threads(void);
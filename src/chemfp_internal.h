@@ -17,6 +17,52 @@ int chemfp_set_option_report_popcount(int);
 int chemfp_get_option_report_intersect_popcount(void);
 int chemfp_set_option_report_intersect_popcount(int);
 
+int chemfp_get_option_tile_size(void);
+int chemfp_set_option_tile_size(int);
+
 int chemfp_add_hit(chemfp_search_result *result, int target_index, double score);
 
+/* Access the scores of a chemfp_search_result, whatever its score type */
+
+static inline uint16_t chemfp_uint16_score(double score) {
+  if (score <= 0.0) {
+    return 0;
+  }
+  if (score >= 1.0) {
+    return CHEMFP_UINT16_SCORE_SCALE;
+  }
+  return (uint16_t) (score * CHEMFP_UINT16_SCORE_SCALE + 0.5);
+}
+
+static inline double chemfp_get_hit_score(const chemfp_search_result *result, int i) {
+  switch (result->score_type) {
+  case CHEMFP_SCORE_FLOAT: return ((const float *) result->scores)[i];
+  case CHEMFP_SCORE_UINT16: return ((const uint16_t *) result->scores)[i] / (double) CHEMFP_UINT16_SCORE_SCALE;
+  default: return ((const double *) result->scores)[i];
+  }
+}
+
+static inline void chemfp_set_hit_score(chemfp_search_result *result, int i, double score) {
+  switch (result->score_type) {
+  case CHEMFP_SCORE_FLOAT: ((float *) result->scores)[i] = (float) score; break;
+  case CHEMFP_SCORE_UINT16: ((uint16_t *) result->scores)[i] = chemfp_uint16_score(score); break;
+  default: ((double *) result->scores)[i] = score; break;
+  }
+}
+
+/* Return the score as it would be after storing it with the given
+   score type. A uint16 score outside of 0.0 to 1.0 is left as-is,
+   so it stays above or below every stored score. */
+static inline double chemfp_round_score(int score_type, double score) {
+  switch (score_type) {
+  case CHEMFP_SCORE_FLOAT: return (float) score;
+  case CHEMFP_SCORE_UINT16:
+    if (score < 0.0 || score > 1.0) {
+      return score;
+    }
+    return chemfp_uint16_score(score) / (double) CHEMFP_UINT16_SCORE_SCALE;
+  default: return score;
+  }
+}
+
 #endif
@@ -0,0 +1,285 @@
+#include <stdlib.h>
+#include <string.h>
+
+#include "chemfp.h"
+#include "chemfp_internal.h"
+
+/* Substructure screening with a bit-sliced inverted index.
+
+   A target can only match a substructure query if every bit set in
+   the query is also set in the target. Testing that one target at a
+   time means reading the entire arena for every query. Instead, the
+   contains index stores the transpose of the arena. For each of the
+   num_bits fingerprint bits there is a "posting" bitmap with one bit
+   per fingerprint in the range [start, end). It uses num_words 64-bit
+   words, where num_words = ceil((end-start)/64), so posting b is
+
+     postings[b*num_words] ... postings[(b+1)*num_words-1]
+
+   and bit j of the posting is set if fingerprint start+j has bit b
+   set. bit_counts[b] is the number of fingerprints with bit b set.
+
+   The screen for a query is the AND of the postings for the bits in
+   the query. The postings are ANDed together from the rarest bit to
+   the most common, which quickly narrows the candidate set, and the
+   search stops once there are no candidates left. If the arena is
+   ordered by popcount then targets with fewer bits than the query are
+   skipped entirely. A query with no bits set matches every target. */
+
+int
+chemfp_get_contains_index_num_words(int num_fingerprints) {
+  if (num_fingerprints < 0) {
+    return CHEMFP_BAD_ARG;
+  }
+  return (num_fingerprints + 63) / 64;
+}
+
+int
+chemfp_make_contains_index(int num_bits, int storage_size, const unsigned char *arena,
+                           int start, int end,
+                           int num_words, uint64_t *postings, int *bit_counts) {
+  int fp_size = (num_bits+7) / 8;
+  int fp_index, byte_index, bit, value;
+  int word;
+  uint64_t mask;
+  const unsigned char *fp;
+
+  if (start > end) {
+    end = start;
+  }
+  if (num_words != chemfp_get_contains_index_num_words(end - start)) {
+    return CHEMFP_BAD_ARG;
+  }
+  memset(postings, 0, ((size_t) num_bits) * num_words * sizeof(uint64_t));
+  memset(bit_counts, 0, num_bits * sizeof(int));
+
+  fp = arena + start*storage_size;
+  for (fp_index=0; fp_index<end-start; fp_index++, fp += storage_size) {
+    word = fp_index / 64;
+    mask = ((uint64_t) 1) << (fp_index % 64);
+    for (byte_index=0; byte_index<fp_size; byte_index++) {
+      value = fp[byte_index];
+      for (bit=byte_index*8; value; bit++, value >>= 1) {
+        if (value & 1) {
+          if (bit >= num_bits) {
+            /* The bits after num_bits must be 0 */
+            return CHEMFP_BAD_FINGERPRINT;
+          }
+          postings[((size_t) bit)*num_words + word] |= mask;
+          bit_counts[bit]++;
+        }
+      }
+    }
+  }
+  return CHEMFP_OK;
+}
+
+typedef struct {
+  int count;
+  int bit;
+} bit_count_pair;
+
+static int
+compare_bit_counts(const void *a, const void *b) {
+  const bit_count_pair *x = a, *y = b;
+  if (x->count != y->count) {
+    return (x->count < y->count) ? -1 : 1;
+  }
+  return x->bit - y->bit;
+}
+
+/* Compute the candidates for one query. The candidates are stored */
+/* in candidates[first_word:num_words] and the rest are not used. */
+/* Returns the first word to use, or num_words if there are no */
+/* candidates, or -1 if out of memory. */
+static int
+screen_query(int num_bits, const unsigned char *query_fp,
+             int target_start, int target_end,
+             int num_words, const uint64_t *postings, const int *bit_counts,
+             const int *target_popcount_indices,
+             uint64_t *candidates) {
+  int fp_size = (num_bits+7) / 8;
+  int num_query_bits = 0, query_popcount;
+  int byte_index, bit, value, i, word, first_word, first_target;
+  int num_targets = target_end - target_start;
+  bit_count_pair *query_bits;
+  const uint64_t *posting;
+  uint64_t any;
+
+  query_popcount = chemfp_byte_popcount(fp_size, query_fp);
+  if (query_popcount > num_bits) {
+    /* Bits are set after num_bits, so nothing can match */
+    return num_words;
+  }
+
+  /* In a popcount-ordered arena, skip targets with fewer bits than the query */
+  first_word = 0;
+  if (target_popcount_indices != NULL) {
+    first_target = target_popcount_indices[query_popcount];
+    if (first_target >= target_end) {
+      return num_words;
+    }
+    if (first_target > target_start) {
+      first_word = (first_target - target_start) / 64;
+    }
+  }
+
+  if (query_popcount == 0) {
+    /* Everything matches */
+    for (word=first_word; word<num_words; word++) {
+      candidates[word] = ~((uint64_t) 0);
+    }
+    if (num_targets % 64) {
+      candidates[num_words-1] = (((uint64_t) 1) << (num_targets % 64)) - 1;
+    }
+    return first_word;
+  }
+
+  query_bits = (bit_count_pair *) malloc(query_popcount * sizeof(bit_count_pair));
+  if (query_bits == NULL) {
+    return -1;
+  }
+  for (byte_index=0; byte_index<fp_size; byte_index++) {
+    value = query_fp[byte_index];
+    for (bit=byte_index*8; value; bit++, value >>= 1) {
+      if (value & 1) {
+        if (bit >= num_bits) {
+          free(query_bits);
+          return num_words;
+        }
+        query_bits[num_query_bits].count = bit_counts[bit];
+        query_bits[num_query_bits].bit = bit;
+        num_query_bits++;
+      }
+    }
+  }
+  qsort(query_bits, num_query_bits, sizeof(bit_count_pair), compare_bit_counts);
+
+  if (query_bits[0].count == 0) {
+    free(query_bits);
+    return num_words;
+  }
+  posting = postings + ((size_t) query_bits[0].bit)*num_words;
+  memcpy(candidates+first_word, posting+first_word,
+         (num_words-first_word) * sizeof(uint64_t));
+
+  for (i=1; i<num_query_bits; i++) {
+    posting = postings + ((size_t) query_bits[i].bit)*num_words;
+    any = 0;
+    for (word=first_word; word<num_words; word++) {
+      candidates[word] &= posting[word];
+      any |= candidates[word];
+    }
+    if (!any) {
+      free(query_bits);
+      return num_words;
+    }
+  }
+  free(query_bits);
+  return first_word;
+}
+
+int
+chemfp_count_contains_arena(
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_start, int target_end,
+        int num_words, const uint64_t *postings, const int *bit_counts,
+        int *target_popcount_indices,
+        int *result_counts) {
+  int query_index, first_word, count;
+  int errval = CHEMFP_OK;
+  uint64_t *candidates;
+
+  if (query_start >= query_end) {
+    return CHEMFP_OK;
+  }
+  if (num_words != chemfp_get_contains_index_num_words(target_end - target_start)) {
+    return CHEMFP_BAD_ARG;
+  }
+
+#if defined(_OPENMP)
+  #pragma omp parallel for private(candidates, first_word, count) schedule(dynamic)
+#endif
+  for (query_index=query_start; query_index<query_end; query_index++) {
+    count = 0;
+    if (num_words > 0) {
+      candidates = (uint64_t *) malloc(num_words * sizeof(uint64_t));
+      if (candidates == NULL) {
+        errval = CHEMFP_NO_MEM;
+      } else {
+        first_word = screen_query(num_bits, query_arena + query_index*query_storage_size,
+                                  target_start, target_end,
+                                  num_words, postings, bit_counts,
+                                  target_popcount_indices, candidates);
+        if (first_word < 0) {
+          errval = CHEMFP_NO_MEM;
+        } else {
+          count = chemfp_byte_popcount((num_words - first_word) * (int) sizeof(uint64_t),
+                                       (const unsigned char *) (candidates + first_word));
+        }
+        free(candidates);
+      }
+    }
+    result_counts[query_index - query_start] = count;
+  }
+  return errval;
+}
+
+int
+chemfp_contains_arena(
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_start, int target_end,
+        int num_words, const uint64_t *postings, const int *bit_counts,
+        int *target_popcount_indices,
+        chemfp_search_result *results) {
+  int query_index, first_word, word, offset;
+  int errval = CHEMFP_OK;
+  uint64_t *candidates, value;
+
+  if (query_start >= query_end) {
+    return CHEMFP_OK;
+  }
+  if (num_words != chemfp_get_contains_index_num_words(target_end - target_start)) {
+    return CHEMFP_BAD_ARG;
+  }
+  if (num_words == 0) {
+    return CHEMFP_OK;
+  }
+
+#if defined(_OPENMP)
+  #pragma omp parallel for private(candidates, first_word, word, offset, value) schedule(dynamic)
+#endif
+  for (query_index=query_start; query_index<query_end; query_index++) {
+    candidates = (uint64_t *) malloc(num_words * sizeof(uint64_t));
+    if (candidates == NULL) {
+      errval = CHEMFP_NO_MEM;
+      continue;
+    }
+    first_word = screen_query(num_bits, query_arena + query_index*query_storage_size,
+                              target_start, target_end,
+                              num_words, postings, bit_counts,
+                              target_popcount_indices, candidates);
+    if (first_word < 0) {
+      errval = CHEMFP_NO_MEM;
+      first_word = num_words;
+    }
+    /* Add the hits in target index order */
+    for (word=first_word; word<num_words; word++) {
+      value = candidates[word];
+      for (offset=0; value; offset++, value >>= 1) {
+        if (value & 1) {
+          if (!chemfp_add_hit(results + (query_index - query_start),
+                              target_start + word*64 + offset, 0.0)) {
+            errval = CHEMFP_NO_MEM;
+          }
+        }
+      }
+    }
+    free(candidates);
+  }
+  return errval;
+}
@@ -33,15 +33,24 @@
 #define bit_SSE4_1  (1 << 19)
 #define bit_SSE4_2  (1 << 20)
 #define bit_POPCNT  (1 << 23)
+#define bit_OSXSAVE (1 << 27)
 #define bit_AVX     (1 << 28)
 
 /* %edx bit flags */
 #define bit_SSE     (1 << 25)
 #define bit_SSE2    (1 << 26)
 
+/* Extended features (info = 7): %ebx bit flags */
+#define bit_AVX2     (1 <<  5)
+#define bit_AVX512F  (1 << 16)
+
+/* Extended features (info = 7): %ecx bit flags */
+#define bit_AVX512_VPOPCNTDQ (1 << 14)
+
 /**
  * Portable cpuid implementation for x86 and x86-64 CPUs
- * (supports PIC and non-PIC code).
+ * (supports PIC and non-PIC code). Leaves with sub-leaves,
+ * like the extended features in leaf 7, use sub-leaf 0.
  * @return  1 if the CPU supports the cpuid instruction else -1.
  */
 static int cpuid(unsigned int info,
@@ -52,7 +61,7 @@ static int cpuid(unsigned int info,
 {
 #if defined(_MSC_VER) && (defined(_WIN32) || defined(_WIN64))
   int regs[4];
-  __cpuid(regs, info);
+  __cpuidex(regs, info, 0);
   *eax = regs[0];
   *ebx = regs[1];
   *ecx = regs[2];
@@ -60,6 +69,7 @@ static int cpuid(unsigned int info,
   return 1;
 #elif defined(__i386__) || defined(__i386)
   *eax = info;
+  *ecx = 0;
   #if defined(__PIC__)
   __asm__ __volatile__ (
    "mov %%ebx, %%esi;" /* save %ebx PIC register */
@@ -67,24 +77,25 @@ static int cpuid(unsigned int info,
    "xchg %%ebx, %%esi;"
    : "+a" (*eax), 
      "=S" (*ebx),
-     "=c" (*ecx),
+     "+c" (*ecx),
      "=d" (*edx));
   #else
   __asm__ __volatile__ (
    "cpuid;"
    : "+a" (*eax), 
      "=b" (*ebx),
-     "=c" (*ecx),
+     "+c" (*ecx),
      "=d" (*edx));
   #endif
   return 1;
 #elif defined(__x86_64__)
   *eax = info;
+  *ecx = 0;
   __asm__ __volatile__ (
    "cpuid;"
    : "+a" (*eax), 
      "=b" (*ebx),
-     "=c" (*ecx),
+     "+c" (*ecx),
      "=d" (*edx));
   return 1;
 #else
@@ -115,6 +126,7 @@ static int get_cpuid_flags(void)
                     bit_SSE4_1 | 
                     bit_SSE4_2 | 
                     bit_POPCNT | 
+                    bit_OSXSAVE |
                     bit_AVX));
   }
   return flags;
@@ -9,6 +9,19 @@
 
 enum {ADD_TO_HEAP, REPLACE_IN_HEAP, MAXED_OUT_HEAP};
 
+/* The linear FPS searches compare a byte query fingerprint to each hex
+   target fingerprint using one of these score functions. The Tanimoto
+   ignores the Tversky alpha and beta weights. */
+typedef double (*fps_score_f)(int size, const unsigned char *byte_fp, const char *hex_fp,
+                              double alpha, double beta);
+
+static double fps_tanimoto_score(int size, const unsigned char *byte_fp, const char *hex_fp,
+                                 double alpha, double beta) {
+  (void) alpha;
+  (void) beta;
+  return chemfp_byte_hex_tanimoto(size, byte_fp, hex_fp);
+}
+
 /* Internal function to find the id field in an FPS line */
 /* (Which means the fingerprint field is from line to *id_start-1 ) */
 /* The line MUST match /^[0-9A-Fa-f]+\t[^\t\r\n]+/ */
@@ -73,9 +86,8 @@ int chemfp_fps_line_validate(int hex_size, int line_size, const char *line_start
   return chemfp_fps_find_id(hex_size, line_start, &id_start, &id_end);
 }
 
-/* Return the number of fingerprints in the fps block which are greater
-   than or equal to the specified threshold. */
-int chemfp_fps_count_tanimoto_hits(
+static int fps_count_hits(
+        fps_score_f calc_score, double alpha, double beta,
         int num_bits,
         int query_storage_size,
         const unsigned char *query_arena, int query_start, int query_end,
@@ -107,7 +119,7 @@ int chemfp_fps_count_tanimoto_hits(
     query_fp = query_arena + query_start * query_storage_size;
     for (query_index=query_start; query_index<query_end;
          query_index++, query_fp += query_storage_size) {
-      score = chemfp_byte_hex_tanimoto(fp_size, query_fp, line);
+      score = calc_score(fp_size, query_fp, line, alpha, beta);
       if (score >= threshold)
         counts[query_index]++;
     }
@@ -120,9 +132,98 @@ int chemfp_fps_count_tanimoto_hits(
   return err;
 }
 
+/* Return the number of fingerprints in the fps block which are greater
+   than or equal to the specified threshold. */
+int chemfp_fps_count_tanimoto_hits(
+        int num_bits,
+        int query_storage_size,
+        const unsigned char *query_arena, int query_start, int query_end,
+        const char *target_block, int target_block_end,
+        double threshold,
+        int *counts, int *num_lines_processed) {
+  return fps_count_hits(fps_tanimoto_score, 1.0, 1.0,
+                        num_bits, query_storage_size, query_arena, query_start, query_end,
+                        target_block, target_block_end, threshold,
+                        counts, num_lines_processed);
+}
+
+/* The same, using the Tversky similarity */
+int chemfp_fps_count_tversky_hits(
+        int num_bits,
+        int query_storage_size,
+        const unsigned char *query_arena, int query_start, int query_end,
+        const char *target_block, int target_block_end,
+        double alpha, double beta, double threshold,
+        int *counts, int *num_lines_processed) {
+  return fps_count_hits(chemfp_byte_hex_tversky, alpha, beta,
+                        num_bits, query_storage_size, query_arena, query_start, query_end,
+                        target_block, target_block_end, threshold,
+                        counts, num_lines_processed);
+}
+
+/****** Load an fps block into an arena ********/
+
+/* Decode each line of the block into the next storage_size bytes of
+   'fps', with zero padding, and set the popcount and index (starting
+   from first_index) in 'ordering'. Each id, followed by a newline, is
+   appended to the id block at *id_pos, and offsets[i] is set to the
+   end of the i-th id in this block. This is the id block layout used
+   by chemfp.id_table.IdTable. */
+int chemfp_fps_load_block(
+        int num_bytes, int storage_size,
+        const char *block, int block_end,
+        int max_fingerprints, unsigned char *fps,
+        ChemFPOrderedPopcount *ordering, int first_index,
+        int id_block_size, char *id_block, int *id_pos, unsigned int *offsets,
+        int *num_lines_processed) {
+  const char *line, *end, *id_start, *id_end;
+  int num_lines = 0, pos = *id_pos;
+  int id_len, err;
+
+  end = block + block_end;
+  if (block_end == 0 || end[-1] != '\n') {
+    err = CHEMFP_MISSING_NEWLINE;
+    goto finish;
+  }
+  line = block;
+  while (line < end) {
+    err = chemfp_fps_find_id(num_bytes*2, line, &id_start, &id_end);
+    if (err < 0)
+      goto finish;
+    if (num_lines == max_fingerprints) {
+      err = CHEMFP_BAD_ARG;
+      goto finish;
+    }
+    id_len = (int)(id_end - id_start);
+    if (id_len + 1 > id_block_size - pos) {
+      err = CHEMFP_BAD_ARG;
+      goto finish;
+    }
+
+    ordering[num_lines].popcount = chemfp_hex_decode_popcount(num_bytes, line, fps);
+    ordering[num_lines].index = first_index + num_lines;
+    memset(fps + num_bytes, 0, storage_size - num_bytes);
+    fps += storage_size;
+
+    memcpy(id_block + pos, id_start, id_len);
+    pos += id_len;
+    id_block[pos++] = '\n';
+    offsets[num_lines] = (unsigned int) pos;
+
+    num_lines++;
+    line = chemfp_to_next_line(id_end);
+  }
+  err = CHEMFP_OK;
+ finish:
+  *id_pos = pos;
+  *num_lines_processed = num_lines;
+  return err;
+}
+
 /****** Linear Tanimoto search with threshold and unlimited number of hits ********/
 
-int chemfp_fps_threshold_tanimoto_search(
+static int fps_threshold_search(
+        fps_score_f calc_score, double alpha, double beta,
         int num_bits,
         int query_storage_size,
         const unsigned char *query_arena, int query_start, int query_end,
@@ -169,7 +270,7 @@ int chemfp_fps_threshold_tanimoto_search(
     query_fp = query_arena + query_start * query_storage_size;
     for (query_index=query_start; query_index<query_end;
          query_index++, query_fp += query_storage_size) {
-      score = chemfp_byte_hex_tanimoto(fp_size, query_fp, line);
+      score = calc_score(fp_size, query_fp, line, alpha, beta);
       if (score >= threshold) {
         current_cell->score = score;
         current_cell->query_index = query_index;
@@ -192,6 +293,37 @@ int chemfp_fps_threshold_tanimoto_search(
   return retval;
 }
 
+int chemfp_fps_threshold_tanimoto_search(
+        int num_bits,
+        int query_storage_size,
+        const unsigned char *query_arena, int query_start, int query_end,
+        const char *target_block, int target_block_end,
+        double threshold,
+        int num_cells, chemfp_tanimoto_cell *cells,
+        const char ** stopped_at, int *num_lines_processed, int *num_cells_processed) {
+  return fps_threshold_search(fps_tanimoto_score, 1.0, 1.0,
+                              num_bits, query_storage_size, query_arena, query_start, query_end,
+                              target_block, target_block_end, threshold,
+                              num_cells, cells,
+                              stopped_at, num_lines_processed, num_cells_processed);
+}
+
+/* The same, using the Tversky similarity */
+int chemfp_fps_threshold_tversky_search(
+        int num_bits,
+        int query_storage_size,
+        const unsigned char *query_arena, int query_start, int query_end,
+        const char *target_block, int target_block_end,
+        double alpha, double beta, double threshold,
+        int num_cells, chemfp_tanimoto_cell *cells,
+        const char ** stopped_at, int *num_lines_processed, int *num_cells_processed) {
+  return fps_threshold_search(chemfp_byte_hex_tversky, alpha, beta,
+                              num_bits, query_storage_size, query_arena, query_start, query_end,
+                              target_block, target_block_end, threshold,
+                              num_cells, cells,
+                              stopped_at, num_lines_processed, num_cells_processed);
+}
+
 /****** Manage the best-of-N Tanimoto linear searches ********/
 
 /* Compare two heap entries based on their score.
@@ -300,7 +432,8 @@ static char *new_string(const char *start, const char *end) {
 }
 
 
-int chemfp_fps_knearest_tanimoto_search_feed(
+static int fps_knearest_search_feed(
+        fps_score_f calc_score, double alpha, double beta,
         chemfp_fps_knearest_search *knearest_search,
         int target_block_len, const char *target_block) {
   int k;
@@ -337,7 +470,7 @@ int chemfp_fps_knearest_tanimoto_search_feed(
     for (i=0; i<knearest_search->num_queries; i++, query_fp += query_storage_size, heap++) {
       switch(heap->heap_state) {
       case ADD_TO_HEAP:
-        score = chemfp_byte_hex_tanimoto(query_fp_size, query_fp, line);
+        score = calc_score(query_fp_size, query_fp, line, alpha, beta);
         if (score >= threshold) {
           heap->scores[heap->size] = score;
           s = new_string(id_start, id_end);
@@ -356,7 +489,7 @@ int chemfp_fps_knearest_tanimoto_search_feed(
         break;
 
       case REPLACE_IN_HEAP:
-        score = chemfp_byte_hex_tanimoto(query_fp_size, query_fp, line);
+        score = calc_score(query_fp_size, query_fp, line, alpha, beta);
         if (score > heap->scores[0]) {
           heap->scores[0] = score;
           free(heap->ids[0]);
@@ -389,6 +522,22 @@ int chemfp_fps_knearest_tanimoto_search_feed(
   return retval;
 }
 
+int chemfp_fps_knearest_tanimoto_search_feed(
+        chemfp_fps_knearest_search *knearest_search,
+        int target_block_len, const char *target_block) {
+  return fps_knearest_search_feed(fps_tanimoto_score, 1.0, 1.0,
+                                  knearest_search, target_block_len, target_block);
+}
+
+/* The same, using the Tversky similarity */
+int chemfp_fps_knearest_tversky_search_feed(
+        chemfp_fps_knearest_search *knearest_search,
+        double alpha, double beta,
+        int target_block_len, const char *target_block) {
+  return fps_knearest_search_feed(chemfp_byte_hex_tversky, alpha, beta,
+                                  knearest_search, target_block_len, target_block);
+}
+
 void chemfp_fps_knearest_search_free(chemfp_fps_knearest_search *knearest_search) {
   free(knearest_search->_all_scores);
   free(knearest_search->_all_ids);
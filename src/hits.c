@@ -566,45 +566,80 @@ int chemfp_get_num_hits(chemfp_search_result *result) {
   return result->num_hits;
 }
 
+/* The score storage types, in chemfp_score_types order */
+static const char *score_type_names[] = {"double", "float", "uint16"};
+static const int score_type_sizes[] = {sizeof(double), sizeof(float), sizeof(uint16_t)};
+
+int chemfp_get_num_score_types(void) {
+  return sizeof(score_type_names) / sizeof(score_type_names[0]);
+}
+
+const char *chemfp_get_score_type_name(int score_type) {
+  if (score_type < 0 || score_type >= chemfp_get_num_score_types()) {
+    return NULL;
+  }
+  return score_type_names[score_type];
+}
+
+int chemfp_get_score_type_size(int score_type) {
+  if (score_type < 0 || score_type >= chemfp_get_num_score_types()) {
+    return -1;
+  }
+  return score_type_sizes[score_type];
+}
+
+/* The scores and indices share one block, with the scores first. */
+/* An even number of elements keeps the indices aligned after */
+/* an array of 2 byte scores. */
+static int resize_hits(chemfp_search_result *result, int num_allocated) {
+  int score_size = score_type_sizes[result->score_type];
+  int num_hits = result->num_hits;
+  char *scores;
+  int *indices;
+
+  num_allocated += (num_allocated & 1);
+  if (result->num_allocated == 0 || num_hits == 0) {
+    if (result->num_allocated != 0) {
+      free(result->scores);
+    }
+    scores = (char *) malloc(num_allocated * (sizeof(int)+score_size));
+    if (!scores) {
+      return 0;
+    }
+    indices = (int *) (scores + num_allocated * score_size);
+  } else {
+    scores = (char *) realloc(result->scores, num_allocated * (sizeof(int)+score_size));
+    if (!scores) {
+      return 0;
+    }
+    /* Shift the indices to its new location */
+    indices = (int *) (scores + num_allocated * score_size);
+    memmove(indices, scores + result->num_allocated * score_size, num_hits*sizeof(int));
+  }
+  result->num_allocated = num_allocated;
+  result->indices = indices;
+  result->scores = scores;
+  return 1;
+}
+
 int chemfp_add_hit(chemfp_search_result *result,
                    int target_index, double score) {
   int num_hits = result->num_hits;
   int num_allocated = result->num_allocated;
-  int *indices, *old_indices;
-  double *scores;
 
   if (num_hits == num_allocated) {
     if (num_hits == 0) {
       num_allocated = 6;
-      scores = (double *) malloc(num_allocated * (sizeof(int)+sizeof(double)));
-      if (!scores) {
-	return 0;
-      }
-      indices = (int *) (scores + num_allocated);
-      result->num_allocated = num_allocated;
-      result->indices = indices;
-      result->scores = scores;
     } else {
       /* Grow by about 12% each time; this is the Python listobject resize strategy */
       num_allocated += (num_allocated >> 3) + (num_allocated < 9 ? 3 : 6);
-      scores = (double *) realloc(result->scores, num_allocated * (sizeof(int)+sizeof(double)));
-      if (!scores) {
-	return 0;
-      }
-      /* Shift the indices to its new location */
-      old_indices = (int *) (scores + num_hits);
-      indices = (int *) (scores + num_allocated);
-      memmove(indices, old_indices, num_hits*sizeof(int));
-      result->num_allocated = num_allocated;
-      result->indices = indices;
-      result->scores = scores;
     }
-  } else {
-    indices = result->indices;
-    scores = result->scores;
+    if (!resize_hits(result, num_allocated)) {
+      return 0;
+    }
   }
-  indices[num_hits] = target_index;
-  scores[num_hits] = score;
+  result->indices[num_hits] = target_index;
+  chemfp_set_hit_score(result, num_hits, score);
   result->num_hits = num_hits+1;
   return 1;
 }
@@ -614,12 +649,12 @@ int chemfp_fill_lower_triangle(int n, chemfp_search_result *results) {
   int *sizes = (int *) malloc(n * sizeof(int));
   int retval;
   int *counts = (int *) malloc(n * sizeof(int));
-  int num_hits, num_allocated;
-  double *scores;
-  int *old_indices, *indices;
+  int num_allocated;
   chemfp_search_result *result;
 
-  if (!sizes) {
+  if (!sizes || !counts) {
+    free(sizes);
+    free(counts);
     return CHEMFP_NO_MEM;
   }
   /* Save all of the count information */
@@ -634,36 +669,22 @@ int chemfp_fill_lower_triangle(int n, chemfp_search_result *results) {
   }
 
   /* Increase the sizes */
+  retval = CHEMFP_OK;
   for (i=0; i<n; i++) {
     result = results+i;
     num_allocated = result->num_hits + counts[i];
-    if (result->num_hits + counts[i] > result->num_allocated) {
-      if (result->num_allocated == 0) {
-        scores = (double *) malloc(num_allocated * (sizeof(int)+sizeof(double)));
-        if (!scores) {
-          return CHEMFP_NO_MEM;
-        }
-        indices = (int *) (scores + num_allocated);
-      } else {
-        num_hits = result->num_hits;
-        scores = (double *) realloc(result->scores, num_allocated * (sizeof(int)+sizeof(double)));
-        if (!scores) {
-          return CHEMFP_NO_MEM;
-        }
-        old_indices = (int *) (scores + result->num_allocated);
-        indices = (int *) (scores + num_allocated);
-        memmove(indices, old_indices, num_hits*sizeof(int));
+    if (num_allocated > result->num_allocated) {
+      if (!resize_hits(result, num_allocated)) {
+        retval = CHEMFP_NO_MEM;
+        goto done;
       }
-      result->num_allocated = num_allocated;
-      result->indices = indices;
-      result->scores = scores;
     }
   }
 
-  retval = CHEMFP_OK;
   for (i=0; i<n; i++) {
     for (j=0; j<sizes[i]; j++) {
-      if (!chemfp_add_hit(results+results[i].indices[j], i, results[i].scores[j])) {
+      if (!chemfp_add_hit(results+results[i].indices[j], i,
+                          chemfp_get_hit_score(results+i, j))) {
         retval = CHEMFP_NO_MEM;
         goto done;
       }
@@ -672,6 +693,61 @@ int chemfp_fill_lower_triangle(int n, chemfp_search_result *results) {
 
  done:
   free(sizes);
+  free(counts);
+  return retval;
+}
+
+/* Turn the per-row hit counts into CSR row offsets. Returns the total
+   number of hits, which is also indptr[n]. */
+long long chemfp_make_csr_indptr(int n, const int *counts, long long *indptr) {
+  int i;
+  long long total = 0;
+  for (i=0; i<n; i++) {
+    indptr[i] = total;
+    total += counts[i];
+  }
+  indptr[n] = total;
+  return total;
+}
+
+/* Copy the upper-triangle hits of a CSR matrix to the lower triangle. */
+/* The upper-triangle hits for row i must be the last upper_counts[i] */
+/* entries of the row, and the rest of the row must be unused. Going */
+/* through the rows in order puts the lower-triangle hits in increasing */
+/* column order. */
+int chemfp_fill_csr_lower_triangle(int n, const long long *indptr, const int *upper_counts,
+                                   int *indices, float *scores) {
+  int i, j;
+  long long pos, upper_start;
+  long long *next_pos = (long long *) malloc((n ? n : 1) * sizeof(long long));
+  int retval = CHEMFP_OK;
+
+  if (!next_pos) {
+    return CHEMFP_NO_MEM;
+  }
+  for (i=0; i<n; i++) {
+    next_pos[i] = indptr[i];
+  }
+  for (i=0; i<n; i++) {
+    upper_start = indptr[i+1] - upper_counts[i];
+    /* By now all of the lower-triangle hits for this row are in place */
+    if (next_pos[i] != upper_start) {
+      retval = CHEMFP_BAD_ARG;
+      break;
+    }
+    for (pos=upper_start; pos<indptr[i+1]; pos++) {
+      j = indices[pos];
+      if (j <= i || j >= n || next_pos[j] >= indptr[j+1] - upper_counts[j]) {
+        retval = CHEMFP_BAD_ARG;
+        goto done;
+      }
+      indices[next_pos[j]] = i;
+      scores[next_pos[j]] = scores[pos];
+      next_pos[j]++;
+    }
+  }
+ done:
+  free(next_pos);
   return retval;
 }
 
@@ -801,53 +877,68 @@ static reorder_method_t *chemfp_get_reorder_method(const char *name) {
   return NULL;
 }
 
+/* The reorder methods work on double scores. Other score types are */
+/* converted to doubles and back, which doesn't change their values. */
+static int reorder_hits(chemfp_search_result *result, reorder_method_t *reorder_method) {
+  int i, num_hits = result->num_hits;
+  double *scores;
+
+  if (num_hits <= 1) {
+    return CHEMFP_OK;
+  }
+  if (result->score_type == CHEMFP_SCORE_DOUBLE) {
+    scores = (double *) result->scores;
+  } else {
+    scores = (double *) malloc(num_hits * sizeof(double));
+    if (!scores) {
+      return CHEMFP_NO_MEM;
+    }
+    for (i=0; i<num_hits; i++) {
+      scores[i] = chemfp_get_hit_score(result, i);
+    }
+  }
+  if (reorder_method->reorder) {
+    reorder_method->reorder(num_hits, result->indices, scores);
+  } else {
+    hits_tim_sort(result->indices, scores, num_hits, reorder_method->hit_compare);
+  }
+  if (result->score_type != CHEMFP_SCORE_DOUBLE) {
+    for (i=0; i<num_hits; i++) {
+      chemfp_set_hit_score(result, i, scores[i]);
+    }
+    free(scores);
+  }
+  return CHEMFP_OK;
+}
+
 int chemfp_search_results_reorder(int num_results, chemfp_search_result *results,
                                   const char *ordering) {
-  int i, num_hits;
+  int i, errval;
   reorder_method_t *reorder_method = chemfp_get_reorder_method(ordering);
   if (reorder_method == NULL) {
     return CHEMFP_UNKNOWN_ORDERING;
   }
-  if (reorder_method->reorder) {
-    for (i=0; i<num_results; i++) {
-      num_hits = results[i].num_hits;
-      if (num_hits > 1) {
-        reorder_method->reorder(num_hits, results[i].indices, results[i].scores);
-      }
-    }
-  } else {
-    for (i=0; i<num_results; i++) {
-      num_hits = results[i].num_hits;
-      if (num_hits > 1) {
-        hits_tim_sort(results[i].indices, results[i].scores, num_hits,
-                      reorder_method->hit_compare);
-      }
+  for (i=0; i<num_results; i++) {
+    errval = reorder_hits(results+i, reorder_method);
+    if (errval) {
+      return errval;
     }
   }
   return CHEMFP_OK;
 }
 
 int chemfp_search_result_reorder(chemfp_search_result *result, const char *ordering) {
-  int num_hits;
   reorder_method_t *reorder_method = chemfp_get_reorder_method(ordering);
   if (reorder_method == NULL) {
     return CHEMFP_UNKNOWN_ORDERING;
   }
-  num_hits = result->num_hits;
-  if (num_hits > 1) {
-    if (reorder_method->reorder) {
-      reorder_method->reorder(num_hits, result->indices, result->scores);
-    } else {
-      hits_tim_sort(result->indices, result->scores, num_hits,
-                    reorder_method->hit_compare);
-    }
-  }
-  return CHEMFP_OK;
+  return reorder_hits(result, reorder_method);
 }
 
 void chemfp_search_result_clear(chemfp_search_result *result) {
   if (result->num_hits != 0) {
     result->num_hits=0;
+    result->num_allocated=0;
     free(result->scores);
     result->scores = NULL;
     result->indices = NULL;
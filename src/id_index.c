@@ -0,0 +1,127 @@
+#include <string.h>
+
+#include "chemfp.h"
+#include "chemfp_internal.h"
+
+/* An open-addressing hash table from identifier to record index.
+
+   The identifiers are stored in an id block, in the same layout as
+   the FPID chunk of an fpb file: each id is followed by a newline,
+   and offsets[i] is the start of id i in the block, with offsets[num_ids]
+   the end of the block. The hash table is a power-of-two sized array
+   of unsigned 32-bit values. A 0 means the slot is empty, otherwise
+   it is the record index plus one. Collisions use linear probing.
+
+   The table contains no pointers, so it can be saved to a file and
+   memory-mapped back in. The offsets and table might come directly
+   from a memory-mapped file, which doesn't guarantee alignment, so
+   they are read with memcpy. The lookup checks every offset and table
+   entry, so a damaged file cannot cause an out-of-bounds read.
+
+   If an id occurs more than once then the table contains the last
+   one, which is the same as building a Python dictionary. */
+
+static unsigned int
+hash_id(int len, const char *id) {
+  /* 32-bit FNV-1a. Changing this changes the saved table format. */
+  unsigned int h = 2166136261U;
+  int i;
+  for (i=0; i<len; i++) {
+    h ^= (unsigned char) id[i];
+    h *= 16777619U;
+  }
+  return h;
+}
+
+static unsigned int
+load_uint(const unsigned int *values, int i) {
+  unsigned int value;
+  memcpy(&value, values+i, sizeof(unsigned int));
+  return value;
+}
+
+/* Return the number of slots needed for num_ids ids. The load */
+/* factor is at most 2/3, and the minimum size is 8 slots. */
+int
+chemfp_get_id_index_size(int num_ids) {
+  long long target = ((long long) num_ids) * 3 / 2 + 1;
+  long long size = 8;
+  while (size < target) {
+    size *= 2;
+  }
+  if (size > (1<<30)) {
+    return CHEMFP_BAD_ARG;
+  }
+  return (int) size;
+}
+
+static int
+id_matches(int num_ids, int id_block_size, const char *id_block,
+           const unsigned int *offsets, unsigned int index,
+           int id_len, const char *id) {
+  unsigned int start, end;
+  if (index >= (unsigned int) num_ids) {
+    return 0;
+  }
+  start = load_uint(offsets, index);
+  end = load_uint(offsets, index+1);
+  return (start < end && end <= (unsigned int) id_block_size &&
+          (int)(end - start - 1) == id_len &&
+          memcmp(id_block + start, id, id_len) == 0);
+}
+
+int
+chemfp_make_id_index(int num_ids, int id_block_size, const char *id_block,
+                     const unsigned int *offsets,
+                     int table_size, unsigned int *table) {
+  unsigned int mask, slot, entry, start, end;
+  int i;
+
+  if (table_size <= 0 || (table_size & (table_size-1)) || table_size <= num_ids) {
+    return CHEMFP_BAD_ARG;
+  }
+  mask = (unsigned int) table_size - 1;
+  memset(table, 0, table_size * sizeof(unsigned int));
+
+  for (i=0; i<num_ids; i++) {
+    start = load_uint(offsets, i);
+    end = load_uint(offsets, i+1);
+    if (end <= start || end > (unsigned int) id_block_size) {
+      return CHEMFP_BAD_ID;
+    }
+    slot = hash_id(end-start-1, id_block+start) & mask;
+    while ((entry = table[slot]) != 0) {
+      if (id_matches(num_ids, id_block_size, id_block, offsets, entry-1,
+                     end-start-1, id_block+start)) {
+        break;
+      }
+      slot = (slot + 1) & mask;
+    }
+    table[slot] = i+1;
+  }
+  return CHEMFP_OK;
+}
+
+/* Return the index of the id, or -1 if it isn't present */
+int
+chemfp_id_index_lookup(int num_ids, int id_block_size, const char *id_block,
+                       const unsigned int *offsets,
+                       int table_size, const unsigned int *table,
+                       int id_len, const char *id) {
+  unsigned int mask = (unsigned int) table_size - 1;
+  unsigned int slot = hash_id(id_len, id) & mask;
+  unsigned int entry;
+  int probe;
+
+  for (probe=0; probe<table_size; probe++) {
+    entry = load_uint(table, slot);
+    if (entry == 0) {
+      break;
+    }
+    if (id_matches(num_ids, id_block_size, id_block, offsets, entry-1, id_len, id)) {
+      return (int) entry-1;
+    }
+    slot = (slot + 1) & mask;
+  }
+  return -1;
+}
@@ -0,0 +1,370 @@
+#include <stdlib.h>
+#include <string.h>
+
+#include "chemfp.h"
+#include "chemfp_internal.h"
+
+/* Approximate k-nearest search with MinHash and banded LSH.
+
+   For binary fingerprints the Tanimoto is the Jaccard similarity of
+   the sets of on-bits. If h is a random hash function on bit
+   positions then the probability that the on-bit with the smallest
+   h(bit) is the same for two fingerprints is their Tanimoto. The
+   MinHash signature of a fingerprint is that minimum for each of
+   num_bands*rows_per_band hash functions.
+
+   The signature is split into num_bands bands of rows_per_band values,
+   and each band is hashed to a 32-bit key. Two fingerprints with
+   Tanimoto t have the same key for a given band with probability
+   about t**rows_per_band, so similar fingerprints are very likely to
+   share at least one band key, and dissimilar ones are not.
+
+   The index has one table for each band, with a (key, index) entry
+   for each fingerprint in [start, end), where index is the offset
+   from start. Table b is entries[b*num_fingerprints] to
+   entries[(b+1)*num_fingerprints-1], sorted by key then index. A
+   query looks up its keys in the first num_probe_bands tables. The
+   fingerprints with a matching key are the candidates, and the
+   candidates are re-scored with the exact Tanimoto. Probing fewer
+   bands is faster but finds fewer of the true nearest neighbors.
+
+   The hash functions are h_i(bit) = (a_i*bit + b_i) >> 32 using 64-bit
+   arithmetic, where a_i (odd) and b_i come from a splitmix64 sequence
+   started at 'seed', so the index is reproducible. */
+
+static uint64_t
+splitmix64(uint64_t *state) {
+  uint64_t z = (*state += 0x9E3779B97F4A7C15ULL);
+  z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+  z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+  return z ^ (z >> 31);
+}
+
+int
+chemfp_check_lsh_parameters(int num_bands, int rows_per_band) {
+  if (num_bands < 1 || num_bands > CHEMFP_LSH_MAX_BANDS ||
+      rows_per_band < 1 || rows_per_band > CHEMFP_LSH_MAX_ROWS_PER_BAND) {
+    return CHEMFP_BAD_ARG;
+  }
+  return CHEMFP_OK;
+}
+
+/* Get the a_i and b_i coefficients, interleaved */
+static void
+make_hash_coefficients(unsigned int seed, int num_hashes, uint64_t *coefficients) {
+  uint64_t state = seed;
+  int i;
+  for (i=0; i<num_hashes; i++) {
+    coefficients[2*i] = splitmix64(&state) | 1;
+    coefficients[2*i+1] = splitmix64(&state);
+  }
+}
+
+/* Get the band keys for a fingerprint, using 'bits' as scratch space */
+/* for the list of on-bits. An empty fingerprint has the maximum hash */
+/* value in every row. */
+static void
+get_band_keys(int fp_size, const unsigned char *fp,
+              int num_bands, int rows_per_band, const uint64_t *coefficients,
+              int *bits, uint32_t *keys) {
+  int num_on_bits = 0;
+  int byte_index, bit, value, band, row, i;
+  uint32_t minhash, h;
+  uint64_t a, b, key;
+
+  for (byte_index=0; byte_index<fp_size; byte_index++) {
+    value = fp[byte_index];
+    for (bit=byte_index*8; value; bit++, value >>= 1) {
+      if (value & 1) {
+        bits[num_on_bits++] = bit;
+      }
+    }
+  }
+
+  for (band=0; band<num_bands; band++) {
+    key = 0xCBF29CE484222325ULL;
+    for (row=0; row<rows_per_band; row++) {
+      a = coefficients[2*(band*rows_per_band + row)];
+      b = coefficients[2*(band*rows_per_band + row) + 1];
+      minhash = 0xFFFFFFFFU;
+      for (i=0; i<num_on_bits; i++) {
+        h = (uint32_t) ((a * (uint64_t) bits[i] + b) >> 32);
+        if (h < minhash) {
+          minhash = h;
+        }
+      }
+      key = (key ^ minhash) * 0x100000001B3ULL;
+      key ^= key >> 29;
+    }
+    keys[band] = (uint32_t) (key ^ (key >> 32));
+  }
+}
+
+static int
+compare_lsh_entries(const void *x, const void *y) {
+  const chemfp_lsh_entry *a = x, *b = y;
+  if (a->key != b->key) {
+    return (a->key < b->key) ? -1 : 1;
+  }
+  return (a->index < b->index) ? -1 : (a->index > b->index);
+}
+
+int
+chemfp_make_lsh_index(int num_bits, int storage_size, const unsigned char *arena,
+                      int start, int end,
+                      int num_bands, int rows_per_band, unsigned int seed,
+                      chemfp_lsh_entry *entries) {
+  int fp_size = (num_bits+7) / 8;
+  int num_fingerprints, fp_index, band;
+  int errval = CHEMFP_OK;
+  int *bits;
+  uint32_t *keys;
+  uint64_t *coefficients;
+
+  if (chemfp_check_lsh_parameters(num_bands, rows_per_band) != CHEMFP_OK) {
+    return CHEMFP_BAD_ARG;
+  }
+  if (start >= end) {
+    return CHEMFP_OK;
+  }
+  num_fingerprints = end - start;
+  coefficients = (uint64_t *) malloc(2 * num_bands * rows_per_band * sizeof(uint64_t));
+  if (coefficients == NULL) {
+    return CHEMFP_NO_MEM;
+  }
+  make_hash_coefficients(seed, num_bands * rows_per_band, coefficients);
+
+  /* Compute the band keys for each fingerprint */
+#if defined(_OPENMP)
+  #pragma omp parallel private(bits, keys, fp_index, band)
+#endif
+  {
+    bits = (int *) malloc(fp_size * 8 * sizeof(int));
+    keys = (uint32_t *) malloc(num_bands * sizeof(uint32_t));
+    /* Every thread must reach the "omp for", even without its scratch space */
+#if defined(_OPENMP)
+    #pragma omp for schedule(static)
+#endif
+    for (fp_index=0; fp_index<num_fingerprints; fp_index++) {
+      if (bits == NULL || keys == NULL) {
+        errval = CHEMFP_NO_MEM;
+        continue;
+      }
+      get_band_keys(fp_size, arena + (start+fp_index)*storage_size,
+                    num_bands, rows_per_band, coefficients, bits, keys);
+      for (band=0; band<num_bands; band++) {
+        entries[((size_t) band)*num_fingerprints + fp_index].key = keys[band];
+        entries[((size_t) band)*num_fingerprints + fp_index].index = fp_index;
+      }
+    }
+    free(bits);
+    free(keys);
+  }
+  free(coefficients);
+  if (errval != CHEMFP_OK) {
+    return errval;
+  }
+
+  /* Sort each table */
+#if defined(_OPENMP)
+  #pragma omp parallel for schedule(dynamic)
+#endif
+  for (band=0; band<num_bands; band++) {
+    qsort(entries + ((size_t) band)*num_fingerprints, num_fingerprints,
+          sizeof(chemfp_lsh_entry), compare_lsh_entries);
+  }
+  return CHEMFP_OK;
+}
+
+
+/* Candidates for one query, and the hits which pass the threshold */
+
+typedef struct {
+  double score;
+  int index;
+} lsh_hit;
+
+static int
+compare_ints(const void *x, const void *y) {
+  int a = *(const int *) x, b = *(const int *) y;
+  return (a < b) ? -1 : (a > b);
+}
+
+/* Order by decreasing score, then increasing index */
+static int
+compare_lsh_hits(const void *x, const void *y) {
+  const lsh_hit *a = x, *b = y;
+  if (a->score != b->score) {
+    return (a->score > b->score) ? -1 : 1;
+  }
+  return (a->index < b->index) ? -1 : (a->index > b->index);
+}
+
+/* Append the indices with the given key in the table to the candidates */
+static int
+add_candidates(const chemfp_lsh_entry *table, int num_fingerprints, uint32_t key,
+               int **candidates, size_t *num_candidates, size_t *max_candidates) {
+  int lo = 0, hi = num_fingerprints, mid;
+  size_t new_size;
+  int *new_candidates;
+
+  /* Find the first entry with the key */
+  while (lo < hi) {
+    mid = lo + (hi - lo) / 2;
+    if (table[mid].key < key) {
+      lo = mid + 1;
+    } else {
+      hi = mid;
+    }
+  }
+  for (; lo < num_fingerprints && table[lo].key == key; lo++) {
+    if (*num_candidates == *max_candidates) {
+      new_size = (*max_candidates) * 2 + 64;
+      new_candidates = (int *) realloc(*candidates, new_size * sizeof(int));
+      if (new_candidates == NULL) {
+        return 0;
+      }
+      *candidates = new_candidates;
+      *max_candidates = new_size;
+    }
+    (*candidates)[(*num_candidates)++] = table[lo].index;
+  }
+  return 1;
+}
+
+int
+chemfp_knearest_tanimoto_lsh_arena(
+        int k, double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int num_bands, int rows_per_band, unsigned int seed,
+        const chemfp_lsh_entry *entries, int num_probe_bands,
+        chemfp_search_result *results) {
+  int fp_size = (num_bits+7) / 8;
+  int num_targets = target_end - target_start;
+  int query_index, band, i, num_hits;
+  /* Up to num_probe_bands*num_targets candidates, which can be more than INT_MAX */
+  size_t candidate_i, num_candidates, max_candidates;
+  int query_popcount, target_popcount, intersect_popcount;
+  int errval = CHEMFP_OK;
+  double score;
+  const unsigned char *query_fp, *target_fp;
+  int *bits, *candidates;
+  uint32_t *keys;
+  uint64_t *coefficients;
+  lsh_hit *hits;
+
+  chemfp_popcount_f calc_popcount;
+  chemfp_intersect_popcount_f calc_intersect_popcount;
+
+  if (chemfp_check_lsh_parameters(num_bands, rows_per_band) != CHEMFP_OK ||
+      num_probe_bands < 1 || num_probe_bands > num_bands) {
+    return CHEMFP_BAD_ARG;
+  }
+  if (query_start >= query_end || target_start >= target_end || k == 0) {
+    return CHEMFP_OK;
+  }
+  coefficients = (uint64_t *) malloc(2 * num_bands * rows_per_band * sizeof(uint64_t));
+  if (coefficients == NULL) {
+    return CHEMFP_NO_MEM;
+  }
+  make_hash_coefficients(seed, num_bands * rows_per_band, coefficients);
+
+  calc_popcount = chemfp_select_popcount(num_bits, target_storage_size, target_arena);
+  calc_intersect_popcount = chemfp_select_intersect_popcount(
+                num_bits, query_storage_size, query_arena,
+                target_storage_size, target_arena);
+
+#if defined(_OPENMP)
+  #pragma omp parallel private(bits, keys, candidates, hits, max_candidates, num_candidates, \
+          num_hits, query_index, query_fp, query_popcount, band, i, candidate_i, target_fp, \
+          target_popcount, intersect_popcount, score)
+#endif
+  {
+    bits = (int *) malloc(fp_size * 8 * sizeof(int));
+    keys = (uint32_t *) malloc(num_bands * sizeof(uint32_t));
+    candidates = NULL;
+    hits = NULL;
+    max_candidates = 0;
+    /* Every thread must reach the "omp for", even without its scratch space */
+#if defined(_OPENMP)
+    #pragma omp for schedule(dynamic)
+#endif
+    for (query_index=query_start; query_index<query_end; query_index++) {
+      if (bits == NULL || keys == NULL) {
+        errval = CHEMFP_NO_MEM;
+        continue;
+      }
+      query_fp = query_arena + query_index * query_storage_size;
+      query_popcount = calc_popcount(fp_size, query_fp);
+      if (query_popcount == 0) {
+        /* Like the exact search, an empty query has no hits */
+        continue;
+      }
+      get_band_keys(fp_size, query_fp, num_probe_bands, rows_per_band, coefficients,
+                    bits, keys);
+
+      /* Gather the unique candidates */
+      num_candidates = 0;
+      for (band=0; band<num_probe_bands; band++) {
+        if (!add_candidates(entries + ((size_t) band)*num_targets, num_targets, keys[band],
+                            &candidates, &num_candidates, &max_candidates)) {
+          errval = CHEMFP_NO_MEM;
+          num_candidates = 0;
+          break;
+        }
+      }
+      if (num_candidates == 0) {
+        continue;
+      }
+      qsort(candidates, num_candidates, sizeof(int), compare_ints);
+
+      free(hits);
+      hits = (lsh_hit *) malloc(num_candidates * sizeof(lsh_hit));
+      if (hits == NULL) {
+        errval = CHEMFP_NO_MEM;
+        continue;
+      }
+
+      /* Re-score them */
+      num_hits = 0;
+      for (candidate_i=0; candidate_i<num_candidates; candidate_i++) {
+        if (candidate_i > 0 && candidates[candidate_i] == candidates[candidate_i-1]) {
+          continue;
+        }
+        target_fp = target_arena + (target_start + candidates[candidate_i]) * target_storage_size;
+        target_popcount = calc_popcount(fp_size, target_fp);
+        intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+        score = ((double) intersect_popcount) /
+                  (query_popcount + target_popcount - intersect_popcount);
+        if (score >= threshold) {
+          hits[num_hits].score = score;
+          hits[num_hits].index = target_start + candidates[candidate_i];
+          num_hits++;
+        }
+      }
+
+      /* Keep the best k, in decreasing score order */
+      qsort(hits, num_hits, sizeof(lsh_hit), compare_lsh_hits);
+      if (num_hits > k) {
+        num_hits = k;
+      }
+      for (i=0; i<num_hits; i++) {
+        if (!chemfp_add_hit(results + (query_index - query_start),
+                            hits[i].index, hits[i].score)) {
+          errval = CHEMFP_NO_MEM;
+          break;
+        }
+      }
+    }
+    free(bits);
+    free(keys);
+    free(candidates);
+    free(hits);
+  }
+  free(coefficients);
+  return errval;
+}
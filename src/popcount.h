@@ -11,7 +11,9 @@ enum {
   CHEMFP_ALIGN4,
   CHEMFP_ALIGN8_SMALL,
   CHEMFP_ALIGN8_LARGE,
-  CHEMFP_ALIGN_SSSE3
+  CHEMFP_ALIGN_SSSE3,
+  CHEMFP_ALIGN_AVX2,
+  CHEMFP_ALIGN_AVX512
 };
 
 /* These are in the same order as compile_time_methods */
@@ -22,7 +24,9 @@ enum {
   CHEMFP_LAURADOUX,
   CHEMFP_POPCNT,
   CHEMFP_GILLIES,
-  CHEMFP_SSSE3
+  CHEMFP_SSSE3,
+  CHEMFP_AVX2,
+  CHEMFP_AVX512
 };
 
 typedef int (*chemfp_method_check_f)(void);
@@ -65,8 +69,25 @@ int chemfp_intersect_popcount_lauradoux(int size, const uint64_t *fp1, const uin
 
 int chemfp_popcount_popcnt(int size, const uint64_t *fp);
 int chemfp_intersect_popcount_popcnt(int size, const uint64_t *fp1, const uint64_t *fp2);
+int chemfp_intersect_popcount_popcnt_166(int size, const uint64_t *fp1, const uint64_t *fp2);
+int chemfp_intersect_popcount_popcnt_881(int size, const uint64_t *fp1, const uint64_t *fp2);
+int chemfp_intersect_popcount_popcnt_1024(int size, const uint64_t *fp1, const uint64_t *fp2);
+int chemfp_intersect_popcount_popcnt_2048(int size, const uint64_t *fp1, const uint64_t *fp2);
+int chemfp_intersect_popcount_popcnt_4096(int size, const uint64_t *fp1, const uint64_t *fp2);
 
 int chemfp_popcount_SSSE3(int, const unsigned*);
 int chemfp_intersect_popcount_SSSE3(int, const unsigned*, const unsigned*);
 int chemfp_has_ssse3(void);
+
+int chemfp_popcount_avx2(int size, const uint64_t *fp);
+int chemfp_intersect_popcount_avx2(int size, const uint64_t *fp1, const uint64_t *fp2);
+int chemfp_has_avx2(void);
+
+int chemfp_popcount_avx512(int size, const uint64_t *fp);
+int chemfp_intersect_popcount_avx512(int size, const uint64_t *fp1, const uint64_t *fp2);
+int chemfp_intersect_popcount_avx512_166(int size, const uint64_t *fp1, const uint64_t *fp2);
+int chemfp_intersect_popcount_avx512_1024(int size, const uint64_t *fp1, const uint64_t *fp2);
+int chemfp_intersect_popcount_avx512_2048(int size, const uint64_t *fp1, const uint64_t *fp2);
+int chemfp_intersect_popcount_avx512_4096(int size, const uint64_t *fp1, const uint64_t *fp2);
+int chemfp_has_avx512_vpopcntdq(void);
 #endif
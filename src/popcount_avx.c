@@ -0,0 +1,314 @@
+/*
+  Popcount functions using the AVX2 and AVX-512 instruction sets.
+
+  The AVX2 version uses the Harley-Seal carry-save adder with a PSHUFB
+  nibble lookup, from Mula W, Kurz N, and Lemire D. "Faster Population
+  Counts Using AVX2 Instructions." The Computer Journal 61(1), 2018.
+  The AVX-512 version uses the VPOPCNTQ instruction from the
+  AVX512_VPOPCNTDQ extension.
+
+  The rest of chemfp is compiled for the baseline processor, so these
+  functions use the compiler's per-function "target" attribute instead
+  of -mavx2/-mavx512f, and the run-time checks make sure the processor
+  and operating system support the instructions before they are used.
+
+  Like the SSSE3 method, these work on complete blocks (32 bytes for
+  AVX2, 64 bytes for AVX-512), so the fingerprint storage must be
+  padded to a multiple of the block size. Unaligned loads are used, so
+  the fingerprints do not need to be aligned, though aligned
+  fingerprints are faster.
+*/
+
+#include "popcount.h"
+#include "cpuid.h"
+
+#if defined(__x86_64__) && defined(__clang__)
+  #if __clang_major__ >= 5
+    #define GENERATE_AVX2
+    #define GENERATE_AVX512
+  #endif
+#elif defined(__x86_64__) && defined(__GNUC__)
+  #if (__GNUC__ > 4) || (__GNUC__ == 4 && __GNUC_MINOR__ >= 9)
+    #define GENERATE_AVX2
+  #endif
+  #if __GNUC__ >= 7
+    #define GENERATE_AVX512
+  #endif
+#endif
+
+#if defined(GENERATE_AVX2) || defined(GENERATE_AVX512)
+#include <immintrin.h>
+
+/* Get the extended feature flags (leaf 7, subleaf 0) */
+static void
+get_cpuid_leaf7_flags(unsigned int *ebx, unsigned int *ecx) {
+  unsigned int eax, edx;
+  if (cpuid(0x00000000, &eax, ebx, ecx, &edx) == -1 || eax < 7) {
+    *ebx = *ecx = 0;
+    return;
+  }
+  if (cpuid(0x00000007, &eax, ebx, ecx, &edx) == -1) {
+    *ebx = *ecx = 0;
+  }
+}
+
+/* The operating system must save the AVX registers on a context switch */
+static uint64_t
+get_xcr0(void) {
+  uint32_t eax, edx;
+  if (!(get_cpuid_flags() & bit_OSXSAVE)) {
+    return 0;
+  }
+  __asm__ __volatile__ ("xgetbv" : "=a" (eax), "=d" (edx) : "c" (0));
+  return ((uint64_t) edx << 32) | eax;
+}
+#endif
+
+
+/***** AVX2 *****/
+
+#if defined(GENERATE_AVX2)
+
+#define AVX2_TARGET __attribute__((target("avx2")))
+
+/* Popcount of each 64-bit word, using a lookup table for each nibble */
+AVX2_TARGET static __m256i
+popcount256(__m256i v) {
+  const __m256i lookup = _mm256_setr_epi8(
+      0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4,
+      0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4);
+  const __m256i low_mask = _mm256_set1_epi8(0x0f);
+  __m256i lo = _mm256_and_si256(v, low_mask);
+  __m256i hi = _mm256_and_si256(_mm256_srli_epi16(v, 4), low_mask);
+  __m256i counts = _mm256_add_epi8(_mm256_shuffle_epi8(lookup, lo),
+                                   _mm256_shuffle_epi8(lookup, hi));
+  return _mm256_sad_epu8(counts, _mm256_setzero_si256());
+}
+
+/* Carry-save adder: (h, l) = a + b + c */
+#define CSA(h, l, a, b, c) {                       \
+    __m256i u = _mm256_xor_si256(a, b);            \
+    h = _mm256_or_si256(_mm256_and_si256(a, b),    \
+                        _mm256_and_si256(u, c));   \
+    l = _mm256_xor_si256(u, c);                    \
+  }
+
+/* Harley-Seal over groups of 8 blocks, then a lookup for what's left. */
+/* If 'fp2' is not NULL then count the bits in the intersection. */
+AVX2_TARGET static int
+harley_seal_avx2(int num_blocks, const __m256i *fp1, const __m256i *fp2) {
+  __m256i total = _mm256_setzero_si256();
+  __m256i ones = _mm256_setzero_si256();
+  __m256i twos = _mm256_setzero_si256();
+  __m256i fours = _mm256_setzero_si256();
+  __m256i twos_a, twos_b, fours_a, fours_b, eights;
+  __m256i v[8];
+  uint64_t counts[4];
+  int i, j;
+
+  for (i = 0; i + 8 <= num_blocks; i += 8) {
+    for (j = 0; j < 8; j++) {
+      v[j] = _mm256_loadu_si256(fp1 + i + j);
+      if (fp2 != NULL) {
+        v[j] = _mm256_and_si256(v[j], _mm256_loadu_si256(fp2 + i + j));
+      }
+    }
+    CSA(twos_a, ones, ones, v[0], v[1]);
+    CSA(twos_b, ones, ones, v[2], v[3]);
+    CSA(fours_a, twos, twos, twos_a, twos_b);
+    CSA(twos_a, ones, ones, v[4], v[5]);
+    CSA(twos_b, ones, ones, v[6], v[7]);
+    CSA(fours_b, twos, twos, twos_a, twos_b);
+    CSA(eights, fours, fours, fours_a, fours_b);
+    total = _mm256_add_epi64(total, popcount256(eights));
+  }
+  total = _mm256_slli_epi64(total, 3);
+  total = _mm256_add_epi64(total, _mm256_slli_epi64(popcount256(fours), 2));
+  total = _mm256_add_epi64(total, _mm256_slli_epi64(popcount256(twos), 1));
+  total = _mm256_add_epi64(total, popcount256(ones));
+
+  for (; i < num_blocks; i++) {
+    v[0] = _mm256_loadu_si256(fp1 + i);
+    if (fp2 != NULL) {
+      v[0] = _mm256_and_si256(v[0], _mm256_loadu_si256(fp2 + i));
+    }
+    total = _mm256_add_epi64(total, popcount256(v[0]));
+  }
+
+  _mm256_storeu_si256((__m256i *) counts, total);
+  return (int) (counts[0] + counts[1] + counts[2] + counts[3]);
+}
+
+#endif /* GENERATE_AVX2 */
+
+/**
+ * Count the number of bits set in a fingerprint using AVX2.
+ * @warning  1) The fingerprint storage must be a multiple of 32 bytes.
+ *           2) Use chemfp_has_avx2() to test if the CPU supports AVX2.
+ */
+int chemfp_popcount_avx2(int size, const uint64_t *fp) {
+#if defined(GENERATE_AVX2)
+  return harley_seal_avx2((size + 31) / 32, (const __m256i *) fp, NULL);
+#else
+  UNUSED(size);
+  UNUSED(fp);
+  return 0;
+#endif
+}
+
+/**
+ * Count the number of bits set within the intersection of two
+ * fingerprints using AVX2.
+ * @warning  1) The fingerprint storage must be a multiple of 32 bytes.
+ *           2) Use chemfp_has_avx2() to test if the CPU supports AVX2.
+ */
+int chemfp_intersect_popcount_avx2(int size, const uint64_t *fp1, const uint64_t *fp2) {
+#if defined(GENERATE_AVX2)
+  return harley_seal_avx2((size + 31) / 32, (const __m256i *) fp1, (const __m256i *) fp2);
+#else
+  UNUSED(size);
+  UNUSED(fp1);
+  UNUSED(fp2);
+  return 0;
+#endif
+}
+
+int chemfp_has_avx2(void) {
+#if defined(GENERATE_AVX2)
+  unsigned int ebx, ecx;
+  /* The OS must save the XMM and YMM registers */
+  if ((get_xcr0() & 0x06) != 0x06) {
+    return 0;
+  }
+  get_cpuid_leaf7_flags(&ebx, &ecx);
+  return (ebx & bit_AVX2) != 0;
+#else
+  (void)(get_cpuid_flags); /* suppress compiler warning */
+  return 0;
+#endif
+}
+
+
+/***** AVX-512 *****/
+
+#if defined(GENERATE_AVX512)
+
+#define AVX512_TARGET __attribute__((target("avx512f,avx512vpopcntdq")))
+
+/* Always inline so the fixed-size versions get a constant num_blocks */
+AVX512_TARGET static inline __attribute__((always_inline)) int
+popcount_avx512(int num_blocks, const __m512i *fp1, const __m512i *fp2) {
+  __m512i total0 = _mm512_setzero_si512();
+  __m512i total1 = _mm512_setzero_si512();
+  __m512i v0, v1;
+  int i;
+
+  /* Two accumulators hide the latency of VPOPCNTQ */
+  for (i = 0; i + 2 <= num_blocks; i += 2) {
+    v0 = _mm512_loadu_si512(fp1 + i);
+    v1 = _mm512_loadu_si512(fp1 + i + 1);
+    if (fp2 != NULL) {
+      v0 = _mm512_and_si512(v0, _mm512_loadu_si512(fp2 + i));
+      v1 = _mm512_and_si512(v1, _mm512_loadu_si512(fp2 + i + 1));
+    }
+    total0 = _mm512_add_epi64(total0, _mm512_popcnt_epi64(v0));
+    total1 = _mm512_add_epi64(total1, _mm512_popcnt_epi64(v1));
+  }
+  if (i < num_blocks) {
+    v0 = _mm512_loadu_si512(fp1 + i);
+    if (fp2 != NULL) {
+      v0 = _mm512_and_si512(v0, _mm512_loadu_si512(fp2 + i));
+    }
+    total0 = _mm512_add_epi64(total0, _mm512_popcnt_epi64(v0));
+  }
+  return (int) _mm512_reduce_add_epi64(_mm512_add_epi64(total0, total1));
+}
+
+/* The general version, for any number of blocks */
+AVX512_TARGET static int
+popcount_avx512_blocks(int num_blocks, const __m512i *fp1, const __m512i *fp2) {
+  return popcount_avx512(num_blocks, fp1, fp2);
+}
+
+#endif /* GENERATE_AVX512 */
+
+/**
+ * Count the number of bits set in a fingerprint using the AVX-512
+ * VPOPCNTQ instruction.
+ * @warning  1) The fingerprint storage must be a multiple of 64 bytes.
+ *           2) Use chemfp_has_avx512_vpopcntdq() to test if the CPU
+ *              supports the instruction.
+ */
+int chemfp_popcount_avx512(int size, const uint64_t *fp) {
+#if defined(GENERATE_AVX512)
+  return popcount_avx512_blocks((size + 63) / 64, (const __m512i *) fp, NULL);
+#else
+  UNUSED(size);
+  UNUSED(fp);
+  return 0;
+#endif
+}
+
+/**
+ * Count the number of bits set within the intersection of two
+ * fingerprints using the AVX-512 VPOPCNTQ instruction.
+ * @warning  1) The fingerprint storage must be a multiple of 64 bytes.
+ *           2) Use chemfp_has_avx512_vpopcntdq() to test if the CPU
+ *              supports the instruction.
+ */
+int chemfp_intersect_popcount_avx512(int size, const uint64_t *fp1, const uint64_t *fp2) {
+#if defined(GENERATE_AVX512)
+  return popcount_avx512_blocks((size + 63) / 64, (const __m512i *) fp1, (const __m512i *) fp2);
+#else
+  UNUSED(size);
+  UNUSED(fp1);
+  UNUSED(fp2);
+  return 0;
+#endif
+}
+
+/**
+ * Intersection popcounts for the most common fingerprint sizes, with
+ * a constant number of 64 byte blocks. The 'size' parameter is ignored.
+ * (881 bits uses the same function as 1024 bits, and 166 bits needs
+ * only one block.)
+ * @warning  Same as chemfp_intersect_popcount_avx512()
+ */
+#if defined(GENERATE_AVX512)
+#define INTERSECT_POPCOUNT_AVX512_FIXED(num_bits, num_blocks)           \
+AVX512_TARGET int                                                       \
+chemfp_intersect_popcount_avx512_##num_bits(int size, const uint64_t *fp1, \
+                                            const uint64_t *fp2) {      \
+  UNUSED(size);                                                         \
+  return popcount_avx512(num_blocks, (const __m512i *) fp1, (const __m512i *) fp2); \
+}
+#else
+#define INTERSECT_POPCOUNT_AVX512_FIXED(num_bits, num_blocks)           \
+int                                                                     \
+chemfp_intersect_popcount_avx512_##num_bits(int size, const uint64_t *fp1, \
+                                            const uint64_t *fp2) {      \
+  UNUSED(size);                                                         \
+  UNUSED(fp1);                                                          \
+  UNUSED(fp2);                                                          \
+  return 0;                                                             \
+}
+#endif
+
+INTERSECT_POPCOUNT_AVX512_FIXED(166, 1)
+INTERSECT_POPCOUNT_AVX512_FIXED(1024, 2)
+INTERSECT_POPCOUNT_AVX512_FIXED(2048, 4)
+INTERSECT_POPCOUNT_AVX512_FIXED(4096, 8)
+
+int chemfp_has_avx512_vpopcntdq(void) {
+#if defined(GENERATE_AVX512)
+  unsigned int ebx, ecx;
+  /* The OS must save the XMM, YMM, opmask and ZMM registers */
+  if ((get_xcr0() & 0xe6) != 0xe6) {
+    return 0;
+  }
+  get_cpuid_leaf7_flags(&ebx, &ecx);
+  return (ebx & bit_AVX512F) && (ecx & bit_AVX512_VPOPCNTDQ);
+#else
+  return 0;
+#endif
+}
@@ -110,3 +110,48 @@ int chemfp_intersect_popcount_popcnt(int size, const uint64_t *fp1, const uint64
 #endif
   return bit_count;
 }
+
+/**
+ * Intersection popcounts for the most common fingerprint sizes. The
+ * number of words is a compile-time constant, so the compiler can
+ * fully unroll the loop. The 'size' parameter is ignored.
+ * @warning  1) The fingerprints must be 8 byte aligned and padded
+ *              to a multiple of 8 bytes.
+ *           2) Use (get_cpuid_flags() & bit_POPCNT) to test if
+ *              the CPU supports the POPCNT instruction.
+ */
+
+#if defined(__GNUC__) && !defined(__clang__) && (__GNUC__ >= 8)
+  #define FULL_UNROLL _Pragma("GCC unroll 64")
+#elif defined(__clang__)
+  #define FULL_UNROLL _Pragma("unroll")
+#else
+  #define FULL_UNROLL
+#endif
+
+#if defined(_WIN64) || defined(__x86_64__)
+#define INTERSECT_POPCOUNT_POPCNT_FIXED(num_bits, num_words)            \
+int chemfp_intersect_popcount_popcnt_##num_bits(int size, const uint64_t *fp1, \
+                                                const uint64_t *fp2) { \
+  int bit_count = 0;                                                   \
+  int i;                                                               \
+  UNUSED(size);                                                        \
+  FULL_UNROLL                                                          \
+  for (i = 0; i < num_words; i++)                                      \
+    bit_count += (int) POPCNT64(fp1[i] & fp2[i]);                      \
+  return bit_count;                                                    \
+}
+#else
+#define INTERSECT_POPCOUNT_POPCNT_FIXED(num_bits, num_words)            \
+int chemfp_intersect_popcount_popcnt_##num_bits(int size, const uint64_t *fp1, \
+                                                const uint64_t *fp2) { \
+  UNUSED(size);                                                        \
+  return chemfp_intersect_popcount_popcnt(num_words*8, fp1, fp2);      \
+}
+#endif
+
+INTERSECT_POPCOUNT_POPCNT_FIXED(166, 3)
+INTERSECT_POPCOUNT_POPCNT_FIXED(881, 14)
+INTERSECT_POPCOUNT_POPCNT_FIXED(1024, 16)
+INTERSECT_POPCOUNT_POPCNT_FIXED(2048, 32)
+INTERSECT_POPCOUNT_POPCNT_FIXED(4096, 64)
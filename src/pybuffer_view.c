@@ -0,0 +1,197 @@
+#include "pybuffer_view.h"
+
+#include "chemfp.h"
+#include "chemfp_internal.h"
+
+/************ Buffer view type ***************/
+
+/* The search functions get the arena bytes through the old-style
+   Python 2 buffer interface ("s#" and "t#"). Some objects, like NumPy
+   arrays, support both interfaces, but others, like memoryview, only
+   support the new one and a bytearray isn't accepted as a read-only
+   buffer. A BufferView gets a read-only, contiguous view of any
+   buffer object and exports it through both interfaces, without
+   copying the underlying data. It keeps a reference to the original
+   object so the memory stays valid. */
+
+static void
+BufferView_dealloc(BufferView *self) {
+  if (self->has_view) {
+    PyBuffer_Release(&self->view);
+    self->has_view = 0;
+  }
+  Py_CLEAR(self->obj);
+  self->ob_type->tp_free((PyObject *) self);
+}
+
+static PyObject *
+BufferView_new(PyTypeObject *type, PyObject *args, PyObject *kwds) {
+  BufferView *self;
+  PyObject *obj;
+  const void *buf;
+  Py_ssize_t len;
+  static char *kwlist[] = {"obj", NULL};
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "O:BufferView", kwlist, &obj)) {
+    return NULL;
+  }
+
+  self = (BufferView *) type->tp_alloc(type, 0);
+  if (self == NULL) {
+    return NULL;
+  }
+  self->has_view = 0;
+
+  if (PyObject_CheckBuffer(obj)) {
+    /* PyBUF_SIMPLE only succeeds for C-contiguous data */
+    if (PyObject_GetBuffer(obj, &self->view, PyBUF_SIMPLE)) {
+      Py_DECREF(self);
+      return NULL;
+    }
+    self->has_view = 1;
+    self->buf = (const char *) self->view.buf;
+    self->len = self->view.len;
+  } else {
+    if (PyObject_AsReadBuffer(obj, &buf, &len)) {
+      Py_DECREF(self);
+      return NULL;
+    }
+    self->buf = (const char *) buf;
+    self->len = len;
+  }
+  Py_INCREF(obj);
+  self->obj = obj;
+  return (PyObject *) self;
+}
+
+static Py_ssize_t
+BufferView_length(BufferView *self) {
+  return self->len;
+}
+
+static PyObject *
+BufferView_get_alignment(BufferView *self, void *closure) {
+  UNUSED(closure);
+  /* The largest power of two (up to 64) which divides the start address */
+  if (ALIGNMENT(self->buf, 64) == 0) return PyInt_FromLong(64);
+  if (ALIGNMENT(self->buf, 32) == 0) return PyInt_FromLong(32);
+  if (ALIGNMENT(self->buf, 16) == 0) return PyInt_FromLong(16);
+  if (ALIGNMENT(self->buf,  8) == 0) return PyInt_FromLong(8);
+  if (ALIGNMENT(self->buf,  4) == 0) return PyInt_FromLong(4);
+  if (ALIGNMENT(self->buf,  2) == 0) return PyInt_FromLong(2);
+  return PyInt_FromLong(1);
+}
+
+static PyObject *
+BufferView_get_obj(BufferView *self, void *closure) {
+  UNUSED(closure);
+  Py_INCREF(self->obj);
+  return self->obj;
+}
+
+/* Old-style buffer interface */
+
+static Py_ssize_t
+BufferView_getreadbuffer(BufferView *self, Py_ssize_t segment, void **ptrptr) {
+  if (segment != 0) {
+    PyErr_SetString(PyExc_SystemError, "accessing non-existent BufferView segment");
+    return -1;
+  }
+  *ptrptr = (void *) self->buf;
+  return self->len;
+}
+
+static Py_ssize_t
+BufferView_getsegcount(BufferView *self, Py_ssize_t *lenp) {
+  if (lenp) {
+    *lenp = self->len;
+  }
+  return 1;
+}
+
+static Py_ssize_t
+BufferView_getcharbuffer(BufferView *self, Py_ssize_t segment, char **ptrptr) {
+  return BufferView_getreadbuffer(self, segment, (void **) ptrptr);
+}
+
+/* New-style buffer interface */
+
+static int
+BufferView_getbuffer(BufferView *self, Py_buffer *view, int flags) {
+  return PyBuffer_FillInfo(view, (PyObject *) self, (void *) self->buf, self->len,
+                           1, flags);
+}
+
+
+static PyGetSetDef BufferView_getset[] = {
+  {"alignment", (getter) BufferView_get_alignment, NULL,
+   "the largest power of two, up to 64, which evenly divides the start address", NULL},
+  {"obj", (getter) BufferView_get_obj, NULL,
+   "the object which owns the memory", NULL},
+  {NULL}
+};
+
+static PySequenceMethods BufferView_as_sequence = {
+    (lenfunc)BufferView_length,                       /* sq_length */
+    NULL,       /* sq_concat */
+    NULL,       /* sq_repeat */
+    NULL,       /* sq_item */
+    NULL,       /* sq_slice */
+    NULL,       /* sq_ass_item */
+    NULL,       /* sq_ass_slice */
+    NULL,       /* sq_contains */
+    NULL,       /* sq_inplace_concat */
+    NULL        /* sq_inplace_repeat */
+};
+
+static PyBufferProcs BufferView_as_buffer = {
+    (readbufferproc) BufferView_getreadbuffer,   /* bf_getreadbuffer */
+    NULL,                                        /* bf_getwritebuffer */
+    (segcountproc) BufferView_getsegcount,       /* bf_getsegcount */
+    (charbufferproc) BufferView_getcharbuffer,   /* bf_getcharbuffer */
+    (getbufferproc) BufferView_getbuffer,        /* bf_getbuffer */
+    NULL,                                        /* bf_releasebuffer */
+};
+
+
+PyTypeObject chemfp_py_BufferViewType = {
+    PyObject_HEAD_INIT(NULL)
+    0,                         /*ob_size*/
+    "_chemfp.BufferView",      /*tp_name*/
+    sizeof(BufferView),        /*tp_basicsize*/
+    0,                         /*tp_itemsize*/
+    (destructor) BufferView_dealloc,  /*tp_dealloc*/
+    0,                         /*tp_print*/
+    0,                         /*tp_getattr*/
+    0,                         /*tp_setattr*/
+    0,                         /*tp_compare*/
+    0,                         /*tp_repr*/
+    0,                         /*tp_as_number*/
+    &BufferView_as_sequence,   /*tp_as_sequence*/
+    0,                         /*tp_as_mapping*/
+    0,                         /*tp_hash */
+    0,                         /*tp_call*/
+    0,                         /*tp_str*/
+    0,                         /*tp_getattro*/
+    0,                         /*tp_setattro*/
+    &BufferView_as_buffer,     /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_NEWBUFFER, /*tp_flags*/
+    "BufferView(obj)\n\nA read-only, contiguous view of an object which supports the buffer interface", /* tp_doc */
+    0,                         /* tp_traverse */
+    0,                         /* tp_clear */
+    0,		               /* tp_richcompare */
+    0,		               /* tp_weaklistoffset */
+    0,		               /* tp_iter */
+    0,		               /* tp_iternext */
+    0,                         /* tp_methods */
+    0,                         /* tp_members */
+    BufferView_getset,         /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    0,                         /* tp_init */
+    0,                         /* tp_alloc */
+    BufferView_new             /* tp_new */
+};
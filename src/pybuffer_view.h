@@ -0,0 +1,12 @@
+#include <Python.h>
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *obj;
+    Py_buffer view;
+    int has_view;
+    const char *buf;
+    Py_ssize_t len;
+} BufferView;
+
+extern PyTypeObject chemfp_py_BufferViewType;
@@ -7,6 +7,8 @@
 
 /************ Search Result type ***************/
 
+#define SCORE(i) chemfp_get_hit_score(result, i)
+
 
 /* Help with cyclical garbage collection, in case someone does result.target_ids = result */
 static int
@@ -43,6 +45,8 @@ SearchResults_new(PyTypeObject *type, PyObject *args, PyObject *kwds) {
     }
     self->num_results = 0;
     self->results = NULL;
+    self->score_type = CHEMFP_SCORE_DOUBLE;
+    self->num_exports = 0;
     Py_INCREF(Py_None);
     self->target_ids = Py_None;
     return (PyObject *)self;
@@ -53,17 +57,32 @@ SearchResults_init(SearchResults *self, PyObject *args, PyObject *kwds)
 {
   int num_results=0;
   PyObject *target_ids=Py_None;
+  const char *score_type_name="double";
+  int score_type, i;
   chemfp_search_result *results;
 
-  static char *kwlist[] = {"num_results", "target_ids", NULL};
+  static char *kwlist[] = {"num_results", "target_ids", "score_type", NULL};
 
-  if (!PyArg_ParseTupleAndKeywords(args, kwds, "i|O", kwlist, &num_results, &target_ids)) {
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "i|Os", kwlist, &num_results, &target_ids,
+                                   &score_type_name)) {
     return -1;
   }
   if (num_results < 0) {
     PyErr_SetString(PyExc_ValueError, "num_results must be non-negative");
     return -1;
   }
+  for (score_type=0; score_type<chemfp_get_num_score_types(); score_type++) {
+    if (!strcmp(score_type_name, chemfp_get_score_type_name(score_type))) {
+      break;
+    }
+  }
+  if (score_type == chemfp_get_num_score_types()) {
+    PyErr_SetString(PyExc_ValueError, "score_type must be one of 'double', 'float' or 'uint16'");
+    return -1;
+  }
+  if (!chemfp_py_check_no_exports(self)) {
+    return -1;
+  }
   if (num_results == 0) {
     results = NULL;
   } else {
@@ -72,10 +91,17 @@ SearchResults_init(SearchResults *self, PyObject *args, PyObject *kwds)
       PyErr_NoMemory();
       return -1;
     }
+    for (i=0; i<num_results; i++) {
+      results[i].score_type = score_type;
+    }
   }
 
+  if (self->results) {
+    chemfp_free_results(self->num_results, self->results);
+  }
   self->num_results = num_results;
   self->results = results;
+  self->score_type = score_type;
 
   Py_XINCREF(target_ids);
   Py_XDECREF(self->target_ids);
@@ -84,6 +110,16 @@ SearchResults_init(SearchResults *self, PyObject *args, PyObject *kwds)
   return 0;
 }
 
+int
+chemfp_py_check_no_exports(SearchResults *results) {
+  if (results->num_exports) {
+    PyErr_SetString(PyExc_BufferError,
+                    "cannot change the hits while a hit view is in use");
+    return 0;
+  }
+  return 1;
+}
+
 /* len(search_results) */
 static Py_ssize_t
 SearchResults_length(SearchResults *result) {
@@ -108,8 +144,10 @@ check_row(int num_results, int *row) {
   return 1;
 }
 
+/* The bounds are rounded to the score type, so a hit compares against */
+/* a bound as if the bound had been stored in the search results. */
 static int
-check_min_max_score(PyObject *min_score_obj, PyObject *max_score_obj,
+check_min_max_score(int score_type, PyObject *min_score_obj, PyObject *max_score_obj,
                     double *min_score, double *max_score) {
   double value;
   if (min_score_obj == Py_None) {
@@ -121,7 +159,7 @@ check_min_max_score(PyObject *min_score_obj, PyObject *max_score_obj,
         return 0;
       }
     }
-    *min_score = value;
+    *min_score = chemfp_round_score(score_type, value);
   }
   if (max_score_obj == Py_None) {
     *max_score = HUGE_VAL;
@@ -132,13 +170,13 @@ check_min_max_score(PyObject *min_score_obj, PyObject *max_score_obj,
         return 0;
       }
     }
-    *max_score = value;
+    *max_score = chemfp_round_score(score_type, value);
   }
   return 1;
 }
 
-static int
-check_interval(const char *interval, int *include_min, int *include_max) {
+int
+chemfp_py_check_interval(const char *interval, int *include_min, int *include_max) {
   switch (interval[0]) {
   case '(':
     *include_min = 0;
@@ -208,7 +246,7 @@ SearchResults_reorder_row(SearchResults *self, PyObject *args, PyObject *kwds) {
 #define COUNT_ALL_MACRO(expr)                           \
   for (row=0; row<num_rows; row++) {                    \
     num_hits = chemfp_get_num_hits(self->results+row);  \
-    scores = self->results[row].scores;                 \
+    result = self->results+row;                         \
     for (i=0; i<num_hits; i++) {                        \
       if (expr) {                                       \
         count++;                                        \
@@ -223,7 +261,7 @@ SearchResults_count_all(SearchResults *self, PyObject *args, PyObject *kwds) {
   PyObject *min_score_obj=Py_None, *max_score_obj=Py_None;
   double min_score=0.0, max_score=1.0;
   int num_hits, num_rows;
-  double *scores;
+  chemfp_search_result *result;
   int include_min=0, include_max=0;
   int count=0;
   int i;
@@ -232,8 +270,8 @@ SearchResults_count_all(SearchResults *self, PyObject *args, PyObject *kwds) {
                                    &min_score_obj, &max_score_obj, &interval)) {
     return NULL;
   }
-  if (!check_min_max_score(min_score_obj, max_score_obj, &min_score, &max_score) ||
-      !check_interval(interval, &include_min, &include_max)) {
+  if (!check_min_max_score(self->score_type, min_score_obj, max_score_obj, &min_score, &max_score) ||
+      !chemfp_py_check_interval(interval, &include_min, &include_max)) {
     return NULL;
   }
   if ((min_score > max_score) ||
@@ -253,25 +291,25 @@ SearchResults_count_all(SearchResults *self, PyObject *args, PyObject *kwds) {
           }
         } else {
           /* No lower bound */
-          COUNT_ALL_MACRO(scores[i] <= max_score);
+          COUNT_ALL_MACRO(SCORE(i) <= max_score);
         }
       } else {
         if (max_score_obj == Py_None) {
           /* Lower bound but no upper bound */
-          COUNT_ALL_MACRO(min_score <= scores[i]);
+          COUNT_ALL_MACRO(min_score <= SCORE(i));
         } else {
           /* Definite lower and upper bound */
-          COUNT_ALL_MACRO(min_score <= scores[i] && scores[i] <= max_score);
+          COUNT_ALL_MACRO(min_score <= SCORE(i) && SCORE(i) <= max_score);
         }
       }
     } else {
       /* [) -- Include the minimum but not the maximum */
       if (min_score_obj == Py_None) {
         /* There is no minimum */
-        COUNT_ALL_MACRO(scores[i] < max_score);
+        COUNT_ALL_MACRO(SCORE(i) < max_score);
       } else {
         /* There is a minimum and a maximum test */
-        COUNT_ALL_MACRO(min_score <= scores[i] && scores[i] < max_score);
+        COUNT_ALL_MACRO(min_score <= SCORE(i) && SCORE(i) < max_score);
       }
     }
   } else {
@@ -279,13 +317,13 @@ SearchResults_count_all(SearchResults *self, PyObject *args, PyObject *kwds) {
       /* (] -- Exclude the minimum, include the maximum */
       if (max_score_obj == Py_None) {
         /* No specified max, so must only be greater than the lower bound */
-        COUNT_ALL_MACRO(min_score < scores[i]);
+        COUNT_ALL_MACRO(min_score < SCORE(i));
       } else {
-        COUNT_ALL_MACRO(min_score < scores[i] && scores[i] <= max_score);
+        COUNT_ALL_MACRO(min_score < SCORE(i) && SCORE(i) <= max_score);
       }
     } else {
       /* () -- Exclude the minimum and exclude the maximum */
-      COUNT_ALL_MACRO(min_score < scores[i] && scores[i] < max_score);
+      COUNT_ALL_MACRO(min_score < SCORE(i) && SCORE(i) < max_score);
     }
   }
   return PyInt_FromLong(count);
@@ -305,7 +343,7 @@ SearchResults_count_row(SearchResults *self, PyObject *args, PyObject *kwds) {
   PyObject *min_score_obj=Py_None, *max_score_obj=Py_None;
   double min_score=0.0, max_score=1.0;
   int num_hits;
-  double *scores;
+  chemfp_search_result *result;
   int include_min=0, include_max=0;
   int count=0;
   int i;
@@ -315,12 +353,12 @@ SearchResults_count_row(SearchResults *self, PyObject *args, PyObject *kwds) {
     return NULL;
   }
   if (!check_row(self->num_results, &row) ||
-      !check_min_max_score(min_score_obj, max_score_obj, &min_score, &max_score) ||
-      !check_interval(interval, &include_min, &include_max)) {
+      !check_min_max_score(self->score_type, min_score_obj, max_score_obj, &min_score, &max_score) ||
+      !chemfp_py_check_interval(interval, &include_min, &include_max)) {
     return NULL;
   }
   num_hits = chemfp_get_num_hits(self->results+row);
-  scores = (self->results+row)->scores;
+  result = self->results+row;
 
   if ((min_score > max_score) ||
       (min_score == max_score && (!include_min || !include_max))) {
@@ -336,25 +374,25 @@ SearchResults_count_row(SearchResults *self, PyObject *args, PyObject *kwds) {
           count = chemfp_get_num_hits(self->results+row);
         } else {
           /* No lower bound */
-          COUNT_ROW_MACRO(scores[i] <= max_score);
+          COUNT_ROW_MACRO(SCORE(i) <= max_score);
         }
       } else {
         if (max_score_obj == Py_None) {
           /* Lower bound but no upper bound */
-          COUNT_ROW_MACRO(min_score <= scores[i]);
+          COUNT_ROW_MACRO(min_score <= SCORE(i));
         } else {
           /* Definite lower and upper bound */
-          COUNT_ROW_MACRO(min_score <= scores[i] && scores[i] <= max_score);
+          COUNT_ROW_MACRO(min_score <= SCORE(i) && SCORE(i) <= max_score);
         }
       }
     } else {
       /* [) -- Include the minimum but not the maximum */
       if (min_score_obj == Py_None) {
         /* There is no minimum */
-        COUNT_ROW_MACRO(scores[i] < max_score);
+        COUNT_ROW_MACRO(SCORE(i) < max_score);
       } else {
         /* There is a minimum and a maximum test */
-        COUNT_ROW_MACRO(min_score <= scores[i] && scores[i] < max_score);
+        COUNT_ROW_MACRO(min_score <= SCORE(i) && SCORE(i) < max_score);
       }
     }
   } else {
@@ -362,13 +400,13 @@ SearchResults_count_row(SearchResults *self, PyObject *args, PyObject *kwds) {
       /* (] -- Exclude the minimum, include the maximum */
       if (max_score_obj == Py_None) {
         /* No specified max, so must only be greater than the lower bound */
-        COUNT_ROW_MACRO(min_score < scores[i]);
+        COUNT_ROW_MACRO(min_score < SCORE(i));
       } else {
-        COUNT_ROW_MACRO(min_score < scores[i] && scores[i] <= max_score);
+        COUNT_ROW_MACRO(min_score < SCORE(i) && SCORE(i) <= max_score);
       }
     } else {
       /* () -- Exclude the minimum and exclude the maximum */
-      COUNT_ROW_MACRO(min_score < scores[i] && scores[i] < max_score);
+      COUNT_ROW_MACRO(min_score < SCORE(i) && SCORE(i) < max_score);
     }
   }
   return PyInt_FromLong(count);
@@ -377,10 +415,10 @@ SearchResults_count_row(SearchResults *self, PyObject *args, PyObject *kwds) {
 #define CUMULATIVE_SCORE_ALL_MACRO(expr)                \
   for (row=0; row<num_rows; row++) {                    \
     num_hits = chemfp_get_num_hits(self->results+row);  \
-    scores = self->results[row].scores;                 \
+    result = self->results+row;                         \
     for (i=0; i<num_hits; i++) {                        \
       if (expr) {                                       \
-        score += scores[i];                             \
+        score += SCORE(i);                              \
       }                                                 \
     }                                                   \
   }
@@ -392,7 +430,7 @@ SearchResults_cumulative_score_all(SearchResults *self, PyObject *args, PyObject
   PyObject *min_score_obj=Py_None, *max_score_obj=Py_None;
   double min_score=0.0, max_score=1.0;
   int num_hits, num_rows;
-  double *scores;
+  chemfp_search_result *result;
   int include_min=0, include_max=0;
   double score=0.0;
   int i;
@@ -401,8 +439,8 @@ SearchResults_cumulative_score_all(SearchResults *self, PyObject *args, PyObject
                                    &min_score_obj, &max_score_obj, &interval)) {
     return NULL;
   }
-  if (!check_min_max_score(min_score_obj, max_score_obj, &min_score, &max_score) ||
-      !check_interval(interval, &include_min, &include_max)) {
+  if (!check_min_max_score(self->score_type, min_score_obj, max_score_obj, &min_score, &max_score) ||
+      !chemfp_py_check_interval(interval, &include_min, &include_max)) {
     return NULL;
   }
   if ((min_score > max_score) ||
@@ -419,25 +457,25 @@ SearchResults_cumulative_score_all(SearchResults *self, PyObject *args, PyObject
           CUMULATIVE_SCORE_ALL_MACRO(1);
         } else {
           /* No lower bound */
-          CUMULATIVE_SCORE_ALL_MACRO(scores[i] <= max_score);
+          CUMULATIVE_SCORE_ALL_MACRO(SCORE(i) <= max_score);
         }
       } else {
         if (max_score_obj == Py_None) {
           /* Lower bound but no upper bound */
-          CUMULATIVE_SCORE_ALL_MACRO(min_score <= scores[i]);
+          CUMULATIVE_SCORE_ALL_MACRO(min_score <= SCORE(i));
         } else {
           /* Definite lower and upper bound */
-          CUMULATIVE_SCORE_ALL_MACRO(min_score <= scores[i] && scores[i] <= max_score);
+          CUMULATIVE_SCORE_ALL_MACRO(min_score <= SCORE(i) && SCORE(i) <= max_score);
         }
       }
     } else {
       /* [) -- Include the minimum but not the maximum */
       if (min_score_obj == Py_None) {
         /* There is no minimum */
-        CUMULATIVE_SCORE_ALL_MACRO(scores[i] < max_score);
+        CUMULATIVE_SCORE_ALL_MACRO(SCORE(i) < max_score);
       } else {
         /* There is a minimum and a maximum test */
-        CUMULATIVE_SCORE_ALL_MACRO(min_score <= scores[i] && scores[i] < max_score);
+        CUMULATIVE_SCORE_ALL_MACRO(min_score <= SCORE(i) && SCORE(i) < max_score);
       }
     }
   } else {
@@ -445,13 +483,13 @@ SearchResults_cumulative_score_all(SearchResults *self, PyObject *args, PyObject
       /* (] -- Exclude the minimum, include the maximum */
       if (max_score_obj == Py_None) {
         /* No specified max, so must only be greater than the lower bound */
-        CUMULATIVE_SCORE_ALL_MACRO(min_score < scores[i]);
+        CUMULATIVE_SCORE_ALL_MACRO(min_score < SCORE(i));
       } else {
-        CUMULATIVE_SCORE_ALL_MACRO(min_score < scores[i] && scores[i] <= max_score);
+        CUMULATIVE_SCORE_ALL_MACRO(min_score < SCORE(i) && SCORE(i) <= max_score);
       }
     } else {
       /* () -- Exclude the minimum and exclude the maximum */
-      CUMULATIVE_SCORE_ALL_MACRO(min_score < scores[i] && scores[i] < max_score);
+      CUMULATIVE_SCORE_ALL_MACRO(min_score < SCORE(i) && SCORE(i) < max_score);
     }
   }
   return PyFloat_FromDouble(score);
@@ -460,7 +498,7 @@ SearchResults_cumulative_score_all(SearchResults *self, PyObject *args, PyObject
 #define CUMULATIVE_SCORE_ROW_MACRO(expr)              \
   for (i=0; i<num_hits; i++) {                        \
     if (expr) {                                       \
-      score += scores[i];                             \
+      score += SCORE(i);                              \
     }                                                 \
   }
 
@@ -472,7 +510,7 @@ SearchResults_cumulative_score_row(SearchResults *self, PyObject *args, PyObject
   PyObject *min_score_obj=Py_None, *max_score_obj=Py_None;
   double min_score=0.0, max_score=1.0;
   int num_hits;
-  double *scores;
+  chemfp_search_result *result;
   int include_min=0, include_max=0;
   double score=0.0;
   int i;
@@ -482,12 +520,12 @@ SearchResults_cumulative_score_row(SearchResults *self, PyObject *args, PyObject
     return NULL;
   }
   if (!check_row(self->num_results, &row) ||
-      !check_min_max_score(min_score_obj, max_score_obj, &min_score, &max_score) ||
-      !check_interval(interval, &include_min, &include_max)) {
+      !check_min_max_score(self->score_type, min_score_obj, max_score_obj, &min_score, &max_score) ||
+      !chemfp_py_check_interval(interval, &include_min, &include_max)) {
     return NULL;
   }
   num_hits = chemfp_get_num_hits(self->results+row);
-  scores = (self->results+row)->scores;
+  result = self->results+row;
 
   if ((min_score > max_score) ||
       (min_score == max_score && (!include_min || !include_max))) {
@@ -502,25 +540,25 @@ SearchResults_cumulative_score_row(SearchResults *self, PyObject *args, PyObject
           CUMULATIVE_SCORE_ROW_MACRO(1);
         } else {
           /* No lower bound */
-          CUMULATIVE_SCORE_ROW_MACRO(scores[i] <= max_score);
+          CUMULATIVE_SCORE_ROW_MACRO(SCORE(i) <= max_score);
         }
       } else {
         if (max_score_obj == Py_None) {
           /* Lower bound but no upper bound */
-          CUMULATIVE_SCORE_ROW_MACRO(min_score <= scores[i]);
+          CUMULATIVE_SCORE_ROW_MACRO(min_score <= SCORE(i));
         } else {
           /* Definite lower and upper bound */
-          CUMULATIVE_SCORE_ROW_MACRO(min_score <= scores[i] && scores[i] <= max_score);
+          CUMULATIVE_SCORE_ROW_MACRO(min_score <= SCORE(i) && SCORE(i) <= max_score);
         }
       }
     } else {
       /* [) -- Include the minimum but not the maximum */
       if (min_score_obj == Py_None) {
         /* There is no minimum */
-        CUMULATIVE_SCORE_ROW_MACRO(scores[i] < max_score);
+        CUMULATIVE_SCORE_ROW_MACRO(SCORE(i) < max_score);
       } else {
         /* There is a minimum and a maximum test */
-        CUMULATIVE_SCORE_ROW_MACRO(min_score <= scores[i] && scores[i] < max_score);
+        CUMULATIVE_SCORE_ROW_MACRO(min_score <= SCORE(i) && SCORE(i) < max_score);
       }
     }
   } else {
@@ -528,13 +566,13 @@ SearchResults_cumulative_score_row(SearchResults *self, PyObject *args, PyObject
       /* (] -- Exclude the minimum, include the maximum */
       if (max_score_obj == Py_None) {
         /* No specified max, so must only be greater than the lower bound */
-        CUMULATIVE_SCORE_ROW_MACRO(min_score < scores[i]);
+        CUMULATIVE_SCORE_ROW_MACRO(min_score < SCORE(i));
       } else {
-        CUMULATIVE_SCORE_ROW_MACRO(min_score < scores[i] && scores[i] <= max_score);
+        CUMULATIVE_SCORE_ROW_MACRO(min_score < SCORE(i) && SCORE(i) <= max_score);
       }
     } else {
       /* () -- Exclude the minimum and exclude the maximum */
-      CUMULATIVE_SCORE_ROW_MACRO(min_score < scores[i] && scores[i] < max_score);
+      CUMULATIVE_SCORE_ROW_MACRO(min_score < SCORE(i) && SCORE(i) < max_score);
     }
   }
   return PyFloat_FromDouble(score);
@@ -544,6 +582,9 @@ SearchResults_cumulative_score_row(SearchResults *self, PyObject *args, PyObject
 static PyObject *
 SearchResults_clear_all(SearchResults *self) {
   int i;
+  if (!chemfp_py_check_no_exports(self)) {
+    return NULL;
+  }
   for (i=0; i<self->num_results; i++) {
     chemfp_search_result_clear(self->results+i);
   }
@@ -560,6 +601,9 @@ SearchResults_clear_row(SearchResults *self, PyObject *args, PyObject *kwds) {
   if (!check_row(self->num_results, &row)) {
     return NULL;
   }
+  if (!chemfp_py_check_no_exports(self)) {
+    return NULL;
+  }
   chemfp_search_result_clear(self->results+row);
   Py_RETURN_NONE;
 }
@@ -586,7 +630,7 @@ SearchResults_get_indices_and_scores(SearchResults *self, PyObject *args, PyObje
     return NULL;
   }
   for (i=0; i<n; i++) {
-    obj = Py_BuildValue("(id)", result->indices[i], result->scores[i]);
+    obj = Py_BuildValue("(id)", result->indices[i], chemfp_get_hit_score(result, i));
     if (!obj) {
       goto error;
     }
@@ -678,16 +722,39 @@ SearchResults_get_indices(SearchResults *self, PyObject *args, PyObject *kwds) {
 static PyObject *
 SearchResults_get_scores(SearchResults *self, PyObject *args, PyObject *kwds) {
   static char *kwlist[] = {"row", NULL};
-  int row;
+  int row, num_hits, i;
+  chemfp_search_result *result;
+  double *scores;
+  PyObject *array;
   if (!PyArg_ParseTupleAndKeywords(args, kwds, "i:get_scores", kwlist, &row)) {
     return NULL;
   }
   if (!check_row(self->num_results, &row)) {
     return NULL;
   }
-  return data_blob_to_array(chemfp_get_num_hits(self->results+row),
-                            self->results[row].scores,
-                            "d", sizeof(double));
+  result = self->results+row;
+  if (result->score_type == CHEMFP_SCORE_DOUBLE) {
+    return data_blob_to_array(chemfp_get_num_hits(result), result->scores,
+                              "d", sizeof(double));
+  }
+  /* Always return the scores as doubles */
+  num_hits = chemfp_get_num_hits(result);
+  scores = (double *) PyMem_Malloc((num_hits ? num_hits : 1) * sizeof(double));
+  if (!scores) {
+    return PyErr_NoMemory();
+  }
+  for (i=0; i<num_hits; i++) {
+    scores[i] = SCORE(i);
+  }
+  array = data_blob_to_array(num_hits, scores, "d", sizeof(double));
+  PyMem_Free(scores);
+  return array;
+}
+
+static PyObject *
+SearchResults_get_score_type(SearchResults *self, void *closure) {
+  UNUSED(closure);
+  return PyString_FromString(chemfp_get_score_type_name(self->score_type));
 }
 
 static PyObject *
@@ -716,10 +783,199 @@ SearchResults_add_hit(SearchResults *self, PyObject *args, PyObject *kwds) {
   if (!check_row(self->num_results, &row)) {
     return NULL;
   }
+  if (!chemfp_py_check_no_exports(self)) {
+    return NULL;
+  }
   return PyInt_FromLong(chemfp_add_hit(self->results+row, column, score));
   Py_RETURN_NONE;
 }
 
+/* The buffer format characters for each of the chemfp_score_types */
+static const char score_formats[] = "dfH";
+
+static PyObject *
+new_hit_view(SearchResults *owner, void *buf, void *copy, Py_ssize_t num_items,
+             Py_ssize_t itemsize, char format) {
+  HitView *view = PyObject_New(HitView, &chemfp_py_HitViewType);
+  if (!view) {
+    PyMem_Free(copy);
+    return NULL;
+  }
+  Py_INCREF(owner);
+  view->owner = (PyObject *) owner;
+  view->buf = buf;
+  view->copy = copy;
+  view->num_items = num_items;
+  view->itemsize = itemsize;
+  view->format[0] = format;
+  view->format[1] = '\0';
+  if (!copy) {
+    /* The view points into a row, so the row must not be reallocated */
+    owner->num_exports++;
+  }
+  return (PyObject *) view;
+}
+
+static PyObject *
+SearchResults_get_indices_view(SearchResults *self, PyObject *args, PyObject *kwds) {
+  static char *kwlist[] = {"row", NULL};
+  int row;
+  chemfp_search_result *result;
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "i:get_indices_view", kwlist, &row)) {
+    return NULL;
+  }
+  if (!check_row(self->num_results, &row)) {
+    return NULL;
+  }
+  result = self->results+row;
+  return new_hit_view(self, result->indices, NULL, chemfp_get_num_hits(result),
+                      sizeof(int), 'i');
+}
+
+static PyObject *
+SearchResults_get_scores_view(SearchResults *self, PyObject *args, PyObject *kwds) {
+  static char *kwlist[] = {"row", NULL};
+  int row;
+  chemfp_search_result *result;
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "i:get_scores_view", kwlist, &row)) {
+    return NULL;
+  }
+  if (!check_row(self->num_results, &row)) {
+    return NULL;
+  }
+  result = self->results+row;
+  return new_hit_view(self, result->scores, NULL, chemfp_get_num_hits(result),
+                      chemfp_get_score_type_size(result->score_type),
+                      score_formats[result->score_type]);
+}
+
+/* The rows are allocated separately, so the flattened arrays are a
+   copy, made with one memcpy() per row. The copies are owned by the
+   views and don't stop the hits from changing. */
+static PyObject *
+SearchResults_get_flat_views(SearchResults *self) {
+  int i, num_hits;
+  long long total=0, *offsets=NULL;
+  int *indices=NULL;
+  char *scores=NULL;
+  size_t score_size = chemfp_get_score_type_size(self->score_type);
+  PyObject *offsets_view=NULL, *indices_view=NULL, *scores_view=NULL, *views;
+
+  for (i=0; i<self->num_results; i++) {
+    total += chemfp_get_num_hits(self->results+i);
+  }
+  if ((unsigned long long) total > PY_SSIZE_T_MAX / sizeof(double)) {
+    return PyErr_NoMemory();
+  }
+  offsets = (long long *) PyMem_Malloc((self->num_results+1) * sizeof(long long));
+  indices = (int *) PyMem_Malloc((total ? total : 1) * sizeof(int));
+  scores = (char *) PyMem_Malloc((total ? total : 1) * score_size);
+  if (!offsets || !indices || !scores) {
+    PyMem_Free(offsets);
+    PyMem_Free(indices);
+    PyMem_Free(scores);
+    return PyErr_NoMemory();
+  }
+
+  total = 0;
+  for (i=0; i<self->num_results; i++) {
+    offsets[i] = total;
+    num_hits = chemfp_get_num_hits(self->results+i);
+    if (num_hits) {
+      memcpy(indices+total, self->results[i].indices, num_hits*sizeof(int));
+      memcpy(scores+total*score_size, self->results[i].scores, num_hits*score_size);
+    }
+    total += num_hits;
+  }
+  offsets[self->num_results] = total;
+
+  /* new_hit_view() frees the copy on failure */
+  offsets_view = new_hit_view(self, offsets, offsets, self->num_results+1,
+                              sizeof(long long), 'q');
+  indices_view = new_hit_view(self, indices, indices, (Py_ssize_t) total, sizeof(int), 'i');
+  scores_view = new_hit_view(self, scores, scores, (Py_ssize_t) total, score_size,
+                             score_formats[self->score_type]);
+  if (!offsets_view || !indices_view || !scores_view) {
+    Py_XDECREF(offsets_view);
+    Py_XDECREF(indices_view);
+    Py_XDECREF(scores_view);
+    return NULL;
+  }
+  views = PyTuple_New(3);
+  if (!views) {
+    Py_DECREF(offsets_view);
+    Py_DECREF(indices_view);
+    Py_DECREF(scores_view);
+    return NULL;
+  }
+  PyTuple_SET_ITEM(views, 0, offsets_view);
+  PyTuple_SET_ITEM(views, 1, indices_view);
+  PyTuple_SET_ITEM(views, 2, scores_view);
+  return views;
+}
+
+/* Add the (offsets, indices, scores) from get_flat_views() of a SearchResults */
+/* with "double" scores to the rows starting at 'row'. The strings may not be */
+/* aligned, so the offsets and scores are copied out one at a time. */
+static PyObject *
+SearchResults_add_flat_hits(SearchResults *self, PyObject *args, PyObject *kwds) {
+  static char *kwlist[] = {"row", "offsets", "indices", "scores", NULL};
+  int row, i, offsets_size, indices_size, scores_size, num_rows;
+  const char *offsets, *indices, *scores;
+  long long offset, next_offset, j;
+  int index;
+  double score;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "is#s#s#:_add_flat_hits", kwlist,
+                                   &row, &offsets, &offsets_size,
+                                   &indices, &indices_size,
+                                   &scores, &scores_size)) {
+    return NULL;
+  }
+  if (offsets_size < (int) sizeof(long long) || offsets_size % sizeof(long long) != 0) {
+    PyErr_SetString(PyExc_ValueError, "offsets must contain at least one 64-bit integer");
+    return NULL;
+  }
+  num_rows = offsets_size / sizeof(long long) - 1;
+  if (row < 0 || row > self->num_results - num_rows) {
+    PyErr_SetString(PyExc_IndexError, "the rows are out of range");
+    return NULL;
+  }
+  memcpy(&offset, offsets, sizeof(long long));
+  memcpy(&next_offset, offsets + num_rows*sizeof(long long), sizeof(long long));
+  if (offset != 0 ||
+      next_offset * sizeof(int) != (unsigned long long) indices_size ||
+      next_offset * sizeof(double) != (unsigned long long) scores_size) {
+    PyErr_SetString(PyExc_ValueError, "the offsets do not match the indices and scores");
+    return NULL;
+  }
+  for (i=0; i<num_rows; i++) {
+    memcpy(&next_offset, offsets + (i+1)*sizeof(long long), sizeof(long long));
+    if (next_offset < offset) {
+      PyErr_SetString(PyExc_ValueError, "the offsets must not decrease");
+      return NULL;
+    }
+    offset = next_offset;
+  }
+  if (!chemfp_py_check_no_exports(self)) {
+    return NULL;
+  }
+
+  memcpy(&offset, offsets, sizeof(long long));
+  for (i=0; i<num_rows; i++) {
+    memcpy(&next_offset, offsets + (i+1)*sizeof(long long), sizeof(long long));
+    for (j=offset; j<next_offset; j++) {
+      memcpy(&index, indices + j*sizeof(int), sizeof(int));
+      memcpy(&score, scores + j*sizeof(double), sizeof(double));
+      if (!chemfp_add_hit(self->results+row+i, index, score)) {
+        return PyErr_NoMemory();
+      }
+    }
+    offset = next_offset;
+  }
+  Py_RETURN_NONE;
+}
+
 
 static PyMethodDef SearchResults_methods[] = {
   {"clear_all", (PyCFunction) SearchResults_clear_all, METH_VARARGS | METH_KEYWORDS,
@@ -748,6 +1004,14 @@ static PyMethodDef SearchResults_methods[] = {
    "(internal) Reorder the hits based on the requested ordering for a given row"},
   {"_add_hit", (PyCFunction) SearchResults_add_hit, METH_VARARGS | METH_KEYWORDS,
    "(internal) Add a target index and hit score to a given row"},
+  {"_get_indices_view", (PyCFunction) SearchResults_get_indices_view, METH_VARARGS | METH_KEYWORDS,
+   "(internal) A read-only buffer view of the target indices for a given row"},
+  {"_get_scores_view", (PyCFunction) SearchResults_get_scores_view, METH_VARARGS | METH_KEYWORDS,
+   "(internal) A read-only buffer view of the stored scores for a given row"},
+  {"get_flat_views", (PyCFunction) SearchResults_get_flat_views, METH_NOARGS,
+   "The (offsets, indices, scores) buffer views of all of the rows, concatenated"},
+  {"_add_flat_hits", (PyCFunction) SearchResults_add_flat_hits, METH_VARARGS | METH_KEYWORDS,
+   "(internal) Add the get_flat_views() hits of a SearchResults with double scores, starting at `row`"},
   {NULL}
 };
 
@@ -758,6 +1022,12 @@ static PyMemberDef SearchResults_members[] = {
 };
 
 
+static PyGetSetDef SearchResults_getset[] = {
+  {"score_type", (getter) SearchResults_get_score_type, NULL,
+   "how the scores are stored; one of 'double', 'float' or 'uint16'", NULL},
+  {NULL}
+};
+
 static PySequenceMethods SearchResults_as_sequence = {
     (lenfunc)SearchResults_length,                       /* sq_length */
     NULL,       /* sq_concat */
@@ -804,7 +1074,7 @@ PyTypeObject chemfp_py_SearchResultsType = {
     0,		               /* tp_iternext */
     SearchResults_methods,     /* tp_methods */
     SearchResults_members,     /* tp_members */
-    0,                         /* tp_getset */
+    SearchResults_getset,      /* tp_getset */
     0,                         /* tp_base */
     0,                         /* tp_dict */
     0,                         /* tp_descr_get */
@@ -814,3 +1084,171 @@ PyTypeObject chemfp_py_SearchResultsType = {
     0,                         /* tp_alloc */
     SearchResults_new          /* tp_new */
 };
+
+
+/************ Hit view type ***************/
+
+/* A HitView exports a hit array through both the old-style and the
+   new-style buffer interfaces. The new-style interface includes the
+   item format, so memoryview() and numpy.asarray() get the right
+   type. A row view points directly into the row's arrays. It keeps a
+   reference to the SearchResults, and the SearchResults refuses to
+   add or clear hits until all of its row views are gone. Reordering
+   is allowed, and the view sees the new order. */
+
+/* Something to point to for an empty row */
+static char empty_hits[8];
+
+static void
+HitView_dealloc(HitView *self) {
+  if (self->copy) {
+    PyMem_Free(self->copy);
+  } else {
+    ((SearchResults *) self->owner)->num_exports--;
+  }
+  Py_CLEAR(self->owner);
+  PyObject_Del(self);
+}
+
+static Py_ssize_t
+HitView_length(HitView *self) {
+  return self->num_items;
+}
+
+static void *
+HitView_get_buf(HitView *self) {
+  return self->buf ? self->buf : (void *) empty_hits;
+}
+
+static PyObject *
+HitView_get_format(HitView *self, void *closure) {
+  UNUSED(closure);
+  return PyString_FromString(self->format);
+}
+
+static PyObject *
+HitView_get_itemsize(HitView *self, void *closure) {
+  UNUSED(closure);
+  return PyInt_FromSsize_t(self->itemsize);
+}
+
+static PyObject *
+HitView_get_obj(HitView *self, void *closure) {
+  UNUSED(closure);
+  Py_INCREF(self->owner);
+  return self->owner;
+}
+
+/* Old-style buffer interface */
+
+static Py_ssize_t
+HitView_getreadbuffer(HitView *self, Py_ssize_t segment, void **ptrptr) {
+  if (segment != 0) {
+    PyErr_SetString(PyExc_SystemError, "accessing non-existent HitView segment");
+    return -1;
+  }
+  *ptrptr = HitView_get_buf(self);
+  return self->num_items * self->itemsize;
+}
+
+static Py_ssize_t
+HitView_getsegcount(HitView *self, Py_ssize_t *lenp) {
+  if (lenp) {
+    *lenp = self->num_items * self->itemsize;
+  }
+  return 1;
+}
+
+static Py_ssize_t
+HitView_getcharbuffer(HitView *self, Py_ssize_t segment, char **ptrptr) {
+  return HitView_getreadbuffer(self, segment, (void **) ptrptr);
+}
+
+/* New-style buffer interface */
+
+static int
+HitView_getbuffer(HitView *self, Py_buffer *view, int flags) {
+  if (PyBuffer_FillInfo(view, (PyObject *) self, HitView_get_buf(self),
+                        self->num_items * self->itemsize, 1, flags)) {
+    return -1;
+  }
+  view->itemsize = self->itemsize;
+  if ((flags & PyBUF_FORMAT) == PyBUF_FORMAT) {
+    view->format = self->format;
+  }
+  if ((flags & PyBUF_ND) == PyBUF_ND) {
+    view->shape = &self->num_items;
+  }
+  if ((flags & PyBUF_STRIDES) == PyBUF_STRIDES) {
+    view->strides = &self->itemsize;
+  }
+  return 0;
+}
+
+
+static PyGetSetDef HitView_getset[] = {
+  {"format", (getter) HitView_get_format, NULL,
+   "the struct-style format character for each item", NULL},
+  {"itemsize", (getter) HitView_get_itemsize, NULL,
+   "the number of bytes in each item", NULL},
+  {"obj", (getter) HitView_get_obj, NULL,
+   "the SearchResults which owns the hits", NULL},
+  {NULL}
+};
+
+static PySequenceMethods HitView_as_sequence = {
+    (lenfunc)HitView_length,                       /* sq_length */
+    NULL,       /* sq_concat */
+    NULL,       /* sq_repeat */
+    NULL,       /* sq_item */
+    NULL,       /* sq_slice */
+    NULL,       /* sq_ass_item */
+    NULL,       /* sq_ass_slice */
+    NULL,       /* sq_contains */
+    NULL,       /* sq_inplace_concat */
+    NULL        /* sq_inplace_repeat */
+};
+
+static PyBufferProcs HitView_as_buffer = {
+    (readbufferproc) HitView_getreadbuffer,   /* bf_getreadbuffer */
+    NULL,                                     /* bf_getwritebuffer */
+    (segcountproc) HitView_getsegcount,       /* bf_getsegcount */
+    (charbufferproc) HitView_getcharbuffer,   /* bf_getcharbuffer */
+    (getbufferproc) HitView_getbuffer,        /* bf_getbuffer */
+    NULL,                                     /* bf_releasebuffer */
+};
+
+
+PyTypeObject chemfp_py_HitViewType = {
+    PyObject_HEAD_INIT(NULL)
+    0,                         /*ob_size*/
+    "_chemfp.HitView",         /*tp_name*/
+    sizeof(HitView),           /*tp_basicsize*/
+    0,                         /*tp_itemsize*/
+    (destructor) HitView_dealloc,  /*tp_dealloc*/
+    0,                         /*tp_print*/
+    0,                         /*tp_getattr*/
+    0,                         /*tp_setattr*/
+    0,                         /*tp_compare*/
+    0,                         /*tp_repr*/
+    0,                         /*tp_as_number*/
+    &HitView_as_sequence,      /*tp_as_sequence*/
+    0,                         /*tp_as_mapping*/
+    0,                         /*tp_hash */
+    0,                         /*tp_call*/
+    0,                         /*tp_str*/
+    0,                         /*tp_getattro*/
+    0,                         /*tp_setattro*/
+    &HitView_as_buffer,        /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_NEWBUFFER, /*tp_flags*/
+    "A read-only view of the target indices or scores of a SearchResults", /* tp_doc */
+    0,                         /* tp_traverse */
+    0,                         /* tp_clear */
+    0,		               /* tp_richcompare */
+    0,		               /* tp_weaklistoffset */
+    0,		               /* tp_iter */
+    0,		               /* tp_iternext */
+    0,                         /* tp_methods */
+    0,                         /* tp_members */
+    HitView_getset,            /* tp_getset */
+};
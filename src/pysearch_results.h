@@ -6,6 +6,27 @@ typedef struct {
     int num_results;
     chemfp_search_result *results;
     PyObject *target_ids;
+    int score_type;  /* one of the chemfp_score_types */
+    Py_ssize_t num_exports;  /* number of HitViews which use the row arrays */
 } SearchResults;
 
+/* A read-only view of a hit array, exported through the buffer interface */
+typedef struct {
+    PyObject_HEAD
+    PyObject *owner;   /* the SearchResults which owns the hits */
+    void *buf;
+    void *copy;        /* NULL if buf points into a row, else memory owned by the view */
+    Py_ssize_t num_items;
+    Py_ssize_t itemsize;
+    char format[2];
+} HitView;
+
 extern PyTypeObject chemfp_py_SearchResultsType;
+extern PyTypeObject chemfp_py_HitViewType;
+
+/* Parse an interval like "[]" or "[)". Returns 0 and sets an exception if invalid */
+int chemfp_py_check_interval(const char *interval, int *include_min, int *include_max);
+
+/* Returns 0 and sets an exception if a HitView uses the row arrays, which means
+   the hits must not be added to, cleared, or reallocated */
+int chemfp_py_check_no_exports(SearchResults *results);
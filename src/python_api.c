@@ -3,6 +3,7 @@
 #include "chemfp.h"
 #include "chemfp_internal.h"
 #include "pysearch_results.h"
+#include "pybuffer_view.h"
 
 static PyObject *
 version(PyObject *self, PyObject *args) {
@@ -141,6 +142,48 @@ byte_tanimoto(PyObject *self, PyObject *args) {
   return PyFloat_FromDouble(chemfp_byte_tanimoto(len1, s1, s2));
 }
 
+static PyObject *
+hex_tversky(PyObject *self, PyObject *args) {
+  char *s1, *s2;
+  int len1, len2;
+  double alpha = 1.0, beta = 1.0;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "s#s#|dd:hex_tversky", &s1, &len1, &s2, &len2, &alpha, &beta))
+    return NULL;
+  if (len1 != len2) {
+    PyErr_SetString(PyExc_ValueError,
+                    "hex fingerprints must have the same length");
+    return NULL;
+  }
+  if (alpha < 0.0 || beta < 0.0) {
+    PyErr_SetString(PyExc_ValueError, "alpha and beta must not be negative");
+    return NULL;
+  }
+  return PyFloat_FromDouble(chemfp_hex_tversky(len1, s1, s2, alpha, beta));
+}
+
+static PyObject *
+byte_tversky(PyObject *self, PyObject *args) {
+  unsigned char *s1, *s2;
+  int len1, len2;
+  double alpha = 1.0, beta = 1.0;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "s#s#|dd:byte_tversky", &s1, &len1, &s2, &len2, &alpha, &beta))
+    return NULL;
+  if (len1 != len2) {
+    PyErr_SetString(PyExc_ValueError,
+                    "byte fingerprints must have the same length");
+    return NULL;
+  }
+  if (alpha < 0.0 || beta < 0.0) {
+    PyErr_SetString(PyExc_ValueError, "alpha and beta must not be negative");
+    return NULL;
+  }
+  return PyFloat_FromDouble(chemfp_byte_tversky(len1, s1, s2, alpha, beta));
+}
+
 static PyObject *
 byte_contains(PyObject *self, PyObject *args) {
   unsigned char *s1, *s2;
@@ -261,6 +304,77 @@ bad_threshold(double threshold) {
   return 0;
 }
 
+/* Check the per-query thresholds, after the query limits are known */
+static int
+bad_query_thresholds(const double *thresholds, int thresholds_size,
+                     int query_start, int query_end) {
+  int i, num_queries = (query_end > query_start) ? query_end - query_start : 0;
+  if (thresholds_size < (int)(num_queries * sizeof(double))) {
+    PyErr_SetString(PyExc_ValueError, "not enough thresholds for the queries");
+    return 1;
+  }
+  for (i=0; i<num_queries; i++) {
+    if (bad_threshold(thresholds[i])) {
+      return 1;
+    }
+  }
+  return 0;
+}
+
+static int
+bad_query_ks(const int *ks, int ks_size, int query_start, int query_end) {
+  int i, num_queries = (query_end > query_start) ? query_end - query_start : 0;
+  if (ks_size < (int)(num_queries * sizeof(int))) {
+    PyErr_SetString(PyExc_ValueError, "not enough k values for the queries");
+    return 1;
+  }
+  for (i=0; i<num_queries; i++) {
+    if (bad_k(ks[i])) {
+      return 1;
+    }
+  }
+  return 0;
+}
+
+static int
+bad_tversky_weights(double alpha, double beta) {
+  if (alpha < 0.0 || beta < 0.0) {
+    PyErr_SetString(PyExc_ValueError, "alpha and beta must not be negative");
+    return 1;
+  }
+  return 0;
+}
+
+/* For a similarity, min_score is the threshold. For a distance, max_score is the threshold */
+static int
+bad_metric(int metric_type, double alpha, double beta, double min_score, double max_score) {
+  int is_distance = chemfp_metric_is_distance(metric_type);
+  if (is_distance < 0) {
+    PyErr_SetString(PyExc_ValueError, "unknown metric");
+    return 1;
+  }
+  if (bad_tversky_weights(alpha, beta)) {
+    return 1;
+  }
+  if (is_distance) {
+    if (!(max_score >= 0.0)) {
+      PyErr_SetString(PyExc_ValueError, "distance threshold must not be negative");
+      return 1;
+    }
+    if (!(min_score >= 0.0)) {
+      PyErr_SetString(PyExc_ValueError, "minimum distance must not be negative");
+      return 1;
+    }
+    return 0;
+  }
+  return bad_threshold(min_score);
+}
+
+static int
+bad_interval(const char *interval_str, chemfp_interval *interval) {
+  return !chemfp_py_check_interval(interval_str, &interval->include_min, &interval->include_max);
+}
+
 static int
 bad_alignment(int alignment) {
   if (chemfp_byte_popcount(sizeof(int), (unsigned char *) &alignment) != 1) {
@@ -340,6 +454,9 @@ bad_results(SearchResults *results, int results_offset) {
     PyErr_SetString(PyExc_ValueError, "non-zero results_offset?");
     return 1;
   }
+  if (!chemfp_py_check_no_exports(results)) {
+    return 1;
+  }
   return 0;
 }
 
@@ -750,6 +867,154 @@ fps_knearest_tanimoto_search_feed(PyObject *self, PyObject *args) {
   return PyInt_FromLong(err);
 }
 
+/* In Python this is
+ (err, num_lines_processed) = fps_count_tversky_hits(
+     num_bits, query_start_padding, query_end_padding,
+     query_storage_size, query_arena, query_start, query_end,
+     target_block, target_start, target_end,
+     alpha, beta, threshold, counts)
+*/
+static PyObject *
+fps_count_tversky_hits(PyObject *self, PyObject *args) {
+  int num_bits, query_storage_size, query_arena_size, query_start, query_end;
+  int query_start_padding, query_end_padding;
+  const unsigned char *query_arena;
+  const char *target_block;
+  int target_block_size, target_start, target_end;
+  double alpha, beta, threshold;
+  int *counts, counts_size;
+  int num_lines_processed = 0;
+  int err;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "iiiit#iit#iidddw#:fps_count_tversky_hits",
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_block, &target_block_size,
+                        &target_start, &target_end,
+                        &alpha, &beta, &threshold,
+                        &counts, &counts_size))
+    return NULL;
+
+  if (bad_num_bits(num_bits) ||
+      bad_padding("query_", query_start_padding, query_end_padding,
+                  &query_arena, &query_arena_size) ||
+      bad_arena_size("query_", num_bits, query_storage_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_block_limits(target_block_size, &target_start, &target_end) ||
+      bad_tversky_weights(alpha, beta) ||
+      bad_threshold(threshold) ||
+      bad_counts(counts_size, query_arena_size / query_storage_size)) {
+    return NULL;
+  }
+
+  if (target_start >= target_end) {
+    return Py_BuildValue("ii", CHEMFP_OK, 0);
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  err = chemfp_fps_count_tversky_hits(
+        num_bits, 
+        query_storage_size, query_arena, query_start, query_end,
+        target_block+target_start, target_end-target_start,
+        alpha, beta, threshold, counts, &num_lines_processed);
+  Py_END_ALLOW_THREADS;
+
+  return Py_BuildValue("ii", err, num_lines_processed);
+}
+
+/* In Python this is
+ (err, next_start, num_lines_processed, num_cells_processed) = 
+     fps_threshold_tversky_search(num_bits, query_start_padding, query_end_padding,
+                                  query_storage_size, query_arena, query_start, query_end,
+                                  target_block, target_start, target_end,
+                                  alpha, beta, threshold, cells)
+*/
+static PyObject *
+fps_threshold_tversky_search(PyObject *self, PyObject *args) {
+  int num_bits, query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size, query_start, query_end;
+  const unsigned char *query_arena;
+  const char *target_block, *stopped_at;
+  int target_block_size, target_start, target_end;
+  chemfp_tanimoto_cell *cells;
+  double alpha, beta, threshold;
+  int cells_size;
+  int num_lines_processed = 0, num_cells_processed = 0;
+  int num_cells, err;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "iiiit#iit#iidddw#:fps_threshold_tversky_search",
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_block, &target_block_size,
+                        &target_start, &target_end,
+                        &alpha, &beta, &threshold,
+                        &cells, &cells_size))
+    return NULL;
+
+  if (bad_num_bits(num_bits) ||
+      bad_padding("query_", query_start_padding, query_end_padding,
+                  &query_arena, &query_arena_size) ||
+      bad_arena_size("query_", num_bits, query_storage_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_block_limits(target_block_size, &target_start, &target_end) ||
+      bad_tversky_weights(alpha, beta) ||
+      bad_threshold(threshold) ||
+      bad_fps_cells(&num_cells, cells_size, query_arena_size / query_storage_size)) {
+    return NULL;
+  }
+  if (target_start >= target_end) {
+    /* start of next byte to process, num lines processed, num cells */
+    return Py_BuildValue("iiii", CHEMFP_OK, target_end, 0, 0);
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  err = chemfp_fps_threshold_tversky_search(
+        num_bits, 
+        query_storage_size, query_arena, query_start, query_end,
+        target_block+target_start, target_end-target_start,
+        alpha, beta, threshold,
+        num_cells, cells,
+        &stopped_at, &num_lines_processed, &num_cells_processed);
+  Py_END_ALLOW_THREADS;
+
+  return Py_BuildValue("iiii", err, stopped_at - target_block,
+                       num_lines_processed, num_cells_processed);
+}
+
+static PyObject *
+fps_knearest_tversky_search_feed(PyObject *self, PyObject *args) {
+  chemfp_fps_knearest_search *knearest_search;  
+  int knearest_search_size;
+  const char *target_block;
+  int target_block_size, target_start, target_end;
+  double alpha, beta;
+  int err;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "w#ddt#ii:fps_knearest_tversky_search_feed",
+                        &knearest_search, &knearest_search_size,
+                        &alpha, &beta,
+                        &target_block, &target_block_size, &target_start, &target_end))
+    return NULL;
+
+  if (bad_knearest_search_size(knearest_search_size) ||
+      bad_tversky_weights(alpha, beta) ||
+      bad_block_limits(target_block_size, &target_start, &target_end))
+    return NULL;
+
+  Py_BEGIN_ALLOW_THREADS;
+  err = chemfp_fps_knearest_tversky_search_feed(knearest_search, alpha, beta,
+                                                target_block_size, target_block);
+  Py_END_ALLOW_THREADS;
+  return PyInt_FromLong(err);
+}
+
 static PyObject *
 fps_knearest_search_finish(PyObject *self, PyObject *args) {
   chemfp_fps_knearest_search *knearest_search;  
@@ -1098,62 +1363,651 @@ make_sorted_aligned_arena(PyObject *self, PyObject *args) {
 }
 
 
-/* count_tanimoto_arena */
-static PyObject *
-count_tanimoto_arena(PyObject *self, PyObject *args) {
-  double threshold;
-  int num_bits;
-  const unsigned char *query_arena, *target_arena;
-  int query_start_padding, query_end_padding;
-  int query_storage_size, query_arena_size=0, query_start=0, query_end=0;
-  int target_start_padding, target_end_padding;
-  int target_storage_size, target_arena_size=0, target_start=0, target_end=0;
-  int *target_popcount_indices, target_popcount_indices_size;
-  int result_counts_size, *result_counts;
-  UNUSED(self);
-
-  if (!PyArg_ParseTuple(args, "diiiis#iiiiis#iis#w#:count_tanimoto_arena",
-                        &threshold,
-                        &num_bits,
-                        &query_start_padding, &query_end_padding,
-                        &query_storage_size, &query_arena, &query_arena_size,
-                        &query_start, &query_end,
-                        &target_start_padding, &target_end_padding,
-                        &target_storage_size, &target_arena, &target_arena_size,
-                        &target_start, &target_end,
-                        &target_popcount_indices, &target_popcount_indices_size,
-                        &result_counts, &result_counts_size))
-    return NULL;
+/* Grow the string in *string_obj, which must not be used anywhere */
+/* else, so it has space for 'size' bytes after a start padding which */
+/* puts them at the alignment. The first 'used' bytes are kept. The */
+/* capacity at least doubles, so the total cost stays linear. On */
+/* failure this returns 0 and *string_obj may be NULL. */
+static int
+grow_aligned_string(PyObject **string_obj, Py_ssize_t *capacity, int *start_padding,
+                    Py_ssize_t used, Py_ssize_t size, int alignment) {
+  Py_ssize_t new_capacity;
+  char *s;
+  int new_padding;
 
-  if (bad_threshold(threshold) ||
-      bad_num_bits(num_bits) ||
-      bad_padding("query ", query_start_padding, query_end_padding,
-                  &query_arena, &query_arena_size) ||
-      bad_padding("target ", target_start_padding, target_end_padding,
-                  &target_arena, &target_arena_size) ||
-      bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
-      bad_arena_limits("query ", query_arena_size, query_storage_size,
-                       &query_start, &query_end) ||
-      bad_arena_limits("target ", target_arena_size, target_storage_size,
-                       &target_start, &target_end) ||
-      bad_popcount_indices("target ", 1, num_bits, 
-                            target_popcount_indices_size, &target_popcount_indices)) {
-    return NULL;
+  if (size <= *capacity) {
+    return 1;
   }
-
-  if (query_start > query_end) {
-    Py_RETURN_NONE;
+  if (size > INT_MAX - alignment) {
+    PyErr_SetString(PyExc_ValueError, "the fingerprints are larger than the 2 GB limit for an arena");
+    return 0;
+  }
+  new_capacity = (*capacity > size / 2) ? 2 * *capacity : size;
+  if (new_capacity > INT_MAX - alignment) {
+    new_capacity = INT_MAX - alignment;
+  }
+  if (_PyString_Resize(string_obj, new_capacity + alignment - 1)) {
+    return 0;
   }
+  /* realloc() may have moved the data to a different alignment */
+  s = PyString_AS_STRING(*string_obj);
+  new_padding = (int)((alignment - ALIGNMENT(s, alignment)) % alignment);
+  if (new_padding != *start_padding) {
+    memmove(s + new_padding, s + *start_padding, used);
+    *start_padding = new_padding;
+  }
+  *capacity = new_capacity;
+  return 1;
+}
 
-  if (result_counts_size < (int)((query_end - query_start)*sizeof(int))) {
-    PyErr_SetString(PyExc_ValueError, "not enough space allocated for result_counts");
-    return NULL;
+static int
+grow_array(void **array, Py_ssize_t *capacity, Py_ssize_t size, size_t itemsize) {
+  Py_ssize_t new_capacity;
+  void *new_array;
+  if (size <= *capacity) {
+    return 1;
+  }
+  new_capacity = (*capacity > size / 2) ? 2 * *capacity : size;
+  if ((size_t) new_capacity > PY_SSIZE_T_MAX / itemsize) {
+    PyErr_NoMemory();
+    return 0;
+  }
+  new_array = PyMem_Realloc(*array, new_capacity * itemsize);
+  if (!new_array) {
+    PyErr_NoMemory();
+    return 0;
   }
+  *array = new_array;
+  *capacity = new_capacity;
+  return 1;
+}
 
-  Py_BEGIN_ALLOW_THREADS;
-  chemfp_count_tanimoto_arena(threshold,
-                              num_bits,
-                              query_storage_size, query_arena, query_start, query_end,
+/* Move each fingerprint to its place in the sorted ordering by */
+/* following the cycles of the permutation. This needs space for one */
+/* fingerprint and one bit per fingerprint instead of a second arena. */
+static int
+reorder_arena_in_place(int storage_size, unsigned char *fps, int num_fingerprints,
+                       const ChemFPOrderedPopcount *ordering) {
+  unsigned char *saved_fp, *is_done;
+  int i, j, k;
+
+  saved_fp = (unsigned char *) malloc(storage_size);
+  is_done = (unsigned char *) calloc(num_fingerprints/8 + 1, 1);
+  if (!saved_fp || !is_done) {
+    free(saved_fp);
+    free(is_done);
+    return 0;
+  }
+  for (i=0; i<num_fingerprints; i++) {
+    if (is_done[i/8] & (1 << (i%8))) {
+      continue;
+    }
+    /* Fingerprint j gets the fingerprint which was at ordering[j].index */
+    memcpy(saved_fp, fps + ((Py_ssize_t) i)*storage_size, storage_size);
+    j = i;
+    for (;;) {
+      is_done[j/8] |= (1 << (j%8));
+      k = ordering[j].index;
+      if (k == i) {
+        break;
+      }
+      memcpy(fps + ((Py_ssize_t) j)*storage_size, fps + ((Py_ssize_t) k)*storage_size,
+             storage_size);
+      j = k;
+    }
+    memcpy(fps + ((Py_ssize_t) j)*storage_size, saved_fp, storage_size);
+  }
+  free(saved_fp);
+  free(is_done);
+  return 1;
+}
+
+/* In Python this is
+ (err, num_lines, start_padding, end_padding, arena, ordering, id_block, offsets) =
+     fps_load_arena(num_bits, num_bytes, storage_size, alignment, blocks, popcount_indices)
+ Decode the fps blocks from the 'blocks' iterable directly into a new
+ aligned arena, and compute the popcounts in the same pass. If
+ popcount_indices is not empty then the fingerprints are sorted by
+ popcount in place, the popcount indices are set, and 'ordering' is
+ the ChemFPOrderedPopcount data for the new order, or None if the
+ fingerprints were already in order. 'id_block' and 'offsets' are for
+ an IdTable. If there is a parse error then 'err' is not CHEMFP_OK,
+ 'num_lines' is the number of lines read including the bad line, and
+ the other values are None. */
+static PyObject *
+fps_load_arena(PyObject *self, PyObject *args) {
+  int num_bits, num_bytes, storage_size, alignment, popcount_indices_size;
+  int *popcount_indices;
+  PyObject *blocks, *iterator=NULL, *block_obj=NULL;
+  PyObject *arena_obj=NULL, *ordering_obj=NULL, *id_block_obj=NULL, *offsets_obj=NULL;
+  const char *block, *s;
+  Py_ssize_t block_size, piece_size, i;
+  Py_ssize_t arena_capacity, ordering_capacity=0, id_block_capacity=0, offsets_capacity=0;
+  ChemFPOrderedPopcount *ordering=NULL;
+  char *id_block=NULL;
+  unsigned int *offsets=NULL;
+  unsigned char *fps;
+  int start_padding, end_padding, num_fingerprints=0, total_lines=0, id_pos=0;
+  int num_lines, max_lines, err=CHEMFP_OK, need_to_sort=0, reorder_ok=1;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "iiiiOw#:fps_load_arena",
+                        &num_bits, &num_bytes, &storage_size, &alignment,
+                        &blocks,
+                        &popcount_indices, &popcount_indices_size)) {
+    return NULL;
+  }
+  if (bad_num_bits(num_bits) ||
+      bad_arena_size("", num_bits, storage_size) ||
+      bad_alignment(alignment)) {
+    return NULL;
+  }
+  if (num_bytes < 1 || storage_size < num_bytes) {
+    PyErr_SetString(PyExc_ValueError, "storage_size must be at least num_bytes");
+    return NULL;
+  }
+  if (popcount_indices_size != 0 &&
+      bad_popcount_indices("", 0, num_bits, popcount_indices_size, NULL)) {
+    return NULL;
+  }
+
+  iterator = PyObject_GetIter(blocks);
+  if (!iterator) {
+    return NULL;
+  }
+  /* Start with space for one fingerprint. This isn't the shared empty */
+  /* string, so it can be resized. */
+  arena_obj = PyString_FromStringAndSize(NULL, storage_size + alignment - 1);
+  if (!arena_obj) {
+    goto error;
+  }
+  arena_capacity = storage_size;
+  s = PyString_AS_STRING(arena_obj);
+  start_padding = (int)((alignment - ALIGNMENT(s, alignment)) % alignment);
+  if (!grow_array((void **) &offsets, &offsets_capacity, 1, sizeof(unsigned int))) {
+    goto error;
+  }
+  offsets[0] = 0;
+
+  while ((block_obj = PyIter_Next(iterator)) != NULL) {
+    if (PyObject_AsCharBuffer(block_obj, &block, &block_size)) {
+      goto error;
+    }
+    if (block_size > INT_MAX) {
+      PyErr_SetString(PyExc_ValueError, "fps block is too large");
+      goto error;
+    }
+    while (block_size > 0) {
+      /* Load the complete lines first, so the error is reported */
+      /* at the line which is missing the newline */
+      piece_size = block_size;
+      if (block[block_size-1] != '\n') {
+        for (i=block_size-1; i>=0; i--) {
+          if (block[i] == '\n') {
+            piece_size = i+1;
+            break;
+          }
+        }
+      }
+      max_lines = 1;
+      for (i=0; i<piece_size; i++) {
+        if (block[i] == '\n') {
+          max_lines++;
+        }
+      }
+      if (!grow_aligned_string(&arena_obj, &arena_capacity, &start_padding,
+                               ((Py_ssize_t) num_fingerprints) * storage_size,
+                               ((Py_ssize_t) num_fingerprints + max_lines) * storage_size,
+                               alignment) ||
+          !grow_array((void **) &ordering, &ordering_capacity, num_fingerprints + max_lines,
+                      sizeof(ChemFPOrderedPopcount)) ||
+          !grow_array((void **) &offsets, &offsets_capacity, num_fingerprints + max_lines + 1,
+                      sizeof(unsigned int)) ||
+          !grow_array((void **) &id_block, &id_block_capacity, id_pos + piece_size, 1)) {
+        goto error;
+      }
+      if (id_block_capacity > INT_MAX) {
+        PyErr_SetString(PyExc_ValueError, "the ids are larger than the 2 GB limit for an id block");
+        goto error;
+      }
+      fps = (unsigned char *) PyString_AS_STRING(arena_obj) + start_padding;
+
+      Py_BEGIN_ALLOW_THREADS;
+      err = chemfp_fps_load_block(num_bytes, storage_size, block, (int) piece_size,
+                                  max_lines, fps + ((Py_ssize_t) num_fingerprints) * storage_size,
+                                  ordering + num_fingerprints, num_fingerprints,
+                                  (int) id_block_capacity, id_block, &id_pos,
+                                  offsets + num_fingerprints + 1, &num_lines);
+      Py_END_ALLOW_THREADS;
+      num_fingerprints += num_lines;
+      total_lines += num_lines;
+      if (err != CHEMFP_OK) {
+        break;
+      }
+      block += piece_size;
+      block_size -= piece_size;
+    }
+    Py_DECREF(block_obj);
+    block_obj = NULL;
+    if (err != CHEMFP_OK) {
+      break;
+    }
+  }
+  if (PyErr_Occurred()) {
+    goto error;
+  }
+  if (err != CHEMFP_OK) {
+    Py_DECREF(iterator);
+    Py_DECREF(arena_obj);
+    PyMem_Free(ordering);
+    PyMem_Free(id_block);
+    PyMem_Free(offsets);
+    return Py_BuildValue("iiOOOOOO", err, total_lines,
+                         Py_None, Py_None, Py_None, Py_None, Py_None, Py_None);
+  }
+  Py_CLEAR(iterator);
+
+  if (popcount_indices_size != 0) {
+    for (i=1; i<num_fingerprints; i++) {
+      if (ordering[i].popcount < ordering[i-1].popcount) {
+        need_to_sort = 1;
+        break;
+      }
+    }
+  }
+
+  /* Trim the arena. Use the same layout as make_sorted_aligned_arena */
+  /* and make_unsorted_aligned_arena: if the fingerprints don't need */
+  /* to be sorted and the string is aligned then there's no padding, */
+  /* otherwise use the layout from _alloc_aligned_arena. */
+  end_padding = -1;
+  if (!need_to_sort && start_padding == 0) {
+    if (_PyString_Resize(&arena_obj, ((Py_ssize_t) num_fingerprints) * storage_size)) {
+      goto error;
+    }
+    if (ALIGNMENT(PyString_AS_STRING(arena_obj), alignment) == 0) {
+      end_padding = 0;
+    }
+  }
+  if (end_padding == -1) {
+    if (_PyString_Resize(&arena_obj,
+                         ((Py_ssize_t) num_fingerprints) * storage_size + alignment - 1)) {
+      goto error;
+    }
+    s = PyString_AS_STRING(arena_obj);
+    i = (Py_ssize_t)((alignment - ALIGNMENT(s, alignment)) % alignment);
+    if (i != start_padding) {
+      memmove((char *) s + i, s + start_padding, ((Py_ssize_t) num_fingerprints) * storage_size);
+      start_padding = (int) i;
+    }
+    end_padding = alignment - 1 - start_padding;
+  }
+  fps = (unsigned char *) PyString_AS_STRING(arena_obj);
+  memset(fps, 0, start_padding);
+  fps += start_padding;
+  memset(fps + ((Py_ssize_t) num_fingerprints) * storage_size, 0, end_padding);
+
+  if (popcount_indices_size != 0) {
+    Py_BEGIN_ALLOW_THREADS;
+    if (need_to_sort) {
+      qsort(ordering, num_fingerprints, sizeof(ChemFPOrderedPopcount), compare_by_popcount);
+      reorder_ok = reorder_arena_in_place(storage_size, fps, num_fingerprints, ordering);
+    }
+    if (reorder_ok) {
+      set_popcount_indicies(num_fingerprints, num_bits, ordering, popcount_indices);
+    }
+    Py_END_ALLOW_THREADS;
+    if (!reorder_ok) {
+      PyErr_NoMemory();
+      goto error;
+    }
+  }
+
+  if (need_to_sort) {
+    ordering_obj = PyString_FromStringAndSize((const char *) ordering,
+                                              num_fingerprints * sizeof(ChemFPOrderedPopcount));
+  } else {
+    Py_INCREF(Py_None);
+    ordering_obj = Py_None;
+  }
+  id_block_obj = PyString_FromStringAndSize(id_block, id_pos);
+  offsets_obj = PyString_FromStringAndSize((const char *) offsets,
+                                           (num_fingerprints + 1) * sizeof(unsigned int));
+  PyMem_Free(ordering);
+  PyMem_Free(id_block);
+  PyMem_Free(offsets);
+  if (!ordering_obj || !id_block_obj || !offsets_obj) {
+    Py_DECREF(arena_obj);
+    Py_XDECREF(ordering_obj);
+    Py_XDECREF(id_block_obj);
+    Py_XDECREF(offsets_obj);
+    return NULL;
+  }
+  return Py_BuildValue("iiiiNNNN", CHEMFP_OK, total_lines, start_padding, end_padding,
+                       arena_obj, ordering_obj, id_block_obj, offsets_obj);
+
+ error:
+  Py_XDECREF(block_obj);
+  Py_XDECREF(iterator);
+  Py_XDECREF(arena_obj);
+  PyMem_Free(ordering);
+  PyMem_Free(id_block);
+  PyMem_Free(offsets);
+  return NULL;
+}
+
+
+/* Compute the popcount_indices for an arena, but only if the */
+/* fingerprints are already in popcount order. This never copies */
+/* the arena. Returns 1 if the indices were set, otherwise 0. */
+static PyObject *
+make_popcount_indices(PyObject *self, PyObject *args) {
+  int start = 0;
+  int num_bits, storage_size, start_padding, end_padding, num_fingerprints;
+  int arena_size, popcount_indices_size;
+  const unsigned char *arena, *fp;
+  int *popcount_indices;
+  chemfp_popcount_f calc_popcount;
+  int fp_index, popcount, prev_popcount, is_sorted = 1;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "iiiit#iw#:make_popcount_indices",
+                        &num_bits, &start_padding, &end_padding,
+                        &storage_size, &arena, &arena_size,
+                        &num_fingerprints,
+                        &popcount_indices, &popcount_indices_size)) {
+    return NULL;
+  }
+  if (bad_num_bits(num_bits) ||
+      bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
+      bad_arena_limits("", arena_size, storage_size, &start, &num_fingerprints) ||
+      bad_popcount_indices("", 0, num_bits, popcount_indices_size, NULL)) {
+    return NULL;
+  }
+
+  Py_BEGIN_ALLOW_THREADS;
+  calc_popcount = chemfp_select_popcount(num_bits, storage_size, arena);
+  prev_popcount = 0;
+  popcount_indices[0] = 0;
+  fp = arena;
+  for (fp_index = 0; fp_index < num_fingerprints; fp_index++, fp += storage_size) {
+    popcount = calc_popcount(storage_size, fp);
+    if (popcount < prev_popcount) {
+      is_sorted = 0;
+      break;
+    }
+    /* As with set_popcount_indicies, treat popcounts > num_bits as num_bits */
+    while (prev_popcount < popcount && prev_popcount < num_bits) {
+      popcount_indices[++prev_popcount] = fp_index;
+    }
+  }
+  if (is_sorted) {
+    while (prev_popcount <= num_bits) {
+      popcount_indices[++prev_popcount] = num_fingerprints;
+    }
+  }
+  Py_END_ALLOW_THREADS;
+
+  return PyBool_FromLong(is_sorted);
+}
+
+/* The id index functions. See id_index.c for the table layout. */
+
+static int
+bad_id_table(int num_ids, int id_block_size, const unsigned int *offsets, int offsets_size) {
+  unsigned int last_offset;
+  if (num_ids < 0) {
+    PyErr_SetString(PyExc_ValueError, "num_ids must not be negative");
+    return 1;
+  }
+  if (offsets_size / (int) sizeof(unsigned int) < num_ids + 1) {
+    PyErr_SetString(PyExc_ValueError, "offsets is too small for num_ids");
+    return 1;
+  }
+  memcpy(&last_offset, offsets + num_ids, sizeof(unsigned int));
+  if (last_offset > (unsigned int) id_block_size) {
+    PyErr_SetString(PyExc_ValueError, "offsets extend past the end of the id block");
+    return 1;
+  }
+  return 0;
+}
+
+static int
+bad_id_index_table(int table_size) {
+  if (table_size <= 0 || (table_size & (table_size-1))) {
+    PyErr_SetString(PyExc_ValueError, "id index table size must be a power of two");
+    return 1;
+  }
+  return 0;
+}
+
+static PyObject *
+get_id_index_size(PyObject *self, PyObject *args) {
+  int num_ids, table_size;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "i:get_id_index_size", &num_ids)) {
+    return NULL;
+  }
+  if (num_ids < 0) {
+    PyErr_SetString(PyExc_ValueError, "num_ids must not be negative");
+    return NULL;
+  }
+  table_size = chemfp_get_id_index_size(num_ids);
+  if (table_size < 0) {
+    PyErr_SetString(PyExc_ValueError, "too many ids for an id index");
+    return NULL;
+  }
+  return PyInt_FromLong(table_size);
+}
+
+static PyObject *
+make_id_index(PyObject *self, PyObject *args) {
+  int num_ids, id_block_size, offsets_size, table_size, err;
+  const char *id_block;
+  const unsigned int *offsets;
+  unsigned int *table;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "is#s#w#:make_id_index",
+                        &num_ids, &id_block, &id_block_size,
+                        &offsets, &offsets_size,
+                        &table, &table_size)) {
+    return NULL;
+  }
+  table_size /= sizeof(unsigned int);
+  if (bad_id_table(num_ids, id_block_size, offsets, offsets_size) ||
+      bad_id_index_table(table_size)) {
+    return NULL;
+  }
+  if (table_size <= num_ids) {
+    PyErr_SetString(PyExc_ValueError, "id index table is too small");
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  err = chemfp_make_id_index(num_ids, id_block_size, id_block, offsets, table_size, table);
+  Py_END_ALLOW_THREADS;
+  if (err < 0) {
+    PyErr_SetString(PyExc_ValueError, "invalid offsets in the id table");
+    return NULL;
+  }
+  return Py_BuildValue("");
+}
+
+static PyObject *
+id_index_lookup(PyObject *self, PyObject *args) {
+  int num_ids, id_block_size, offsets_size, table_size, id_len;
+  const char *id_block, *id;
+  const unsigned int *offsets, *table;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "is#s#s#s#:id_index_lookup",
+                        &num_ids, &id_block, &id_block_size,
+                        &offsets, &offsets_size,
+                        &table, &table_size,
+                        &id, &id_len)) {
+    return NULL;
+  }
+  table_size /= sizeof(unsigned int);
+  if (bad_id_table(num_ids, id_block_size, offsets, offsets_size) ||
+      bad_id_index_table(table_size)) {
+    return NULL;
+  }
+  return PyInt_FromLong(chemfp_id_index_lookup(num_ids, id_block_size, id_block, offsets,
+                                               table_size, table, id_len, id));
+}
+
+/* Get an id from an id table. Negative indices are not supported. */
+static PyObject *
+get_id_table_item(PyObject *self, PyObject *args) {
+  int id_block_size, offsets_size, num_ids, i;
+  const char *id_block;
+  const unsigned int *offsets;
+  unsigned int start, end;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "s#s#i:get_id_table_item",
+                        &id_block, &id_block_size,
+                        &offsets, &offsets_size, &i)) {
+    return NULL;
+  }
+  num_ids = offsets_size / (int) sizeof(unsigned int) - 1;
+  if (i < 0 || i >= num_ids) {
+    PyErr_SetString(PyExc_IndexError, "id index out of range");
+    return NULL;
+  }
+  memcpy(&start, offsets+i, sizeof(unsigned int));
+  memcpy(&end, offsets+i+1, sizeof(unsigned int));
+  if (end <= start || end > (unsigned int) id_block_size) {
+    PyErr_SetString(PyExc_ValueError, "invalid offsets in the id table");
+    return NULL;
+  }
+  return PyString_FromStringAndSize(id_block+start, end-start-1);
+}
+
+/* Make a new id block containing the ids at the given indices, in order. */
+/* The new offsets must have space for num_indices+1 values. */
+static PyObject *
+take_id_table_items(PyObject *self, PyObject *args) {
+  int id_block_size, offsets_size, indices_size, new_offsets_size;
+  int num_ids, num_indices, i, index;
+  const char *id_block;
+  const unsigned int *offsets;
+  const int *indices;
+  unsigned int *new_offsets, start, end, pos;
+  long long total_size = 0;
+  PyObject *new_id_block;
+  char *dest;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "s#s#s#w#:take_id_table_items",
+                        &id_block, &id_block_size,
+                        &offsets, &offsets_size,
+                        &indices, &indices_size,
+                        &new_offsets, &new_offsets_size)) {
+    return NULL;
+  }
+  num_ids = offsets_size / (int) sizeof(unsigned int) - 1;
+  num_indices = indices_size / (int) sizeof(int);
+  if (new_offsets_size / (int) sizeof(unsigned int) < num_indices + 1) {
+    PyErr_SetString(PyExc_ValueError, "new offsets are too small");
+    return NULL;
+  }
+
+  /* Validate everything and find the new block size */
+  for (i=0; i<num_indices; i++) {
+    index = indices[i];
+    if (index < 0 || index >= num_ids) {
+      PyErr_SetString(PyExc_IndexError, "id index out of range");
+      return NULL;
+    }
+    memcpy(&start, offsets+index, sizeof(unsigned int));
+    memcpy(&end, offsets+index+1, sizeof(unsigned int));
+    if (end <= start || end > (unsigned int) id_block_size) {
+      PyErr_SetString(PyExc_ValueError, "invalid offsets in the id table");
+      return NULL;
+    }
+    total_size += end - start;
+  }
+  if (total_size >= 0xFFFFFFFFLL || total_size > PY_SSIZE_T_MAX) {
+    PyErr_SetString(PyExc_ValueError, "too many ids for an id table");
+    return NULL;
+  }
+
+  new_id_block = PyString_FromStringAndSize(NULL, (Py_ssize_t) total_size);
+  if (new_id_block == NULL) {
+    return NULL;
+  }
+  dest = PyString_AS_STRING(new_id_block);
+  pos = 0;
+  for (i=0; i<num_indices; i++) {
+    index = indices[i];
+    memcpy(&start, offsets+index, sizeof(unsigned int));
+    memcpy(&end, offsets+index+1, sizeof(unsigned int));
+    new_offsets[i] = pos;
+    memcpy(dest+pos, id_block+start, end-start);
+    pos += end-start;
+  }
+  new_offsets[num_indices] = pos;
+  return new_id_block;
+}
+
+/* count_tanimoto_arena */
+static PyObject *
+count_tanimoto_arena(PyObject *self, PyObject *args) {
+  double threshold;
+  int num_bits;
+  const unsigned char *query_arena, *target_arena;
+  int query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size=0, query_start=0, query_end=0;
+  int target_start_padding, target_end_padding;
+  int target_storage_size, target_arena_size=0, target_start=0, target_end=0;
+  int *target_popcount_indices, target_popcount_indices_size;
+  int result_counts_size, *result_counts;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "diiiis#iiiiis#iis#w#:count_tanimoto_arena",
+                        &threshold,
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_start_padding, &target_end_padding,
+                        &target_storage_size, &target_arena, &target_arena_size,
+                        &target_start, &target_end,
+                        &target_popcount_indices, &target_popcount_indices_size,
+                        &result_counts, &result_counts_size))
+    return NULL;
+
+  if (bad_threshold(threshold) ||
+      bad_num_bits(num_bits) ||
+      bad_padding("query ", query_start_padding, query_end_padding,
+                  &query_arena, &query_arena_size) ||
+      bad_padding("target ", target_start_padding, target_end_padding,
+                  &target_arena, &target_arena_size) ||
+      bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_arena_limits("target ", target_arena_size, target_storage_size,
+                       &target_start, &target_end) ||
+      bad_popcount_indices("target ", 1, num_bits, 
+                            target_popcount_indices_size, &target_popcount_indices)) {
+    return NULL;
+  }
+
+  if (query_start > query_end) {
+    Py_RETURN_NONE;
+  }
+
+  if (result_counts_size < (int)((query_end - query_start)*sizeof(int))) {
+    PyErr_SetString(PyExc_ValueError, "not enough space allocated for result_counts");
+    return NULL;
+  }
+
+  Py_BEGIN_ALLOW_THREADS;
+  chemfp_count_tanimoto_arena(threshold,
+                              num_bits,
+                              query_storage_size, query_arena, query_start, query_end,
                               target_storage_size, target_arena, target_start, target_end,
                               target_popcount_indices,
                               result_counts);
@@ -1161,10 +2015,1537 @@ count_tanimoto_arena(PyObject *self, PyObject *args) {
 
   Py_RETURN_NONE;
 }
-    
-/* threshold_tanimoto_arena */
+    
+/* threshold_tanimoto_arena */
+static PyObject *
+threshold_tanimoto_arena(PyObject *self, PyObject *args) {
+  double threshold;
+  int num_bits;
+  int query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size, query_start, query_end;
+  const unsigned char *query_arena;
+  int target_start_padding, target_end_padding;
+  int target_storage_size, target_arena_size, target_start, target_end;
+  const unsigned char *target_arena;
+
+  int *target_popcount_indices, target_popcount_indices_size;
+
+  int errval, result_offset;
+  SearchResults *results;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "diiiit#iiiiit#iit#Oi:threshold_tanimoto_arena",
+                        &threshold,
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_start_padding, &target_end_padding,
+                        &target_storage_size, &target_arena, &target_arena_size,
+                        &target_start, &target_end,
+                        &target_popcount_indices, &target_popcount_indices_size,
+                        &results, &result_offset)) {
+    return NULL;
+  }
+
+  if (bad_threshold(threshold) ||
+      bad_num_bits(num_bits) ||
+      bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
+      bad_padding("query ", query_start_padding, query_end_padding, 
+                  &query_arena, &query_arena_size) ||
+      bad_padding("target ", target_start_padding, target_end_padding, 
+                  &target_arena, &target_arena_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_arena_limits("target ", target_arena_size, target_storage_size,
+                       &target_start, &target_end) ||
+      bad_popcount_indices("target ", 1, num_bits,
+                            target_popcount_indices_size, &target_popcount_indices) ||
+      bad_results(results, result_offset)
+      ) {
+    return NULL;
+  }
+
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_threshold_tanimoto_arena(
+        threshold,
+        num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices,
+        results->results + result_offset);
+  Py_END_ALLOW_THREADS;
+
+  return PyInt_FromLong(errval);
+}
+
+/* knearest_tanimoto_arena */
+static PyObject *
+knearest_tanimoto_arena(PyObject *self, PyObject *args) {
+  int k;
+  double threshold;
+  int num_bits;
+  int query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size, query_start, query_end;
+  const unsigned char *query_arena;
+  int target_start_padding, target_end_padding;
+  int target_storage_size, target_arena_size, target_start, target_end;
+  const unsigned char *target_arena;
+
+  int *target_popcount_indices, target_popcount_indices_size;
+
+  int errval, result_offset;
+  SearchResults *results;
+
+  UNUSED(self);
+    
+  if (!PyArg_ParseTuple(args, "idiiiit#iiiiit#iit#Oi:knearest_tanimoto_arena",
+                        &k, &threshold,
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_start_padding, &target_end_padding,
+                        &target_storage_size, &target_arena, &target_arena_size,
+                        &target_start, &target_end,
+                        &target_popcount_indices, &target_popcount_indices_size,
+                        &results, &result_offset)) {
+    return NULL;
+  }
+
+  if (bad_k(k) ||
+      bad_threshold(threshold) ||
+      bad_num_bits(num_bits) ||
+      bad_padding("query ", query_start_padding, query_end_padding,
+                  &query_arena, &query_arena_size) ||
+      bad_padding("target ", target_start_padding, target_end_padding,
+                  &target_arena, &target_arena_size) ||
+      bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_arena_limits("target ", target_arena_size, target_storage_size,
+                       &target_start, &target_end) ||
+      bad_popcount_indices("target ", 1, num_bits,
+                            target_popcount_indices_size, &target_popcount_indices) ||
+      bad_results(results, result_offset)) {
+    return NULL;
+  }
+  
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_knearest_tanimoto_arena(
+        k, threshold,
+        num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices,
+        results->results);
+  Py_END_ALLOW_THREADS;
+  
+  return PyInt_FromLong(errval);
+}
+
+/* count_tanimoto_arena_per_query */
+static PyObject *
+count_tanimoto_arena_per_query(PyObject *self, PyObject *args) {
+  const double *thresholds;
+  int thresholds_size;
+  int num_bits;
+  const unsigned char *query_arena, *target_arena;
+  int query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size=0, query_start=0, query_end=0;
+  int target_start_padding, target_end_padding;
+  int target_storage_size, target_arena_size=0, target_start=0, target_end=0;
+  int *target_popcount_indices, target_popcount_indices_size;
+  int result_counts_size, *result_counts;
+  int errval;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "s#iiiis#iiiiis#iis#w#:count_tanimoto_arena_per_query",
+                        &thresholds, &thresholds_size,
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_start_padding, &target_end_padding,
+                        &target_storage_size, &target_arena, &target_arena_size,
+                        &target_start, &target_end,
+                        &target_popcount_indices, &target_popcount_indices_size,
+                        &result_counts, &result_counts_size))
+    return NULL;
+
+  if (bad_num_bits(num_bits) ||
+      bad_padding("query ", query_start_padding, query_end_padding,
+                  &query_arena, &query_arena_size) ||
+      bad_padding("target ", target_start_padding, target_end_padding,
+                  &target_arena, &target_arena_size) ||
+      bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_arena_limits("target ", target_arena_size, target_storage_size,
+                       &target_start, &target_end) ||
+      bad_popcount_indices("target ", 1, num_bits, 
+                            target_popcount_indices_size, &target_popcount_indices) ||
+      bad_query_thresholds(thresholds, thresholds_size, query_start, query_end)) {
+    return NULL;
+  }
+
+  if (query_start > query_end) {
+    Py_RETURN_NONE;
+  }
+
+  if (result_counts_size < (int)((query_end - query_start)*sizeof(int))) {
+    PyErr_SetString(PyExc_ValueError, "not enough space allocated for result_counts");
+    return NULL;
+  }
+
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_count_tanimoto_arena_per_query(
+        thresholds,
+        num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices,
+        result_counts);
+  Py_END_ALLOW_THREADS;
+
+  return PyInt_FromLong(errval);
+}
+
+/* threshold_tanimoto_arena_per_query */
+static PyObject *
+threshold_tanimoto_arena_per_query(PyObject *self, PyObject *args) {
+  const double *thresholds;
+  int thresholds_size;
+  int num_bits;
+  int query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size, query_start, query_end;
+  const unsigned char *query_arena;
+  int target_start_padding, target_end_padding;
+  int target_storage_size, target_arena_size, target_start, target_end;
+  const unsigned char *target_arena;
+
+  int *target_popcount_indices, target_popcount_indices_size;
+
+  int errval, result_offset;
+  SearchResults *results;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "s#iiiit#iiiiit#iit#Oi:threshold_tanimoto_arena_per_query",
+                        &thresholds, &thresholds_size,
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_start_padding, &target_end_padding,
+                        &target_storage_size, &target_arena, &target_arena_size,
+                        &target_start, &target_end,
+                        &target_popcount_indices, &target_popcount_indices_size,
+                        &results, &result_offset)) {
+    return NULL;
+  }
+
+  if (bad_num_bits(num_bits) ||
+      bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
+      bad_padding("query ", query_start_padding, query_end_padding, 
+                  &query_arena, &query_arena_size) ||
+      bad_padding("target ", target_start_padding, target_end_padding, 
+                  &target_arena, &target_arena_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_arena_limits("target ", target_arena_size, target_storage_size,
+                       &target_start, &target_end) ||
+      bad_popcount_indices("target ", 1, num_bits,
+                            target_popcount_indices_size, &target_popcount_indices) ||
+      bad_results(results, result_offset) ||
+      bad_query_thresholds(thresholds, thresholds_size, query_start, query_end)) {
+    return NULL;
+  }
+
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_threshold_tanimoto_arena_per_query(
+        thresholds,
+        num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices,
+        results->results + result_offset);
+  Py_END_ALLOW_THREADS;
+
+  return PyInt_FromLong(errval);
+}
+
+/* knearest_tanimoto_arena_per_query */
+static PyObject *
+knearest_tanimoto_arena_per_query(PyObject *self, PyObject *args) {
+  const int *ks;
+  int ks_size;
+  const double *thresholds;
+  int thresholds_size;
+  int num_bits;
+  int query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size, query_start, query_end;
+  const unsigned char *query_arena;
+  int target_start_padding, target_end_padding;
+  int target_storage_size, target_arena_size, target_start, target_end;
+  const unsigned char *target_arena;
+
+  int *target_popcount_indices, target_popcount_indices_size;
+
+  int errval, result_offset;
+  SearchResults *results;
+
+  UNUSED(self);
+    
+  if (!PyArg_ParseTuple(args, "s#s#iiiit#iiiiit#iit#Oi:knearest_tanimoto_arena_per_query",
+                        &ks, &ks_size, &thresholds, &thresholds_size,
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_start_padding, &target_end_padding,
+                        &target_storage_size, &target_arena, &target_arena_size,
+                        &target_start, &target_end,
+                        &target_popcount_indices, &target_popcount_indices_size,
+                        &results, &result_offset)) {
+    return NULL;
+  }
+
+  if (bad_num_bits(num_bits) ||
+      bad_padding("query ", query_start_padding, query_end_padding,
+                  &query_arena, &query_arena_size) ||
+      bad_padding("target ", target_start_padding, target_end_padding,
+                  &target_arena, &target_arena_size) ||
+      bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_arena_limits("target ", target_arena_size, target_storage_size,
+                       &target_start, &target_end) ||
+      bad_popcount_indices("target ", 1, num_bits,
+                            target_popcount_indices_size, &target_popcount_indices) ||
+      bad_results(results, result_offset) ||
+      bad_query_ks(ks, ks_size, query_start, query_end) ||
+      bad_query_thresholds(thresholds, thresholds_size, query_start, query_end)) {
+    return NULL;
+  }
+  
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_knearest_tanimoto_arena_per_query(
+        ks, thresholds,
+        num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices,
+        results->results + result_offset);
+  Py_END_ALLOW_THREADS;
+  
+  return PyInt_FromLong(errval);
+}
+
+static PyObject *
+knearest_results_finalize(PyObject *self, PyObject *args) {
+  int result_offset, num_results;
+  SearchResults *results;
+  UNUSED(self);
+    
+  if (!PyArg_ParseTuple(args, "Oii",
+                        &results, &result_offset, &num_results)) {
+    return NULL;
+  }
+  if (bad_results(results, result_offset) ||
+      bad_num_results(num_results)) {
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  chemfp_knearest_results_finalize(results->results+result_offset,
+                                   results->results+result_offset+num_results);
+  Py_END_ALLOW_THREADS;
+  return Py_BuildValue("");
+}
+
+/***** Symmetric search code ****/
+
+/* The symmetric searches call this from the thread which started the
+   search, with the GIL released, so a ^C can stop a long search. The
+   interrupt_data is the PyThreadState from Py_BEGIN_ALLOW_THREADS. If
+   there is a pending signal then the Python signal handler raises an
+   exception, and the search returns CHEMFP_INTERRUPTED. */
+static int
+check_signals(void *interrupt_data) {
+  PyThreadState **save = (PyThreadState **) interrupt_data;
+  int result;
+  PyEval_RestoreThread(*save);
+  result = PyErr_CheckSignals();
+  *save = PyEval_SaveThread();
+  return result != 0;
+}
+
+/* Returns 1 and sets an exception (if it isn't already set) if the symmetric search failed */
+static int
+symmetric_search_failed(int errval) {
+  if (errval == CHEMFP_INTERRUPTED) {
+    if (!PyErr_Occurred()) {
+      PyErr_SetString(PyExc_KeyboardInterrupt, "");
+    }
+    return 1;
+  }
+  if (errval == CHEMFP_NO_MEM) {
+    PyErr_NoMemory();
+    return 1;
+  }
+  return 0;
+}
+
+static PyObject *
+count_tanimoto_hits_arena_symmetric(PyObject *self, PyObject *args) {
+  double threshold;
+  int num_bits, start_padding, end_padding, storage_size, arena_size;
+  int query_start, query_end, target_start, target_end;
+  const unsigned char *arena;
+  int *popcount_indices, *result_counts;
+  int popcount_indices_size, result_counts_size;
+  int errval;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "diiiis#iiiis#w#:count_tanimoto_arena",
+                        &threshold,
+                        &num_bits,
+                        &start_padding, &end_padding,
+                        &storage_size, &arena, &arena_size,
+                        &query_start, &query_end,
+                        &target_start, &target_end,
+                        &popcount_indices, &popcount_indices_size,
+                        &result_counts, &result_counts_size)) {
+    return NULL;
+  }
+  if (bad_threshold(threshold) ||
+      bad_num_bits(num_bits) ||
+      bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
+      bad_fingerprint_sizes(num_bits, storage_size, storage_size) ||
+      bad_arena_limits("query ", arena_size, storage_size, &query_start, &query_end) ||
+      bad_arena_limits("target ", arena_size, storage_size, &target_start, &target_end) ||
+      bad_popcount_indices("", 1, num_bits, popcount_indices_size, &popcount_indices)) {
+    return NULL;
+  }
+  if (result_counts_size < (arena_size / storage_size) * sizeof(int) ) {
+    PyErr_SetString(PyExc_ValueError, "not enough space allocated for result_counts");
+    return NULL;
+  }
+  if (query_start > query_end) {
+    Py_RETURN_NONE;
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_count_tanimoto_hits_arena_symmetric(threshold,
+                                                      num_bits,
+                                                      storage_size, arena,
+                                                      query_start, query_end,
+                                                      target_start, target_end,
+                                                      popcount_indices,
+                                                      result_counts,
+                                                      check_signals, &_save);
+  Py_END_ALLOW_THREADS;
+  if (symmetric_search_failed(errval)) {
+    return NULL;
+  }
+  
+  Py_RETURN_NONE;
+}
+
+/* Add the counts from another count_tanimoto_hits_arena_symmetric array */
+static PyObject *
+add_counts(PyObject *self, PyObject *args) {
+  int *counts;
+  const int *increments;
+  int counts_size, increments_size, i, n;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "w#s#:add_counts",
+                        &counts, &counts_size,
+                        &increments, &increments_size)) {
+    return NULL;
+  }
+  if (counts_size != increments_size) {
+    PyErr_SetString(PyExc_ValueError, "counts and increments must have the same size");
+    return NULL;
+  }
+  n = counts_size / sizeof(int);
+  Py_BEGIN_ALLOW_THREADS;
+  for (i=0; i<n; i++) {
+    counts[i] += increments[i];
+  }
+  Py_END_ALLOW_THREADS;
+  Py_RETURN_NONE;
+}
+
+static PyObject *
+threshold_tanimoto_arena_symmetric(PyObject *self, PyObject *args) {
+  double threshold;
+  int num_bits, start_padding, end_padding, storage_size, arena_size;
+  int query_start, query_end, target_start, target_end;
+  const unsigned char *arena;
+  int *popcount_indices;
+  int popcount_indices_size;
+  SearchResults *results;
+  int errval, result_offset;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "diiiis#iiiis#Oi:threshold_tanimoto_arena_symmetric",
+                        &threshold,
+                        &num_bits,
+                        &start_padding, &end_padding,
+                        &storage_size, &arena, &arena_size,
+                        &query_start, &query_end,
+                        &target_start, &target_end,
+                        &popcount_indices, &popcount_indices_size,
+                        &results, &result_offset)) {
+    return NULL;
+  }
+  if (bad_threshold(threshold) ||
+      bad_num_bits(num_bits) ||
+      bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
+      bad_fingerprint_sizes(num_bits, storage_size, storage_size) ||
+      bad_arena_limits("query ", arena_size, storage_size, &query_start, &query_end) ||
+      bad_arena_limits("target ", arena_size, storage_size, &target_start, &target_end) ||
+      bad_popcount_indices("", 1, num_bits, popcount_indices_size, &popcount_indices) ||
+      bad_results(results, 0)) {
+    return NULL;
+  }
+  if (query_start >= query_end) {
+    Py_RETURN_NONE;
+  }
+  /* The hits for query_start go into row result_offset */
+  if (result_offset < 0 || result_offset > results->num_results - (query_end - query_start)) {
+    PyErr_SetString(PyExc_ValueError, "not enough space allocated for the results");
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  /* The C code uses results[query_index], so shift the pointer to match */
+  errval = chemfp_threshold_tanimoto_arena_symmetric(threshold,
+                                                     num_bits,
+                                                     storage_size, arena,
+                                                     query_start, query_end,
+                                                     target_start, target_end,
+                                                     popcount_indices,
+                                                     results->results + result_offset - query_start,
+                                                     check_signals, &_save);
+  Py_END_ALLOW_THREADS;
+  if (symmetric_search_failed(errval)) {
+    return NULL;
+  }
+  
+  Py_RETURN_NONE;
+}
+
+/* knearest_tanimoto_arena */
+static PyObject *
+knearest_tanimoto_arena_symmetric(PyObject *self, PyObject *args) {
+  double threshold;
+  int k, num_bits, start_padding, end_padding, storage_size, arena_size;
+  int query_start, query_end, target_start, target_end;
+  const unsigned char *arena;
+  int *popcount_indices;
+  int popcount_indices_size;
+  SearchResults *results;
+  int errval;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "idiiiis#iiiis#O:knearest_tanimoto_arena_symmetric",
+                        &k, &threshold,
+                        &num_bits,
+                        &start_padding, &end_padding,
+                        &storage_size, &arena, &arena_size,
+                        &query_start, &query_end,
+                        &target_start, &target_end,
+                        &popcount_indices, &popcount_indices_size,
+                        &results)) {
+    return NULL;
+  }
+  if (bad_k(k) ||
+      bad_threshold(threshold) ||
+      bad_num_bits(num_bits) ||
+      bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
+      bad_fingerprint_sizes(num_bits, storage_size, storage_size) ||
+      bad_arena_limits("query ", arena_size, storage_size, &query_start, &query_end) ||
+      bad_arena_limits("target ", arena_size, storage_size, &target_start, &target_end) ||
+      bad_popcount_indices("", 1, num_bits, popcount_indices_size, &popcount_indices) ||
+      bad_results(results, 0)) {
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_knearest_tanimoto_arena_symmetric(k, threshold,
+                                                    num_bits,
+                                                    storage_size, arena,
+                                                    query_start, query_end,
+                                                    target_start, target_end,
+                                                    popcount_indices,
+                                                    results->results,
+                                                    check_signals, &_save);
+  Py_END_ALLOW_THREADS;
+  if (symmetric_search_failed(errval)) {
+    return NULL;
+  }
+  
+  Py_RETURN_NONE;
+}
+
+/***** Metric search code ****/
+
+/* count_metric_arena */
+static PyObject *
+count_metric_arena(PyObject *self, PyObject *args) {
+  int metric_type;
+  double alpha, beta, min_score, max_score;
+  const char *interval_str;
+  chemfp_interval interval;
+  chemfp_metric metric;
+  int num_bits;
+  const unsigned char *query_arena, *target_arena;
+  int query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size=0, query_start=0, query_end=0;
+  int target_start_padding, target_end_padding;
+  int target_storage_size, target_arena_size=0, target_start=0, target_end=0;
+  int *target_popcount_indices, target_popcount_indices_size;
+  int result_counts_size, *result_counts;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "iddddsiiiis#iiiiis#iis#w#:count_metric_arena",
+                        &metric_type, &alpha, &beta, &min_score, &max_score, &interval_str,
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_start_padding, &target_end_padding,
+                        &target_storage_size, &target_arena, &target_arena_size,
+                        &target_start, &target_end,
+                        &target_popcount_indices, &target_popcount_indices_size,
+                        &result_counts, &result_counts_size))
+    return NULL;
+
+  if (bad_metric(metric_type, alpha, beta, min_score, max_score) ||
+      bad_interval(interval_str, &interval) ||
+      bad_num_bits(num_bits) ||
+      bad_padding("query ", query_start_padding, query_end_padding,
+                  &query_arena, &query_arena_size) ||
+      bad_padding("target ", target_start_padding, target_end_padding,
+                  &target_arena, &target_arena_size) ||
+      bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_arena_limits("target ", target_arena_size, target_storage_size,
+                       &target_start, &target_end) ||
+      bad_popcount_indices("target ", 1, num_bits, 
+                            target_popcount_indices_size, &target_popcount_indices)) {
+    return NULL;
+  }
+
+  if (query_start > query_end) {
+    Py_RETURN_NONE;
+  }
+
+  if (result_counts_size < (int)((query_end - query_start)*sizeof(int))) {
+    PyErr_SetString(PyExc_ValueError, "not enough space allocated for result_counts");
+    return NULL;
+  }
+
+  Py_BEGIN_ALLOW_THREADS;
+  metric.type = metric_type;
+  metric.alpha = alpha;
+  metric.beta = beta;
+  interval.min_score = min_score;
+  interval.max_score = max_score;
+  chemfp_count_metric_arena(&metric, &interval,
+                            num_bits,
+                            query_storage_size, query_arena, query_start, query_end,
+                            target_storage_size, target_arena, target_start, target_end,
+                            target_popcount_indices,
+                            result_counts);
+  Py_END_ALLOW_THREADS;
+
+  Py_RETURN_NONE;
+}
+
+/* threshold_metric_arena */
+static PyObject *
+threshold_metric_arena(PyObject *self, PyObject *args) {
+  int metric_type;
+  double alpha, beta, min_score, max_score;
+  const char *interval_str;
+  chemfp_interval interval;
+  chemfp_metric metric;
+  int num_bits;
+  int query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size, query_start, query_end;
+  const unsigned char *query_arena;
+  int target_start_padding, target_end_padding;
+  int target_storage_size, target_arena_size, target_start, target_end;
+  const unsigned char *target_arena;
+
+  int *target_popcount_indices, target_popcount_indices_size;
+
+  int errval, result_offset;
+  SearchResults *results;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "iddddsiiiit#iiiiit#iit#Oi:threshold_metric_arena",
+                        &metric_type, &alpha, &beta, &min_score, &max_score, &interval_str,
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_start_padding, &target_end_padding,
+                        &target_storage_size, &target_arena, &target_arena_size,
+                        &target_start, &target_end,
+                        &target_popcount_indices, &target_popcount_indices_size,
+                        &results, &result_offset)) {
+    return NULL;
+  }
+
+  if (bad_metric(metric_type, alpha, beta, min_score, max_score) ||
+      bad_interval(interval_str, &interval) ||
+      bad_num_bits(num_bits) ||
+      bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
+      bad_padding("query ", query_start_padding, query_end_padding, 
+                  &query_arena, &query_arena_size) ||
+      bad_padding("target ", target_start_padding, target_end_padding, 
+                  &target_arena, &target_arena_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_arena_limits("target ", target_arena_size, target_storage_size,
+                       &target_start, &target_end) ||
+      bad_popcount_indices("target ", 1, num_bits,
+                            target_popcount_indices_size, &target_popcount_indices) ||
+      bad_results(results, result_offset)) {
+    return NULL;
+  }
+
+  Py_BEGIN_ALLOW_THREADS;
+  metric.type = metric_type;
+  metric.alpha = alpha;
+  metric.beta = beta;
+  interval.min_score = min_score;
+  interval.max_score = max_score;
+  errval = chemfp_threshold_metric_arena(&metric, &interval,
+        num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices,
+        results->results + result_offset);
+  Py_END_ALLOW_THREADS;
+
+  return PyInt_FromLong(errval);
+}
+
+/* knearest_metric_arena */
+static PyObject *
+knearest_metric_arena(PyObject *self, PyObject *args) {
+  int k;
+  int metric_type;
+  double alpha, beta, min_score, max_score;
+  const char *interval_str;
+  chemfp_interval interval;
+  chemfp_metric metric;
+  int num_bits;
+  int query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size, query_start, query_end;
+  const unsigned char *query_arena;
+  int target_start_padding, target_end_padding;
+  int target_storage_size, target_arena_size, target_start, target_end;
+  const unsigned char *target_arena;
+
+  int *target_popcount_indices, target_popcount_indices_size;
+
+  int errval, result_offset;
+  SearchResults *results;
+  UNUSED(self);
+    
+  if (!PyArg_ParseTuple(args, "iiddddsiiiit#iiiiit#iit#Oi:knearest_metric_arena",
+                        &k, &metric_type, &alpha, &beta, &min_score, &max_score, &interval_str,
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_start_padding, &target_end_padding,
+                        &target_storage_size, &target_arena, &target_arena_size,
+                        &target_start, &target_end,
+                        &target_popcount_indices, &target_popcount_indices_size,
+                        &results, &result_offset)) {
+    return NULL;
+  }
+
+  if (bad_k(k) ||
+      bad_metric(metric_type, alpha, beta, min_score, max_score) ||
+      bad_interval(interval_str, &interval) ||
+      bad_num_bits(num_bits) ||
+      bad_padding("query ", query_start_padding, query_end_padding,
+                  &query_arena, &query_arena_size) ||
+      bad_padding("target ", target_start_padding, target_end_padding,
+                  &target_arena, &target_arena_size) ||
+      bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_arena_limits("target ", target_arena_size, target_storage_size,
+                       &target_start, &target_end) ||
+      bad_popcount_indices("target ", 1, num_bits,
+                            target_popcount_indices_size, &target_popcount_indices) ||
+      bad_results(results, result_offset)) {
+    return NULL;
+  }
+  
+  Py_BEGIN_ALLOW_THREADS;
+  metric.type = metric_type;
+  metric.alpha = alpha;
+  metric.beta = beta;
+  interval.min_score = min_score;
+  interval.max_score = max_score;
+  errval = chemfp_knearest_metric_arena(k, &metric, &interval,
+        num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices,
+        results->results + result_offset);
+  Py_END_ALLOW_THREADS;
+  
+  return PyInt_FromLong(errval);
+}
+
+static PyObject *
+count_metric_arena_symmetric(PyObject *self, PyObject *args) {
+  int metric_type;
+  double alpha, beta, min_score, max_score;
+  const char *interval_str;
+  chemfp_interval interval;
+  chemfp_metric metric;
+  int num_bits, start_padding, end_padding, storage_size, arena_size;
+  int query_start, query_end, target_start, target_end;
+  const unsigned char *arena;
+  int *popcount_indices, *result_counts;
+  int popcount_indices_size, result_counts_size;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "iddddsiiiis#iiiis#w#:count_metric_arena_symmetric",
+                        &metric_type, &alpha, &beta, &min_score, &max_score, &interval_str,
+                        &num_bits,
+                        &start_padding, &end_padding,
+                        &storage_size, &arena, &arena_size,
+                        &query_start, &query_end,
+                        &target_start, &target_end,
+                        &popcount_indices, &popcount_indices_size,
+                        &result_counts, &result_counts_size)) {
+    return NULL;
+  }
+  if (bad_metric(metric_type, alpha, beta, min_score, max_score) ||
+      bad_interval(interval_str, &interval) ||
+      bad_num_bits(num_bits) ||
+      bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
+      bad_fingerprint_sizes(num_bits, storage_size, storage_size) ||
+      bad_arena_limits("query ", arena_size, storage_size, &query_start, &query_end) ||
+      bad_arena_limits("target ", arena_size, storage_size, &target_start, &target_end) ||
+      bad_popcount_indices("", 1, num_bits, popcount_indices_size, &popcount_indices)) {
+    return NULL;
+  }
+  if (result_counts_size < (arena_size / storage_size) * sizeof(int) ) {
+    PyErr_SetString(PyExc_ValueError, "not enough space allocated for result_counts");
+    return NULL;
+  }
+  if (query_start > query_end) {
+    Py_RETURN_NONE;
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  metric.type = metric_type;
+  metric.alpha = alpha;
+  metric.beta = beta;
+  interval.min_score = min_score;
+  interval.max_score = max_score;
+  chemfp_count_metric_arena_symmetric(&metric, &interval,
+                                      num_bits,
+                                      storage_size, arena,
+                                      query_start, query_end,
+                                      target_start, target_end,
+                                      popcount_indices,
+                                      result_counts);
+  Py_END_ALLOW_THREADS;
+  
+  Py_RETURN_NONE;
+}
+
+static PyObject *
+threshold_metric_arena_symmetric(PyObject *self, PyObject *args) {
+  int metric_type;
+  double alpha, beta, min_score, max_score;
+  const char *interval_str;
+  chemfp_interval interval;
+  chemfp_metric metric;
+  int num_bits, start_padding, end_padding, storage_size, arena_size;
+  int query_start, query_end, target_start, target_end;
+  const unsigned char *arena;
+  int *popcount_indices;
+  int popcount_indices_size;
+  int errval;
+  SearchResults *results;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "iddddsiiiis#iiiis#O:threshold_metric_arena_symmetric",
+                        &metric_type, &alpha, &beta, &min_score, &max_score, &interval_str,
+                        &num_bits,
+                        &start_padding, &end_padding,
+                        &storage_size, &arena, &arena_size,
+                        &query_start, &query_end,
+                        &target_start, &target_end,
+                        &popcount_indices, &popcount_indices_size,
+                        &results)) {
+    return NULL;
+  }
+  if (bad_metric(metric_type, alpha, beta, min_score, max_score) ||
+      bad_interval(interval_str, &interval) ||
+      bad_num_bits(num_bits) ||
+      bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
+      bad_fingerprint_sizes(num_bits, storage_size, storage_size) ||
+      bad_arena_limits("query ", arena_size, storage_size, &query_start, &query_end) ||
+      bad_arena_limits("target ", arena_size, storage_size, &target_start, &target_end) ||
+      bad_popcount_indices("", 1, num_bits, popcount_indices_size, &popcount_indices) ||
+      bad_results(results, 0)) {
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  metric.type = metric_type;
+  metric.alpha = alpha;
+  metric.beta = beta;
+  interval.min_score = min_score;
+  interval.max_score = max_score;
+  errval = chemfp_threshold_metric_arena_symmetric(&metric, &interval,
+                                                   num_bits,
+                                                   storage_size, arena,
+                                                   query_start, query_end,
+                                                   target_start, target_end,
+                                                   popcount_indices,
+                                                   results->results);
+  Py_END_ALLOW_THREADS;
+  
+  return PyInt_FromLong(errval);
+}
+
+static PyObject *
+knearest_metric_arena_symmetric(PyObject *self, PyObject *args) {
+  int metric_type;
+  double alpha, beta, min_score, max_score;
+  const char *interval_str;
+  chemfp_interval interval;
+  chemfp_metric metric;
+  int k, num_bits, start_padding, end_padding, storage_size, arena_size;
+  int query_start, query_end, target_start, target_end;
+  const unsigned char *arena;
+  int *popcount_indices;
+  int popcount_indices_size;
+  int errval;
+  SearchResults *results;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "iiddddsiiiis#iiiis#O:knearest_metric_arena_symmetric",
+                        &k, &metric_type, &alpha, &beta, &min_score, &max_score, &interval_str,
+                        &num_bits,
+                        &start_padding, &end_padding,
+                        &storage_size, &arena, &arena_size,
+                        &query_start, &query_end,
+                        &target_start, &target_end,
+                        &popcount_indices, &popcount_indices_size,
+                        &results)) {
+    return NULL;
+  }
+  if (bad_k(k) ||
+      bad_metric(metric_type, alpha, beta, min_score, max_score) ||
+      bad_interval(interval_str, &interval) ||
+      bad_num_bits(num_bits) ||
+      bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
+      bad_fingerprint_sizes(num_bits, storage_size, storage_size) ||
+      bad_arena_limits("query ", arena_size, storage_size, &query_start, &query_end) ||
+      bad_arena_limits("target ", arena_size, storage_size, &target_start, &target_end) ||
+      bad_popcount_indices("", 1, num_bits, popcount_indices_size, &popcount_indices) ||
+      bad_results(results, 0)) {
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  metric.type = metric_type;
+  metric.alpha = alpha;
+  metric.beta = beta;
+  interval.min_score = min_score;
+  interval.max_score = max_score;
+  errval = chemfp_knearest_metric_arena_symmetric(k, &metric, &interval,
+                                                  num_bits,
+                                                  storage_size, arena,
+                                                  query_start, query_end,
+                                                  target_start, target_end,
+                                                  popcount_indices,
+                                                  results->results);
+  Py_END_ALLOW_THREADS;
+  
+  return PyInt_FromLong(errval);
+}
+
+static PyObject *
+fill_lower_triangle(PyObject *self, PyObject *args) {
+  int num_results, errval;
+  SearchResults *results;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "Oi:fill_lower_triangle",
+                        &results, &num_results)) {
+    return NULL;
+  }
+  if (bad_results(results, 0) ||
+      bad_num_results(num_results)) {
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_fill_lower_triangle(num_results, results->results);
+  Py_END_ALLOW_THREADS;
+
+  if (errval) {
+    PyErr_SetString(PyExc_ValueError, chemfp_strerror(errval));
+    return NULL;
+  }
+  Py_RETURN_NONE;
+}
+
+
+/***** Sparse matrix (CSR) output for the symmetric threshold search ****/
+
+/* Check that the CSR arrays are large enough for an n*n matrix and
+   that the row offsets are in order. Sets *num_hits to indptr[n]. */
+static int
+bad_csr(int n, const long long *indptr, int indptr_size,
+        int upper_counts_size, int indices_size, int scores_size,
+        long long *num_hits) {
+  int i;
+  if ((long long) indptr_size < ((long long) n + 1) * (long long) sizeof(long long)) {
+    PyErr_SetString(PyExc_ValueError, "indptr is too small");
+    return 1;
+  }
+  if ((long long) upper_counts_size < ((long long) n) * (long long) sizeof(int)) {
+    PyErr_SetString(PyExc_ValueError, "upper_counts is too small");
+    return 1;
+  }
+  if (indptr[0] != 0) {
+    PyErr_SetString(PyExc_ValueError, "indptr must start with 0");
+    return 1;
+  }
+  for (i=0; i<n; i++) {
+    if (indptr[i+1] < indptr[i]) {
+      PyErr_SetString(PyExc_ValueError, "indptr must not decrease");
+      return 1;
+    }
+  }
+  *num_hits = indptr[n];
+  if ((long long) indices_size < *num_hits * (long long) sizeof(int)) {
+    PyErr_SetString(PyExc_ValueError, "indices is too small");
+    return 1;
+  }
+  if ((long long) scores_size < *num_hits * (long long) sizeof(float)) {
+    PyErr_SetString(PyExc_ValueError, "scores is too small");
+    return 1;
+  }
+  return 0;
+}
+
+static PyObject *
+make_csr_indptr(PyObject *self, PyObject *args) {
+  const int *counts;
+  long long *indptr, num_hits;
+  int counts_size, indptr_size, n;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "s#w#:make_csr_indptr",
+                        &counts, &counts_size, &indptr, &indptr_size)) {
+    return NULL;
+  }
+  n = counts_size / sizeof(int);
+  if ((long long) indptr_size < ((long long) n + 1) * (long long) sizeof(long long)) {
+    PyErr_SetString(PyExc_ValueError, "indptr is too small");
+    return NULL;
+  }
+  num_hits = chemfp_make_csr_indptr(n, counts, indptr);
+  return PyLong_FromLongLong(num_hits);
+}
+
+static PyObject *
+threshold_tanimoto_arena_symmetric_csr(PyObject *self, PyObject *args) {
+  double threshold;
+  int num_bits, start_padding, end_padding, storage_size, arena_size;
+  int num_fingerprints, query_start, query_end;
+  const unsigned char *arena;
+  int *popcount_indices, *upper_counts, *indices;
+  const long long *indptr;
+  float *scores;
+  int popcount_indices_size, indptr_size, upper_counts_size, indices_size, scores_size;
+  long long num_hits;
+  int errval;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "diiiis#iiis#s#w#w#w#:threshold_tanimoto_arena_symmetric_csr",
+                        &threshold,
+                        &num_bits,
+                        &start_padding, &end_padding,
+                        &storage_size, &arena, &arena_size,
+                        &num_fingerprints, &query_start, &query_end,
+                        &popcount_indices, &popcount_indices_size,
+                        &indptr, &indptr_size,
+                        &upper_counts, &upper_counts_size,
+                        &indices, &indices_size,
+                        &scores, &scores_size)) {
+    return NULL;
+  }
+  if (bad_threshold(threshold) ||
+      bad_num_bits(num_bits) ||
+      bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
+      bad_fingerprint_sizes(num_bits, storage_size, storage_size) ||
+      bad_arena_limits("query ", arena_size, storage_size, &query_start, &query_end) ||
+      bad_popcount_indices("", 1, num_bits, popcount_indices_size, &popcount_indices)) {
+    return NULL;
+  }
+  if (num_fingerprints < 0 || num_fingerprints > arena_size / storage_size) {
+    PyErr_SetString(PyExc_ValueError, "num_fingerprints is out of range");
+    return NULL;
+  }
+  if (query_end > num_fingerprints) {
+    query_end = num_fingerprints;
+  }
+  if (bad_csr(num_fingerprints, indptr, indptr_size, upper_counts_size,
+              indices_size, scores_size, &num_hits)) {
+    return NULL;
+  }
+  if (query_start >= query_end) {
+    Py_RETURN_NONE;
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_threshold_tanimoto_arena_symmetric_csr(threshold,
+                                                         num_bits,
+                                                         storage_size, arena,
+                                                         num_fingerprints, query_start, query_end,
+                                                         popcount_indices,
+                                                         indptr, upper_counts,
+                                                         indices, scores,
+                                                         check_signals, &_save);
+  Py_END_ALLOW_THREADS;
+
+  if (symmetric_search_failed(errval)) {
+    return NULL;
+  }
+  if (errval) {
+    PyErr_SetString(PyExc_ValueError, "the hit counts do not match the CSR row sizes");
+    return NULL;
+  }
+  Py_RETURN_NONE;
+}
+
+static PyObject *
+fill_csr_lower_triangle(PyObject *self, PyObject *args) {
+  int n, errval;
+  const long long *indptr;
+  const int *upper_counts;
+  int *indices;
+  float *scores;
+  int indptr_size, upper_counts_size, indices_size, scores_size;
+  long long num_hits;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "is#s#w#w#:fill_csr_lower_triangle",
+                        &n, &indptr, &indptr_size,
+                        &upper_counts, &upper_counts_size,
+                        &indices, &indices_size,
+                        &scores, &scores_size)) {
+    return NULL;
+  }
+  if (n < 0) {
+    PyErr_SetString(PyExc_ValueError, "n must not be negative");
+    return NULL;
+  }
+  if (bad_csr(n, indptr, indptr_size, upper_counts_size,
+              indices_size, scores_size, &num_hits)) {
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_fill_csr_lower_triangle(n, indptr, upper_counts, indices, scores);
+  Py_END_ALLOW_THREADS;
+
+  if (errval == CHEMFP_NO_MEM) {
+    return PyErr_NoMemory();
+  }
+  if (errval) {
+    PyErr_SetString(PyExc_ValueError, "the upper triangle does not match the CSR row sizes");
+    return NULL;
+  }
+  Py_RETURN_NONE;
+}
+
+
+/***** Substructure screening ****/
+
+/* The contains index needs num_bits postings of num_words words, and num_bits counts */
+static int
+bad_contains_index(int num_bits, int start, int end, int postings_size, int bit_counts_size,
+                   int *num_words) {
+  if (start < 0 || end < start) {
+    PyErr_SetString(PyExc_ValueError, "contains index start and end are out of range");
+    return 1;
+  }
+  *num_words = chemfp_get_contains_index_num_words(end - start);
+  if ((long long) postings_size < ((long long) num_bits) * (*num_words) * (long long) sizeof(uint64_t)) {
+    PyErr_SetString(PyExc_ValueError, "postings are too small for the contains index");
+    return 1;
+  }
+  if ((long long) bit_counts_size < ((long long) num_bits) * (long long) sizeof(int)) {
+    PyErr_SetString(PyExc_ValueError, "bit_counts are too small for the contains index");
+    return 1;
+  }
+  return 0;
+}
+
+static PyObject *
+contains_error(int errval) {
+  if (errval == CHEMFP_NO_MEM) {
+    return PyErr_NoMemory();
+  }
+  PyErr_SetString(PyExc_ValueError, chemfp_strerror(errval));
+  return NULL;
+}
+
+static PyObject *
+get_contains_index_num_words(PyObject *self, PyObject *args) {
+  int num_fingerprints;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "i:get_contains_index_num_words", &num_fingerprints)) {
+    return NULL;
+  }
+  if (num_fingerprints < 0) {
+    PyErr_SetString(PyExc_ValueError, "num_fingerprints must not be negative");
+    return NULL;
+  }
+  return PyInt_FromLong(chemfp_get_contains_index_num_words(num_fingerprints));
+}
+
+static PyObject *
+make_contains_index(PyObject *self, PyObject *args) {
+  int num_bits, start_padding, end_padding, storage_size, arena_size, start, end;
+  const unsigned char *arena;
+  int postings_size, bit_counts_size, num_words, errval;
+  uint64_t *postings;
+  int *bit_counts;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "iiiit#iiw#w#:make_contains_index",
+                        &num_bits, &start_padding, &end_padding,
+                        &storage_size, &arena, &arena_size,
+                        &start, &end,
+                        &postings, &postings_size,
+                        &bit_counts, &bit_counts_size)) {
+    return NULL;
+  }
+  if (bad_num_bits(num_bits) ||
+      bad_arena_size("", num_bits, storage_size) ||
+      bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
+      bad_arena_limits("", arena_size, storage_size, &start, &end) ||
+      bad_contains_index(num_bits, start, end, postings_size, bit_counts_size, &num_words)) {
+    return NULL;
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_make_contains_index(num_bits, storage_size, arena, start, end,
+                                      num_words, postings, bit_counts);
+  Py_END_ALLOW_THREADS;
+  if (errval) {
+    return contains_error(errval);
+  }
+  Py_RETURN_NONE;
+}
+
+static PyObject *
+count_contains_arena(PyObject *self, PyObject *args) {
+  int num_bits;
+  int query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size, query_start, query_end;
+  const unsigned char *query_arena;
+  int target_start, target_end;
+  const uint64_t *postings;
+  const int *bit_counts;
+  int postings_size, bit_counts_size, num_words;
+  int *target_popcount_indices, target_popcount_indices_size;
+  int result_counts_size, *result_counts;
+  int errval;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "iiiit#iiiis#s#t#w#:count_contains_arena",
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_start, &target_end,
+                        &postings, &postings_size,
+                        &bit_counts, &bit_counts_size,
+                        &target_popcount_indices, &target_popcount_indices_size,
+                        &result_counts, &result_counts_size)) {
+    return NULL;
+  }
+  if (bad_num_bits(num_bits) ||
+      bad_arena_size("query_", num_bits, query_storage_size) ||
+      bad_padding("query ", query_start_padding, query_end_padding,
+                  &query_arena, &query_arena_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_contains_index(num_bits, target_start, target_end, postings_size, bit_counts_size,
+                         &num_words) ||
+      bad_popcount_indices("target ", 1, num_bits,
+                            target_popcount_indices_size, &target_popcount_indices)) {
+    return NULL;
+  }
+  if (query_start > query_end) {
+    Py_RETURN_NONE;
+  }
+  if (bad_counts(result_counts_size, query_end - query_start)) {
+    return NULL;
+  }
+
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_count_contains_arena(num_bits,
+                                       query_storage_size, query_arena, query_start, query_end,
+                                       target_start, target_end,
+                                       num_words, postings, bit_counts,
+                                       target_popcount_indices,
+                                       result_counts);
+  Py_END_ALLOW_THREADS;
+  if (errval) {
+    return contains_error(errval);
+  }
+  Py_RETURN_NONE;
+}
+
+static PyObject *
+contains_arena(PyObject *self, PyObject *args) {
+  int num_bits;
+  int query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size, query_start, query_end;
+  const unsigned char *query_arena;
+  int target_start, target_end;
+  const uint64_t *postings;
+  const int *bit_counts;
+  int postings_size, bit_counts_size, num_words;
+  int *target_popcount_indices, target_popcount_indices_size;
+  int errval, result_offset;
+  SearchResults *results;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "iiiit#iiiis#s#t#Oi:contains_arena",
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_start, &target_end,
+                        &postings, &postings_size,
+                        &bit_counts, &bit_counts_size,
+                        &target_popcount_indices, &target_popcount_indices_size,
+                        &results, &result_offset)) {
+    return NULL;
+  }
+  if (bad_num_bits(num_bits) ||
+      bad_arena_size("query_", num_bits, query_storage_size) ||
+      bad_padding("query ", query_start_padding, query_end_padding,
+                  &query_arena, &query_arena_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_contains_index(num_bits, target_start, target_end, postings_size, bit_counts_size,
+                         &num_words) ||
+      bad_popcount_indices("target ", 1, num_bits,
+                            target_popcount_indices_size, &target_popcount_indices) ||
+      bad_results(results, result_offset)) {
+    return NULL;
+  }
+
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_contains_arena(num_bits,
+                                 query_storage_size, query_arena, query_start, query_end,
+                                 target_start, target_end,
+                                 num_words, postings, bit_counts,
+                                 target_popcount_indices,
+                                 results->results + result_offset);
+  Py_END_ALLOW_THREADS;
+  if (errval) {
+    return contains_error(errval);
+  }
+  Py_RETURN_NONE;
+}
+
+
+/***** Folded-fingerprint prefilter ****/
+
+/* The folded arena has one folded fingerprint and one lost bit count */
+/* for each of the fingerprints in the target arena. The stats are two */
+/* long longs, for the number of candidates and the number pruned. */
+static int
+bad_folded_arena(int num_bits, int folded_num_bits,
+                 int target_storage_size, int target_arena_size,
+                 int folded_arena_size, int lost_bits_size, int stats_size,
+                 chemfp_folded_arena *folded) {
+  long long num_fingerprints;
+  if (folded_num_bits < 64 || folded_num_bits > 1024 || folded_num_bits % 64 != 0 ||
+      folded_num_bits >= num_bits) {
+    PyErr_SetString(PyExc_ValueError,
+                    "folded num_bits must be a multiple of 64 between 64 and 1024, "
+                    "and less than num_bits");
+    return 1;
+  }
+  num_fingerprints = target_arena_size / target_storage_size;
+  if ((long long) folded_arena_size < num_fingerprints * (folded_num_bits / 8)) {
+    PyErr_SetString(PyExc_ValueError, "folded arena is too small for the target arena");
+    return 1;
+  }
+  if ((long long) lost_bits_size < num_fingerprints * (long long) sizeof(int)) {
+    PyErr_SetString(PyExc_ValueError, "lost_bits are too small for the target arena");
+    return 1;
+  }
+  if (stats_size < (int)(2 * sizeof(long long))) {
+    PyErr_SetString(PyExc_ValueError, "stats must have space for two long longs");
+    return 1;
+  }
+  folded->num_bits = folded_num_bits;
+  folded->num_candidates = 0;
+  folded->num_pruned = 0;
+  return 0;
+}
+
+/* Add the number of candidates and pruned candidates to the stats */
+static void
+add_folded_stats(const chemfp_folded_arena *folded, long long *stats) {
+  stats[0] += folded->num_candidates;
+  stats[1] += folded->num_pruned;
+}
+
+static PyObject *
+fold_arena(PyObject *self, PyObject *args) {
+  int num_bits, start_padding, end_padding, storage_size, arena_size, start, end;
+  const unsigned char *arena;
+  int folded_num_bits, folded_arena_size, lost_bits_size, errval;
+  unsigned char *folded_arena;
+  int *lost_bits;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "iiiit#iiiw#w#:fold_arena",
+                        &num_bits, &start_padding, &end_padding,
+                        &storage_size, &arena, &arena_size,
+                        &start, &end,
+                        &folded_num_bits,
+                        &folded_arena, &folded_arena_size,
+                        &lost_bits, &lost_bits_size)) {
+    return NULL;
+  }
+  if (bad_num_bits(num_bits) ||
+      bad_arena_size("", num_bits, storage_size) ||
+      bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
+      bad_arena_limits("", arena_size, storage_size, &start, &end)) {
+    return NULL;
+  }
+  if (folded_num_bits < 64 || folded_num_bits > 1024 || folded_num_bits % 64 != 0 ||
+      folded_num_bits >= num_bits) {
+    PyErr_SetString(PyExc_ValueError,
+                    "folded num_bits must be a multiple of 64 between 64 and 1024, "
+                    "and less than num_bits");
+    return NULL;
+  }
+  if (start < end) {
+    if ((long long) folded_arena_size < ((long long) (end - start)) * (folded_num_bits / 8)) {
+      PyErr_SetString(PyExc_ValueError, "not enough space allocated for the folded arena");
+      return NULL;
+    }
+    if ((long long) lost_bits_size < ((long long) (end - start)) * (long long) sizeof(int)) {
+      PyErr_SetString(PyExc_ValueError, "not enough space allocated for lost_bits");
+      return NULL;
+    }
+  }
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_fold_arena(num_bits, storage_size, arena, start, end,
+                             folded_num_bits, folded_arena, lost_bits);
+  Py_END_ALLOW_THREADS;
+  if (errval) {
+    return contains_error(errval);
+  }
+  Py_RETURN_NONE;
+}
+
+static PyObject *
+count_tanimoto_arena_folded(PyObject *self, PyObject *args) {
+  double threshold;
+  int num_bits;
+  int query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size, query_start, query_end;
+  const unsigned char *query_arena;
+  int target_start_padding, target_end_padding;
+  int target_storage_size, target_arena_size, target_start, target_end;
+  const unsigned char *target_arena;
+  int *target_popcount_indices, target_popcount_indices_size;
+  int folded_num_bits, folded_arena_size, lost_bits_size, stats_size;
+  chemfp_folded_arena folded;
+  long long *stats;
+  int result_counts_size, *result_counts;
+  int errval;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "diiiit#iiiiit#iit#is#s#w#w#:count_tanimoto_arena_folded",
+                        &threshold,
+                        &num_bits,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
+                        &query_start, &query_end,
+                        &target_start_padding, &target_end_padding,
+                        &target_storage_size, &target_arena, &target_arena_size,
+                        &target_start, &target_end,
+                        &target_popcount_indices, &target_popcount_indices_size,
+                        &folded_num_bits,
+                        &folded.arena, &folded_arena_size,
+                        &folded.lost_bits, &lost_bits_size,
+                        &stats, &stats_size,
+                        &result_counts, &result_counts_size)) {
+    return NULL;
+  }
+
+  if (bad_threshold(threshold) ||
+      bad_num_bits(num_bits) ||
+      bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
+      bad_padding("query ", query_start_padding, query_end_padding,
+                  &query_arena, &query_arena_size) ||
+      bad_padding("target ", target_start_padding, target_end_padding,
+                  &target_arena, &target_arena_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_arena_limits("target ", target_arena_size, target_storage_size,
+                       &target_start, &target_end) ||
+      bad_popcount_indices("target ", 1, num_bits,
+                            target_popcount_indices_size, &target_popcount_indices) ||
+      bad_folded_arena(num_bits, folded_num_bits, target_storage_size, target_arena_size,
+                       folded_arena_size, lost_bits_size, stats_size, &folded)) {
+    return NULL;
+  }
+  if (query_start > query_end) {
+    Py_RETURN_NONE;
+  }
+  if (bad_counts(result_counts_size, query_end - query_start)) {
+    return NULL;
+  }
+
+  Py_BEGIN_ALLOW_THREADS;
+  errval = chemfp_count_tanimoto_arena_folded(
+        threshold,
+        num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        target_popcount_indices,
+        &folded,
+        result_counts);
+  Py_END_ALLOW_THREADS;
+  if (errval) {
+    return contains_error(errval);
+  }
+  add_folded_stats(&folded, stats);
+  Py_RETURN_NONE;
+}
+
 static PyObject *
-threshold_tanimoto_arena(PyObject *self, PyObject *args) {
+threshold_tanimoto_arena_folded(PyObject *self, PyObject *args) {
   double threshold;
   int num_bits;
   int query_start_padding, query_end_padding;
@@ -1173,14 +3554,15 @@ threshold_tanimoto_arena(PyObject *self, PyObject *args) {
   int target_start_padding, target_end_padding;
   int target_storage_size, target_arena_size, target_start, target_end;
   const unsigned char *target_arena;
-
   int *target_popcount_indices, target_popcount_indices_size;
-
+  int folded_num_bits, folded_arena_size, lost_bits_size, stats_size;
+  chemfp_folded_arena folded;
+  long long *stats;
   int errval, result_offset;
   SearchResults *results;
   UNUSED(self);
 
-  if (!PyArg_ParseTuple(args, "diiiit#iiiiit#iit#Oi:threshold_tanimoto_arena",
+  if (!PyArg_ParseTuple(args, "diiiit#iiiiit#iit#is#s#w#Oi:threshold_tanimoto_arena_folded",
                         &threshold,
                         &num_bits,
                         &query_start_padding, &query_end_padding,
@@ -1190,6 +3572,10 @@ threshold_tanimoto_arena(PyObject *self, PyObject *args) {
                         &target_storage_size, &target_arena, &target_arena_size,
                         &target_start, &target_end,
                         &target_popcount_indices, &target_popcount_indices_size,
+                        &folded_num_bits,
+                        &folded.arena, &folded_arena_size,
+                        &folded.lost_bits, &lost_bits_size,
+                        &stats, &stats_size,
                         &results, &result_offset)) {
     return NULL;
   }
@@ -1197,9 +3583,9 @@ threshold_tanimoto_arena(PyObject *self, PyObject *args) {
   if (bad_threshold(threshold) ||
       bad_num_bits(num_bits) ||
       bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
-      bad_padding("query ", query_start_padding, query_end_padding, 
+      bad_padding("query ", query_start_padding, query_end_padding,
                   &query_arena, &query_arena_size) ||
-      bad_padding("target ", target_start_padding, target_end_padding, 
+      bad_padding("target ", target_start_padding, target_end_padding,
                   &target_arena, &target_arena_size) ||
       bad_arena_limits("query ", query_arena_size, query_storage_size,
                        &query_start, &query_end) ||
@@ -1207,27 +3593,31 @@ threshold_tanimoto_arena(PyObject *self, PyObject *args) {
                        &target_start, &target_end) ||
       bad_popcount_indices("target ", 1, num_bits,
                             target_popcount_indices_size, &target_popcount_indices) ||
-      bad_results(results, result_offset)
-      ) {
+      bad_folded_arena(num_bits, folded_num_bits, target_storage_size, target_arena_size,
+                       folded_arena_size, lost_bits_size, stats_size, &folded) ||
+      bad_results(results, result_offset)) {
     return NULL;
   }
 
   Py_BEGIN_ALLOW_THREADS;
-  errval = chemfp_threshold_tanimoto_arena(
+  errval = chemfp_threshold_tanimoto_arena_folded(
         threshold,
         num_bits,
         query_storage_size, query_arena, query_start, query_end,
         target_storage_size, target_arena, target_start, target_end,
         target_popcount_indices,
+        &folded,
         results->results + result_offset);
   Py_END_ALLOW_THREADS;
-
-  return PyInt_FromLong(errval);
+  if (errval) {
+    return contains_error(errval);
+  }
+  add_folded_stats(&folded, stats);
+  Py_RETURN_NONE;
 }
 
-/* knearest_tanimoto_arena */
 static PyObject *
-knearest_tanimoto_arena(PyObject *self, PyObject *args) {
+knearest_tanimoto_arena_folded(PyObject *self, PyObject *args) {
   int k;
   double threshold;
   int num_bits;
@@ -1237,15 +3627,15 @@ knearest_tanimoto_arena(PyObject *self, PyObject *args) {
   int target_start_padding, target_end_padding;
   int target_storage_size, target_arena_size, target_start, target_end;
   const unsigned char *target_arena;
-
   int *target_popcount_indices, target_popcount_indices_size;
-
+  int folded_num_bits, folded_arena_size, lost_bits_size, stats_size;
+  chemfp_folded_arena folded;
+  long long *stats;
   int errval, result_offset;
   SearchResults *results;
-
   UNUSED(self);
-    
-  if (!PyArg_ParseTuple(args, "idiiiit#iiiiit#iit#Oi:knearest_tanimoto_arena",
+
+  if (!PyArg_ParseTuple(args, "idiiiit#iiiiit#iit#is#s#w#Oi:knearest_tanimoto_arena_folded",
                         &k, &threshold,
                         &num_bits,
                         &query_start_padding, &query_end_padding,
@@ -1255,6 +3645,10 @@ knearest_tanimoto_arena(PyObject *self, PyObject *args) {
                         &target_storage_size, &target_arena, &target_arena_size,
                         &target_start, &target_end,
                         &target_popcount_indices, &target_popcount_indices_size,
+                        &folded_num_bits,
+                        &folded.arena, &folded_arena_size,
+                        &folded.lost_bits, &lost_bits_size,
+                        &stats, &stats_size,
                         &results, &result_offset)) {
     return NULL;
   }
@@ -1262,220 +3656,169 @@ knearest_tanimoto_arena(PyObject *self, PyObject *args) {
   if (bad_k(k) ||
       bad_threshold(threshold) ||
       bad_num_bits(num_bits) ||
+      bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
       bad_padding("query ", query_start_padding, query_end_padding,
                   &query_arena, &query_arena_size) ||
       bad_padding("target ", target_start_padding, target_end_padding,
                   &target_arena, &target_arena_size) ||
-      bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
       bad_arena_limits("query ", query_arena_size, query_storage_size,
                        &query_start, &query_end) ||
       bad_arena_limits("target ", target_arena_size, target_storage_size,
                        &target_start, &target_end) ||
       bad_popcount_indices("target ", 1, num_bits,
                             target_popcount_indices_size, &target_popcount_indices) ||
+      bad_folded_arena(num_bits, folded_num_bits, target_storage_size, target_arena_size,
+                       folded_arena_size, lost_bits_size, stats_size, &folded) ||
       bad_results(results, result_offset)) {
     return NULL;
   }
-  
+
   Py_BEGIN_ALLOW_THREADS;
-  errval = chemfp_knearest_tanimoto_arena(
+  errval = chemfp_knearest_tanimoto_arena_folded(
         k, threshold,
         num_bits,
         query_storage_size, query_arena, query_start, query_end,
         target_storage_size, target_arena, target_start, target_end,
         target_popcount_indices,
-        results->results);
+        &folded,
+        results->results + result_offset);
   Py_END_ALLOW_THREADS;
-  
-  return PyInt_FromLong(errval);
-}
-
-static PyObject *
-knearest_results_finalize(PyObject *self, PyObject *args) {
-  int result_offset, num_results;
-  SearchResults *results;
-  UNUSED(self);
-    
-  if (!PyArg_ParseTuple(args, "Oii",
-                        &results, &result_offset, &num_results)) {
-    return NULL;
-  }
-  if (bad_results(results, result_offset) ||
-      bad_num_results(num_results)) {
-    return NULL;
+  if (errval) {
+    return contains_error(errval);
   }
-  Py_BEGIN_ALLOW_THREADS;
-  chemfp_knearest_results_finalize(results->results+result_offset,
-                                   results->results+result_offset+num_results);
-  Py_END_ALLOW_THREADS;
-  return Py_BuildValue("");
+  add_folded_stats(&folded, stats);
+  Py_RETURN_NONE;
 }
 
-/***** Symmetric search code ****/
 
-static PyObject *
-count_tanimoto_hits_arena_symmetric(PyObject *self, PyObject *args) {
-  double threshold;
-  int num_bits, start_padding, end_padding, storage_size, arena_size;
-  int query_start, query_end, target_start, target_end;
-  const unsigned char *arena;
-  int *popcount_indices, *result_counts;
-  int popcount_indices_size, result_counts_size;
-  UNUSED(self);
+/***** Approximate k-nearest search with MinHash and LSH ****/
 
-  if (!PyArg_ParseTuple(args, "diiiis#iiiis#w#:count_tanimoto_arena",
-                        &threshold,
-                        &num_bits,
-                        &start_padding, &end_padding,
-                        &storage_size, &arena, &arena_size,
-                        &query_start, &query_end,
-                        &target_start, &target_end,
-                        &popcount_indices, &popcount_indices_size,
-                        &result_counts, &result_counts_size)) {
-    return NULL;
-  }
-  if (bad_threshold(threshold) ||
-      bad_num_bits(num_bits) ||
-      bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
-      bad_fingerprint_sizes(num_bits, storage_size, storage_size) ||
-      bad_arena_limits("query ", arena_size, storage_size, &query_start, &query_end) ||
-      bad_arena_limits("target ", arena_size, storage_size, &target_start, &target_end) ||
-      bad_popcount_indices("", 1, num_bits, popcount_indices_size, &popcount_indices)) {
-    return NULL;
-  }
-  if (result_counts_size < (arena_size / storage_size) * sizeof(int) ) {
-    PyErr_SetString(PyExc_ValueError, "not enough space allocated for result_counts");
-    return NULL;
+/* The LSH tables use 8*num_bands bytes per fingerprint, so they can be
+   larger than 2 GB even when the arena isn't. They are passed in as a
+   Py_buffer, which has a Py_ssize_t length, instead of with "s#". */
+static int
+bad_lsh_index(int num_bands, int rows_per_band, int num_fingerprints, Py_ssize_t entries_size) {
+  if (chemfp_check_lsh_parameters(num_bands, rows_per_band) != CHEMFP_OK) {
+    PyErr_SetString(PyExc_ValueError, "num_bands or rows_per_band is out of range");
+    return 1;
   }
-  if (query_start > query_end) {
-    Py_RETURN_NONE;
+  if ((long long) entries_size <
+      ((long long) num_bands) * num_fingerprints * (long long) sizeof(chemfp_lsh_entry)) {
+    PyErr_SetString(PyExc_ValueError, "LSH tables are too small for the arena");
+    return 1;
   }
-  Py_BEGIN_ALLOW_THREADS;
-  chemfp_count_tanimoto_hits_arena_symmetric(threshold,
-                                             num_bits,
-                                             storage_size, arena,
-                                             query_start, query_end,
-                                             target_start, target_end,
-                                             popcount_indices,
-                                             result_counts);
-  Py_END_ALLOW_THREADS;
-  
-  Py_RETURN_NONE;
+  return 0;
 }
 
 static PyObject *
-threshold_tanimoto_arena_symmetric(PyObject *self, PyObject *args) {
-  double threshold;
-  int num_bits, start_padding, end_padding, storage_size, arena_size;
-  int query_start, query_end, target_start, target_end;
+make_lsh_index(PyObject *self, PyObject *args) {
+  int num_bits, start_padding, end_padding, storage_size, arena_size, start, end;
   const unsigned char *arena;
-  int *popcount_indices;
-  int popcount_indices_size;
-  SearchResults *results;
+  int num_bands, rows_per_band, errval;
+  unsigned int seed;
+  Py_buffer entries;
   UNUSED(self);
 
-  if (!PyArg_ParseTuple(args, "diiiis#iiiis#O:threshold_tanimoto_arena_symmetric",
-                        &threshold,
-                        &num_bits,
-                        &start_padding, &end_padding,
+  if (!PyArg_ParseTuple(args, "iiiit#iiiiIw*:make_lsh_index",
+                        &num_bits, &start_padding, &end_padding,
                         &storage_size, &arena, &arena_size,
-                        &query_start, &query_end,
-                        &target_start, &target_end,
-                        &popcount_indices, &popcount_indices_size,
-                        &results)) {
+                        &start, &end,
+                        &num_bands, &rows_per_band, &seed,
+                        &entries)) {
     return NULL;
   }
-  if (bad_threshold(threshold) ||
-      bad_num_bits(num_bits) ||
+  if (bad_num_bits(num_bits) ||
+      bad_arena_size("", num_bits, storage_size) ||
       bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
-      bad_fingerprint_sizes(num_bits, storage_size, storage_size) ||
-      bad_arena_limits("query ", arena_size, storage_size, &query_start, &query_end) ||
-      bad_arena_limits("target ", arena_size, storage_size, &target_start, &target_end) ||
-      bad_popcount_indices("", 1, num_bits, popcount_indices_size, &popcount_indices) ||
-      bad_results(results, 0)) {
+      bad_arena_limits("", arena_size, storage_size, &start, &end) ||
+      bad_lsh_index(num_bands, rows_per_band, (start < end) ? (end - start) : 0, entries.len)) {
+    PyBuffer_Release(&entries);
     return NULL;
   }
   Py_BEGIN_ALLOW_THREADS;
-  chemfp_threshold_tanimoto_arena_symmetric(threshold,
-                                            num_bits,
-                                            storage_size, arena,
-                                            query_start, query_end,
-                                            target_start, target_end,
-                                            popcount_indices,
-                                            results->results);
+  errval = chemfp_make_lsh_index(num_bits, storage_size, arena, start, end,
+                                 num_bands, rows_per_band, seed,
+                                 (chemfp_lsh_entry *) entries.buf);
   Py_END_ALLOW_THREADS;
-  
+  PyBuffer_Release(&entries);
+  if (errval) {
+    return contains_error(errval);
+  }
   Py_RETURN_NONE;
 }
 
-/* knearest_tanimoto_arena */
 static PyObject *
-knearest_tanimoto_arena_symmetric(PyObject *self, PyObject *args) {
+knearest_tanimoto_lsh_arena(PyObject *self, PyObject *args) {
+  int k;
   double threshold;
-  int k, num_bits, start_padding, end_padding, storage_size, arena_size;
-  int query_start, query_end, target_start, target_end;
-  const unsigned char *arena;
-  int *popcount_indices;
-  int popcount_indices_size;
+  int num_bits;
+  int query_start_padding, query_end_padding;
+  int query_storage_size, query_arena_size, query_start, query_end;
+  const unsigned char *query_arena;
+  int target_start_padding, target_end_padding;
+  int target_storage_size, target_arena_size, target_start, target_end;
+  const unsigned char *target_arena;
+  int num_bands, rows_per_band, num_probe_bands;
+  unsigned int seed;
+  Py_buffer entries;
+  int errval, result_offset;
   SearchResults *results;
   UNUSED(self);
 
-  if (!PyArg_ParseTuple(args, "idiiiis#iiiis#O:knearest_tanimoto_arena_symmetric",
+  if (!PyArg_ParseTuple(args, "idiiiit#iiiiit#iiiiIs*iOi:knearest_tanimoto_lsh_arena",
                         &k, &threshold,
                         &num_bits,
-                        &start_padding, &end_padding,
-                        &storage_size, &arena, &arena_size,
+                        &query_start_padding, &query_end_padding,
+                        &query_storage_size, &query_arena, &query_arena_size,
                         &query_start, &query_end,
+                        &target_start_padding, &target_end_padding,
+                        &target_storage_size, &target_arena, &target_arena_size,
                         &target_start, &target_end,
-                        &popcount_indices, &popcount_indices_size,
-                        &results)) {
+                        &num_bands, &rows_per_band, &seed,
+                        &entries,
+                        &num_probe_bands,
+                        &results, &result_offset)) {
     return NULL;
   }
+
   if (bad_k(k) ||
       bad_threshold(threshold) ||
       bad_num_bits(num_bits) ||
-      bad_padding("", start_padding, end_padding, &arena, &arena_size) ||
-      bad_fingerprint_sizes(num_bits, storage_size, storage_size) ||
-      bad_arena_limits("query ", arena_size, storage_size, &query_start, &query_end) ||
-      bad_arena_limits("target ", arena_size, storage_size, &target_start, &target_end) ||
-      bad_popcount_indices("", 1, num_bits, popcount_indices_size, &popcount_indices) ||
-      bad_results(results, 0)) {
-    return NULL;
-  }
-  Py_BEGIN_ALLOW_THREADS;
-  chemfp_knearest_tanimoto_arena_symmetric(k, threshold,
-                                           num_bits,
-                                           storage_size, arena,
-                                           query_start, query_end,
-                                           target_start, target_end,
-                                           popcount_indices,
-                                           results->results);
-  Py_END_ALLOW_THREADS;
-  
-  Py_RETURN_NONE;
-}
-
-static PyObject *
-fill_lower_triangle(PyObject *self, PyObject *args) {
-  int num_results, errval;
-  SearchResults *results;
-  UNUSED(self);
-
-  if (!PyArg_ParseTuple(args, "Oi:fill_lower_triangle",
-                        &results, &num_results)) {
+      bad_fingerprint_sizes(num_bits, query_storage_size, target_storage_size) ||
+      bad_padding("query ", query_start_padding, query_end_padding,
+                  &query_arena, &query_arena_size) ||
+      bad_padding("target ", target_start_padding, target_end_padding,
+                  &target_arena, &target_arena_size) ||
+      bad_arena_limits("query ", query_arena_size, query_storage_size,
+                       &query_start, &query_end) ||
+      bad_arena_limits("target ", target_arena_size, target_storage_size,
+                       &target_start, &target_end) ||
+      bad_lsh_index(num_bands, rows_per_band,
+                    (target_start < target_end) ? (target_end - target_start) : 0,
+                    entries.len) ||
+      bad_results(results, result_offset)) {
+    PyBuffer_Release(&entries);
     return NULL;
   }
-  if (bad_results(results, 0) ||
-      bad_num_results(num_results)) {
+  if (num_probe_bands < 1 || num_probe_bands > num_bands) {
+    PyErr_SetString(PyExc_ValueError, "num_probe_bands must be between 1 and num_bands");
+    PyBuffer_Release(&entries);
     return NULL;
   }
+
   Py_BEGIN_ALLOW_THREADS;
-  errval = chemfp_fill_lower_triangle(num_results, results->results);
+  errval = chemfp_knearest_tanimoto_lsh_arena(
+        k, threshold,
+        num_bits,
+        query_storage_size, query_arena, query_start, query_end,
+        target_storage_size, target_arena, target_start, target_end,
+        num_bands, rows_per_band, seed,
+        (const chemfp_lsh_entry *) entries.buf, num_probe_bands,
+        results->results + result_offset);
   Py_END_ALLOW_THREADS;
-
+  PyBuffer_Release(&entries);
   if (errval) {
-    PyErr_SetString(PyExc_ValueError, chemfp_strerror(errval));
-    return NULL;
+    return contains_error(errval);
   }
   Py_RETURN_NONE;
 }
@@ -1508,6 +3851,47 @@ get_method_name(PyObject *self, PyObject *args) {
   return PyString_FromString(s);
 }
 
+static PyObject *
+get_num_metrics(PyObject *self, PyObject *args) {
+  UNUSED(self);
+  UNUSED(args);
+
+  return PyInt_FromLong(chemfp_get_num_metrics());
+}
+
+static PyObject *
+get_metric_name(PyObject *self, PyObject *args) {
+  int metric_type;
+  const char *s;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "i:get_metric_name", &metric_type)) {
+    return NULL;
+  }
+  s = chemfp_get_metric_name(metric_type);
+  if (s == NULL) {
+    PyErr_SetString(PyExc_IndexError, "metric index is out of range");
+    return NULL;
+  }
+  return PyString_FromString(s);
+}
+
+static PyObject *
+metric_is_distance(PyObject *self, PyObject *args) {
+  int metric_type, is_distance;
+  UNUSED(self);
+
+  if (!PyArg_ParseTuple(args, "i:metric_is_distance", &metric_type)) {
+    return NULL;
+  }
+  is_distance = chemfp_metric_is_distance(metric_type);
+  if (is_distance < 0) {
+    PyErr_SetString(PyExc_IndexError, "metric index is out of range");
+    return NULL;
+  }
+  return PyBool_FromLong(is_distance);
+}
+
 static PyObject *
 get_num_alignments(PyObject *self, PyObject *args) {
   UNUSED(self);
@@ -1702,6 +4086,10 @@ static PyMethodDef chemfp_methods[] = {
    "byte_intersect_popcount(fp1, fp2)\n\nReturn the number of bits set in the instersection of the two byte fingerprints"},
   {"byte_tanimoto", byte_tanimoto, METH_VARARGS,
    "byte_tanimoto(fp1, fp2)\n\nCompute the Tanimoto similarity between two byte fingerprints"},
+  {"byte_tversky", byte_tversky, METH_VARARGS,
+   "byte_tversky(fp1, fp2, alpha=1.0, beta=1.0)\n\nCompute the Tversky similarity between two byte fingerprints"},
+  {"hex_tversky", hex_tversky, METH_VARARGS,
+   "hex_tversky(fp1, fp2, alpha=1.0, beta=1.0)\n\nCompute the Tversky similarity between two hex fingerprints.\nReturn a float between 0.0 and 1.0, or -1.0 if either string is not a hex fingerprint"},
   {"byte_contains", byte_contains, METH_VARARGS,
    "byte_contains(super_fp, sub_fp)\n\nReturn 1 if the on bits of sub_fp are also 1 bits in super_fp"},
 
@@ -1729,6 +4117,12 @@ static PyMethodDef chemfp_methods[] = {
    "fps_knearest_search_init (TODO: document)"},
   {"fps_knearest_tanimoto_search_feed", fps_knearest_tanimoto_search_feed, METH_VARARGS,
    "fps_knearest_tanimoto_search_feed (TODO: document)"},
+  {"fps_count_tversky_hits", fps_count_tversky_hits, METH_VARARGS,
+   "fps_count_tversky_hits (TODO: document)"},
+  {"fps_threshold_tversky_search", fps_threshold_tversky_search, METH_VARARGS,
+   "fps_threshold_tversky_search (TODO: document)"},
+  {"fps_knearest_tversky_search_feed", fps_knearest_tversky_search_feed, METH_VARARGS,
+   "fps_knearest_tversky_search_feed (TODO: document)"},
   {"fps_knearest_search_finish", fps_knearest_search_finish, METH_VARARGS,
    "fps_knearest_search_finish (TODO: document)"},
   {"fps_knearest_search_free", fps_knearest_search_free, METH_VARARGS,
@@ -1742,22 +4136,107 @@ static PyMethodDef chemfp_methods[] = {
 
   {"knearest_tanimoto_arena", knearest_tanimoto_arena, METH_VARARGS,
    "knearest_tanimoto_arena (TODO: document)"},
+
+  {"count_tanimoto_arena_per_query", count_tanimoto_arena_per_query, METH_VARARGS,
+   "count_tanimoto_arena_per_query(thresholds, ...)\n\n"
+   "Like count_tanimoto_arena, with a double array of one threshold per query"},
+  {"threshold_tanimoto_arena_per_query", threshold_tanimoto_arena_per_query, METH_VARARGS,
+   "threshold_tanimoto_arena_per_query(thresholds, ...)\n\n"
+   "Like threshold_tanimoto_arena, with a double array of one threshold per query"},
+  {"knearest_tanimoto_arena_per_query", knearest_tanimoto_arena_per_query, METH_VARARGS,
+   "knearest_tanimoto_arena_per_query(ks, thresholds, ...)\n\n"
+   "Like knearest_tanimoto_arena, with an int array of one k per query\n"
+   "and a double array of one threshold per query"},
   {"knearest_results_finalize", knearest_results_finalize, METH_VARARGS,
    "knearest_results_finalize (TODO: document)"},
 
   {"count_tanimoto_hits_arena_symmetric", count_tanimoto_hits_arena_symmetric, METH_VARARGS,
    "count_tanimoto_hits_arena_symmetric (TODO: document)"},
+  {"add_counts", add_counts, METH_VARARGS,
+   "add_counts(counts, increments)\n\n"
+   "Add each of the integers in 'increments' to the same position in 'counts'"},
   {"threshold_tanimoto_arena_symmetric", threshold_tanimoto_arena_symmetric, METH_VARARGS,
    "threshold_tanimoto_arena_symmetric (TODO: document)"},
   {"knearest_tanimoto_arena_symmetric", knearest_tanimoto_arena_symmetric, METH_VARARGS,
    "knearest_tanimoto_arena_symmetric (TODO: document)"},
 
+  {"count_metric_arena", count_metric_arena, METH_VARARGS,
+   "count_metric_arena (TODO: document)"},
+  {"threshold_metric_arena", threshold_metric_arena, METH_VARARGS,
+   "threshold_metric_arena (TODO: document)"},
+  {"knearest_metric_arena", knearest_metric_arena, METH_VARARGS,
+   "knearest_metric_arena (TODO: document)"},
+  {"count_metric_arena_symmetric", count_metric_arena_symmetric, METH_VARARGS,
+   "count_metric_arena_symmetric (TODO: document)"},
+  {"threshold_metric_arena_symmetric", threshold_metric_arena_symmetric, METH_VARARGS,
+   "threshold_metric_arena_symmetric (TODO: document)"},
+  {"knearest_metric_arena_symmetric", knearest_metric_arena_symmetric, METH_VARARGS,
+   "knearest_metric_arena_symmetric (TODO: document)"},
+
   {"fill_lower_triangle", fill_lower_triangle, METH_VARARGS,
    "fill_lower_triangle (TODO: document)"},
 
+  {"make_csr_indptr", make_csr_indptr, METH_VARARGS,
+   "make_csr_indptr(counts, indptr)\n\n"
+   "Set the CSR row offsets in indptr from the int counts for each row.\n"
+   "Returns the total number of hits"},
+
+  {"threshold_tanimoto_arena_symmetric_csr", threshold_tanimoto_arena_symmetric_csr, METH_VARARGS,
+   "threshold_tanimoto_arena_symmetric_csr(threshold, num_bits, start_padding, end_padding, "
+   "storage_size, arena, num_fingerprints, query_start, query_end, popcount_indices, "
+   "indptr, upper_counts, indices, scores)\n\n"
+   "Fill in the upper-triangle hits of the CSR rows query_start to query_end"},
+
+  {"fill_csr_lower_triangle", fill_csr_lower_triangle, METH_VARARGS,
+   "fill_csr_lower_triangle(n, indptr, upper_counts, indices, scores)\n\n"
+   "Copy the upper-triangle hits of a CSR matrix to the lower triangle"},
+
+  {"get_contains_index_num_words", get_contains_index_num_words, METH_VARARGS,
+   "get_contains_index_num_words(num_fingerprints)\n\n"
+   "Return the number of 64-bit words in each posting of a contains index"},
+
+  {"make_contains_index", make_contains_index, METH_VARARGS,
+   "make_contains_index(num_bits, start_padding, end_padding, storage_size, arena, start, end, postings, bit_counts)\n\n"
+   "Fill in the bit-sliced postings and bit counts for the fingerprints in [start, end)"},
+
+  {"count_contains_arena", count_contains_arena, METH_VARARGS,
+   "count_contains_arena(num_bits, query_start_padding, query_end_padding, query_storage_size, query_arena, query_start, query_end, target_start, target_end, postings, bit_counts, target_popcount_indices, result_counts)\n\n"
+   "Count the targets which contain each query, using a contains index"},
+
+  {"contains_arena", contains_arena, METH_VARARGS,
+   "contains_arena(num_bits, query_start_padding, query_end_padding, query_storage_size, query_arena, query_start, query_end, target_start, target_end, postings, bit_counts, target_popcount_indices, results, result_offset)\n\n"
+   "Find the targets which contain each query, using a contains index"},
+
+  {"fold_arena", fold_arena, METH_VARARGS,
+   "fold_arena(num_bits, start_padding, end_padding, storage_size, arena, start, end, folded_num_bits, folded_arena, lost_bits)\n\n"
+   "Fold the fingerprints in [start, end) to folded_num_bits, and get the number of bits lost by folding"},
+
+  {"count_tanimoto_arena_folded", count_tanimoto_arena_folded, METH_VARARGS,
+   "count_tanimoto_arena_folded(threshold, ..., target_popcount_indices, folded_num_bits, folded_arena, lost_bits, stats, result_counts)\n\n"
+   "Like count_tanimoto_arena, using a folded-fingerprint prefilter"},
+  {"threshold_tanimoto_arena_folded", threshold_tanimoto_arena_folded, METH_VARARGS,
+   "threshold_tanimoto_arena_folded(threshold, ..., target_popcount_indices, folded_num_bits, folded_arena, lost_bits, stats, results, result_offset)\n\n"
+   "Like threshold_tanimoto_arena, using a folded-fingerprint prefilter"},
+  {"knearest_tanimoto_arena_folded", knearest_tanimoto_arena_folded, METH_VARARGS,
+   "knearest_tanimoto_arena_folded(k, threshold, ..., target_popcount_indices, folded_num_bits, folded_arena, lost_bits, stats, results, result_offset)\n\n"
+   "Like knearest_tanimoto_arena, using a folded-fingerprint prefilter"},
+
+  {"make_lsh_index", make_lsh_index, METH_VARARGS,
+   "make_lsh_index(num_bits, start_padding, end_padding, storage_size, arena, start, end, num_bands, rows_per_band, seed, entries)\n\n"
+   "Fill in the sorted MinHash LSH tables for the fingerprints in [start, end)"},
+  {"knearest_tanimoto_lsh_arena", knearest_tanimoto_lsh_arena, METH_VARARGS,
+   "knearest_tanimoto_lsh_arena(k, threshold, ..., target_start, target_end, num_bands, rows_per_band, seed, entries, num_probe_bands, results, result_offset)\n\n"
+   "Find the approximate k-nearest targets using the MinHash LSH tables"},
+
   {"make_sorted_aligned_arena", make_sorted_aligned_arena, METH_VARARGS,
    "make_sorted_aligned_arena (TODO: document)"},
 
+  {"fps_load_arena", fps_load_arena, METH_VARARGS,
+   "fps_load_arena(num_bits, num_bytes, storage_size, alignment, blocks, popcount_indices)\n\n"
+   "Decode fps blocks directly into an aligned arena, sorted by popcount if popcount_indices\n"
+   "is not empty. Returns (err, num_lines, start_padding, end_padding, arena, ordering,\n"
+   "id_block, offsets)"},
+
   {"make_unsorted_aligned_arena", make_unsorted_aligned_arena, METH_VARARGS,
    "make_unsorted_aligned_arena (TODO: document)"},
 
@@ -1771,6 +4250,15 @@ static PyMethodDef chemfp_methods[] = {
   {"get_method_name", get_method_name, METH_VARARGS,
    "get_method_name (TODO: document)"},
 
+  {"get_num_metrics", get_num_metrics, METH_NOARGS,
+   "get_num_metrics()\n\nReturn the number of similarity and distance metrics"},
+
+  {"get_metric_name", get_metric_name, METH_VARARGS,
+   "get_metric_name(metric_type)\n\nReturn the name of the given metric type"},
+
+  {"metric_is_distance", metric_is_distance, METH_VARARGS,
+   "metric_is_distance(metric_type)\n\nReturn True if smaller values of the metric are better"},
+
   {"get_num_alignments", get_num_alignments, METH_NOARGS,
    "get_num_alignments (TODO: document)"},
 
@@ -1798,6 +4286,26 @@ static PyMethodDef chemfp_methods[] = {
   {"set_option", set_option, METH_VARARGS,
    "set option (TODO: document)"},
 
+  {"make_popcount_indices", make_popcount_indices, METH_VARARGS,
+   "make_popcount_indices(num_bits, start_padding, end_padding, storage_size, arena, num_fingerprints, popcount_indices)\n\n"
+   "Fill in popcount_indices if the arena fingerprints are in popcount order. Returns True if they are, otherwise False"},
+
+  {"get_id_index_size", get_id_index_size, METH_VARARGS,
+   "get_id_index_size(num_ids)\n\nReturn the number of slots in the id index table for num_ids ids"},
+
+  {"make_id_index", make_id_index, METH_VARARGS,
+   "make_id_index(num_ids, id_block, offsets, table)\n\nFill in the id index hash table"},
+
+  {"id_index_lookup", id_index_lookup, METH_VARARGS,
+   "id_index_lookup(num_ids, id_block, offsets, table, id)\n\nReturn the index of id, or -1 if not present"},
+
+  {"get_id_table_item", get_id_table_item, METH_VARARGS,
+   "get_id_table_item(id_block, offsets, i)\n\nReturn id i from the id table"},
+
+  {"take_id_table_items", take_id_table_items, METH_VARARGS,
+   "take_id_table_items(id_block, offsets, indices, new_offsets)\n\n"
+   "Return a new id block with the ids at the given indices, and fill in new_offsets"},
+
   {"get_num_threads", get_num_threads, METH_NOARGS,
    "get_num_threads()\n\nSet the number of OpenMP threads to use in a search"},
 
@@ -1819,7 +4327,17 @@ init_chemfp(void)
   if (PyType_Ready(&chemfp_py_SearchResultsType) < 0) {
     return ;
   }
+  if (PyType_Ready(&chemfp_py_BufferViewType) < 0) {
+    return ;
+  }
+  if (PyType_Ready(&chemfp_py_HitViewType) < 0) {
+    return ;
+  }
   m = Py_InitModule3("_chemfp", chemfp_methods, "Documentation goes here");
   Py_INCREF(&chemfp_py_SearchResultsType);
   PyModule_AddObject(m, "SearchResults", (PyObject *)&chemfp_py_SearchResultsType);
+  Py_INCREF(&chemfp_py_BufferViewType);
+  PyModule_AddObject(m, "BufferView", (PyObject *)&chemfp_py_BufferViewType);
+  Py_INCREF(&chemfp_py_HitViewType);
+  PyModule_AddObject(m, "HitView", (PyObject *)&chemfp_py_HitViewType);
 }
@@ -24,10 +24,235 @@ available, then this file will be #include'd twice.
 
 */
 
+/* The Tanimoto arena searches take a single threshold (and k) for all
+   of the queries, or a 'thresholds' (and 'ks') array with one value
+   for each query, starting with query_start. If the array is NULL
+   then every query uses the single value. */
+
+/* Tiled search for the count and threshold searches. See the comments */
+/* for "tile-size" in searches.c. Exactly one of result_counts and */
+/* results is not NULL. Each query's hits are added in increasing */
+/* target index order, the same as the untiled searches. */
+static int
+RENAME(tiled_tanimoto_arena)(
+        double threshold, const double *thresholds,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        TileQuery *tile_queries,
+        int *result_counts,
+        chemfp_search_result *results) {
+  int fp_size = (num_bits+7) / 8;
+  int num_queries = query_end - query_start;
+  int num_tile_queries = 0, num_tile_targets, block_size, num_blocks, block;
+  int query_index, target_index, query_popcount, target_popcount, tile_popcount;
+  int start_target_popcount, end_target_popcount;
+  int start, end, lo, hi, tile_start, tile_end, window_start, window_end;
+  int intersect_popcount, popcount_sum, count;
+  int denominator = num_bits * 10;
+  int add_hit_error = 0;
+  double query_threshold, score;
+  const unsigned char *query_fp, *target_fp;
+  TileQuery *tile_query, *first_query, *last_query;
+
+  chemfp_popcount_f calc_popcount;
+  chemfp_intersect_popcount_f calc_intersect_popcount;
+
+  calc_popcount = chemfp_select_popcount(num_bits, query_storage_size, query_arena);
+  calc_intersect_popcount = chemfp_select_intersect_popcount(
+                num_bits, query_storage_size, query_arena,
+                target_storage_size, target_arena);
+
+  /* Figure out the target window for each query. Handle the queries */
+  /* which don't need a search, the same way as the untiled searches. */
+  for (query_index = 0; query_index < num_queries; query_index++) {
+    query_fp = query_arena + (query_start + query_index) * query_storage_size;
+    query_threshold = tanimoto_query_threshold(threshold, thresholds, query_index, num_bits);
+    if (result_counts != NULL) {
+      result_counts[query_index] = 0;
+    }
+    if (query_threshold > 1.0) {
+      continue;
+    }
+    if (result_counts != NULL && query_threshold <= 0.0) {
+      result_counts[query_index] = (target_end - target_start);
+      continue;
+    }
+    tile_query = tile_queries + num_tile_queries;
+    if (target_popcount_indices == NULL) {
+      /* Compare the query to every target */
+      query_popcount = 0;
+      start_target_popcount = end_target_popcount = 0;
+      start = target_start;
+      end = target_end;
+    } else {
+      query_popcount = calc_popcount(fp_size, query_fp);
+      if (query_popcount == 0) {
+        /* Everything has a score of 0.0 */
+        if (result_counts == NULL && query_threshold == 0.0) {
+          for (target_index = target_start; target_index < target_end; target_index++) {
+            if (!chemfp_add_hit(results+query_index, target_index, 0.0)) {
+              add_hit_error = 1;
+            }
+          }
+        }
+        continue;
+      }
+      if (query_threshold == 0.0) {
+        start_target_popcount = 0;
+        end_target_popcount = num_bits;
+      } else {
+        start_target_popcount = (int)(query_popcount * query_threshold);
+        end_target_popcount = (int)(ceil(query_popcount / query_threshold));
+        if (end_target_popcount > num_bits) {
+          end_target_popcount = num_bits;
+        }
+      }
+      start = MAX(target_popcount_indices[start_target_popcount], target_start);
+      end = MIN(target_popcount_indices[end_target_popcount+1], target_end);
+      if (start >= end) {
+        continue;
+      }
+    }
+    tile_query->query_index = query_index;
+    tile_query->query_fp = query_fp;
+    tile_query->popcount = query_popcount;
+    tile_query->threshold = query_threshold;
+    tile_query->numerator = (int)(query_threshold * denominator);
+    tile_query->start_popcount = start_target_popcount;
+    tile_query->end_popcount = end_target_popcount;
+    tile_query->start = start;
+    tile_query->end = end;
+    num_tile_queries++;
+  }
+
+  /* Group the queries with overlapping windows together */
+  qsort(tile_queries, num_tile_queries, sizeof(TileQuery), compare_tile_queries);
+
+  num_tile_targets = chemfp_get_option_tile_size() / target_storage_size;
+  if (num_tile_targets < 1) {
+    num_tile_targets = 1;
+  }
+  block_size = TILE_QUERY_BLOCK_SIZE;
+#if USE_OPENMP == 1
+  /* Make enough blocks to keep all of the threads busy */
+  if (num_tile_queries < block_size * chemfp_get_num_threads() * 4) {
+    block_size = num_tile_queries / (chemfp_get_num_threads() * 4);
+    if (block_size < 1) {
+      block_size = 1;
+    }
+  }
+#endif
+  num_blocks = (num_tile_queries + block_size - 1) / block_size;
+
+#if USE_OPENMP == 1
+  #pragma omp parallel for \
+      private(first_query, last_query, window_start, window_end, tile_popcount, \
+          tile_start, tile_end, tile_query, lo, hi, target_popcount, start, end, \
+          popcount_sum, target_fp, target_index, intersect_popcount, score, count) \
+      schedule(dynamic)
+#endif
+  for (block = 0; block < num_blocks; block++) {
+    first_query = tile_queries + block * block_size;
+    last_query = MIN(first_query + block_size, tile_queries + num_tile_queries);
+
+    /* The queries are sorted by start, so this is the union of the windows */
+    window_start = first_query->start;
+    window_end = first_query->end;
+    for (tile_query = first_query+1; tile_query < last_query; tile_query++) {
+      window_end = MAX(window_end, tile_query->end);
+    }
+
+    tile_popcount = 0;
+    for (tile_start = window_start; tile_start < window_end; tile_start += num_tile_targets) {
+      tile_end = MIN(tile_start + num_tile_targets, window_end);
+      if (target_popcount_indices != NULL) {
+        /* The popcount of the first target in the tile */
+        while (target_popcount_indices[tile_popcount+1] <= tile_start) {
+          tile_popcount++;
+        }
+      }
+
+      for (tile_query = first_query; tile_query < last_query; tile_query++) {
+        lo = MAX(tile_query->start, tile_start);
+        hi = MIN(tile_query->end, tile_end);
+        if (lo >= hi) {
+          continue;
+        }
+        count = 0;
+
+        if (target_popcount_indices == NULL) {
+          target_fp = target_arena + lo * target_storage_size;
+          for (target_index = lo; target_index < hi;
+               target_index++, target_fp += target_storage_size) {
+            score = chemfp_byte_tanimoto(fp_size, tile_query->query_fp, target_fp);
+            if (score >= tile_query->threshold) {
+              if (result_counts != NULL) {
+                count++;
+              } else if (!chemfp_add_hit(results+tile_query->query_index, target_index, score)) {
+                add_hit_error = 1;
+              }
+            }
+          }
+        } else {
+          for (target_popcount = MAX(tile_query->start_popcount, tile_popcount);
+               target_popcount <= tile_query->end_popcount; target_popcount++) {
+            start = target_popcount_indices[target_popcount];
+            if (start >= hi) {
+              break;
+            }
+            start = MAX(start, lo);
+            end = MIN(target_popcount_indices[target_popcount+1], hi);
+
+            target_fp = target_arena + start * target_storage_size;
+            popcount_sum = tile_query->popcount + target_popcount;
+            if (result_counts != NULL) {
+              /* Use the same test as the untiled count search */
+              for (target_index = start; target_index < end;
+                   target_index++, target_fp += target_storage_size) {
+                intersect_popcount = calc_intersect_popcount(fp_size, tile_query->query_fp, target_fp);
+                score = intersect_popcount / (((double) popcount_sum) - intersect_popcount);
+                if (score >= tile_query->threshold) {
+                  count++;
+                }
+              }
+            } else {
+              /* Use the same integer test as the untiled threshold search */
+              for (target_index = start; target_index < end;
+                   target_index++, target_fp += target_storage_size) {
+                intersect_popcount = calc_intersect_popcount(fp_size, tile_query->query_fp, target_fp);
+                if (denominator * intersect_popcount  >=
+                    tile_query->numerator * (popcount_sum - intersect_popcount)) {
+                  score = ((double) intersect_popcount) / (popcount_sum - intersect_popcount);
+                  if (!chemfp_add_hit(results+tile_query->query_index, target_index, score)) {
+                    add_hit_error = 1;
+                  }
+                }
+              }
+            }
+          }
+        }
+        if (result_counts != NULL) {
+          result_counts[tile_query->query_index] += count;
+        }
+      } /* went through the queries in the block */
+    } /* went through the tiles */
+  } /* went through the blocks */
+
+  if (add_hit_error) {
+    return CHEMFP_NO_MEM;
+  }
+  return CHEMFP_OK;
+}
+
 /* count code */
-int RENAME(chemfp_count_tanimoto_arena)(
+static int
+RENAME(count_tanimoto_arena_core)(
         /* Count all matches within the given threshold */
-        double threshold,
+        double threshold, const double *thresholds,
 
         /* Number of bits in the fingerprint */
         int num_bits,
@@ -51,10 +276,12 @@ int RENAME(chemfp_count_tanimoto_arena)(
   int start, end;
   int count;
   int fp_size = (num_bits+7) / 8;
-  double score, popcount_sum;
+  double score, popcount_sum, query_threshold;
   int query_popcount, start_target_popcount, end_target_popcount;
   int target_popcount;
   int intersect_popcount;
+  int errval;
+  TileQuery *tile_queries;
 
   chemfp_popcount_f calc_popcount;
   chemfp_intersect_popcount_f calc_intersect_popcount;
@@ -63,12 +290,7 @@ int RENAME(chemfp_count_tanimoto_arena)(
     /* No queries */
     return CHEMFP_OK;
   }
-  /* Prevent overflow if someone uses a threshold of, say, 1E-80 */
-  /* (Not really needed unless you trap IEEE 754 overflow errors) */
-  if (threshold > 0.0 && threshold < 1.0/num_bits) {
-    threshold = 0.5 / num_bits;
-  }
-  if ((target_start >= target_end) || threshold > 1.0) {
+  if (target_start >= target_end) {
     for (query_index = 0; query_index < (query_end-query_start); query_index++) {
       /* No possible targets */
       result_counts[query_index] = 0;
@@ -76,30 +298,37 @@ int RENAME(chemfp_count_tanimoto_arena)(
     return CHEMFP_OK;
   }
 
-  if (threshold <= 0.0) {
-    /* Everything will match, so there's no need to figure that out */
-    for (query_index = 0; query_index < (query_end-query_start); query_index++) {
-      result_counts[query_index] = (target_end - target_start);
+  if (use_tiles(query_end-query_start, target_end-target_start, target_storage_size)) {
+    tile_queries = (TileQuery *) malloc((query_end-query_start) * sizeof(TileQuery));
+    if (tile_queries != NULL) {
+      errval = RENAME(tiled_tanimoto_arena)(
+                threshold, thresholds, num_bits,
+                query_storage_size, query_arena, query_start, query_end,
+                target_storage_size, target_arena, target_start, target_end,
+                target_popcount_indices, tile_queries, result_counts, NULL);
+      free(tile_queries);
+      return errval;
     }
-    return CHEMFP_OK;
+    /* Not enough memory for the tiles, so use the untiled search */
   }
 
   if (target_popcount_indices == NULL) {
     /* Handle the case when precomputed targets aren't available. */
     /* This is a slower algorithm because it tests everything. */
 #if USE_OPENMP == 1
-    #pragma omp parallel for private(query_fp, target_fp, count, target_index, score) schedule(dynamic)
+    #pragma omp parallel for private(query_fp, target_fp, count, target_index, score, query_threshold) schedule(dynamic)
 #endif
     for (query_index = 0; query_index < (query_end-query_start); query_index++) {
       query_fp = query_arena + (query_start + query_index) * query_storage_size;
       target_fp = target_arena + (target_start * target_storage_size);
+      query_threshold = tanimoto_query_threshold(threshold, thresholds, query_index, num_bits);
       /* Handle the popcount(query) == 0 special case? */
       count = 0;
 
       for (target_index = target_start; target_index < target_end;
            target_index++, target_fp += target_storage_size) {
         score = chemfp_byte_tanimoto(fp_size, query_fp, target_fp);
-        if (score >= threshold) {
+        if (score >= query_threshold) {
           count++;
         }
       }
@@ -119,29 +348,34 @@ int RENAME(chemfp_count_tanimoto_arena)(
 #if USE_OPENMP == 1
   #pragma omp parallel for \
       private(query_fp, query_popcount, start_target_popcount, end_target_popcount, \
-          count, target_popcount, start, end, target_fp, popcount_sum, target_index, intersect_popcount, score) \
+          count, target_popcount, start, end, target_fp, popcount_sum, target_index, intersect_popcount, score, \
+          query_threshold) \
       schedule(dynamic)
 #endif
   for (query_index = 0; query_index < (query_end-query_start); query_index++) {
+    query_threshold = tanimoto_query_threshold(threshold, thresholds, query_index, num_bits);
+    if (query_threshold > 1.0) {
+      /* No possible targets */
+      result_counts[query_index] = 0;
+      continue;
+    }
+    if (query_threshold <= 0.0) {
+      /* Everything will match, so there's no need to figure that out */
+      result_counts[query_index] = (target_end - target_start);
+      continue;
+    }
     query_fp = query_arena + (query_start + query_index) * query_storage_size;
     query_popcount = calc_popcount(fp_size, query_fp);
     /* Special case when popcount(query) == 0; everything has a score of 0.0 */
     if (query_popcount == 0) {
-      if (threshold == 0.0) {
-        result_counts[query_index] = (target_end - target_start);
-      }
+      result_counts[query_index] = 0;
       continue;
     }
     /* Figure out which fingerprints to search */
-    if (threshold == 0.0) {
-      start_target_popcount = 0;
+    start_target_popcount = (int)(query_popcount * query_threshold);
+    end_target_popcount = (int)(ceil(query_popcount / query_threshold));
+    if (end_target_popcount > num_bits) {
       end_target_popcount = num_bits;
-    } else {
-      start_target_popcount = (int)(query_popcount * threshold);
-      end_target_popcount = (int)(ceil(query_popcount / threshold));
-      if (end_target_popcount > num_bits) {
-        end_target_popcount = num_bits;
-      }
     }
     count = 0;
     for (target_popcount = start_target_popcount; target_popcount <= end_target_popcount;
@@ -161,7 +395,7 @@ int RENAME(chemfp_count_tanimoto_arena)(
            target_index++, target_fp += target_storage_size) {
         intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
         score = intersect_popcount / (popcount_sum - intersect_popcount);
-        if (score >= threshold) {
+        if (score >= query_threshold) {
           count++;
         }
       }
@@ -171,9 +405,42 @@ int RENAME(chemfp_count_tanimoto_arena)(
   return CHEMFP_OK;
 }
 
-int RENAME(chemfp_threshold_tanimoto_arena)(
-        /* Within the given threshold */
+int RENAME(chemfp_count_tanimoto_arena)(
         double threshold,
+        int num_bits,
+        int query_storage_size,
+        const unsigned char *query_arena, int query_start, int query_end,
+        int target_storage_size,
+        const unsigned char *target_arena, int target_start, int target_end,
+        int *target_popcount_indices,
+        int *result_counts) {
+  return RENAME(count_tanimoto_arena_core)(
+                threshold, NULL, num_bits,
+                query_storage_size, query_arena, query_start, query_end,
+                target_storage_size, target_arena, target_start, target_end,
+                target_popcount_indices, result_counts);
+}
+
+int RENAME(chemfp_count_tanimoto_arena_per_query)(
+        const double *thresholds,
+        int num_bits,
+        int query_storage_size,
+        const unsigned char *query_arena, int query_start, int query_end,
+        int target_storage_size,
+        const unsigned char *target_arena, int target_start, int target_end,
+        int *target_popcount_indices,
+        int *result_counts) {
+  return RENAME(count_tanimoto_arena_core)(
+                0.0, thresholds, num_bits,
+                query_storage_size, query_arena, query_start, query_end,
+                target_storage_size, target_arena, target_start, target_end,
+                target_popcount_indices, result_counts);
+}
+
+static int
+RENAME(threshold_tanimoto_arena_core)(
+        /* Within the given threshold */
+        double threshold, const double *thresholds,
 
         /* Number of bits in the fingerprint */
         int num_bits,
@@ -197,12 +464,14 @@ int RENAME(chemfp_threshold_tanimoto_arena)(
   const unsigned char *query_fp, *target_fp;
   int start, end;
   int fp_size = (num_bits+7) / 8;
-  double score;
+  double score, query_threshold;
   int query_popcount, start_target_popcount, end_target_popcount;
   int target_popcount;
   int intersect_popcount, popcount_sum;
   int numerator, denominator;
   int add_hit_error = 0;
+  int errval;
+  TileQuery *tile_queries;
 
   chemfp_popcount_f calc_popcount;
   chemfp_intersect_popcount_f calc_intersect_popcount;
@@ -212,29 +481,43 @@ int RENAME(chemfp_threshold_tanimoto_arena)(
     return CHEMFP_OK;
   }
 
-  /* Prevent overflow if someone uses a threshold of, say, 1E-80 */
-  /* (Not really needed unless you trap IEEE 754 overflow errors) */
-  if (threshold > 0.0 && threshold < 1.0/num_bits) {
-    threshold = 0.5 / num_bits;
-  }
-  if ((target_start >= target_end) || threshold > 1.0) {
+  if (target_start >= target_end) {
     return CHEMFP_OK;
   }
 
+  if (use_tiles(query_end-query_start, target_end-target_start, target_storage_size)) {
+    tile_queries = (TileQuery *) malloc((query_end-query_start) * sizeof(TileQuery));
+    if (tile_queries != NULL) {
+      errval = RENAME(tiled_tanimoto_arena)(
+                threshold, thresholds, num_bits,
+                query_storage_size, query_arena, query_start, query_end,
+                target_storage_size, target_arena, target_start, target_end,
+                target_popcount_indices, tile_queries, NULL, results);
+      free(tile_queries);
+      return errval;
+    }
+    /* Not enough memory for the tiles, so use the untiled search */
+  }
+
   if (target_popcount_indices == NULL) {
     /* Handle the case when precomputed targets aren't available. */
     /* This is a slower algorithm because it tests everything. */
 #if USE_OPENMP == 1
-    #pragma omp parallel for private(query_fp, target_fp, target_index, score) schedule(dynamic)
+    #pragma omp parallel for private(query_fp, target_fp, target_index, score, query_threshold) schedule(dynamic)
 #endif
     for (query_index = query_start; query_index < query_end; query_index++) {
+      query_threshold = tanimoto_query_threshold(threshold, thresholds,
+                                                 query_index-query_start, num_bits);
+      if (query_threshold > 1.0) {
+        continue;
+      }
       query_fp = query_arena + (query_index * query_storage_size);
       target_fp = target_arena + (target_start * target_storage_size);
       /* Handle the popcount(query) == 0 special case? */
       for (target_index = target_start; target_index < target_end;
            target_index++, target_fp += target_storage_size) {
         score = chemfp_byte_tanimoto(fp_size, query_fp, target_fp);
-        if (score >= threshold) {
+        if (score >= query_threshold) {
           if (!chemfp_add_hit(results+(query_index-query_start), target_index, score)) {
             add_hit_error = 1;
           }
@@ -254,7 +537,6 @@ int RENAME(chemfp_threshold_tanimoto_arena)(
                 target_storage_size, target_arena);
   
   denominator = num_bits * 10;
-  numerator = (int)(threshold * denominator);
 
   /* This uses the limits from Swamidass and Baldi */
   /* It doesn't use the search ordering because it's supposed to find everything */
@@ -262,16 +544,22 @@ int RENAME(chemfp_threshold_tanimoto_arena)(
 #if USE_OPENMP == 1
   #pragma omp parallel for \
       private(query_fp, query_popcount, target_index, target_fp, start_target_popcount, \
-          end_target_popcount, target_popcount, start, end, popcount_sum, intersect_popcount, score) \
+          end_target_popcount, target_popcount, start, end, popcount_sum, intersect_popcount, score, \
+          query_threshold, numerator) \
       schedule(dynamic)
 #endif
   for (query_index = query_start; query_index < query_end; query_index++) {
+    query_threshold = tanimoto_query_threshold(threshold, thresholds,
+                                               query_index-query_start, num_bits);
+    if (query_threshold > 1.0) {
+      continue;
+    }
     query_fp = query_arena + (query_index * query_storage_size);
     query_popcount = calc_popcount(fp_size, query_fp);
 
     /* Special case when popcount(query) == 0; everything has a score of 0.0 */
     if (query_popcount == 0) {
-      if (threshold == 0.0) {
+      if (query_threshold == 0.0) {
         for (target_index = target_start; target_index < target_end; target_index++) {
           if (!chemfp_add_hit(results+(query_index-query_start), target_index, 0.0)) {
             add_hit_error = 1;
@@ -282,16 +570,17 @@ int RENAME(chemfp_threshold_tanimoto_arena)(
     }
 
     /* Figure out which fingerprints to search */
-    if (threshold == 0.0) {
+    if (query_threshold == 0.0) {
       start_target_popcount = 0;
       end_target_popcount = num_bits;
     } else {
-      start_target_popcount = (int)(query_popcount * threshold);
-      end_target_popcount = (int)(ceil(query_popcount / threshold));
+      start_target_popcount = (int)(query_popcount * query_threshold);
+      end_target_popcount = (int)(ceil(query_popcount / query_threshold));
       if (end_target_popcount > num_bits) {
         end_target_popcount = num_bits;
       }
     }
+    numerator = (int)(query_threshold * denominator);
 
     for (target_popcount=start_target_popcount; target_popcount<=end_target_popcount;
          target_popcount++) {
@@ -329,14 +618,46 @@ int RENAME(chemfp_threshold_tanimoto_arena)(
   return CHEMFP_OK;
 }
 
+int RENAME(chemfp_threshold_tanimoto_arena)(
+        double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results) {
+  return RENAME(threshold_tanimoto_arena_core)(
+                threshold, NULL, num_bits,
+                query_storage_size, query_arena, query_start, query_end,
+                target_storage_size, target_arena, target_start, target_end,
+                target_popcount_indices, results);
+}
+
+int RENAME(chemfp_threshold_tanimoto_arena_per_query)(
+        const double *thresholds,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results) {
+  return RENAME(threshold_tanimoto_arena_core)(
+                0.0, thresholds, num_bits,
+                query_storage_size, query_arena, query_start, query_end,
+                target_storage_size, target_arena, target_start, target_end,
+                target_popcount_indices, results);
+}
+
 
 
 static int 
 RENAME(knearest_tanimoto_arena_no_popcounts)(
         /* Find the 'k' nearest items */
-        int k,
+        int k, const int *ks,
         /* Within the given threshold */
-        double threshold,
+        double threshold, const double *thresholds,
 
         /* Fingerprint size in bits */
         int num_bits,
@@ -352,17 +673,26 @@ RENAME(knearest_tanimoto_arena_no_popcounts)(
         /* Results go into these arrays  */
         chemfp_search_result *results
                                    ) {
-  int query_index, target_index;
+  int query_index, target_index, query_k;
   int fp_size = (num_bits+7)/8;
   const unsigned char *query_fp, *target_fp;
   double query_threshold, score;
   chemfp_search_result *result;
 
+#if USE_OPENMP == 1
+  #pragma omp parallel for \
+      private(query_fp, result, query_k, query_threshold, target_fp, target_index, score) \
+      schedule(dynamic)
+#endif
   for (query_index = 0; query_index < (query_end-query_start); query_index++) {
     query_fp = query_arena + (query_start+query_index) * query_storage_size;
 
     result = results+query_index;
-    query_threshold = threshold;
+    query_k = (ks == NULL) ? k : ks[query_index];
+    if (query_k == 0) {
+      continue;
+    }
+    query_threshold = (thresholds == NULL) ? threshold : thresholds[query_index];
     
     target_fp = target_arena + (target_start * query_storage_size);
     target_index = target_start;
@@ -372,10 +702,10 @@ RENAME(knearest_tanimoto_arena_no_popcounts)(
       score = chemfp_byte_tanimoto(fp_size, query_fp, target_fp);
       if (score >= query_threshold) {
         chemfp_add_hit(result, target_index, score);
-        if (result->num_hits == k) {
-          chemfp_heapq_heapify(k, result, (chemfp_heapq_lt) double_score_lt,
+        if (result->num_hits == query_k) {
+          chemfp_heapq_heapify(query_k, result, (chemfp_heapq_lt) double_score_lt,
                                (chemfp_heapq_swap) double_score_swap);
-          query_threshold = result->scores[0];
+          query_threshold = chemfp_get_hit_score(result, 0);
           /* Since we leave the loop early, I need to advance the pointers */
           target_index++;
           target_fp += target_storage_size;
@@ -384,7 +714,7 @@ RENAME(knearest_tanimoto_arena_no_popcounts)(
       }
     }
     /* Either we've reached the end of the fingerprints or the heap is full */
-    if (result->num_hits == k) {
+    if (result->num_hits == query_k) {
       /* Continue scanning through the fingerprints */
       for (; target_index < target_end;
            target_index++, target_fp += target_storage_size) {
@@ -393,10 +723,10 @@ RENAME(knearest_tanimoto_arena_no_popcounts)(
         /* We need to be strictly *better* than what's in the heap */
         if (score > query_threshold) {
           result->indices[0] = target_index;
-          result->scores[0] = score;
-          chemfp_heapq_siftup(k, result, 0, (chemfp_heapq_lt) double_score_lt,
+          chemfp_set_hit_score(result, 0, score);
+          chemfp_heapq_siftup(query_k, result, 0, (chemfp_heapq_lt) double_score_lt,
                               (chemfp_heapq_swap) double_score_swap);
-          query_threshold = result->scores[0];
+          query_threshold = chemfp_get_hit_score(result, 0);
         } /* heapreplaced the old smallest item with the new item */
       }
       /* End of the fingerprint scan */
@@ -407,15 +737,16 @@ RENAME(knearest_tanimoto_arena_no_popcounts)(
     }
   } /* Loop through the queries */
 
-  return query_index-query_start;
+  return query_end-query_start;
 }
 
 
-int RENAME(chemfp_knearest_tanimoto_arena)(
+static int
+RENAME(knearest_tanimoto_arena_core)(
         /* Find the 'k' nearest items */
-        int k,
+        int k, const int *ks,
         /* Within the given threshold */
-        double threshold,
+        double threshold, const double *thresholds,
 
         /* Size of the fingerprints and size of the storage block */
         int num_bits,
@@ -439,7 +770,7 @@ int RENAME(chemfp_knearest_tanimoto_arena)(
   int query_popcount, target_popcount, intersect_popcount;
   double score, best_possible_score, popcount_sum, query_threshold;
   const unsigned char *query_fp, *target_fp;
-  int query_index, target_index;
+  int query_index, target_index, query_k;
   int start, end;
   PopcountSearchOrder popcount_order;
   chemfp_search_result *result;
@@ -453,7 +784,7 @@ int RENAME(chemfp_knearest_tanimoto_arena)(
     return 0;
   }
   /* k == 0 is a valid input, and of course the result is no matches */
-  if (k == 0) {
+  if (ks == NULL && k == 0) {
     return CHEMFP_OK;
   }
   fp_size = (num_bits+7)/8;
@@ -461,7 +792,7 @@ int RENAME(chemfp_knearest_tanimoto_arena)(
   if (target_popcount_indices == NULL) {
     /* precomputed targets aren't available. Use the slower algorithm. */
     return RENAME(knearest_tanimoto_arena_no_popcounts)(
-        k, threshold, num_bits,
+        k, ks, threshold, thresholds, num_bits,
         query_storage_size, query_arena, query_start, query_end,
         target_storage_size, target_arena, target_start, target_end,
         results);
@@ -474,11 +805,22 @@ int RENAME(chemfp_knearest_tanimoto_arena)(
                 target_storage_size, target_arena);
 
   /* Loop through the query fingerprints */
+#if USE_OPENMP == 1
+  #pragma omp parallel for \
+      private(result, query_fp, query_k, query_threshold, query_popcount, popcount_order, \
+          target_popcount, best_possible_score, start, end, target_fp, popcount_sum, \
+          target_index, intersect_popcount, score) \
+      schedule(dynamic)
+#endif
   for (query_index=0; query_index < (query_end-query_start); query_index++) {
     result = results+query_index;
     query_fp = query_arena + (query_start+query_index) * query_storage_size;
 
-    query_threshold = threshold;
+    query_k = (ks == NULL) ? k : ks[query_index];
+    if (query_k == 0) {
+      continue;
+    }
+    query_threshold = (thresholds == NULL) ? threshold : thresholds[query_index];
     query_popcount = calc_popcount(fp_size, query_fp);
 
     if (query_popcount == 0) {
@@ -516,7 +858,7 @@ int RENAME(chemfp_knearest_tanimoto_arena)(
       target_index = start;
 
       /* There are fewer than 'k' elements in the heap*/
-      if (result->num_hits < k) {
+      if (result->num_hits < query_k) {
         for (; target_index<end; target_index++, target_fp += target_storage_size) {
           intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
           score = intersect_popcount / (popcount_sum - intersect_popcount);
@@ -524,10 +866,10 @@ int RENAME(chemfp_knearest_tanimoto_arena)(
           /* The heap isn't full; only check if we're at or above the query threshold */
           if (score >= query_threshold) {
             chemfp_add_hit(result, target_index, score);
-            if (result->num_hits == k) {
-              chemfp_heapq_heapify(k, result,  (chemfp_heapq_lt) double_score_lt,
+            if (result->num_hits == query_k) {
+              chemfp_heapq_heapify(query_k, result,  (chemfp_heapq_lt) double_score_lt,
                                    (chemfp_heapq_swap) double_score_swap);
-              query_threshold = result->scores[0];
+              query_threshold = chemfp_get_hit_score(result, 0);
               /* We're going to jump to the "heap is full" section */
               /* Since we leave the loop early, I need to advance the pointers */
               target_index++;
@@ -560,10 +902,10 @@ int RENAME(chemfp_knearest_tanimoto_arena)(
         /* We need to be strictly *better* than what's in the heap */
         if (score > query_threshold) {
           result->indices[0] = target_index;
-          result->scores[0] = score;
-          chemfp_heapq_siftup(k, result, 0, (chemfp_heapq_lt) double_score_lt,
+          chemfp_set_hit_score(result, 0, score);
+          chemfp_heapq_siftup(query_k, result, 0, (chemfp_heapq_lt) double_score_lt,
                               (chemfp_heapq_swap) double_score_swap);
-          query_threshold = result->scores[0];
+          query_threshold = chemfp_get_hit_score(result, 0);
           if (query_threshold >= best_possible_score) {
             /* we can't do any better in this section (or in later ones) */
             break;
@@ -573,7 +915,7 @@ int RENAME(chemfp_knearest_tanimoto_arena)(
     } /* Went through all the popcount regions */
 
     /* We have scanned all the fingerprints. Is the heap full? */
-    if (result->num_hits < k) {
+    if (result->num_hits < query_k) {
       /* Not full, so need to heapify it. */
       chemfp_heapq_heapify(result->num_hits, result, (chemfp_heapq_lt) double_score_lt,
                            (chemfp_heapq_swap) double_score_swap);
@@ -582,63 +924,526 @@ int RENAME(chemfp_knearest_tanimoto_arena)(
   return CHEMFP_OK;
 }
 
+int RENAME(chemfp_knearest_tanimoto_arena)(
+        int k, double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results) {
+  return RENAME(knearest_tanimoto_arena_core)(
+                k, NULL, threshold, NULL, num_bits,
+                query_storage_size, query_arena, query_start, query_end,
+                target_storage_size, target_arena, target_start, target_end,
+                target_popcount_indices, results);
+}
 
+int RENAME(chemfp_knearest_tanimoto_arena_per_query)(
+        const int *ks, const double *thresholds,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results) {
+  return RENAME(knearest_tanimoto_arena_core)(
+                0, ks, 0.0, thresholds, num_bits,
+                query_storage_size, query_arena, query_start, query_end,
+                target_storage_size, target_arena, target_start, target_end,
+                target_popcount_indices, results);
+}
 
-/***** Special support for the NxN symmetric case ******/
 
-/* TODO: implement the k-nearest variant. It's harder because a k-nearest
-   search, combined with the Swamidass and Baldi search limits, is not reflexive. */
 
-int RENAME(chemfp_count_tanimoto_hits_arena_symmetric)(
-        /* Count all matches within the given threshold */
-        double threshold,
+/***** Searches with the folded-fingerprint prefilter ******/
 
-        /* Number of bits in the fingerprint */
-        int num_bits,
+/* The folded searches compare the folded query and target first. If */
+/* the upper bound on the score from the folded intersection can't be */
+/* a hit then the full intersection isn't needed. See the comments for */
+/* the folded-fingerprint prefilter in searches.c. */
 
-        /* Fingerprint arena */
-        int storage_size, const unsigned char *arena,
+/* Fold the queries into one block. The folded query i starts at */
+/* i*folded_size, and the number of bits lost by folding it is at */
+/* query_lost_bits[i]. Free the block when done. */
+static unsigned char *
+RENAME(fold_query_arena)(int num_bits, int query_storage_size, const unsigned char *query_arena,
+                         int query_start, int query_end, int folded_size,
+                         int **query_lost_bits) {
+  int num_queries = query_end - query_start;
+  unsigned char *folded_queries;
+  folded_queries = (unsigned char *) malloc(num_queries * (folded_size + sizeof(int)));
+  if (folded_queries == NULL) {
+    return NULL;
+  }
+  /* folded_size is a multiple of 8 so the ints are aligned */
+  *query_lost_bits = (int *) (folded_queries + num_queries * folded_size);
+  fold_fingerprints((num_bits+7) / 8, query_storage_size,
+                    query_arena + query_start * query_storage_size,
+                    num_queries, folded_size, folded_queries, *query_lost_bits);
+  return folded_queries;
+}
 
-        /* Row start and end indices */
+/* Count and threshold search. Exactly one of result_counts and results */
+/* is not NULL. There must be popcount indices, 0.0 < threshold <= 1.0, */
+/* and at least one query and target. */
+static int
+RENAME(folded_tanimoto_arena)(
+        double threshold, int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
         int query_start, int query_end,
-
-        /* Column start and end indices */
+        int target_storage_size, const unsigned char *target_arena,
         int target_start, int target_end,
-
-        /* Target popcount distribution information */
         int *target_popcount_indices,
-
-        /* Results _increment_ existing values in the array - remember to initialize! */
-        int *result_counts
-                                          ) {
+        chemfp_folded_arena *folded,
+        int *result_counts,
+        chemfp_search_result *results) {
   int fp_size = (num_bits+7) / 8;
-  int query_index, target_index;
-  int start, end;
-  int query_popcount, target_popcount;
-  int start_target_popcount, end_target_popcount, intersect_popcount;
-  int count;
-  double popcount_sum, score;
-  const unsigned char *query_fp, *target_fp;
+  int folded_size = folded->num_bits / 8;
+  int num_queries = query_end - query_start;
+  int query_index, target_index, query_popcount, target_popcount, query_lost_bits;
+  int start_target_popcount, end_target_popcount, start, end;
+  int intersect_popcount, bound, popcount_sum, count;
+  int denominator = num_bits * 10;
+  int numerator;
+  int add_hit_error = 0;
+  long long num_candidates = 0, num_pruned = 0;
+  double score;
+  const unsigned char *query_fp, *target_fp, *folded_query_fp;
+  unsigned char *folded_queries;
+  int *all_query_lost_bits;
+
   chemfp_popcount_f calc_popcount;
-  chemfp_intersect_popcount_f calc_intersect_popcount;
-#if USE_OPENMP == 1
-  /* Reduce contention by using a per-thread counts array. For details see: */
-  /* http://www.dalkescientific.com/writings/diary/archive/2012/01/17/I_parallelize_an_algorithm.html */
-  int i;
-  int num_threads;
-  int *parallel_counts;
-  int *per_thread_counts;
-  int per_thread_size;
-#endif
+  chemfp_intersect_popcount_f calc_intersect_popcount, calc_folded_intersect_popcount;
 
-  /* Check that we're not obviously in the lower triangle */
-  if (query_start >= target_end) {  /* No possible hits */
-    return CHEMFP_OK;
+  folded_queries = RENAME(fold_query_arena)(num_bits, query_storage_size, query_arena,
+                                            query_start, query_end, folded_size,
+                                            &all_query_lost_bits);
+  if (folded_queries == NULL) {
+    return CHEMFP_NO_MEM;
   }
 
-  /* Shift the target towards the upper triangle, if needed */
-  if (target_start < query_start) {
-    target_start = query_start;
+  calc_popcount = chemfp_select_popcount(num_bits, query_storage_size, query_arena);
+  calc_intersect_popcount = chemfp_select_intersect_popcount(
+                num_bits, query_storage_size, query_arena,
+                target_storage_size, target_arena);
+  calc_folded_intersect_popcount = chemfp_select_intersect_popcount(
+                folded->num_bits, folded_size, folded_queries,
+                folded_size, folded->arena);
+
+  threshold = tanimoto_query_threshold(threshold, NULL, 0, num_bits);
+  numerator = (int)(threshold * denominator);
+
+#if USE_OPENMP == 1
+  #pragma omp parallel for \
+      private(query_fp, folded_query_fp, query_lost_bits, query_popcount, count, \
+          start_target_popcount, end_target_popcount, target_popcount, start, end, \
+          target_fp, popcount_sum, target_index, bound, intersect_popcount, score) \
+      reduction(+:num_candidates, num_pruned) \
+      schedule(dynamic)
+#endif
+  for (query_index = 0; query_index < num_queries; query_index++) {
+    query_fp = query_arena + (query_start + query_index) * query_storage_size;
+    folded_query_fp = folded_queries + query_index * folded_size;
+    query_lost_bits = all_query_lost_bits[query_index];
+    query_popcount = calc_popcount(fp_size, query_fp);
+    count = 0;
+
+    /* When popcount(query) == 0 everything has a score of 0.0, which */
+    /* is below the threshold */
+    if (query_popcount != 0) {
+      start_target_popcount = (int)(query_popcount * threshold);
+      end_target_popcount = (int)(ceil(query_popcount / threshold));
+      if (end_target_popcount > num_bits) {
+        end_target_popcount = num_bits;
+      }
+    } else {
+      start_target_popcount = 1;
+      end_target_popcount = 0;
+    }
+
+    for (target_popcount = start_target_popcount; target_popcount <= end_target_popcount;
+         target_popcount++) {
+      start = MAX(target_popcount_indices[target_popcount], target_start);
+      end = MIN(target_popcount_indices[target_popcount+1], target_end);
+      if (start >= end) {
+        continue;
+      }
+      num_candidates += end - start;
+
+      target_fp = target_arena + (start * target_storage_size);
+      popcount_sum = query_popcount + target_popcount;
+      for (target_index = start; target_index < end;
+           target_index++, target_fp += target_storage_size) {
+        bound = folded_intersect_bound(
+                     calc_folded_intersect_popcount(folded_size, folded_query_fp,
+                                                    folded->arena + target_index * folded_size),
+                     query_lost_bits, folded->lost_bits[target_index],
+                     query_popcount, target_popcount);
+        /* Use the same comparisons as the unfolded searches */
+        if (result_counts != NULL) {
+          if (((double) bound) / (popcount_sum - bound) < threshold) {
+            num_pruned++;
+            continue;
+          }
+          intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+          score = ((double) intersect_popcount) / (popcount_sum - intersect_popcount);
+          if (score >= threshold) {
+            count++;
+          }
+        } else {
+          if (denominator * bound < numerator * (popcount_sum - bound)) {
+            num_pruned++;
+            continue;
+          }
+          intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+          if (denominator * intersect_popcount >=
+              numerator * (popcount_sum - intersect_popcount)) {
+            score = ((double) intersect_popcount) / (popcount_sum - intersect_popcount);
+            if (!chemfp_add_hit(results+query_index, target_index, score)) {
+              add_hit_error = 1;
+            }
+          }
+        }
+      }
+    }
+    if (result_counts != NULL) {
+      result_counts[query_index] = count;
+    }
+  } /* went through each of the queries */
+
+  free(folded_queries);
+  folded->num_candidates += num_candidates;
+  folded->num_pruned += num_pruned;
+  if (add_hit_error) {
+    return CHEMFP_NO_MEM;
+  }
+  return CHEMFP_OK;
+}
+
+int RENAME(chemfp_count_tanimoto_arena_folded)(
+        double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_folded_arena *folded,
+        int *result_counts) {
+  int query_index;
+  if (bad_folded_num_bits(num_bits, folded->num_bits)) {
+    return CHEMFP_BAD_ARG;
+  }
+  if (target_popcount_indices == NULL || !(threshold > 0.0 && threshold <= 1.0)) {
+    return RENAME(chemfp_count_tanimoto_arena)(
+                threshold, num_bits,
+                query_storage_size, query_arena, query_start, query_end,
+                target_storage_size, target_arena, target_start, target_end,
+                target_popcount_indices, result_counts);
+  }
+  if (query_start >= query_end) {
+    return CHEMFP_OK;
+  }
+  if (target_start >= target_end) {
+    for (query_index = 0; query_index < (query_end-query_start); query_index++) {
+      result_counts[query_index] = 0;
+    }
+    return CHEMFP_OK;
+  }
+  return RENAME(folded_tanimoto_arena)(
+                threshold, num_bits,
+                query_storage_size, query_arena, query_start, query_end,
+                target_storage_size, target_arena, target_start, target_end,
+                target_popcount_indices, folded, result_counts, NULL);
+}
+
+int RENAME(chemfp_threshold_tanimoto_arena_folded)(
+        double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_folded_arena *folded,
+        chemfp_search_result *results) {
+  if (bad_folded_num_bits(num_bits, folded->num_bits)) {
+    return CHEMFP_BAD_ARG;
+  }
+  if (target_popcount_indices == NULL || !(threshold > 0.0 && threshold <= 1.0)) {
+    return RENAME(chemfp_threshold_tanimoto_arena)(
+                threshold, num_bits,
+                query_storage_size, query_arena, query_start, query_end,
+                target_storage_size, target_arena, target_start, target_end,
+                target_popcount_indices, results);
+  }
+  if (query_start >= query_end || target_start >= target_end) {
+    return CHEMFP_OK;
+  }
+  return RENAME(folded_tanimoto_arena)(
+                threshold, num_bits,
+                query_storage_size, query_arena, query_start, query_end,
+                target_storage_size, target_arena, target_start, target_end,
+                target_popcount_indices, folded, NULL, results);
+}
+
+/* This is knearest_tanimoto_arena_core with a single k and threshold, */
+/* and with the prefilter in front of each full intersection */
+int RENAME(chemfp_knearest_tanimoto_arena_folded)(
+        int k, double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_folded_arena *folded,
+        chemfp_search_result *results) {
+  int fp_size = (num_bits+7) / 8;
+  int folded_size = folded->num_bits / 8;
+  int query_popcount, target_popcount, intersect_popcount, bound, query_lost_bits;
+  double score, best_possible_score, popcount_sum, query_threshold;
+  const unsigned char *query_fp, *target_fp, *folded_query_fp;
+  int query_index, target_index;
+  int start, end, errval;
+  long long num_candidates = 0, num_pruned = 0;
+  unsigned char *folded_queries;
+  int *all_query_lost_bits;
+  PopcountSearchOrder popcount_order;
+  chemfp_search_result *result;
+
+  chemfp_popcount_f calc_popcount;
+  chemfp_intersect_popcount_f calc_intersect_popcount, calc_folded_intersect_popcount;
+
+  if (bad_folded_num_bits(num_bits, folded->num_bits)) {
+    return CHEMFP_BAD_ARG;
+  }
+  if (target_popcount_indices == NULL || !(threshold > 0.0 && threshold <= 1.0)) {
+    /* Without popcounts this returns the number of queries, not CHEMFP_OK */
+    errval = RENAME(chemfp_knearest_tanimoto_arena)(
+                k, threshold, num_bits,
+                query_storage_size, query_arena, query_start, query_end,
+                target_storage_size, target_arena, target_start, target_end,
+                target_popcount_indices, results);
+    return (errval < 0) ? errval : CHEMFP_OK;
+  }
+  if (query_start >= query_end || k == 0) {
+    return CHEMFP_OK;
+  }
+
+  folded_queries = RENAME(fold_query_arena)(num_bits, query_storage_size, query_arena,
+                                            query_start, query_end, folded_size,
+                                            &all_query_lost_bits);
+  if (folded_queries == NULL) {
+    return CHEMFP_NO_MEM;
+  }
+
+  calc_popcount = chemfp_select_popcount(num_bits, query_storage_size, query_arena);
+  calc_intersect_popcount = chemfp_select_intersect_popcount(
+                num_bits, query_storage_size, query_arena,
+                target_storage_size, target_arena);
+  calc_folded_intersect_popcount = chemfp_select_intersect_popcount(
+                folded->num_bits, folded_size, folded_queries,
+                folded_size, folded->arena);
+
+#if USE_OPENMP == 1
+  #pragma omp parallel for \
+      private(result, query_fp, folded_query_fp, query_lost_bits, query_threshold, \
+          query_popcount, popcount_order, target_popcount, best_possible_score, start, end, \
+          target_fp, popcount_sum, target_index, bound, intersect_popcount, score) \
+      reduction(+:num_candidates, num_pruned) \
+      schedule(dynamic)
+#endif
+  for (query_index=0; query_index < (query_end-query_start); query_index++) {
+    result = results+query_index;
+    query_fp = query_arena + (query_start+query_index) * query_storage_size;
+    folded_query_fp = folded_queries + query_index * folded_size;
+    query_lost_bits = all_query_lost_bits[query_index];
+    query_threshold = threshold;
+    query_popcount = calc_popcount(fp_size, query_fp);
+
+    if (query_popcount == 0) {
+      /* By definition this will never return hits. */
+      continue;
+    }
+
+    /* Search the bins using the ordering from Swamidass and Baldi.*/
+    init_search_order(&popcount_order, query_popcount, num_bits);
+
+    /* Look through the sections of the arena in optimal popcount order */
+    while (next_popcount(&popcount_order, query_threshold)) {
+      target_popcount = popcount_order.popcount;
+      best_possible_score = popcount_order.score;
+
+      /* If we can't beat the query threshold then we're done with the targets */
+      if (best_possible_score < query_threshold) {
+        break;
+      }
+
+      /* Scan through the targets which have the given popcount */
+      start = target_popcount_indices[target_popcount];
+      end = target_popcount_indices[target_popcount+1];
+      
+      if (!check_bounds(&popcount_order, &start, &end, target_start, target_end)) {
+        continue;
+      }
+
+      /* Iterate over the target fingerprints */
+      target_fp = target_arena + start*target_storage_size;
+      popcount_sum = (double)(query_popcount + target_popcount);
+
+      target_index = start;
+
+      /* There are fewer than 'k' elements in the heap*/
+      if (result->num_hits < k) {
+        for (; target_index<end; target_index++, target_fp += target_storage_size) {
+          num_candidates++;
+          bound = folded_intersect_bound(
+                       calc_folded_intersect_popcount(folded_size, folded_query_fp,
+                                                      folded->arena + target_index * folded_size),
+                       query_lost_bits, folded->lost_bits[target_index],
+                       query_popcount, target_popcount);
+          if (bound / (popcount_sum - bound) < query_threshold) {
+            num_pruned++;
+            continue;
+          }
+          intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+          score = intersect_popcount / (popcount_sum - intersect_popcount);
+
+          /* The heap isn't full; only check if we're at or above the query threshold */
+          if (score >= query_threshold) {
+            chemfp_add_hit(result, target_index, score);
+            if (result->num_hits == k) {
+              chemfp_heapq_heapify(k, result,  (chemfp_heapq_lt) double_score_lt,
+                                   (chemfp_heapq_swap) double_score_swap);
+              query_threshold = chemfp_get_hit_score(result, 0);
+              /* Jump to the "heap is full" section, advancing the pointers */
+              target_index++;
+              target_fp += target_storage_size;
+              goto heap_replace;
+            }
+          } /* Added to heap */
+        } /* Went through target fingerprints */
+
+        /* If we're here then the heap did not fill up. Try the next popcount */
+        continue;
+      }
+
+    heap_replace:
+      /* We only get here if the heap contains k element */
+      if (query_threshold >= best_possible_score) {
+        /* Can't do better. Might as well give up. */
+        break;
+      }
+
+      /* Scan through the target fingerprints; can we improve over the threshold? */
+      for (; target_index<end; target_index++, target_fp += target_storage_size) {
+        num_candidates++;
+        bound = folded_intersect_bound(
+                     calc_folded_intersect_popcount(folded_size, folded_query_fp,
+                                                    folded->arena + target_index * folded_size),
+                     query_lost_bits, folded->lost_bits[target_index],
+                     query_popcount, target_popcount);
+        /* We need to be strictly *better* than what's in the heap */
+        if (bound / (popcount_sum - bound) <= query_threshold) {
+          num_pruned++;
+          continue;
+        }
+        intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+        score = intersect_popcount / (popcount_sum - intersect_popcount);
+
+        if (score > query_threshold) {
+          result->indices[0] = target_index;
+          chemfp_set_hit_score(result, 0, score);
+          chemfp_heapq_siftup(k, result, 0, (chemfp_heapq_lt) double_score_lt,
+                              (chemfp_heapq_swap) double_score_swap);
+          query_threshold = chemfp_get_hit_score(result, 0);
+          if (query_threshold >= best_possible_score) {
+            /* we can't do any better in this section (or in later ones) */
+            break;
+          }
+        } /* heapreplaced the old smallest item with the new item */
+      } /* looped over fingerprints */
+    } /* Went through all the popcount regions */
+
+    /* We have scanned all the fingerprints. Is the heap full? */
+    if (result->num_hits < k) {
+      /* Not full, so need to heapify it. */
+      chemfp_heapq_heapify(result->num_hits, result, (chemfp_heapq_lt) double_score_lt,
+                           (chemfp_heapq_swap) double_score_swap);
+    }
+  } /* looped over all queries */
+
+  free(folded_queries);
+  folded->num_candidates += num_candidates;
+  folded->num_pruned += num_pruned;
+  return CHEMFP_OK;
+}
+
+
+/***** Special support for the NxN symmetric case ******/
+
+/* TODO: implement the k-nearest variant. It's harder because a k-nearest
+   search, combined with the Swamidass and Baldi search limits, is not reflexive. */
+
+int RENAME(chemfp_count_tanimoto_hits_arena_symmetric)(
+        /* Count all matches within the given threshold */
+        double threshold,
+
+        /* Number of bits in the fingerprint */
+        int num_bits,
+
+        /* Fingerprint arena */
+        int storage_size, const unsigned char *arena,
+
+        /* Row start and end indices */
+        int query_start, int query_end,
+
+        /* Column start and end indices */
+        int target_start, int target_end,
+
+        /* Target popcount distribution information */
+        int *target_popcount_indices,
+
+        /* Results _increment_ existing values in the array - remember to initialize! */
+        int *result_counts,
+
+        /* Called to check if the search should stop (may be NULL) */
+        chemfp_check_interrupt_f check_interrupt, void *interrupt_data
+                                          ) {
+  int fp_size = (num_bits+7) / 8;
+  int query_index, target_index, tile, num_tiles;
+  int *tiles;
+  InterruptState interrupt;
+  int start, end;
+  int query_popcount, target_popcount;
+  int start_target_popcount, end_target_popcount, intersect_popcount;
+  int count;
+  double popcount_sum, score;
+  const unsigned char *query_fp, *target_fp;
+  chemfp_popcount_f calc_popcount;
+  chemfp_intersect_popcount_f calc_intersect_popcount;
+#if USE_OPENMP == 1
+  /* Reduce contention by using a per-thread counts array. For details see: */
+  /* http://www.dalkescientific.com/writings/diary/archive/2012/01/17/I_parallelize_an_algorithm.html */
+  int i;
+  int num_threads;
+  int *parallel_counts;
+  int *per_thread_counts;
+  int per_thread_size;
+#endif
+
+  /* Check that we're not obviously in the lower triangle */
+  if (query_start >= target_end) {  /* No possible hits */
+    return CHEMFP_OK;
+  }
+
+  /* Shift the target towards the upper triangle, if needed */
+  if (target_start < query_start) {
+    target_start = query_start;
   }
 
   /* Check for edge cases */
@@ -648,128 +1453,457 @@ int RENAME(chemfp_count_tanimoto_hits_arena_symmetric)(
     return CHEMFP_OK;
   }
 
-  if (threshold <= 0.0) {
-    /* By definition, everything matches */
-    /* FIXME: this is inelegant. I'm finding the symmetry and boundary conditions a bit tricky */
-    for (query_index=query_start; query_index<query_end; query_index++) {
-      for (target_index=MAX(query_index+1, target_start);
-           target_index<target_end; target_index++) {
-        result_counts[query_index] += 1;
-        result_counts[target_index] += 1;
-      }
+  if (threshold <= 0.0) {
+    /* By definition, everything matches */
+    /* FIXME: this is inelegant. I'm finding the symmetry and boundary conditions a bit tricky */
+    for (query_index=query_start; query_index<query_end; query_index++) {
+      for (target_index=MAX(query_index+1, target_start);
+           target_index<target_end; target_index++) {
+        result_counts[query_index] += 1;
+        result_counts[target_index] += 1;
+      }
+    }
+    return CHEMFP_OK;
+  }
+
+
+  /* Prevent overflow if someone uses a threshold of, say, 1E-80 */
+  /* (Not really needed unless you trap IEEE 754 overflow errors) */
+  if (threshold > 0.0 && threshold < 1.0/num_bits) {
+    threshold = 0.5 / num_bits;
+  }
+
+  /* target_popcount_indices must exist; if you don't care for the factor */
+  /* of two performance increase by precomputing/presorting based on popcount */
+  /* then why are you interested in the factor of two based on symmetry? */
+                                                   
+  /* Choose popcount methods optimized for this case */
+  calc_popcount = chemfp_select_popcount(num_bits, storage_size, arena);
+  calc_intersect_popcount = chemfp_select_intersect_popcount(
+                num_bits, storage_size, arena, storage_size, arena);
+
+  init_interrupt_state(&interrupt, check_interrupt, interrupt_data);
+  tiles = make_symmetric_tiles(query_start, query_end, target_start, target_end, 1, &num_tiles);
+  if (!tiles) {
+    return CHEMFP_NO_MEM;
+  }
+
+  /* This uses the limits from Swamidass and Baldi */
+#if USE_OPENMP == 1
+  num_threads = omp_get_max_threads();
+  per_thread_size = MAX(query_end, target_end);
+  parallel_counts = (int *) calloc(num_threads * per_thread_size, sizeof(int));
+  if (!parallel_counts) {
+    free(tiles);
+    return CHEMFP_NO_MEM;
+  }
+  #pragma omp parallel for \
+      private(query_index, query_fp, query_popcount, start_target_popcount, end_target_popcount, \
+          count, target_popcount, start, end, target_fp, popcount_sum, target_index, \
+          intersect_popcount, score, per_thread_counts)                              \
+      schedule(dynamic)
+#endif
+  for (tile = 0; tile < num_tiles; tile++) {
+    for (query_index = tiles[tile]; query_index < tiles[tile+1]; query_index++) {
+      if (symmetric_interrupted(&interrupt, symmetric_row_work(query_index, target_start, target_end, 1))) {
+        break;
+      }
+      query_fp = arena + (query_index * storage_size);
+      query_popcount = calc_popcount(fp_size, query_fp);
+#if USE_OPENMP == 1
+      per_thread_counts = parallel_counts+(omp_get_thread_num() * per_thread_size);
+#endif
+
+      /* Special case when popcount(query) == 0; everything has a score of 0.0 */
+      if (query_popcount == 0) {
+        continue;
+      }
+      /* Figure out which fingerprints to search */
+      start_target_popcount = (int)(query_popcount * threshold);
+      end_target_popcount = (int)(ceil(query_popcount / threshold));
+      if (end_target_popcount > num_bits) {
+        end_target_popcount = num_bits;
+      }
+
+      count = 0;
+      for (target_popcount = start_target_popcount; target_popcount <= end_target_popcount;
+           target_popcount++) {
+        start = target_popcount_indices[target_popcount];
+        end = target_popcount_indices[target_popcount+1];
+        if (start < target_start) {
+          start = target_start;
+        }
+        start = MAX(query_index+1, start);
+        if (end > target_end) {
+          end = target_end;
+        }
+
+        target_fp = arena + (start * storage_size);
+        popcount_sum = query_popcount + target_popcount;
+        for (target_index = start; target_index < end;
+             target_index++, target_fp += storage_size) {
+          intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+          score = intersect_popcount / (popcount_sum - intersect_popcount);
+          if (score >= threshold) {
+            /* Can accumulate the score for the row. This is likely a register */
+            /* instead of a memory location so should be slightly faster. */
+            count++;
+            /* I can't use the same technique for the symmetric match */
+#if USE_OPENMP == 1
+            per_thread_counts[target_index]++;
+#else
+            result_counts[target_index]++;
+#endif
+          }
+        }
+      }
+
+      /* Save the accumulated row counts */
+#if USE_OPENMP == 1
+      if (count) {
+        per_thread_counts[query_index] += count;
+      }
+#else
+      result_counts[query_index] += count;
+#endif
+    }
+  } /* went through each of the queries */
+  free(tiles);
+
+#if USE_OPENMP == 1
+  if (interrupt.interrupted) {
+    free(parallel_counts);
+    return CHEMFP_INTERRUPTED;
+  }
+  /* Merge the per-thread results into the counts array */
+  /* TODO: start from MIN(query_start, query_end) */
+  /* TODO: parallelize? */
+  for (query_index = 0; query_index < per_thread_size; query_index++) {
+    count = 0;
+    for (i=0; i<num_threads; i++) {
+      count += parallel_counts[per_thread_size * i + query_index];
+    }
+    result_counts[query_index] += count;
+  }
+  free(parallel_counts);
+#endif
+  if (interrupt.interrupted) {
+    return CHEMFP_INTERRUPTED;
+  }
+  return CHEMFP_OK;
+}
+
+int RENAME(chemfp_threshold_tanimoto_arena_symmetric)(
+        /* Within the given threshold */
+        double threshold,
+
+        /* Number of bits in the fingerprint */
+        int num_bits,
+
+        /* Arena */
+        int storage_size, const unsigned char *arena,
+
+        /* start and end indices for the rows and columns */
+        int query_start, int query_end,
+        int target_start, int target_end,
+        
+        /* Target popcount distribution information */
+        /*  (must have at least num_bits+1 elements) */
+        int *popcount_indices,
+
+        /* Results go here */
+        /* NOTE: This must have enough space for all of the fingerprints! */
+        chemfp_search_result *results,
+
+        /* Called to check if the search should stop (may be NULL) */
+        chemfp_check_interrupt_f check_interrupt, void *interrupt_data) {
+
+  int fp_size = (num_bits+7) / 8;
+  int query_index, target_index, tile, num_tiles;
+  int *tiles;
+  InterruptState interrupt;
+  int start, end;
+  const unsigned char *query_fp, *target_fp;
+  int query_popcount, target_popcount;
+  int start_target_popcount, end_target_popcount;
+  chemfp_popcount_f calc_popcount;
+  chemfp_intersect_popcount_f calc_intersect_popcount;
+  int numerator, denominator, popcount_sum, intersect_popcount;
+  double score;
+  int add_hit_error = 0;
+
+  /* Check that we're not obviously in the lower triangle */
+  if (query_start >= target_end) {  /* No possible hits */
+    return CHEMFP_OK;
+  }
+
+  /* Shift the target towards the upper triangle, if needed */
+  if (target_start < query_start) {
+    target_start = query_start;
+  }
+
+  /* Corner cases where I don't need to do anything */
+  if ((query_start >= query_end) ||
+      (target_start >= target_end) ||
+      (threshold < 0)) {
+    return CHEMFP_OK;
+  }
+
+  /* if (threshold == 0.0) { */ /* TODO: Optimize this case */
+
+
+  /* Prevent overflow if someone uses a threshold of, say, 1E-80 */
+  if (threshold > 0.0 && threshold < 1.0/num_bits) {
+    threshold = 0.5 / num_bits;
+  }
+  if (threshold > 1.0) {
+    return CHEMFP_OK;
+  }
+
+  calc_popcount = chemfp_select_popcount(num_bits, storage_size, arena);
+  calc_intersect_popcount = chemfp_select_intersect_popcount(
+                num_bits, storage_size, arena, storage_size, arena);
+  
+  denominator = num_bits * 10;
+  numerator = (int)(threshold * denominator);
+
+  init_interrupt_state(&interrupt, check_interrupt, interrupt_data);
+  tiles = make_symmetric_tiles(query_start, query_end, target_start, target_end, 1, &num_tiles);
+  if (!tiles) {
+    return CHEMFP_NO_MEM;
+  }
+
+  /* This uses the limits from Swamidass and Baldi */
+  /* It doesn't use the search ordering because it's supposed to find everything */
+  
+#if USE_OPENMP == 1
+  #pragma omp parallel for \
+      private(query_index, query_fp, query_popcount, start_target_popcount, end_target_popcount, \
+          target_popcount, start, end, target_fp, popcount_sum, target_index, intersect_popcount, score) \
+      schedule(dynamic)
+#endif
+  for (tile = 0; tile < num_tiles; tile++) {
+    for (query_index = tiles[tile]; query_index < tiles[tile+1]; query_index++) {
+      if (symmetric_interrupted(&interrupt, symmetric_row_work(query_index, target_start, target_end, 1))) {
+        break;
+      }
+      query_fp = arena + (query_index * storage_size);
+      query_popcount = calc_popcount(fp_size, query_fp);
+
+      /* Special case when popcount(query) == 0; everything has a score of 0.0 */
+      if (query_popcount == 0) {
+        if (threshold == 0.0) {
+          /* Only populate the upper triangle */
+          target_index = MAX(query_index+1, target_start);
+          for (;target_index < target_end; target_index++) {
+            if (!chemfp_add_hit(results+query_index, target_index, 0.0)) {
+              add_hit_error = 1;
+            }
+          }
+        }
+        continue;
+      }
+      /* Figure out which fingerprints to search, based on the popcount */
+      if (threshold == 0.0) {
+        start_target_popcount = 0;
+        end_target_popcount = num_bits;
+      } else {
+        start_target_popcount = (int)(query_popcount * threshold);
+        end_target_popcount = (int)(ceil(query_popcount / threshold));
+        if (end_target_popcount > num_bits) {
+          end_target_popcount = num_bits;
+        }
+      }
+
+      for (target_popcount=start_target_popcount; target_popcount<=end_target_popcount;
+           target_popcount++) {
+        start = popcount_indices[target_popcount];
+        end = popcount_indices[target_popcount+1];
+        if (start < target_start) {
+          start = target_start;
+        }
+        if (end > target_end) {
+          end = target_end;
+        }
+
+        popcount_sum = query_popcount + target_popcount;
+        for (target_index = MAX(query_index+1, start); target_index < end; target_index++) {
+          target_fp = arena + (target_index * storage_size);
+          intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+
+          if (denominator * intersect_popcount  >=
+              numerator * (popcount_sum - intersect_popcount)) {
+            /* Add to the upper triangle */
+            score = ((double) intersect_popcount) / (popcount_sum - intersect_popcount);
+            if (!chemfp_add_hit(results+query_index, target_index, score)) {
+              add_hit_error = 1;
+            }
+          }
+        }
+      }
+    }
+  } /* went through each of the queries */
+  free(tiles);
+  if (add_hit_error) {
+    return CHEMFP_NO_MEM;
+  }
+  if (interrupt.interrupted) {
+    return CHEMFP_INTERRUPTED;
+  }
+  return CHEMFP_OK;
+}
+
+/* Fill the upper-triangle part of rows query_start to query_end of a
+   CSR matrix. The row sizes in indptr must come from
+   chemfp_count_tanimoto_hits_arena_symmetric() with the same threshold,
+   so this uses the same score test. Each row's upper-triangle hits are
+   written backwards from the end of the row, which leaves them in
+   increasing column order and leaves room at the start of the row for
+   the lower-triangle hits from chemfp_fill_csr_lower_triangle(). */
+int RENAME(chemfp_threshold_tanimoto_arena_symmetric_csr)(
+        /* Within the given threshold */
+        double threshold,
+
+        /* Number of bits in the fingerprint */
+        int num_bits,
+
+        /* Arena */
+        int storage_size, const unsigned char *arena,
+
+        /* The number of fingerprints, and the rows to fill */
+        int num_fingerprints, int query_start, int query_end,
+
+        /* Target popcount distribution information */
+        int *popcount_indices,
+
+        /* The row offsets, which must have num_fingerprints+1 elements */
+        const long long *indptr,
+
+        /* The number of upper-triangle hits in each row is saved here */
+        int *upper_counts,
+
+        /* The column indices and scores */
+        int *indices, float *scores,
+
+        /* Called to check if the search should stop (may be NULL) */
+        chemfp_check_interrupt_f check_interrupt, void *interrupt_data) {
+
+  int fp_size = (num_bits+7) / 8;
+  int query_index, target_index, tile, num_tiles;
+  int *tiles;
+  InterruptState interrupt;
+  int start, end;
+  const unsigned char *query_fp, *target_fp;
+  int query_popcount, target_popcount;
+  int start_target_popcount, end_target_popcount, intersect_popcount;
+  double popcount_sum, score;
+  long long pos, row_start;
+  chemfp_popcount_f calc_popcount;
+  chemfp_intersect_popcount_f calc_intersect_popcount;
+  int bad_counts = 0;
+
+  if (threshold > 1.0) {
+    for (query_index = query_start; query_index < query_end; query_index++) {
+      upper_counts[query_index] = 0;
     }
     return CHEMFP_OK;
   }
 
-
-  /* Prevent overflow if someone uses a threshold of, say, 1E-80 */
-  /* (Not really needed unless you trap IEEE 754 overflow errors) */
+  /* Use the same limit as the count */
   if (threshold > 0.0 && threshold < 1.0/num_bits) {
     threshold = 0.5 / num_bits;
   }
 
-  /* target_popcount_indices must exist; if you don't care for the factor */
-  /* of two performance increase by precomputing/presorting based on popcount */
-  /* then why are you interested in the factor of two based on symmetry? */
-                                                   
-  /* Choose popcount methods optimized for this case */
   calc_popcount = chemfp_select_popcount(num_bits, storage_size, arena);
   calc_intersect_popcount = chemfp_select_intersect_popcount(
                 num_bits, storage_size, arena, storage_size, arena);
 
-  /* This uses the limits from Swamidass and Baldi */
-#if USE_OPENMP == 1
-  num_threads = omp_get_max_threads();
-  per_thread_size = MAX(query_end, target_end);
-  parallel_counts = (int *) calloc(num_threads * per_thread_size, sizeof(int));
-  if (!parallel_counts) {
+  init_interrupt_state(&interrupt, check_interrupt, interrupt_data);
+  tiles = make_symmetric_tiles(query_start, query_end, 0, num_fingerprints, 1, &num_tiles);
+  if (!tiles) {
     return CHEMFP_NO_MEM;
   }
+
+#if USE_OPENMP == 1
   #pragma omp parallel for \
-      private(query_fp, query_popcount, start_target_popcount, end_target_popcount,  \
-          count, target_popcount, start, end, target_fp, popcount_sum, target_index, \
-          intersect_popcount, score, per_thread_counts)                              \
+      private(query_index, query_fp, query_popcount, start_target_popcount, end_target_popcount, \
+          target_popcount, start, end, target_fp, popcount_sum, target_index,       \
+          intersect_popcount, score, pos, row_start)                               \
       schedule(dynamic)
 #endif
-  for (query_index = query_start; query_index < query_end; query_index++) {
-    query_fp = arena + (query_index * storage_size);
-    query_popcount = calc_popcount(fp_size, query_fp);
-#if USE_OPENMP == 1
-    per_thread_counts = parallel_counts+(omp_get_thread_num() * per_thread_size);
-#endif
-
-    /* Special case when popcount(query) == 0; everything has a score of 0.0 */
-    if (query_popcount == 0) {
-      continue;
-    }
-    /* Figure out which fingerprints to search */
-    start_target_popcount = (int)(query_popcount * threshold);
-    end_target_popcount = (int)(ceil(query_popcount / threshold));
-    if (end_target_popcount > num_bits) {
-      end_target_popcount = num_bits;
-    }
-
-    count = 0;
-    for (target_popcount = start_target_popcount; target_popcount <= end_target_popcount;
-         target_popcount++) {
-      start = target_popcount_indices[target_popcount];
-      end = target_popcount_indices[target_popcount+1];
-      if (start < target_start) {
-        start = target_start;
+  for (tile = 0; tile < num_tiles; tile++) {
+    for (query_index = tiles[tile]; query_index < tiles[tile+1]; query_index++) {
+      if (symmetric_interrupted(&interrupt, symmetric_row_work(query_index, 0, num_fingerprints, 1))) {
+        break;
       }
-      start = MAX(query_index+1, start);
-      if (end > target_end) {
-        end = target_end;
+      query_fp = arena + (query_index * storage_size);
+      query_popcount = calc_popcount(fp_size, query_fp);
+      row_start = indptr[query_index];
+      pos = indptr[query_index+1];
+
+      if (threshold <= 0.0) {
+        /* Everything matches, even an empty fingerprint */
+        start_target_popcount = 0;
+        end_target_popcount = num_bits;
+      } else {
+        if (query_popcount == 0) {
+          upper_counts[query_index] = 0;
+          continue;
+        }
+        start_target_popcount = (int)(query_popcount * threshold);
+        end_target_popcount = (int)(ceil(query_popcount / threshold));
+        if (end_target_popcount > num_bits) {
+          end_target_popcount = num_bits;
+        }
       }
 
-      target_fp = arena + (start * storage_size);
-      popcount_sum = query_popcount + target_popcount;
-      for (target_index = start; target_index < end;
-           target_index++, target_fp += storage_size) {
-        intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
-        score = intersect_popcount / (popcount_sum - intersect_popcount);
-        if (score >= threshold) {
-          /* Can accumulate the score for the row. This is likely a register */
-          /* instead of a memory location so should be slightly faster. */
-          count++;
-          /* I can't use the same technique for the symmetric match */
-#if USE_OPENMP == 1
-          per_thread_counts[target_index]++;
-#else
-          result_counts[target_index]++;
-#endif
+      /* Go from the highest column to the lowest */
+      for (target_popcount = end_target_popcount; target_popcount >= start_target_popcount;
+           target_popcount--) {
+        start = MAX(query_index+1, popcount_indices[target_popcount]);
+        end = MIN(num_fingerprints, popcount_indices[target_popcount+1]);
+
+        popcount_sum = query_popcount + target_popcount;
+        for (target_index = end-1; target_index >= start; target_index--) {
+          target_fp = arena + (target_index * storage_size);
+          intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+          if (popcount_sum == intersect_popcount) {
+            /* Both fingerprints are empty */
+            score = 0.0;
+          } else {
+            score = intersect_popcount / (popcount_sum - intersect_popcount);
+          }
+          if (threshold <= 0.0 || score >= threshold) {
+            if (pos == row_start) {
+              /* More hits than the counts said there would be */
+              bad_counts = 1;
+              continue;
+            }
+            pos--;
+            indices[pos] = target_index;
+            scores[pos] = (float) score;
+          }
         }
       }
+      upper_counts[query_index] = (int) (indptr[query_index+1] - pos);
     }
-
-    /* Save the accumulated row counts */
-#if USE_OPENMP == 1
-    if (count) {
-      per_thread_counts[query_index] += count;
-    }
-#else
-    result_counts[query_index] += count;
-#endif
-
   } /* went through each of the queries */
+  free(tiles);
 
-#if USE_OPENMP == 1
-  /* Merge the per-thread results into the counts array */
-  /* TODO: start from MIN(query_start, query_end) */
-  /* TODO: parallelize? */
-  for (query_index = 0; query_index < per_thread_size; query_index++) {
-    count = 0;
-    for (i=0; i<num_threads; i++) {
-      count += parallel_counts[per_thread_size * i + query_index];
-    }
-    result_counts[query_index] += count;
+  if (bad_counts) {
+    return CHEMFP_BAD_ARG;
+  }
+  if (interrupt.interrupted) {
+    return CHEMFP_INTERRUPTED;
   }
-  free(parallel_counts);
-#endif
   return CHEMFP_OK;
 }
 
-int RENAME(chemfp_threshold_tanimoto_arena_symmetric)(
+/* I couldn't figure out a way to take advantage of symmetry */
+/* This is the same as the NxM algorithm except that it excludes self-matches */
+int RENAME(chemfp_knearest_tanimoto_arena_symmetric)(
+        /* Find the 'k' nearest items */
+        int k,
         /* Within the given threshold */
         double threshold,
 
@@ -787,99 +1921,391 @@ int RENAME(chemfp_threshold_tanimoto_arena_symmetric)(
         /*  (must have at least num_bits+1 elements) */
         int *popcount_indices,
 
-        /* Results go here */
-        /* NOTE: This must have enough space for all of the fingerprints! */
-        chemfp_search_result *results) {
+        /* Results go into these arrays  */
+        chemfp_search_result *results,
 
-  int fp_size = (num_bits+7) / 8;
-  int query_index, target_index;
-  int start, end;
+        /* Called to check if the search should stop (may be NULL) */
+        chemfp_check_interrupt_f check_interrupt, void *interrupt_data
+                                   ) {
+
+  int fp_size;
+  int query_popcount, target_popcount, intersect_popcount;
+  double score, best_possible_score, popcount_sum, query_threshold;
   const unsigned char *query_fp, *target_fp;
-  int query_popcount, target_popcount;
-  int start_target_popcount, end_target_popcount;
+  int query_index, target_index, tile, num_tiles;
+  int *tiles;
+  InterruptState interrupt;
+  int start, end;
+  PopcountSearchOrder popcount_order;
+  chemfp_search_result *result;
+  
   chemfp_popcount_f calc_popcount;
   chemfp_intersect_popcount_f calc_intersect_popcount;
-  int numerator, denominator, popcount_sum, intersect_popcount;
-  double score;
-  int add_hit_error = 0;
 
-  /* Check that we're not obviously in the lower triangle */
-  if (query_start >= target_end) {  /* No possible hits */
+  if (query_start >= query_end) {
+    return 0;
+  }
+  /* k == 0 is a valid input, and of course the result is no matches */
+  if (k == 0) {
     return CHEMFP_OK;
   }
+  fp_size = (num_bits+7)/8;
+
+
+  /* Choose popcounts optimized for this case */
+  calc_popcount = chemfp_select_popcount(num_bits, storage_size, arena);
+  calc_intersect_popcount = chemfp_select_intersect_popcount(
+                num_bits, storage_size, arena, storage_size, arena);
+
+  /* Every row searches all of the targets, so the tiles have the same number of rows */
+  init_interrupt_state(&interrupt, check_interrupt, interrupt_data);
+  tiles = make_symmetric_tiles(query_start, query_end, target_start, target_end, 0, &num_tiles);
+  if (!tiles) {
+    return CHEMFP_NO_MEM;
+  }
 
-  /* Shift the target towards the upper triangle, if needed */
-  if (target_start < query_start) {
-    target_start = query_start;
+  /* Loop through the query fingerprints */
+#if USE_OPENMP == 1
+  #pragma omp parallel for \
+    private(query_index, result, query_fp, query_threshold, query_popcount, popcount_order,\
+          target_popcount, best_possible_score, start, end, target_fp, \
+          popcount_sum, target_index, intersect_popcount, score) \
+      schedule(dynamic)
+#endif
+  for (tile = 0; tile < num_tiles; tile++) {
+    for (query_index = tiles[tile]; query_index < tiles[tile+1]; query_index++) {
+      if (symmetric_interrupted(&interrupt, symmetric_row_work(query_index, target_start, target_end, 0))) {
+        break;
+      }
+      result = results+query_index;
+      query_fp = arena + query_index * storage_size;
+
+      query_threshold = threshold;
+      query_popcount = calc_popcount(fp_size, query_fp);
+
+      if (query_popcount == 0) {
+        /* By definition this will never return hits. Even if threshold == 0.0. */
+        /* (I considered returning the first k hits, but that's chemically meaningless.) */
+        /* XXX change this. Make it returns the first k hits */
+        continue;
+      }
+
+      /* Search the bins using the ordering from Swamidass and Baldi.*/
+      init_search_order(&popcount_order, query_popcount, num_bits);
+
+      /* Look through the sections of the arena in optimal popcount order */
+      while (next_popcount(&popcount_order, query_threshold)) {
+        target_popcount = popcount_order.popcount;
+        best_possible_score = popcount_order.score;
+
+        /* If we can't beat the query threshold then we're done with the targets */
+        if (best_possible_score < query_threshold) {
+          break;
+        }
+
+        /* Scan through the targets which have the given popcount */
+        start = popcount_indices[target_popcount];
+        end = popcount_indices[target_popcount+1];
+
+        if (!check_bounds(&popcount_order, &start, &end, target_start, target_end)) {
+          continue;
+        }
+
+        /* Iterate over the target fingerprints */
+        target_fp = arena + start*storage_size;
+        popcount_sum = (double)(query_popcount + target_popcount);
+
+        target_index = start;
+
+        /* There are fewer than 'k' elements in the heap*/
+        if (result->num_hits < k) {
+          for (; target_index<end; target_index++, target_fp += storage_size) {
+            intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+            score = intersect_popcount / (popcount_sum - intersect_popcount);
+
+            /* The heap isn't full; only check if we're at or above the query threshold */
+            if (score >= query_threshold) {
+              if (query_index == target_index) {
+                continue; /* Don't match self */
+              }
+              chemfp_add_hit(result, target_index, score);
+              if (result->num_hits == k) {
+                chemfp_heapq_heapify(k, result,  (chemfp_heapq_lt) double_score_lt,
+                                     (chemfp_heapq_swap) double_score_swap);
+                query_threshold = chemfp_get_hit_score(result, 0);
+                /* We're going to jump to the "heap is full" section */
+                /* Since we leave the loop early, I need to advance the pointers */
+                target_index++;
+                target_fp += storage_size;
+                goto heap_replace;
+              }
+            } /* Added to heap */
+          } /* Went through target fingerprints */
+
+          /* If we're here then the heap did not fill up. Try the next popcount */
+          continue;
+        }
+
+      heap_replace:
+        /* We only get here if the heap contains k element */
+
+        /* Earlier we tested for "best_possible_score<query_threshold". */
+        /* The test to replace an element in the heap is more stringent. */
+        if (query_threshold >= best_possible_score) {
+          /* Can't do better. Might as well give up. */
+          break;
+        }
+
+        /* Scan through the target fingerprints; can we improve over the threshold? */
+        for (; target_index<end; target_index++, target_fp += storage_size) {
+
+          intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+          score = intersect_popcount / (popcount_sum - intersect_popcount);
+
+          /* We need to be strictly *better* than what's in the heap */
+          if (score > query_threshold) {
+            if (query_index == target_index) {
+              continue; /* Don't match self */
+            }
+            result->indices[0] = target_index;
+            chemfp_set_hit_score(result, 0, score);
+            chemfp_heapq_siftup(k, result, 0, (chemfp_heapq_lt) double_score_lt,
+                                (chemfp_heapq_swap) double_score_swap);
+            query_threshold = chemfp_get_hit_score(result, 0);
+            if (query_threshold >= best_possible_score) {
+              /* we can't do any better in this section (or in later ones) */
+              break;
+            }
+          } /* heapreplaced the old smallest item with the new item */
+        } /* looped over fingerprints */
+      } /* Went through all the popcount regions */
+
+      /* We have scanned all the fingerprints. Is the heap full? */
+      if (result->num_hits < k) {
+        /* Not full, so need to heapify it. */
+        chemfp_heapq_heapify(result->num_hits, result, (chemfp_heapq_lt) double_score_lt,
+                             (chemfp_heapq_swap) double_score_swap);
+      }
+    }
+  } /* looped over all queries */
+  free(tiles);
+  if (interrupt.interrupted) {
+    return CHEMFP_INTERRUPTED;
   }
+  return CHEMFP_OK;
+}
 
-  /* Corner cases where I don't need to do anything */
-  if ((query_start >= query_end) ||
-      (target_start >= target_end) ||
-      (threshold < 0)) {
+
+/***** Metric searches ******/
+
+/* Some metrics, like the Tversky similarity, are not symmetric, so a
+   "symmetric" search of an arena against itself can't use the upper
+   triangle. Instead it searches each row against all of the targets,
+   except itself. The core functions support both cases. If
+   'exclude_self' is true then the query and target arenas are the same
+   and a query never matches the target with the same index.
+
+   The kernels work with the metric_score() values, where larger is
+   better, and store the metric_value() in the hits. A hit must be
+   inside the score interval. The upper limit doesn't shrink the
+   popcount ranges, since a target with any popcount might have a low
+   enough score, but it does mean the k-nearest heaps only keep hits
+   inside the interval. The result arrays start at query_start. The
+   counts are incremented. */
+
+static int
+RENAME(count_metric_arena_core)(
+        const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        int exclude_self,
+        int *result_counts) {
+  int query_index, target_index;
+  const unsigned char *query_fp, *target_fp;
+  int start, end;
+  int count;
+  int fp_size = (num_bits+7) / 8;
+  int query_popcount, start_target_popcount, end_target_popcount;
+  int target_popcount, intersect_popcount;
+
+  int is_distance = chemfp_metric_is_distance(metric->type);
+  double threshold;
+  ScoreBounds bounds;
+
+  chemfp_popcount_f calc_popcount, calc_target_popcount;
+  chemfp_intersect_popcount_f calc_intersect_popcount;
+
+  if (is_distance < 0) {
+    return CHEMFP_BAD_ARG;
+  }
+  init_score_bounds(&bounds, metric, interval);
+  threshold = interval_threshold(metric, interval);
+  if ((query_start >= query_end) || (target_start >= target_end) ||
+      empty_score_bounds(&bounds) || (!is_distance && threshold > 1.0)) {
     return CHEMFP_OK;
   }
 
-  /* if (threshold == 0.0) { */ /* TODO: Optimize this case */
+  calc_popcount = chemfp_select_popcount(num_bits, query_storage_size, query_arena);
+  calc_target_popcount = chemfp_select_popcount(num_bits, target_storage_size, target_arena);
+  calc_intersect_popcount = chemfp_select_intersect_popcount(
+                num_bits, query_storage_size, query_arena,
+                target_storage_size, target_arena);
+
+#if USE_OPENMP == 1
+  #pragma omp parallel for \
+      private(query_fp, query_popcount, start_target_popcount, end_target_popcount, \
+          count, target_popcount, start, end, target_fp, target_index, intersect_popcount) \
+      schedule(dynamic)
+#endif
+  for (query_index = query_start; query_index < query_end; query_index++) {
+    query_fp = query_arena + (query_index * query_storage_size);
+    query_popcount = calc_popcount(fp_size, query_fp);
+
+    /* Special case when popcount(query) == 0; every similarity is 0.0 */
+    if (query_popcount == 0 && !is_distance && !in_score_bounds(&bounds, 0.0)) {
+      continue;
+    }
+    count = 0;
+    if (target_popcount_indices == NULL) {
+      /* Handle the case when precomputed targets aren't available. */
+      /* This is a slower algorithm because it tests everything. */
+      target_fp = target_arena + (target_start * target_storage_size);
+      for (target_index = target_start; target_index < target_end;
+           target_index++, target_fp += target_storage_size) {
+        if (exclude_self && target_index == query_index) {
+          continue;
+        }
+        intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+        if (in_score_bounds(&bounds, metric_score(metric, query_popcount,
+                                                  calc_target_popcount(fp_size, target_fp),
+                                                  intersect_popcount))) {
+          count++;
+        }
+      }
+    } else {
+      /* Only search the popcounts which might have a high enough score */
+      metric_popcount_range(metric, query_popcount, num_bits, threshold,
+                            &start_target_popcount, &end_target_popcount);
+      for (target_popcount = start_target_popcount; target_popcount <= end_target_popcount;
+           target_popcount++) {
+        start = target_popcount_indices[target_popcount];
+        end = target_popcount_indices[target_popcount+1];
+        if (start < target_start) {
+          start = target_start;
+        }
+        if (end > target_end) {
+          end = target_end;
+        }
+
+        target_fp = target_arena + (start * target_storage_size);
+        for (target_index = start; target_index < end;
+             target_index++, target_fp += target_storage_size) {
+          if (exclude_self && target_index == query_index) {
+            continue;
+          }
+          intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+          if (in_score_bounds(&bounds, metric_score(metric, query_popcount, target_popcount,
+                                                    intersect_popcount))) {
+            count++;
+          }
+        }
+      }
+    }
+    result_counts[query_index-query_start] += count;
+  } /* went through each of the queries */
+  return CHEMFP_OK;
+}
+
+static int
+RENAME(threshold_metric_arena_core)(
+        const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        int exclude_self,
+        chemfp_search_result *results) {
+  int query_index, target_index;
+  const unsigned char *query_fp, *target_fp;
+  int start, end;
+  int fp_size = (num_bits+7) / 8;
+  int query_popcount, start_target_popcount, end_target_popcount;
+  int target_popcount, intersect_popcount;
+  double score;
+  int add_hit_error = 0;
+
+  int is_distance = chemfp_metric_is_distance(metric->type);
+  double threshold;
+  ScoreBounds bounds;
 
+  chemfp_popcount_f calc_popcount, calc_target_popcount;
+  chemfp_intersect_popcount_f calc_intersect_popcount;
 
-  /* Prevent overflow if someone uses a threshold of, say, 1E-80 */
-  if (threshold > 0.0 && threshold < 1.0/num_bits) {
-    threshold = 0.5 / num_bits;
+  if (is_distance < 0) {
+    return CHEMFP_BAD_ARG;
   }
-  if (threshold > 1.0) {
+  init_score_bounds(&bounds, metric, interval);
+  threshold = interval_threshold(metric, interval);
+  if ((query_start >= query_end) || (target_start >= target_end) ||
+      empty_score_bounds(&bounds) || (!is_distance && threshold > 1.0)) {
     return CHEMFP_OK;
   }
 
-  calc_popcount = chemfp_select_popcount(num_bits, storage_size, arena);
+  calc_popcount = chemfp_select_popcount(num_bits, query_storage_size, query_arena);
+  calc_target_popcount = chemfp_select_popcount(num_bits, target_storage_size, target_arena);
   calc_intersect_popcount = chemfp_select_intersect_popcount(
-                num_bits, storage_size, arena, storage_size, arena);
-  
-  denominator = num_bits * 10;
-  numerator = (int)(threshold * denominator);
+                num_bits, query_storage_size, query_arena,
+                target_storage_size, target_arena);
 
-  /* This uses the limits from Swamidass and Baldi */
-  /* It doesn't use the search ordering because it's supposed to find everything */
-  
 #if USE_OPENMP == 1
   #pragma omp parallel for \
       private(query_fp, query_popcount, start_target_popcount, end_target_popcount, \
-          target_popcount, start, end, target_fp, popcount_sum, target_index, intersect_popcount, score) \
+          target_popcount, start, end, target_fp, target_index, intersect_popcount, score) \
       schedule(dynamic)
 #endif
   for (query_index = query_start; query_index < query_end; query_index++) {
-    query_fp = arena + (query_index * storage_size);
+    query_fp = query_arena + (query_index * query_storage_size);
     query_popcount = calc_popcount(fp_size, query_fp);
 
-    /* Special case when popcount(query) == 0; everything has a score of 0.0 */
-    if (query_popcount == 0) {
-      if (threshold == 0.0) {
-        /* Only populate the upper triangle */
-        target_index = MAX(query_index+1, target_start);
-        for (;target_index < target_end; target_index++) {
-          if (!chemfp_add_hit(results+query_index, target_index, 0.0)) {
+    /* Special case when popcount(query) == 0; every similarity is 0.0 */
+    if (query_popcount == 0 && !is_distance && !in_score_bounds(&bounds, 0.0)) {
+      continue;
+    }
+    if (target_popcount_indices == NULL) {
+      /* Handle the case when precomputed targets aren't available. */
+      /* This is a slower algorithm because it tests everything. */
+      target_fp = target_arena + (target_start * target_storage_size);
+      for (target_index = target_start; target_index < target_end;
+           target_index++, target_fp += target_storage_size) {
+        if (exclude_self && target_index == query_index) {
+          continue;
+        }
+        intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+        score = metric_score(metric, query_popcount, calc_target_popcount(fp_size, target_fp),
+                             intersect_popcount);
+        if (in_score_bounds(&bounds, score)) {
+          if (!chemfp_add_hit(results+(query_index-query_start), target_index,
+                              metric_value(metric, score))) {
             add_hit_error = 1;
           }
         }
       }
       continue;
     }
-    /* Figure out which fingerprints to search, based on the popcount */
-    if (threshold == 0.0) {
-      start_target_popcount = 0;
-      end_target_popcount = num_bits;
-    } else {
-      start_target_popcount = (int)(query_popcount * threshold);
-      end_target_popcount = (int)(ceil(query_popcount / threshold));
-      if (end_target_popcount > num_bits) {
-        end_target_popcount = num_bits;
-      }
-    }
 
-    for (target_popcount=start_target_popcount; target_popcount<=end_target_popcount;
+    /* Only search the popcounts which might have a high enough score */
+    metric_popcount_range(metric, query_popcount, num_bits, threshold,
+                          &start_target_popcount, &end_target_popcount);
+    for (target_popcount = start_target_popcount; target_popcount <= end_target_popcount;
          target_popcount++) {
-      start = popcount_indices[target_popcount];
-      end = popcount_indices[target_popcount+1];
+      start = target_popcount_indices[target_popcount];
+      end = target_popcount_indices[target_popcount+1];
       if (start < target_start) {
         start = target_start;
       }
@@ -887,16 +2313,17 @@ int RENAME(chemfp_threshold_tanimoto_arena_symmetric)(
         end = target_end;
       }
 
-      popcount_sum = query_popcount + target_popcount;
-      for (target_index = MAX(query_index+1, start); target_index < end; target_index++) {
-        target_fp = arena + (target_index * storage_size);
+      target_fp = target_arena + (start * target_storage_size);
+      for (target_index = start; target_index < end;
+           target_index++, target_fp += target_storage_size) {
+        if (exclude_self && target_index == query_index) {
+          continue;
+        }
         intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
-
-        if (denominator * intersect_popcount  >=
-            numerator * (popcount_sum - intersect_popcount)) {
-          /* Add to the upper triangle */
-          score = ((double) intersect_popcount) / (popcount_sum - intersect_popcount);
-          if (!chemfp_add_hit(results+query_index, target_index, score)) {
+        score = metric_score(metric, query_popcount, target_popcount, intersect_popcount);
+        if (in_score_bounds(&bounds, score)) {
+          if (!chemfp_add_hit(results+(query_index-query_start), target_index,
+                              metric_value(metric, score))) {
             add_hit_error = 1;
           }
         }
@@ -909,170 +2336,154 @@ int RENAME(chemfp_threshold_tanimoto_arena_symmetric)(
   return CHEMFP_OK;
 }
 
-/* I couldn't figure out a way to take advantage of symmetry */
-/* This is the same as the NxM algorithm except that it excludes self-matches */
-int RENAME(chemfp_knearest_tanimoto_arena_symmetric)(
-        /* Find the 'k' nearest items */
-        int k,
-        /* Within the given threshold */
-        double threshold,
-
-        /* Number of bits in the fingerprint */
+static int
+RENAME(knearest_metric_arena_core)(
+        int k, const chemfp_metric *metric, const chemfp_interval *interval,
         int num_bits,
-
-        /* Arena */
-        int storage_size, const unsigned char *arena,
-
-        /* start and end indices for the rows and columns */
+        int query_storage_size, const unsigned char *query_arena,
         int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
         int target_start, int target_end,
-        
-        /* Target popcount distribution information */
-        /*  (must have at least num_bits+1 elements) */
-        int *popcount_indices,
-
-        /* Results go into these arrays  */
-        chemfp_search_result *results
-                                   ) {
-
-  int fp_size;
+        int *target_popcount_indices,
+        int exclude_self,
+        chemfp_search_result *results) {
+  int fp_size = (num_bits+7) / 8;
   int query_popcount, target_popcount, intersect_popcount;
-  double score, best_possible_score, popcount_sum, query_threshold;
+  double score, best_possible_score, query_threshold;
   const unsigned char *query_fp, *target_fp;
   int query_index, target_index;
   int start, end;
   PopcountSearchOrder popcount_order;
   chemfp_search_result *result;
-  
-  chemfp_popcount_f calc_popcount;
+  int add_hit_error = 0;
+  int i, is_distance = chemfp_metric_is_distance(metric->type);
+  ScoreBounds bounds;
+
+  chemfp_popcount_f calc_popcount, calc_target_popcount;
   chemfp_intersect_popcount_f calc_intersect_popcount;
 
-  if (query_start >= query_end) {
-    return 0;
+  if (is_distance < 0) {
+    return CHEMFP_BAD_ARG;
   }
+  init_score_bounds(&bounds, metric, interval);
   /* k == 0 is a valid input, and of course the result is no matches */
-  if (k == 0) {
+  if ((query_start >= query_end) || (target_start >= target_end) || k == 0 ||
+      empty_score_bounds(&bounds)) {
     return CHEMFP_OK;
   }
-  fp_size = (num_bits+7)/8;
 
-
-  /* Choose popcounts optimized for this case */
-  calc_popcount = chemfp_select_popcount(num_bits, storage_size, arena);
+  calc_popcount = chemfp_select_popcount(num_bits, query_storage_size, query_arena);
+  calc_target_popcount = chemfp_select_popcount(num_bits, target_storage_size, target_arena);
   calc_intersect_popcount = chemfp_select_intersect_popcount(
-                num_bits, storage_size, arena, storage_size, arena);
+                num_bits, query_storage_size, query_arena,
+                target_storage_size, target_arena);
 
-  /* Loop through the query fingerprints */
 #if USE_OPENMP == 1
   #pragma omp parallel for \
-    private(result, query_fp, query_threshold, query_popcount, popcount_order,\
+    private(result, query_fp, query_threshold, query_popcount, popcount_order, \
           target_popcount, best_possible_score, start, end, target_fp, \
-          popcount_sum, target_index, intersect_popcount, score) \
+          target_index, intersect_popcount, score, i) \
       schedule(dynamic)
 #endif
-  for (query_index=query_start; query_index < query_end; query_index++) {
-    result = results+query_index;
-    query_fp = arena + query_index * storage_size;
+  for (query_index = query_start; query_index < query_end; query_index++) {
+    result = results+(query_index-query_start);
+    query_fp = query_arena + (query_index * query_storage_size);
 
-    query_threshold = threshold;
+    query_threshold = bounds.min_score;
     query_popcount = calc_popcount(fp_size, query_fp);
 
-    if (query_popcount == 0) {
-      /* By definition this will never return hits. Even if threshold == 0.0. */
-      /* (I considered returning the first k hits, but that's chemically meaningless.) */
-      /* XXX change this. Make it returns the first k hits */
+    if (query_popcount == 0 && !is_distance) {
+      /* As with the Tanimoto search, this will never return hits. */
       continue;
     }
 
-    /* Search the bins using the ordering from Swamidass and Baldi.*/
-    init_search_order(&popcount_order, query_popcount, num_bits);
-
-    /* Look through the sections of the arena in optimal popcount order */
-    while (next_popcount(&popcount_order, query_threshold)) {
-      target_popcount = popcount_order.popcount;
-      best_possible_score = popcount_order.score;
-
-      /* If we can't beat the query threshold then we're done with the targets */
-      if (best_possible_score < query_threshold) {
-        break;
-      }
-
-      /* Scan through the targets which have the given popcount */
-      start = popcount_indices[target_popcount];
-      end = popcount_indices[target_popcount+1];
-
-      if (!check_bounds(&popcount_order, &start, &end, target_start, target_end)) {
-        continue;
-      }
-
-      /* Iterate over the target fingerprints */
-      target_fp = arena + start*storage_size;
-      popcount_sum = (double)(query_popcount + target_popcount);
-
-      target_index = start;
-
-      /* There are fewer than 'k' elements in the heap*/
-      if (result->num_hits < k) {
-        for (; target_index<end; target_index++, target_fp += storage_size) {
-          intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
-          score = intersect_popcount / (popcount_sum - intersect_popcount);
-
-          /* The heap isn't full; only check if we're at or above the query threshold */
-          if (score >= query_threshold) {
-            if (query_index == target_index) {
-              continue; /* Don't match self */
+    if (target_popcount_indices == NULL) {
+      /* precomputed targets aren't available. Test everything. */
+      target_fp = target_arena + (target_start * target_storage_size);
+      for (target_index = target_start; target_index < target_end;
+           target_index++, target_fp += target_storage_size) {
+        if (exclude_self && target_index == query_index) {
+          continue;
+        }
+        intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+        score = metric_score(metric, query_popcount, calc_target_popcount(fp_size, target_fp),
+                             intersect_popcount);
+        if (result->num_hits < k) {
+          /* The heap isn't full; only check if we're inside the interval */
+          if (in_score_bounds(&bounds, score)) {
+            if (!chemfp_add_hit(result, target_index, score)) {
+              add_hit_error = 1;
+              break;
             }
-            chemfp_add_hit(result, target_index, score);
             if (result->num_hits == k) {
-              chemfp_heapq_heapify(k, result,  (chemfp_heapq_lt) double_score_lt,
+              chemfp_heapq_heapify(k, result, (chemfp_heapq_lt) double_score_lt,
                                    (chemfp_heapq_swap) double_score_swap);
-              query_threshold = result->scores[0];
-              /* We're going to jump to the "heap is full" section */
-              /* Since we leave the loop early, I need to advance the pointers */
-              target_index++;
-              target_fp += storage_size;
-              goto heap_replace;
+              query_threshold = chemfp_get_hit_score(result, 0);
             }
-          } /* Added to heap */
-        } /* Went through target fingerprints */
-
-        /* If we're here then the heap did not fill up. Try the next popcount */
-        continue;
+          }
+        } else if (score > query_threshold && below_max_score(&bounds, score)) {
+          /* We need to be strictly *better* than what's in the heap */
+          result->indices[0] = target_index;
+          chemfp_set_hit_score(result, 0, score);
+          chemfp_heapq_siftup(k, result, 0, (chemfp_heapq_lt) double_score_lt,
+                              (chemfp_heapq_swap) double_score_swap);
+          query_threshold = chemfp_get_hit_score(result, 0);
+        }
       }
+    } else {
+      /* Search the bins in order of decreasing best possible score */
+      init_metric_search_order(&popcount_order, query_popcount, num_bits, metric);
 
-    heap_replace:
-      /* We only get here if the heap contains k element */
-
-      /* Earlier we tested for "best_possible_score<query_threshold". */
-      /* The test to replace an element in the heap is more stringent. */
-      if (query_threshold >= best_possible_score) {
-        /* Can't do better. Might as well give up. */
-        break;
-      }
+      while (next_popcount(&popcount_order, query_threshold)) {
+        target_popcount = popcount_order.popcount;
+        best_possible_score = popcount_order.score;
 
-      /* Scan through the target fingerprints; can we improve over the threshold? */
-      for (; target_index<end; target_index++, target_fp += storage_size) {
+        /* A full heap can only be improved by a strictly better score */
+        if (result->num_hits == k && query_threshold >= best_possible_score) {
+          break;
+        }
 
-        intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
-        score = intersect_popcount / (popcount_sum - intersect_popcount);
+        /* Scan through the targets which have the given popcount */
+        start = target_popcount_indices[target_popcount];
+        end = target_popcount_indices[target_popcount+1];
+        if (!check_bounds(&popcount_order, &start, &end, target_start, target_end)) {
+          continue;
+        }
 
-        /* We need to be strictly *better* than what's in the heap */
-        if (score > query_threshold) {
-          if (query_index == target_index) {
-            continue; /* Don't match self */
+        target_fp = target_arena + (start * target_storage_size);
+        for (target_index = start; target_index < end;
+             target_index++, target_fp += target_storage_size) {
+          if (exclude_self && target_index == query_index) {
+            continue;
           }
-          result->indices[0] = target_index;
-          result->scores[0] = score;
-          chemfp_heapq_siftup(k, result, 0, (chemfp_heapq_lt) double_score_lt,
-                              (chemfp_heapq_swap) double_score_swap);
-          query_threshold = result->scores[0];
-          if (query_threshold >= best_possible_score) {
-            /* we can't do any better in this section (or in later ones) */
-            break;
+          intersect_popcount = calc_intersect_popcount(fp_size, query_fp, target_fp);
+          score = metric_score(metric, query_popcount, target_popcount, intersect_popcount);
+          if (result->num_hits < k) {
+            if (in_score_bounds(&bounds, score)) {
+              if (!chemfp_add_hit(result, target_index, score)) {
+                add_hit_error = 1;
+                break;
+              }
+              if (result->num_hits == k) {
+                chemfp_heapq_heapify(k, result, (chemfp_heapq_lt) double_score_lt,
+                                     (chemfp_heapq_swap) double_score_swap);
+                query_threshold = chemfp_get_hit_score(result, 0);
+              }
+            }
+          } else if (score > query_threshold && below_max_score(&bounds, score)) {
+            result->indices[0] = target_index;
+            chemfp_set_hit_score(result, 0, score);
+            chemfp_heapq_siftup(k, result, 0, (chemfp_heapq_lt) double_score_lt,
+                                (chemfp_heapq_swap) double_score_swap);
+            query_threshold = chemfp_get_hit_score(result, 0);
+            if (query_threshold >= best_possible_score) {
+              /* we can't do any better in this section (or in later ones) */
+              break;
+            }
           }
-        } /* heapreplaced the old smallest item with the new item */
-      } /* looped over fingerprints */
-    } /* Went through all the popcount regions */
+        } /* looped over fingerprints */
+      } /* Went through all the popcount regions */
+    }
 
     /* We have scanned all the fingerprints. Is the heap full? */
     if (result->num_hits < k) {
@@ -1080,6 +2491,116 @@ int RENAME(chemfp_knearest_tanimoto_arena_symmetric)(
       chemfp_heapq_heapify(result->num_hits, result, (chemfp_heapq_lt) double_score_lt,
                            (chemfp_heapq_swap) double_score_swap);
     }
+    /* Sort from best to worst, then convert to the metric values */
+    chemfp_heapq_heapsort(result->num_hits, result, (chemfp_heapq_lt) double_score_lt,
+                          (chemfp_heapq_swap) double_score_swap);
+    if (is_distance) {
+      for (i=0; i<result->num_hits; i++) {
+        chemfp_set_hit_score(result, i, metric_value(metric, chemfp_get_hit_score(result, i)));
+      }
+    }
   } /* looped over all queries */
+  if (add_hit_error) {
+    return CHEMFP_NO_MEM;
+  }
   return CHEMFP_OK;
 }
+
+int RENAME(chemfp_count_metric_arena)(
+        const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        int *result_counts) {
+  int query_index;
+  for (query_index = 0; query_index < (query_end-query_start); query_index++) {
+    result_counts[query_index] = 0;
+  }
+  return RENAME(count_metric_arena_core)(
+                metric, interval, num_bits,
+                query_storage_size, query_arena, query_start, query_end,
+                target_storage_size, target_arena, target_start, target_end,
+                target_popcount_indices, 0, result_counts);
+}
+
+int RENAME(chemfp_threshold_metric_arena)(
+        const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results) {
+  return RENAME(threshold_metric_arena_core)(
+                metric, interval, num_bits,
+                query_storage_size, query_arena, query_start, query_end,
+                target_storage_size, target_arena, target_start, target_end,
+                target_popcount_indices, 0, results);
+}
+
+int RENAME(chemfp_knearest_metric_arena)(
+        int k, const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results) {
+  return RENAME(knearest_metric_arena_core)(
+                k, metric, interval, num_bits,
+                query_storage_size, query_arena, query_start, query_end,
+                target_storage_size, target_arena, target_start, target_end,
+                target_popcount_indices, 0, results);
+}
+
+/* For the symmetric searches the result arrays are indexed by the arena row */
+
+int RENAME(chemfp_count_metric_arena_symmetric)(
+        const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int query_start, int query_end,
+        int target_start, int target_end,
+        int *popcount_indices,
+        int *result_counts) {
+  return RENAME(count_metric_arena_core)(
+                metric, interval, num_bits,
+                storage_size, arena, query_start, query_end,
+                storage_size, arena, target_start, target_end,
+                popcount_indices, 1, result_counts+query_start);
+}
+
+int RENAME(chemfp_threshold_metric_arena_symmetric)(
+        const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int query_start, int query_end,
+        int target_start, int target_end,
+        int *popcount_indices,
+        chemfp_search_result *results) {
+  return RENAME(threshold_metric_arena_core)(
+                metric, interval, num_bits,
+                storage_size, arena, query_start, query_end,
+                storage_size, arena, target_start, target_end,
+                popcount_indices, 1, results+query_start);
+}
+
+int RENAME(chemfp_knearest_metric_arena_symmetric)(
+        int k, const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int query_start, int query_end,
+        int target_start, int target_end,
+        int *popcount_indices,
+        chemfp_search_result *results) {
+  return RENAME(knearest_metric_arena_core)(
+                k, metric, interval, num_bits,
+                storage_size, arena, query_start, query_end,
+                storage_size, arena, target_start, target_end,
+                popcount_indices, 1, results+query_start);
+}
@@ -28,8 +28,152 @@ typedef struct {
   int up_popcount;
   int down_popcount;
   double score;
+  /* Scores the popcounts; the Tanimoto unless this is a metric search */
+  chemfp_metric metric;
 } PopcountSearchOrder;
 
+/* The Tversky similarity is c / (alpha*(a-c) + beta*(b-c) + c) where a is
+   the query popcount, b the target popcount, and c the intersection
+   popcount. As with the Tanimoto, define 0/0 = 0.0. */
+static double tversky_score(int query_popcount, int target_popcount,
+                            int intersect_popcount, double alpha, double beta) {
+  double denominator = (alpha * (query_popcount - intersect_popcount) +
+                        beta * (target_popcount - intersect_popcount) +
+                        intersect_popcount);
+  if (denominator == 0.0) {
+    return 0.0;
+  }
+  return intersect_popcount / denominator;
+}
+
+/**** Metrics ****/
+
+typedef struct {
+  const char *name;
+  int is_distance;
+} chemfp_metric_info;
+
+static const chemfp_metric_info chemfp_metrics[] = {
+  {"tanimoto", 0},
+  {"tversky", 0},
+  {"dice", 0},
+  {"cosine", 0},
+  {"hamming", 1},
+  {"euclidean", 1},
+};
+
+int
+chemfp_get_num_metrics(void) {
+  return sizeof(chemfp_metrics) / sizeof(chemfp_metric_info);
+}
+
+const char *
+chemfp_get_metric_name(int metric_type) {
+  if (metric_type < 0 || metric_type >= chemfp_get_num_metrics()) {
+    return NULL;
+  }
+  return chemfp_metrics[metric_type].name;
+}
+
+int
+chemfp_metric_is_distance(int metric_type) {
+  if (metric_type < 0 || metric_type >= chemfp_get_num_metrics()) {
+    return -1;
+  }
+  return chemfp_metrics[metric_type].is_distance;
+}
+
+/* The search kernels treat every metric as a similarity, where larger
+   is better. A distance d is scored as -d and a maximum distance D
+   becomes a threshold of -D. The hits are stored as distances. */
+
+static double metric_score(const chemfp_metric *metric, int query_popcount,
+                           int target_popcount, int intersect_popcount) {
+  int denominator;
+  switch (metric->type) {
+  case CHEMFP_METRIC_TANIMOTO:
+    denominator = query_popcount + target_popcount - intersect_popcount;
+    if (denominator == 0) {
+      return 0.0;
+    }
+    return ((double) intersect_popcount) / denominator;
+  case CHEMFP_METRIC_TVERSKY:
+    return tversky_score(query_popcount, target_popcount, intersect_popcount,
+                         metric->alpha, metric->beta);
+  case CHEMFP_METRIC_DICE:
+    denominator = query_popcount + target_popcount;
+    if (denominator == 0) {
+      return 0.0;
+    }
+    return (2.0 * intersect_popcount) / denominator;
+  case CHEMFP_METRIC_COSINE:
+    if (query_popcount == 0 || target_popcount == 0) {
+      return 0.0;
+    }
+    return intersect_popcount / sqrt(((double) query_popcount) * target_popcount);
+  case CHEMFP_METRIC_HAMMING:
+    return -(double)(query_popcount + target_popcount - 2*intersect_popcount);
+  case CHEMFP_METRIC_EUCLIDEAN:
+    return -sqrt((double)(query_popcount + target_popcount - 2*intersect_popcount));
+  }
+  return 0.0;
+}
+
+/* Convert the kernel's score back to the metric's own value */
+static double metric_value(const chemfp_metric *metric, double score) {
+  return chemfp_metrics[metric->type].is_distance ? -score : score;
+}
+
+/* The interval of hits, using the kernel's scores. A distance
+   interval of [min, max] becomes [-max, -min]. */
+typedef struct {
+  double min_score;
+  double max_score;
+  int include_min;
+  int include_max;
+} ScoreBounds;
+
+static void init_score_bounds(ScoreBounds *bounds, const chemfp_metric *metric,
+                              const chemfp_interval *interval) {
+  if (chemfp_metrics[metric->type].is_distance) {
+    bounds->min_score = -interval->max_score;
+    bounds->max_score = -interval->min_score;
+    bounds->include_min = interval->include_max;
+    bounds->include_max = interval->include_min;
+  } else {
+    bounds->min_score = interval->min_score;
+    bounds->max_score = interval->max_score;
+    bounds->include_min = interval->include_min;
+    bounds->include_max = interval->include_max;
+  }
+}
+
+static int above_min_score(const ScoreBounds *bounds, double score) {
+  return (score > bounds->min_score) || (bounds->include_min && score == bounds->min_score);
+}
+
+static int below_max_score(const ScoreBounds *bounds, double score) {
+  return (score < bounds->max_score) || (bounds->include_max && score == bounds->max_score);
+}
+
+static int in_score_bounds(const ScoreBounds *bounds, double score) {
+  return above_min_score(bounds, score) && below_max_score(bounds, score);
+}
+
+static int empty_score_bounds(const ScoreBounds *bounds) {
+  if (bounds->min_score == bounds->max_score) {
+    return !(bounds->include_min && bounds->include_max);
+  }
+  return bounds->min_score > bounds->max_score;
+}
+
+/* The usual search threshold, in the metric's units. The popcount
+   ranges only depend on this end of the interval. */
+static double interval_threshold(const chemfp_metric *metric,
+                                 const chemfp_interval *interval) {
+  return chemfp_metrics[metric->type].is_distance ? interval->max_score : interval->min_score;
+}
+
 static void init_search_order(PopcountSearchOrder *popcount_order, int query_popcount,
                               int max_popcount) {
   popcount_order->query_popcount = query_popcount;
@@ -43,6 +187,113 @@ static void init_search_order(PopcountSearchOrder *popcount_order, int query_pop
     popcount_order->down_popcount = query_popcount-1;
   }
   popcount_order->up_popcount = query_popcount;
+  popcount_order->metric.type = CHEMFP_METRIC_TANIMOTO;
+  popcount_order->metric.alpha = 1.0;
+  popcount_order->metric.beta = 1.0;
+}
+
+/* For every metric, the best possible score for a given target popcount
+   is when the intersection popcount is min(query_popcount, target_popcount).
+   This is largest when the popcounts are the same and decreases in
+   both directions, so the same search order works. The Tanimoto order
+   skips the empty targets of a 1-bit query, since they score 0, but
+   they are only 1 away for a distance, so search them too. */
+static void init_metric_search_order(PopcountSearchOrder *popcount_order, int query_popcount,
+                                     int max_popcount, const chemfp_metric *metric) {
+  init_search_order(popcount_order, query_popcount, max_popcount);
+  popcount_order->metric = *metric;
+  if (query_popcount >= 1 && chemfp_metrics[metric->type].is_distance) {
+    popcount_order->direction = UP_OR_DOWN;
+    popcount_order->down_popcount = query_popcount-1;
+  }
+}
+
+/* Find the range of target popcounts which might have a Tversky score of
+   at least 'threshold'. This generalizes the Swamidass and Baldi limits.
+   For target_popcount <= query_popcount the best score is
+     target_popcount / (alpha*(query_popcount-target_popcount) + target_popcount)
+   and for target_popcount >= query_popcount it is
+     query_popcount / (beta*(target_popcount-query_popcount) + query_popcount)
+   Solve each for the target_popcount, rounding outwards. */
+static void tversky_popcount_range(int query_popcount, int num_bits,
+                                   double alpha, double beta, double threshold,
+                                   int *start_target_popcount, int *end_target_popcount) {
+  double limit;
+  if (threshold <= 0.0) {
+    *start_target_popcount = 0;
+    *end_target_popcount = num_bits;
+    return;
+  }
+  if (alpha == 0.0) {
+    *start_target_popcount = 0;
+  } else {
+    *start_target_popcount = (int)(threshold * alpha * query_popcount /
+                                   (1.0 - threshold + threshold * alpha));
+  }
+  if (beta == 0.0) {
+    *end_target_popcount = num_bits;
+  } else {
+    /* Compare as a double to prevent overflow with very small thresholds */
+    limit = query_popcount * (1.0 - threshold + threshold * beta) / (threshold * beta);
+    if (limit >= num_bits) {
+      *end_target_popcount = num_bits;
+    } else {
+      *end_target_popcount = (int)(ceil(limit));
+    }
+  }
+}
+
+/* The cosine score is at most sqrt(target_popcount/query_popcount) for the
+   smaller target popcounts and sqrt(query_popcount/target_popcount) for
+   the larger ones. A distance is at least |query_popcount-target_popcount|
+   for Hamming, and the square root of that for Euclidean. */
+static void metric_popcount_range(const chemfp_metric *metric, int query_popcount,
+                                  int num_bits, double threshold,
+                                  int *start_target_popcount, int *end_target_popcount) {
+  double limit;
+  int width;
+  switch (metric->type) {
+  case CHEMFP_METRIC_TANIMOTO:
+    tversky_popcount_range(query_popcount, num_bits, 1.0, 1.0, threshold,
+                           start_target_popcount, end_target_popcount);
+    return;
+  case CHEMFP_METRIC_TVERSKY:
+    tversky_popcount_range(query_popcount, num_bits, metric->alpha, metric->beta, threshold,
+                           start_target_popcount, end_target_popcount);
+    return;
+  case CHEMFP_METRIC_DICE:
+    tversky_popcount_range(query_popcount, num_bits, 0.5, 0.5, threshold,
+                           start_target_popcount, end_target_popcount);
+    return;
+  case CHEMFP_METRIC_COSINE:
+    if (threshold <= 0.0) {
+      break;
+    }
+    /* Widen by one on each side to allow for rounding in the square root */
+    *start_target_popcount = (int)(threshold * threshold * query_popcount) - 1;
+    if (*start_target_popcount < 0) {
+      *start_target_popcount = 0;
+    }
+    limit = query_popcount / (threshold * threshold) + 1.0;
+    if (limit >= num_bits) {
+      *end_target_popcount = num_bits;
+    } else {
+      *end_target_popcount = (int)(ceil(limit));
+    }
+    return;
+  case CHEMFP_METRIC_HAMMING:
+  case CHEMFP_METRIC_EUCLIDEAN:
+    limit = (metric->type == CHEMFP_METRIC_HAMMING) ? threshold : (threshold * threshold + 1.0);
+    if (limit >= num_bits) {
+      break;
+    }
+    width = (int) limit;
+    *start_target_popcount = (query_popcount > width) ? (query_popcount - width) : 0;
+    *end_target_popcount = (query_popcount + width < num_bits) ? (query_popcount + width) : num_bits;
+    return;
+  }
+  *start_target_popcount = 0;
+  *end_target_popcount = num_bits;
 }
 
 static void ordering_no_higher(PopcountSearchOrder *popcount_order) {
@@ -71,8 +322,12 @@ static void ordering_no_lower(PopcountSearchOrder *popcount_order) {
 }
 
 
-#define UP_SCORE(po) (((double)(po->query_popcount))/po->up_popcount)
-#define DOWN_SCORE(po) (((double)(po->down_popcount))/po->query_popcount)
+/* For the Tanimoto these are query_popcount/up_popcount and */
+/* down_popcount/query_popcount, which are the Swamidass and Baldi limits */
+#define UP_SCORE(po) metric_score(&po->metric, po->query_popcount, po->up_popcount, \
+                                  po->query_popcount)
+#define DOWN_SCORE(po) metric_score(&po->metric, po->query_popcount, po->down_popcount, \
+                                    po->down_popcount)
 
 static int next_popcount(PopcountSearchOrder *popcount_order, double threshold) {
   double up_score, down_score;
@@ -152,20 +407,22 @@ check_bounds(PopcountSearchOrder *popcount_order,
 /**** Support for the k-nearest code ****/
 
 static int double_score_lt(chemfp_search_result *result, int i, int j) {
-  if (result->scores[i] < result->scores[j])
+  double score_i = chemfp_get_hit_score(result, i);
+  double score_j = chemfp_get_hit_score(result, j);
+  if (score_i < score_j)
     return 1;
-  if (result->scores[i] > result->scores[j])
+  if (score_i > score_j)
     return 0;
   /* Sort in descending order by index. (XXX important or overkill?) */
   return (result->indices[i] >= result->indices[j]);
 }
 static void double_score_swap(chemfp_search_result *result, int i, int j) {
   int tmp_index = result->indices[i];
-  double tmp_score = result->scores[i];
+  double tmp_score = chemfp_get_hit_score(result, i);
   result->indices[i] = result->indices[j];
-  result->scores[i] = result->scores[j];
+  chemfp_set_hit_score(result, i, chemfp_get_hit_score(result, j));
   result->indices[j] = tmp_index;
-  result->scores[j] = tmp_score;
+  chemfp_set_hit_score(result, j, tmp_score);
 }
 
 
@@ -181,8 +438,234 @@ void chemfp_knearest_results_finalize(chemfp_search_result *results_start,
 
 
 #define MAX(x, y) ((x) > (y) ? (x) : (y))
+#define MIN(x, y) ((x) < (y) ? (x) : (y))
+
+/* Get the threshold for the query at 'query_offset' from query_start */
+static double tanimoto_query_threshold(double threshold, const double *thresholds,
+                                       int query_offset, int num_bits) {
+  if (thresholds != NULL) {
+    threshold = thresholds[query_offset];
+  }
+  /* Prevent overflow if someone uses a threshold of, say, 1E-80 */
+  /* (Not really needed unless you trap IEEE 754 overflow errors) */
+  if (threshold > 0.0 && threshold < 1.0/num_bits) {
+    threshold = 0.5 / num_bits;
+  }
+  return threshold;
+}
+
+
+/**** Support for the tiled Tanimoto arena searches ****/
+
+/* The arena searches normally go through the queries one at a time,
+   and each query reads all of the targets in its popcount window.
+   When the target arena is larger than the CPU cache, every query
+   has to read its targets from main memory. A tiled search instead
+   sorts the queries by their target window, so queries with similar
+   popcounts are next to each other, and splits the sorted queries
+   into blocks. Each block goes through its targets one tile at a
+   time, where a tile is "tile-size" bytes of target fingerprints, and
+   every query in the block is compared to the tile while it is in
+   the cache. A tile-size of 0 disables tiling. */
+
+#define TILE_QUERY_BLOCK_SIZE 64
+
+static int chemfp_tile_size = 256*1024;
+
+int chemfp_get_option_tile_size(void) {
+  return chemfp_tile_size;
+}
+int chemfp_set_option_tile_size(int value) {
+  if (value < 0) {
+    return CHEMFP_BAD_ARG;
+  }
+  chemfp_tile_size = value;
+  return CHEMFP_OK;
+}
+
+/* Only use tiles if there are enough queries to share them and */
+/* there are more targets than fit into one tile */
+static int use_tiles(int num_queries, int num_targets, int target_storage_size) {
+  return (chemfp_tile_size > 0 &&
+          num_queries >= 2 &&
+          ((double) num_targets) * target_storage_size > chemfp_tile_size);
+}
+
+typedef struct {
+  int query_index;  /* Offset from query_start */
+  const unsigned char *query_fp;
+  int popcount;
+  double threshold;
+  int numerator;
+  /* The popcount and target index ranges to search */
+  int start_popcount, end_popcount;
+  int start, end;
+} TileQuery;
+
+static int compare_tile_queries(const void *a, const void *b) {
+  const TileQuery *x = a, *y = b;
+  if (x->start != y->start) {
+    return (x->start < y->start) ? -1 : 1;
+  }
+  if (x->end != y->end) {
+    return (x->end < y->end) ? -1 : 1;
+  }
+  return x->query_index - y->query_index;
+}
+
+
+/**** Support for the folded-fingerprint prefilter ****/
+
+/* Folding ORs the bits at the same position in every folded_size */
+/* bytes of the fingerprint. Two bits set at the same folded position */
+/* become one bit, so the folded intersection can be smaller than the */
+/* real intersection, as well as larger. However, at most */
+/* popcount(fp) - popcount(folded fp) of the bits in the intersection */
+/* can be lost that way, for both the query and the target. */
+
+static int bad_folded_num_bits(int num_bits, int folded_num_bits) {
+  return (folded_num_bits < 64 || folded_num_bits > 1024 ||
+          folded_num_bits % 64 != 0 || folded_num_bits >= num_bits);
+}
+
+static void fold_fingerprint(int fp_size, const unsigned char *fp,
+                             int folded_size, unsigned char *folded_fp) {
+  int i;
+  memset(folded_fp, 0, folded_size);
+  for (i=0; i<fp_size; i++) {
+    folded_fp[i % folded_size] |= fp[i];
+  }
+}
+
+static void fold_fingerprints(int fp_size, int storage_size, const unsigned char *arena,
+                              int num_fingerprints, int folded_size,
+                              unsigned char *folded_arena, int *lost_bits) {
+  int i;
+  for (i=0; i<num_fingerprints; i++, arena += storage_size, folded_arena += folded_size) {
+    fold_fingerprint(fp_size, arena, folded_size, folded_arena);
+    lost_bits[i] = (chemfp_byte_popcount(fp_size, arena) -
+                    chemfp_byte_popcount(folded_size, folded_arena));
+  }
+}
+
+/* The upper bound on the intersection popcount of the query and target */
+static int folded_intersect_bound(int folded_intersect_popcount,
+                                  int query_lost_bits, int target_lost_bits,
+                                  int query_popcount, int target_popcount) {
+  int bound = folded_intersect_popcount + MIN(query_lost_bits, target_lost_bits);
+  return MIN(bound, MIN(query_popcount, target_popcount));
+}
+
+
+/**** Support for the symmetric searches ****/
+
+/* The symmetric searches go through all of the rows in one parallel
+   region. The rows are split into tiles with about the same amount of
+   work, which the threads take in order. In the upper triangle the
+   early rows have more targets than the later rows, so the tiles near
+   the start have fewer rows. There are SYMMETRIC_TILES_PER_THREAD
+   tiles per thread so the threads finish at about the same time. */
+
+#define SYMMETRIC_TILES_PER_THREAD 16
+
+/* The number of targets which row query_index compares against */
+static long long symmetric_row_work(int query_index, int target_start, int target_end,
+                                    int upper_triangle) {
+  if (upper_triangle) {
+    target_start = MAX(query_index+1, target_start);
+  }
+  /* Count every row as at least one unit of work */
+  return MAX(target_end - target_start, 0) + 1;
+}
+
+/* Return a malloc'ed array with the (*num_tiles)+1 tile boundaries, */
+/* or NULL if there is no memory. */
+static int *make_symmetric_tiles(int query_start, int query_end,
+                                 int target_start, int target_end,
+                                 int upper_triangle, int *num_tiles) {
+  int query_index, tile, max_tiles;
+  long long total_work = 0, work = 0;
+  int *tiles;
+
+  max_tiles = MIN(query_end - query_start,
+                  chemfp_get_num_threads() * SYMMETRIC_TILES_PER_THREAD);
+  max_tiles = MAX(max_tiles, 1);
+  tiles = (int *) malloc((max_tiles+1) * sizeof(int));
+  if (!tiles) {
+    return NULL;
+  }
+  for (query_index = query_start; query_index < query_end; query_index++) {
+    total_work += symmetric_row_work(query_index, target_start, target_end, upper_triangle);
+  }
+
+  /* Tile t ends at the first row where the total work is at least */
+  /* (t+1)/max_tiles of the work */
+  tiles[0] = query_start;
+  tile = 0;
+  for (query_index = query_start; query_index < query_end; query_index++) {
+    work += symmetric_row_work(query_index, target_start, target_end, upper_triangle);
+    if (work * max_tiles >= (tile+1) * total_work) {
+      tiles[++tile] = query_index+1;
+      if (tile == max_tiles) {
+        break;
+      }
+    }
+  }
+  tiles[tile] = query_end;
+  *num_tiles = tile;
+  return tiles;
+}
+
+/* Only the thread which started the search calls check_interrupt(), */
+/* since for Python it has to get the GIL and check for signals. The */
+/* other threads see the 'interrupted' flag. The check happens after */
+/* about INTERRUPT_CHECK_WORK target comparisons by that thread. */
+
+#define INTERRUPT_CHECK_WORK (1<<22)
+
+typedef struct {
+  chemfp_check_interrupt_f check_interrupt;
+  void *interrupt_data;
+  long long work;
+  volatile int interrupted;
+} InterruptState;
+
+static void init_interrupt_state(InterruptState *state,
+                                 chemfp_check_interrupt_f check_interrupt,
+                                 void *interrupt_data) {
+  state->check_interrupt = check_interrupt;
+  state->interrupt_data = interrupt_data;
+  state->work = 0;
+  state->interrupted = 0;
+}
+
+static int is_calling_thread(void) {
+#if defined(_OPENMP)
+  return omp_get_thread_num() == 0;
+#else
+  return 1;
+#endif
+}
+
+/* Call this before each row, with the amount of work for the row */
+static int symmetric_interrupted(InterruptState *state, long long work) {
+  if (state->interrupted) {
+    return 1;
+  }
+  if (state->check_interrupt == NULL || !is_calling_thread()) {
+    return 0;
+  }
+  state->work += work;
+  if (state->work >= INTERRUPT_CHECK_WORK) {
+    state->work = 0;
+    if (state->check_interrupt(state->interrupt_data)) {
+      state->interrupted = 1;
+    }
+  }
+  return state->interrupted;
+}
+
 
-                             
 /***** Define the main interface code ***/
 
 #if defined(_OPENMP)
@@ -313,6 +796,157 @@ int chemfp_knearest_tanimoto_arena(
   }
 }
 
+/* Per-query thresholds and k */
+
+int chemfp_count_tanimoto_arena_per_query(
+        const double *thresholds,
+        int num_bits,
+        int query_storage_size,
+        const unsigned char *query_arena, int query_start, int query_end,
+        int target_storage_size,
+        const unsigned char *target_arena, int target_start, int target_end,
+        int *target_popcount_indices,
+        int *result_counts) {
+  if (chemfp_get_num_threads() <= 1) {
+    return chemfp_count_tanimoto_arena_per_query_single(
+                           thresholds, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, result_counts);
+  } else {
+    return chemfp_count_tanimoto_arena_per_query_openmp(
+                           thresholds, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, result_counts);
+  }
+}
+
+int chemfp_threshold_tanimoto_arena_per_query(
+        const double *thresholds,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results) {
+  if (chemfp_get_num_threads() <= 1) {
+    return chemfp_threshold_tanimoto_arena_per_query_single(
+                           thresholds, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, results);
+  } else {
+    return chemfp_threshold_tanimoto_arena_per_query_openmp(
+                           thresholds, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, results);
+  }
+}
+
+int chemfp_knearest_tanimoto_arena_per_query(
+        const int *ks, const double *thresholds,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results) {
+  if (chemfp_get_num_threads() <= 1) {
+    return chemfp_knearest_tanimoto_arena_per_query_single(
+                           ks, thresholds, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, results);
+  } else {
+    return chemfp_knearest_tanimoto_arena_per_query_openmp(
+                           ks, thresholds, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, results);
+  }
+}
+
+/* Folded-fingerprint prefilter searches */
+
+int chemfp_count_tanimoto_arena_folded(
+        double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_folded_arena *folded,
+        int *result_counts) {
+  if (chemfp_get_num_threads() <= 1) {
+    return chemfp_count_tanimoto_arena_folded_single(
+                           threshold, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, folded, result_counts);
+  } else {
+    return chemfp_count_tanimoto_arena_folded_openmp(
+                           threshold, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, folded, result_counts);
+  }
+}
+
+int chemfp_threshold_tanimoto_arena_folded(
+        double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_folded_arena *folded,
+        chemfp_search_result *results) {
+  if (chemfp_get_num_threads() <= 1) {
+    return chemfp_threshold_tanimoto_arena_folded_single(
+                           threshold, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, folded, results);
+  } else {
+    return chemfp_threshold_tanimoto_arena_folded_openmp(
+                           threshold, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, folded, results);
+  }
+}
+
+int chemfp_knearest_tanimoto_arena_folded(
+        int k, double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_folded_arena *folded,
+        chemfp_search_result *results) {
+  if (chemfp_get_num_threads() <= 1) {
+    return chemfp_knearest_tanimoto_arena_folded_single(
+                           k, threshold, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, folded, results);
+  } else {
+    return chemfp_knearest_tanimoto_arena_folded_openmp(
+                           k, threshold, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, folded, results);
+  }
+}
+
 int chemfp_count_tanimoto_hits_arena_symmetric(
         /* Count all matches within the given threshold */
         double threshold,
@@ -333,18 +967,23 @@ int chemfp_count_tanimoto_hits_arena_symmetric(
         int *popcount_indices,
 
         /* Results _increment_ existing values in the array - remember to initialize! */
-        int *result_counts
+        int *result_counts,
+
+        /* Called to check if the search should stop (may be NULL) */
+        chemfp_check_interrupt_f check_interrupt, void *interrupt_data
                                                ) {
   if (chemfp_get_num_threads() <= 1) {
     return chemfp_count_tanimoto_hits_arena_symmetric_single(
                            threshold, num_bits, storage_size, arena,
                            query_start, query_end, target_start, target_end,
-                           popcount_indices, result_counts);
+                           popcount_indices, result_counts,
+                           check_interrupt, interrupt_data);
   } else {
     return chemfp_count_tanimoto_hits_arena_symmetric_openmp(
                            threshold, num_bits, storage_size, arena,
                            query_start, query_end, target_start, target_end,
-                           popcount_indices, result_counts);
+                           popcount_indices, result_counts,
+                           check_interrupt, interrupt_data);
   }
 }
 
@@ -368,17 +1007,47 @@ int chemfp_threshold_tanimoto_arena_symmetric(
 
         /* Results go here */
         /* NOTE: This must have enough space for all of the fingerprints! */
-        chemfp_search_result *results) {
+        chemfp_search_result *results,
+
+        /* Called to check if the search should stop (may be NULL) */
+        chemfp_check_interrupt_f check_interrupt, void *interrupt_data) {
   if (chemfp_get_num_threads() <= 1) {
     return chemfp_threshold_tanimoto_arena_symmetric_single(
                            threshold, num_bits, storage_size, arena,
                            query_start, query_end, target_start, target_end,
-                           popcount_indices, results);
+                           popcount_indices, results,
+                           check_interrupt, interrupt_data);
   } else {
     return chemfp_threshold_tanimoto_arena_symmetric_openmp(
                            threshold, num_bits, storage_size, arena,
                            query_start, query_end, target_start, target_end,
-                           popcount_indices, results);
+                           popcount_indices, results,
+                           check_interrupt, interrupt_data);
+  }
+}
+
+int chemfp_threshold_tanimoto_arena_symmetric_csr(
+        double threshold,
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int num_fingerprints, int query_start, int query_end,
+        int *popcount_indices,
+        const long long *indptr,
+        int *upper_counts,
+        int *indices, float *scores,
+        chemfp_check_interrupt_f check_interrupt, void *interrupt_data) {
+  if (chemfp_get_num_threads() <= 1) {
+    return chemfp_threshold_tanimoto_arena_symmetric_csr_single(
+                           threshold, num_bits, storage_size, arena,
+                           num_fingerprints, query_start, query_end,
+                           popcount_indices, indptr, upper_counts, indices, scores,
+                           check_interrupt, interrupt_data);
+  } else {
+    return chemfp_threshold_tanimoto_arena_symmetric_csr_openmp(
+                           threshold, num_bits, storage_size, arena,
+                           num_fingerprints, query_start, query_end,
+                           popcount_indices, indptr, upper_counts, indices, scores,
+                           check_interrupt, interrupt_data);
   }
 }
 
@@ -403,21 +1072,164 @@ int chemfp_knearest_tanimoto_arena_symmetric(
         int *popcount_indices,
 
         /* Results go into these arrays  */
-        chemfp_search_result *results) {
+        chemfp_search_result *results,
+
+        /* Called to check if the search should stop (may be NULL) */
+        chemfp_check_interrupt_f check_interrupt, void *interrupt_data) {
   if (chemfp_get_num_threads() <= 1) {
     return chemfp_knearest_tanimoto_arena_symmetric_single(
                            k, threshold, num_bits, storage_size, arena,
                            query_start, query_end, target_start, target_end,
-                           popcount_indices, results);
+                           popcount_indices, results,
+                           check_interrupt, interrupt_data);
   } else {
     return chemfp_knearest_tanimoto_arena_symmetric_openmp(
                            k, threshold, num_bits, storage_size, arena,
                            query_start, query_end, target_start, target_end,
-                           popcount_indices, results);
+                           popcount_indices, results,
+                           check_interrupt, interrupt_data);
   }
 }  
   
 
+
+/* Metric searches */
+
+int chemfp_count_metric_arena(
+        const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        int *result_counts) {
+  if (chemfp_get_num_threads() <= 1) {
+    return chemfp_count_metric_arena_single(
+                           metric, interval, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, result_counts);
+  } else {
+    return chemfp_count_metric_arena_openmp(
+                           metric, interval, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, result_counts);
+  }
+}
+
+int chemfp_threshold_metric_arena(
+        const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results) {
+  if (chemfp_get_num_threads() <= 1) {
+    return chemfp_threshold_metric_arena_single(
+                           metric, interval, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, results);
+  } else {
+    return chemfp_threshold_metric_arena_openmp(
+                           metric, interval, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, results);
+  }
+}
+
+int chemfp_knearest_metric_arena(
+        int k, const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results) {
+  if (chemfp_get_num_threads() <= 1) {
+    return chemfp_knearest_metric_arena_single(
+                           k, metric, interval, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, results);
+  } else {
+    return chemfp_knearest_metric_arena_openmp(
+                           k, metric, interval, num_bits,
+                           query_storage_size, query_arena, query_start, query_end,
+                           target_storage_size, target_arena, target_start, target_end,
+                           target_popcount_indices, results);
+  }
+}
+
+int chemfp_count_metric_arena_symmetric(
+        const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int query_start, int query_end,
+        int target_start, int target_end,
+        int *popcount_indices,
+        int *result_counts) {
+  if (chemfp_get_num_threads() <= 1) {
+    return chemfp_count_metric_arena_symmetric_single(
+                           metric, interval, num_bits, storage_size, arena,
+                           query_start, query_end, target_start, target_end,
+                           popcount_indices, result_counts);
+  } else {
+    return chemfp_count_metric_arena_symmetric_openmp(
+                           metric, interval, num_bits, storage_size, arena,
+                           query_start, query_end, target_start, target_end,
+                           popcount_indices, result_counts);
+  }
+}
+
+int chemfp_threshold_metric_arena_symmetric(
+        const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int query_start, int query_end,
+        int target_start, int target_end,
+        int *popcount_indices,
+        chemfp_search_result *results) {
+  if (chemfp_get_num_threads() <= 1) {
+    return chemfp_threshold_metric_arena_symmetric_single(
+                           metric, interval, num_bits, storage_size, arena,
+                           query_start, query_end, target_start, target_end,
+                           popcount_indices, results);
+  } else {
+    return chemfp_threshold_metric_arena_symmetric_openmp(
+                           metric, interval, num_bits, storage_size, arena,
+                           query_start, query_end, target_start, target_end,
+                           popcount_indices, results);
+  }
+}
+
+int chemfp_knearest_metric_arena_symmetric(
+        int k, const chemfp_metric *metric, const chemfp_interval *interval,
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int query_start, int query_end,
+        int target_start, int target_end,
+        int *popcount_indices,
+        chemfp_search_result *results) {
+  if (chemfp_get_num_threads() <= 1) {
+    return chemfp_knearest_metric_arena_symmetric_single(
+                           k, metric, interval, num_bits, storage_size, arena,
+                           query_start, query_end, target_start, target_end,
+                           popcount_indices, results);
+  } else {
+    return chemfp_knearest_metric_arena_symmetric_openmp(
+                           k, metric, interval, num_bits, storage_size, arena,
+                           query_start, query_end, target_start, target_end,
+                           popcount_indices, results);
+  }
+}
+
 #else
 
 /* Not compiling for OpenMP; don't need the run-time switch */
@@ -431,3 +1243,138 @@ int chemfp_knearest_tanimoto_arena_symmetric(
 
 #endif
 
+
+
+/***** Folded-fingerprint prefilter *****/
+
+int chemfp_fold_arena(int num_bits, int storage_size, const unsigned char *arena,
+                      int start, int end,
+                      int folded_num_bits, unsigned char *folded_arena, int *lost_bits) {
+  if (bad_folded_num_bits(num_bits, folded_num_bits)) {
+    return CHEMFP_BAD_ARG;
+  }
+  if (start < end) {
+    fold_fingerprints((num_bits+7) / 8, storage_size, arena + start*storage_size,
+                      end - start, folded_num_bits / 8, folded_arena, lost_bits);
+  }
+  return CHEMFP_OK;
+}
+
+
+/***** Tversky searches *****/
+
+/* These are the metric searches with a Tversky metric, and with no */
+/* upper limit on the score */
+
+static void init_tversky_search(chemfp_metric *metric, chemfp_interval *interval,
+                                double alpha, double beta, double threshold) {
+  metric->type = CHEMFP_METRIC_TVERSKY;
+  metric->alpha = alpha;
+  metric->beta = beta;
+  interval->min_score = threshold;
+  interval->max_score = HUGE_VAL;
+  interval->include_min = 1;
+  interval->include_max = 1;
+}
+
+int chemfp_count_tversky_arena(
+        double alpha, double beta, double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        int *result_counts) {
+  chemfp_metric metric;
+  chemfp_interval interval;
+  init_tversky_search(&metric, &interval, alpha, beta, threshold);
+  return chemfp_count_metric_arena(&metric, &interval, num_bits,
+                                   query_storage_size, query_arena, query_start, query_end,
+                                   target_storage_size, target_arena, target_start, target_end,
+                                   target_popcount_indices, result_counts);
+}
+
+int chemfp_threshold_tversky_arena(
+        double alpha, double beta, double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results) {
+  chemfp_metric metric;
+  chemfp_interval interval;
+  init_tversky_search(&metric, &interval, alpha, beta, threshold);
+  return chemfp_threshold_metric_arena(&metric, &interval, num_bits,
+                                       query_storage_size, query_arena, query_start, query_end,
+                                       target_storage_size, target_arena, target_start, target_end,
+                                       target_popcount_indices, results);
+}
+
+int chemfp_knearest_tversky_arena(
+        int k, double alpha, double beta, double threshold,
+        int num_bits,
+        int query_storage_size, const unsigned char *query_arena,
+        int query_start, int query_end,
+        int target_storage_size, const unsigned char *target_arena,
+        int target_start, int target_end,
+        int *target_popcount_indices,
+        chemfp_search_result *results) {
+  chemfp_metric metric;
+  chemfp_interval interval;
+  init_tversky_search(&metric, &interval, alpha, beta, threshold);
+  return chemfp_knearest_metric_arena(k, &metric, &interval, num_bits,
+                                      query_storage_size, query_arena, query_start, query_end,
+                                      target_storage_size, target_arena, target_start, target_end,
+                                      target_popcount_indices, results);
+}
+
+int chemfp_count_tversky_hits_arena_symmetric(
+        double alpha, double beta, double threshold,
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int query_start, int query_end,
+        int target_start, int target_end,
+        int *popcount_indices,
+        int *result_counts) {
+  chemfp_metric metric;
+  chemfp_interval interval;
+  init_tversky_search(&metric, &interval, alpha, beta, threshold);
+  return chemfp_count_metric_arena_symmetric(&metric, &interval, num_bits, storage_size, arena,
+                                             query_start, query_end, target_start, target_end,
+                                             popcount_indices, result_counts);
+}
+
+int chemfp_threshold_tversky_arena_symmetric(
+        double alpha, double beta, double threshold,
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int query_start, int query_end,
+        int target_start, int target_end,
+        int *popcount_indices,
+        chemfp_search_result *results) {
+  chemfp_metric metric;
+  chemfp_interval interval;
+  init_tversky_search(&metric, &interval, alpha, beta, threshold);
+  return chemfp_threshold_metric_arena_symmetric(&metric, &interval, num_bits, storage_size, arena,
+                                                 query_start, query_end, target_start, target_end,
+                                                 popcount_indices, results);
+}
+
+int chemfp_knearest_tversky_arena_symmetric(
+        int k, double alpha, double beta, double threshold,
+        int num_bits,
+        int storage_size, const unsigned char *arena,
+        int query_start, int query_end,
+        int target_start, int target_end,
+        int *popcount_indices,
+        chemfp_search_result *results) {
+  chemfp_metric metric;
+  chemfp_interval interval;
+  init_tversky_search(&metric, &interval, alpha, beta, threshold);
+  return chemfp_knearest_metric_arena_symmetric(k, &metric, &interval, num_bits, storage_size, arena,
+                                                query_start, query_end, target_start, target_end,
+                                                popcount_indices, results);
+}
@@ -55,6 +55,10 @@ chemfp_alignment_type chemfp_alignments[] = {
 
   /* This is a purely hack category. It's only used if set to "ssse3" */
   {"align-ssse3", 64, 64, NULL},
+
+  /* These are only used if set to "avx2" or "avx512" */
+  {"align-avx2", 32, 32, NULL},
+  {"align-avx512", 64, 64, NULL},
 };
 
 static int
@@ -110,6 +114,14 @@ static chemfp_method_type compile_time_methods[] = {
   {0, CHEMFP_SSSE3, "ssse3", 64, 64, chemfp_has_ssse3,
    (chemfp_popcount_f) chemfp_popcount_SSSE3,
    (chemfp_intersect_popcount_f) chemfp_intersect_popcount_SSSE3},
+
+  {0, CHEMFP_AVX2, "avx2", 32, 32, chemfp_has_avx2,
+   (chemfp_popcount_f) chemfp_popcount_avx2,
+   (chemfp_intersect_popcount_f) chemfp_intersect_popcount_avx2},
+
+  {0, CHEMFP_AVX512, "avx512", 64, 64, chemfp_has_avx512_vpopcntdq,
+   (chemfp_popcount_f) chemfp_popcount_avx512,
+   (chemfp_intersect_popcount_f) chemfp_intersect_popcount_avx512},
 };
 
 
@@ -164,7 +176,8 @@ set_default_alignment_methods(void) {
   int lut_method, best64_method, large_method, ssse3_method;
   unsigned long first_time, lut8_time, lut16_time, lut_time;
   unsigned long gillies_time, best64_time, lauradoux_time;
-  unsigned long ssse3_time;
+  unsigned long ssse3_time, large_time, avx_time;
+  chemfp_method_type *avx_method_p;
 
   /* Make sure we haven't already initialized the alignments */
   if (chemfp_alignments[0].method_p != NULL) {
@@ -270,6 +283,42 @@ set_default_alignment_methods(void) {
   }
   chemfp_alignments[CHEMFP_ALIGN_SSSE3].method_p = &compile_time_methods[ssse3_method];
   }
+
+  /* The AVX categories start with the method for large fingerprints, */
+  /* and switch to AVX2 or AVX-512 if that's faster on 2048 bits. */
+  /* These methods are fast enough that I need more repeats to get */
+  /* a reliable time. */
+  avx_method_p = chemfp_alignments[CHEMFP_ALIGN8_LARGE].method_p;
+  first_time = timeit(avx_method_p->popcount, 256, 2000);
+  large_time = timeit(avx_method_p->popcount, 256, 2000);
+  if (first_time < large_time) {
+    large_time = first_time;
+  }
+
+  if (chemfp_has_avx2()) {
+    first_time = timeit(compile_time_methods[CHEMFP_AVX2].popcount, 256, 2000);
+    avx_time = timeit(compile_time_methods[CHEMFP_AVX2].popcount, 256, 2000);
+    if (first_time < avx_time) {
+      avx_time = first_time;
+    }
+    if (avx_time < large_time) {
+      avx_method_p = &compile_time_methods[CHEMFP_AVX2];
+      large_time = avx_time;
+    }
+  }
+  chemfp_alignments[CHEMFP_ALIGN_AVX2].method_p = avx_method_p;
+
+  if (chemfp_has_avx512_vpopcntdq()) {
+    first_time = timeit(compile_time_methods[CHEMFP_AVX512].popcount, 256, 2000);
+    avx_time = timeit(compile_time_methods[CHEMFP_AVX512].popcount, 256, 2000);
+    if (first_time < avx_time) {
+      avx_time = first_time;
+    }
+    if (avx_time < large_time) {
+      avx_method_p = &compile_time_methods[CHEMFP_AVX512];
+    }
+  }
+  chemfp_alignments[CHEMFP_ALIGN_AVX512].method_p = avx_method_p;
 }
 
 
@@ -319,6 +368,13 @@ chemfp_set_alignment_method(int alignment, int method) {
 
 /**************************************/
 
+/* The AVX alignments are only used if set to an AVX method */
+static int
+is_avx_alignment(int alignment) {
+  int id = chemfp_alignments[alignment].method_p->id;
+  return (id == CHEMFP_AVX2 || id == CHEMFP_AVX512);
+}
+
 /* chemfp stores fingerprints as Python strings */
 /* (This may change in the future; memmap, perhaps?) */
 /* The Python payload is 4 byte aligned but not 8 byte aligned. */
@@ -342,6 +398,16 @@ chemfp_determine_alignment(int num_bits,
   }
   if (ALIGNMENT(arena, 8) == 0 &&
       storage_len % 8 == 0) {
+    if (ALIGNMENT(arena, 64) == 0 &&
+        storage_len % 64 == 0 &&
+        is_avx_alignment(CHEMFP_ALIGN_AVX512)) {
+      return CHEMFP_ALIGN_AVX512;
+    }
+    if (ALIGNMENT(arena, 32) == 0 &&
+        storage_len % 32 == 0 &&
+        is_avx_alignment(CHEMFP_ALIGN_AVX2)) {
+      return CHEMFP_ALIGN_AVX2;
+    }
     if (num_bytes >= 96) {
       return CHEMFP_ALIGN8_LARGE;
     } else {
@@ -413,6 +479,21 @@ chemfp_select_intersect_alignment(int num_bits,
       storage_len1 % 8 == 0 &&
       storage_len2 % 8 == 0) {
 
+    if (ALIGNMENT(arena1, 64) == 0 &&
+        ALIGNMENT(arena2, 64) == 0 &&
+        storage_len1 % 64 == 0 &&
+        storage_len2 % 64 == 0 &&
+        is_avx_alignment(CHEMFP_ALIGN_AVX512)) {
+      return CHEMFP_ALIGN_AVX512;
+    }
+    if (ALIGNMENT(arena1, 32) == 0 &&
+        ALIGNMENT(arena2, 32) == 0 &&
+        storage_len1 % 32 == 0 &&
+        storage_len2 % 32 == 0 &&
+        is_avx_alignment(CHEMFP_ALIGN_AVX2)) {
+      return CHEMFP_ALIGN_AVX2;
+    }
+
     /* We only use SSSE3 if this alignment is identical to "CHEMFP_SSSE3" */
     if (chemfp_alignments[CHEMFP_ALIGN_SSSE3].method_p->id == CHEMFP_SSSE3) {
 
@@ -445,6 +526,40 @@ chemfp_select_intersect_alignment(int num_bits,
   return CHEMFP_ALIGN1;
 }
 
+/* Fully unrolled versions of some methods for the common fingerprint sizes */
+/* (MACCS, PubChem, and the usual hash fingerprint sizes) */
+typedef struct {
+  int id;
+  int num_bits;
+  chemfp_intersect_popcount_f intersect_popcount;
+} chemfp_fixed_size_method_type;
+
+static chemfp_fixed_size_method_type fixed_size_methods[] = {
+  {CHEMFP_POPCNT, 166, (chemfp_intersect_popcount_f) chemfp_intersect_popcount_popcnt_166},
+  {CHEMFP_POPCNT, 881, (chemfp_intersect_popcount_f) chemfp_intersect_popcount_popcnt_881},
+  {CHEMFP_POPCNT, 1024, (chemfp_intersect_popcount_f) chemfp_intersect_popcount_popcnt_1024},
+  {CHEMFP_POPCNT, 2048, (chemfp_intersect_popcount_f) chemfp_intersect_popcount_popcnt_2048},
+  {CHEMFP_POPCNT, 4096, (chemfp_intersect_popcount_f) chemfp_intersect_popcount_popcnt_4096},
+
+  {CHEMFP_AVX512, 166, (chemfp_intersect_popcount_f) chemfp_intersect_popcount_avx512_166},
+  {CHEMFP_AVX512, 881, (chemfp_intersect_popcount_f) chemfp_intersect_popcount_avx512_1024},
+  {CHEMFP_AVX512, 1024, (chemfp_intersect_popcount_f) chemfp_intersect_popcount_avx512_1024},
+  {CHEMFP_AVX512, 2048, (chemfp_intersect_popcount_f) chemfp_intersect_popcount_avx512_2048},
+  {CHEMFP_AVX512, 4096, (chemfp_intersect_popcount_f) chemfp_intersect_popcount_avx512_4096},
+};
+
+static chemfp_intersect_popcount_f
+get_fixed_size_intersect_popcount(chemfp_method_type *method_p, int num_bits) {
+  int i;
+  for (i=0; i<(int)(sizeof(fixed_size_methods)/sizeof(chemfp_fixed_size_method_type)); i++) {
+    if (fixed_size_methods[i].id == method_p->id &&
+        fixed_size_methods[i].num_bits == num_bits) {
+      return fixed_size_methods[i].intersect_popcount;
+    }
+  }
+  return method_p->intersect_popcount;
+}
+
 /* Wrapper function which can report the selected intersect popcount method */
 chemfp_intersect_popcount_f
 chemfp_select_intersect_popcount(int num_bits,
@@ -454,6 +569,8 @@ chemfp_select_intersect_popcount(int num_bits,
                                                     storage_len2, arena2);
 
   chemfp_method_type *method_p = chemfp_alignments[alignment].method_p;
+  chemfp_intersect_popcount_f intersect_popcount =
+    get_fixed_size_intersect_popcount(method_p, num_bits);
 
   if (chemfp_report_select_intersect_popcount &&
       chemfp_intersect_popcount_method_p != method_p) {
@@ -466,7 +583,7 @@ chemfp_select_intersect_popcount(int num_bits,
             arena1, _alignment_description(arena1), storage_len1,
             arena2, _alignment_description(arena2), storage_len2);
   }
-  return method_p->intersect_popcount;
+  return intersect_popcount;
 }
   
 
@@ -119,12 +119,17 @@ class TestOptimalAlignment(unittest2.TestCase):
     def setUp(self):
         self._has_popcnt = arena._has_popcnt
         self._has_ssse3 = arena._has_ssse3
+        self._has_avx2 = arena._has_avx2
+        self._has_avx512 = arena._has_avx512
+        arena._has_avx2 = arena._has_avx512 = False
         self.get_alignment_method = bitops.get_alignment_method
         bitops.get_alignment_method = self.hook
 
     def tearDown(self):
         arena._has_popcnt = self._has_popcnt
         arena._has_ssse3 = self._has_ssse3
+        arena._has_avx2 = self._has_avx2
+        arena._has_avx512 = self._has_avx512
         bitops.get_alignment_method = self.get_alignment_method
 
     def hook(self, name):
@@ -199,6 +204,35 @@ class TestOptimalAlignment(unittest2.TestCase):
         self.assertEquals(arena.get_optimal_alignment(300), 8)
         self.assertEquals(arena.get_optimal_alignment(800), 8)
 
+    def test_avx_combinations(self):
+        arena._has_popcnt = True
+        arena._has_ssse3 = True
+        arena._has_avx2 = True
+        arena._has_avx512 = True
+        base = {"align8-large": "POPCNT",
+                "align8-small": "POPCNT",
+                "align-ssse3": "POPCNT"}
+
+        self.data = dict(base, **{"align-avx2": "avx2", "align-avx512": "avx512"})
+        self.assertEquals(arena.get_optimal_alignment(200), 8)
+        self.assertEquals(arena.get_optimal_alignment(300), 64)
+        self.assertEquals(arena.get_optimal_alignment(2048), 64)
+
+        self.data = dict(base, **{"align-avx2": "avx2", "align-avx512": "avx2"})
+        self.assertEquals(arena.get_optimal_alignment(300), 32)
+        self.assertEquals(arena.get_optimal_alignment(2048), 32)
+
+        self.data = dict(base, **{"align-avx2": "POPCNT", "align-avx512": "POPCNT"})
+        self.assertEquals(arena.get_optimal_alignment(300), 8)
+        self.assertEquals(arena.get_optimal_alignment(2048), 8)
+
+        # The methods aren't used if the CPU doesn't support them
+        arena._has_avx512 = False
+        self.data = dict(base, **{"align-avx2": "avx2", "align-avx512": "avx512"})
+        self.assertEquals(arena.get_optimal_alignment(2048), 32)
+        arena._has_avx2 = False
+        self.assertEquals(arena.get_optimal_alignment(2048), 8)
+
 
 # I can't find a better solution than this. (!?)
 def _addressof(s):
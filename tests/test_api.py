@@ -9,6 +9,7 @@ import gzip
 import shutil
 import itertools
 import random
+import array
 
 import chemfp
 from chemfp import bitops, io
@@ -1059,8 +1060,115 @@ class TestArenaGetById(unittest2.TestCase):
         self.assertEqual(arena.get_index_by_id("id1"), 0)
         self.assertEqual(arena.get_index_by_id("id3"), 2)
         self.assertIn(arena.get_index_by_id("id2"), (1, 3))
-        
-        
+
+
+class TestArenaFromBuffer(unittest2.TestCase):
+    def setUp(self):
+        self.arena = chemfp.load_fingerprints(CHEBI_TARGETS)
+        self.data = "".join(fp for (id, fp) in self.arena)
+
+    def _check_arena(self, buf):
+        from chemfp.arena import FingerprintArena
+        arena = FingerprintArena.from_buffer(buf, 166, self.arena.ids)
+        self.assertEqual(len(arena), 2000)
+        self.assertEqual(arena.storage_size, 21)
+        self.assertEqual(arena.popcount_indices, self.arena.popcount_indices)
+        self.assertEqual(list(arena), list(self.arena))
+        self.assertEqual(arena[100], self.arena[100])
+        self.assertEqual(list(chemfp.search.count_tanimoto_hits_symmetric(arena, 0.8)),
+                         list(chemfp.search.count_tanimoto_hits_symmetric(self.arena, 0.8)))
+        return arena
+
+    def test_string(self):
+        arena = self._check_arena(self.data)
+        self.assertIs(arena.arena, self.data)
+
+    def test_bytearray(self):
+        self._check_arena(bytearray(self.data))
+
+    def test_memoryview(self):
+        self._check_arena(memoryview(self.data))
+
+    def test_array(self):
+        self._check_arena(array.array("B", self.data))
+
+    def test_does_not_copy(self):
+        from chemfp.arena import FingerprintArena
+        buf = bytearray(self.data)
+        arena = FingerprintArena.from_buffer(buf, 166, self.arena.ids)
+        buf[0] = "\xff"
+        self.assertEqual(arena[0][1][0], "\xff")
+
+    def test_id_table_is_not_copied(self):
+        from chemfp.arena import FingerprintArena
+        from chemfp.id_table import IdTable
+        ids = self.arena.ids
+        self.assertIsInstance(ids, IdTable)
+        arena = FingerprintArena.from_buffer(self.data, 166, ids)
+        self.assertIs(arena.arena_ids, ids)
+        self.assertEqual(list(arena), list(self.arena))
+
+    def test_other_ids_are_copied(self):
+        from chemfp.arena import FingerprintArena
+        ids = tuple(self.arena.ids)
+        arena = FingerprintArena.from_buffer(self.data, 166, iter(ids))
+        self.assertEqual(arena.arena_ids, list(ids))
+        self.assertEqual(list(arena), list(self.arena))
+
+    def test_storage_size(self):
+        from chemfp.arena import FingerprintArena
+        padded = "".join(fp + "\0\0\0" for (id, fp) in self.arena)
+        arena = FingerprintArena.from_buffer(padded, 166, self.arena.ids)
+        self.assertEqual(arena.storage_size, 24)
+        self.assertIn(arena.alignment, (1, 2, 4, 8))
+        self.assertEqual(list(arena), list(self.arena))
+
+        arena = FingerprintArena.from_buffer(padded, 166, self.arena.ids[:10], storage_size=24)
+        self.assertEqual(len(arena), 10)
+        self.assertEqual(list(arena), list(self.arena[:10]))
+
+    def test_unordered(self):
+        from chemfp.arena import FingerprintArena
+        unordered = chemfp.load_fingerprints(CHEBI_TARGETS, reorder=False)
+        data = "".join(fp for (id, fp) in unordered)
+        arena = FingerprintArena.from_buffer(data, 166, unordered.ids)
+        self.assertEqual(arena.popcount_indices, "")
+        self.assertEqual(list(arena.copy(reorder=True)), list(self.arena))
+
+    def test_popcount_indices(self):
+        from chemfp.arena import FingerprintArena
+        indices = array.array("i", self.arena.popcount_indices)
+        arena = FingerprintArena.from_buffer(self.data, 166, self.arena.ids, indices)
+        self.assertEqual(arena.popcount_indices, self.arena.popcount_indices)
+        with self.assertRaisesRegexp(ValueError, "popcount_indices must contain 168 integers"):
+            FingerprintArena.from_buffer(self.data, 166, self.arena.ids, indices[:-1])
+
+    def test_buffer_too_small(self):
+        from chemfp.arena import FingerprintArena
+        with self.assertRaisesRegexp(ValueError, "too small for 2000 fingerprints"):
+            FingerprintArena.from_buffer(self.data[:-1], 166, self.arena.ids, storage_size=21)
+        with self.assertRaisesRegexp(ValueError, "storage_size of 20 is too small"):
+            FingerprintArena.from_buffer(self.data, 166, self.arena.ids, storage_size=20)
+
+    def test_not_a_buffer(self):
+        from chemfp.arena import FingerprintArena
+        with self.assertRaises(TypeError):
+            FingerprintArena.from_buffer(123, 166, [])
+
+    @unittest2.skipUnless(sys.maxsize > 2**32, "needs a 64-bit Python")
+    def test_buffer_too_large(self):
+        import mmap
+        from chemfp.arena import FingerprintArena, MAX_ARENA_SIZE
+        # A sparse file, so this doesn't use 2 GB of disk or memory
+        with tempfile.TemporaryFile() as f:
+            f.truncate(MAX_ARENA_SIZE + 1)
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                with self.assertRaisesRegexp(ValueError, "larger than the 2 GB limit"):
+                    FingerprintArena.from_buffer(data, 1024, ["ID%d" % i for i in range(10)])
+            finally:
+                data.close()
+
 
 
 
@@ -1284,8 +1392,8 @@ class TestFPSParser(unittest2.TestCase):
         with self.assertRaisesRegexp(ValueError, "Unknown fingerprint format 'pdf'"):
             chemfp.open("spam.sdf", format="pdf")
 
-    def test_fpb_failure(self):
-        with self.assertRaisesRegexp(NotImplementedError, "fpb format support not implemented"):
+    def test_fpb_missing_file(self):
+        with self.assertRaisesRegexp(IOError, "No such file or directory"):
             chemfp.open("spam.fpb")
 
     def test_base_case(self):
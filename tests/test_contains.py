@@ -0,0 +1,124 @@
+from __future__ import absolute_import, with_statement
+
+import pickle
+import unittest2
+
+import chemfp
+import chemfp.search
+from chemfp import bitops
+
+from support import fullpath
+
+targets = chemfp.load_fingerprints(fullpath("targets.fps"))
+unsorted_targets = chemfp.load_fingerprints(fullpath("targets.fps"), reorder=False)
+
+def _and(fp1, fp2):
+    return "".join(chr(ord(c1) & ord(c2)) for (c1, c2) in zip(fp1, fp2))
+
+def _make_queries():
+    # Use the intersection of pairs of targets so there are more hits
+    fps = [fp for (id, fp) in unsorted_targets]
+    records = [("Q%d" % i, _and(fps[i], fps[(i*7+3) % len(fps)])) for i in range(0, len(fps), 3)]
+    records.append(("empty", "\0" * targets.metadata.num_bytes))
+    records.append(("target", fps[17]))
+    return chemfp.load_fingerprints(records, targets.metadata, reorder=False)
+
+queries = _make_queries()
+
+def _contains_hits(query_fp, targets):
+    return [i for i, (id, fp) in enumerate(targets) if bitops.byte_contains(query_fp, fp)]
+
+
+class ContainsMixin(object):
+    def test_count_fp(self):
+        for query_id, query_fp in queries:
+            self.assertEqual(chemfp.search.count_contains_hits_fp(query_fp, self.targets),
+                             len(_contains_hits(query_fp, self.targets)))
+
+    def test_count_arena(self):
+        counts = chemfp.search.count_contains_hits_arena(queries, self.targets)
+        self.assertEqual(list(counts),
+                         [len(_contains_hits(query_fp, self.targets)) for (id, query_fp) in queries])
+
+    def test_search_fp(self):
+        for query_id, query_fp in queries:
+            result = chemfp.search.contains_search_fp(query_fp, self.targets)
+            self.assertEqual(list(result.get_indices()), _contains_hits(query_fp, self.targets))
+            self.assertEqual(set(result.get_scores()), set([0.0]) if len(result) else set())
+
+    def test_search_arena(self):
+        results = chemfp.search.contains_search_arena(queries, self.targets)
+        self.assertEqual(len(results), len(queries))
+        for (query_id, query_fp), result in zip(queries, results):
+            self.assertEqual(list(result.get_indices()), _contains_hits(query_fp, self.targets))
+            self.assertEqual(result.get_ids(),
+                             [self.targets.ids[i] for i in _contains_hits(query_fp, self.targets)])
+
+    def test_has_hits(self):
+        counts = chemfp.search.count_contains_hits_arena(queries, self.targets)
+        self.assertEqual(counts[len(queries)-2], len(self.targets))
+        self.assertTrue(0 < sum(counts[:-2]) < (len(queries)-2) * len(self.targets))
+
+    def test_subarena(self):
+        for start, end in ((10, 90), (64, 65), (3, 3), (0, 64)):
+            subarena = self.targets[start:end]
+            results = chemfp.search.contains_search_arena(queries, subarena)
+            for (query_id, query_fp), result in zip(queries, results):
+                # Like the other searches, the indices are relative to the full arena
+                expected = _contains_hits(query_fp, subarena)
+                self.assertEqual(list(result.get_indices()), [start+i for i in expected])
+                self.assertEqual(result.get_ids(), [subarena.ids[i] for i in expected])
+
+    def test_arena_methods(self):
+        query_fp = queries[5][1]
+        self.assertEqual(self.targets.count_contains_hits_fp(query_fp),
+                         len(_contains_hits(query_fp, self.targets)))
+        self.assertEqual(list(self.targets.count_contains_hits_arena(queries)),
+                         list(chemfp.search.count_contains_hits_arena(queries, self.targets)))
+        self.assertEqual(list(self.targets.contains_search_fp(query_fp).get_indices()),
+                         _contains_hits(query_fp, self.targets))
+        results = self.targets.contains_search_arena(queries)
+        self.assertEqual(len(results), len(queries))
+
+class TestSortedArena(ContainsMixin, unittest2.TestCase):
+    targets = targets
+
+class TestUnsortedArena(ContainsMixin, unittest2.TestCase):
+    targets = unsorted_targets
+
+
+class TestContainsIndex(unittest2.TestCase):
+    def test_index_is_reused(self):
+        arena = targets.copy()
+        chemfp.search.count_contains_hits_fp(queries[0][1], arena)
+        index = arena._contains_index
+        self.assertNotEqual(index, None)
+        chemfp.search.contains_search_arena(queries, arena)
+        self.assertIs(arena._contains_index, index)
+
+    def test_pickle(self):
+        arena = targets[5:60]
+        expected = list(chemfp.search.count_contains_hits_arena(queries, arena))
+        new_arena = pickle.loads(pickle.dumps(arena))
+        self.assertEqual(new_arena._contains_index, None)
+        self.assertEqual(list(chemfp.search.count_contains_hits_arena(queries, new_arena)),
+                         expected)
+
+    def test_empty_arena(self):
+        arena = targets[5:5]
+        self.assertEqual(chemfp.search.count_contains_hits_fp(queries[0][1], arena), 0)
+        self.assertEqual(len(chemfp.search.contains_search_fp(queries[0][1], arena)), 0)
+        self.assertEqual(list(chemfp.search.count_contains_hits_arena(queries, arena)),
+                         [0] * len(queries))
+
+    def test_wrong_query_size(self):
+        with self.assertRaisesRegexp(ValueError, "query_fp uses 4 bytes"):
+            chemfp.search.contains_search_fp("abcd", targets)
+
+    def test_wrong_query_arena_size(self):
+        query_arena = chemfp.load_fingerprints([("A", "\x01\x02")], chemfp.Metadata(num_bits=16))
+        with self.assertRaisesRegexp(ValueError, "query_arena has 16 bits"):
+            chemfp.search.count_contains_hits_arena(query_arena, targets)
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -0,0 +1,165 @@
+from __future__ import absolute_import, with_statement
+
+import random
+import unittest2
+
+import chemfp
+import chemfp.search
+
+from support import fullpath
+
+queries = chemfp.load_fingerprints(fullpath("queries.fps"))[:30].copy()
+targets = chemfp.load_fingerprints(fullpath("targets.fps"))
+unsorted_targets = chemfp.load_fingerprints(fullpath("targets.fps"), reorder=False)
+
+def _sparse_arena(num_bits, n, seed):
+    # Sparse fingerprints, with groups of similar fingerprints so
+    # there are hits at high thresholds
+    rng = random.Random(seed)
+    num_bytes = num_bits // 8
+    fps = []
+    for i in range(n):
+        if i % 4 == 0:
+            bits = set(rng.randrange(num_bits) for j in range(rng.randrange(10, 80)))
+        else:
+            bits = set(bits)
+            for j in range(rng.randrange(3)):
+                bits.add(rng.randrange(num_bits))
+        fp = bytearray(num_bytes)
+        for bit in bits:
+            fp[bit//8] |= 1 << (bit % 8)
+        fps.append(("ID%d" % i, str(fp)))
+    return chemfp.load_fingerprints(fps, chemfp.Metadata(num_bits=num_bits))
+
+def _with_prefilter(arena, num_bits=256):
+    arena = arena.copy()
+    arena.make_folded_prefilter(num_bits)
+    return arena
+
+def _sorted_hits(result):
+    return sorted(result.get_ids_and_scores())
+
+
+class FoldedMixin(object):
+    def test_count(self):
+        for threshold in (0.01, 0.3, 0.6, 0.8, 1.0):
+            expected = chemfp.search.count_tanimoto_hits_arena(self.queries, self.targets, threshold)
+            counts = chemfp.search.count_tanimoto_hits_arena(self.queries, self.folded, threshold)
+            self.assertEqual(list(counts), list(expected), threshold)
+
+    def test_threshold(self):
+        for threshold in (0.01, 0.3, 0.6, 0.8, 1.0):
+            expected = chemfp.search.threshold_tanimoto_search_arena(self.queries, self.targets, threshold)
+            results = chemfp.search.threshold_tanimoto_search_arena(self.queries, self.folded, threshold)
+            for result, expected_result in zip(results, expected):
+                self.assertEqual(_sorted_hits(result), _sorted_hits(expected_result))
+
+    def test_knearest(self):
+        for k, threshold in ((1, 0.0), (3, 0.3), (5, 0.7), (20, 0.1)):
+            expected = chemfp.search.knearest_tanimoto_search_arena(
+                self.queries, self.targets, k, threshold)
+            results = chemfp.search.knearest_tanimoto_search_arena(
+                self.queries, self.folded, k, threshold)
+            for result, expected_result in zip(results, expected):
+                self.assertEqual(result.get_scores(), expected_result.get_scores())
+
+    def test_subarenas(self):
+        subqueries = self.queries[5:15]
+        n = len(self.targets)
+        subtargets = self.targets[n//4:3*n//4]
+        folded_subtargets = self.folded[n//4:3*n//4]
+        self.assertIs(folded_subtargets.folded_prefilter, self.folded.folded_prefilter)
+        expected = chemfp.search.threshold_tanimoto_search_arena(subqueries, subtargets, 0.5)
+        results = chemfp.search.threshold_tanimoto_search_arena(subqueries, folded_subtargets, 0.5)
+        for result, expected_result in zip(results, expected):
+            self.assertEqual(_sorted_hits(result), _sorted_hits(expected_result))
+        expected = chemfp.search.knearest_tanimoto_search_arena(subqueries, subtargets, 3, 0.5)
+        results = chemfp.search.knearest_tanimoto_search_arena(subqueries, folded_subtargets, 3, 0.5)
+        for result, expected_result in zip(results, expected):
+            self.assertEqual(result.get_ids_and_scores(), expected_result.get_ids_and_scores())
+
+    def test_stats(self):
+        prefilter = self.folded.folded_prefilter
+        prefilter.reset_stats()
+        self.assertEqual(prefilter.num_candidates, 0)
+        self.assertEqual(prefilter.num_pruned, 0)
+        chemfp.search.count_tanimoto_hits_arena(self.queries, self.folded, 0.9)
+        self.assertGreater(prefilter.num_candidates, 0)
+        self.assertGreater(prefilter.num_pruned, 0)
+        self.assertLessEqual(prefilter.num_pruned, prefilter.num_candidates)
+        prefilter.reset_stats()
+        self.assertEqual(prefilter.num_candidates, 0)
+
+
+class TestFoldedTargets(FoldedMixin, unittest2.TestCase):
+    queries = queries
+    targets = targets
+    folded = _with_prefilter(targets)
+
+sparse_queries = _sparse_arena(4096, 40, 1)
+sparse_targets = _sparse_arena(4096, 2000, 2)
+
+class TestSparseFoldedTargets(FoldedMixin, unittest2.TestCase):
+    queries = sparse_queries
+    targets = sparse_targets
+    folded = _with_prefilter(sparse_targets, 128)
+
+
+class TestFoldedPrefilter(unittest2.TestCase):
+    def test_default(self):
+        arena = targets.copy()
+        self.assertIs(arena.folded_prefilter, None)
+        prefilter = arena.make_folded_prefilter()
+        self.assertIs(arena.folded_prefilter, prefilter)
+        self.assertEqual(prefilter.num_bits, 256)
+        self.assertEqual(len(prefilter.lost_bits), len(arena))
+
+    def test_lost_bits(self):
+        arena = targets.copy()
+        prefilter = arena.make_folded_prefilter(64)
+        for i, (id, fp) in enumerate(arena):
+            folded_words = prefilter.folded_arena[i:i+1]
+            folded_popcount = bin(folded_words[0]).count("1")
+            self.assertEqual(prefilter.lost_bits[i], chemfp.bitops.byte_popcount(fp) - folded_popcount)
+
+    def test_iter_arenas(self):
+        arena = _with_prefilter(targets)
+        for subarena in arena.iter_arenas(100):
+            self.assertIs(subarena.folded_prefilter, arena.folded_prefilter)
+
+    def test_copy_does_not_keep_prefilter(self):
+        arena = _with_prefilter(targets)
+        self.assertIs(arena.copy().folded_prefilter, None)
+
+    def test_unsorted_targets(self):
+        # Without popcount indices the prefilter isn't used
+        arena = unsorted_targets.copy(reorder=False)
+        prefilter = arena.make_folded_prefilter()
+        results = chemfp.search.threshold_tanimoto_search_arena(queries, arena, 0.5)
+        expected = chemfp.search.threshold_tanimoto_search_arena(queries, unsorted_targets, 0.5)
+        for result, expected_result in zip(results, expected):
+            self.assertEqual(_sorted_hits(result), _sorted_hits(expected_result))
+        results = chemfp.search.knearest_tanimoto_search_arena(queries, arena, 5, 0.5)
+        expected = chemfp.search.knearest_tanimoto_search_arena(queries, unsorted_targets, 5, 0.5)
+        for result, expected_result in zip(results, expected):
+            self.assertEqual(result.get_scores(), expected_result.get_scores())
+        self.assertEqual(prefilter.num_candidates, 0)
+
+    def test_per_query_thresholds(self):
+        # The prefilter isn't used with per-query thresholds
+        arena = _with_prefilter(targets)
+        thresholds = [0.5] * len(queries)
+        counts = chemfp.search.count_tanimoto_hits_arena(queries, arena, thresholds)
+        self.assertEqual(list(counts),
+                         list(chemfp.search.count_tanimoto_hits_arena(queries, targets, 0.5)))
+        self.assertEqual(arena.folded_prefilter.num_candidates, 0)
+
+    def test_bad_num_bits(self):
+        arena = targets.copy()
+        for num_bits in (0, 32, 100, 2048):
+            with self.assertRaisesRegexp(ValueError, "folded num_bits must be a multiple of 64"):
+                arena.make_folded_prefilter(num_bits)
+        self.assertIs(arena.folded_prefilter, None)
+
+if __name__ == "__main__":
+    unittest2.main()
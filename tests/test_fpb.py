@@ -0,0 +1,229 @@
+from __future__ import absolute_import, with_statement
+
+import os
+import mmap
+import unittest2
+import tempfile
+import shutil
+import gzip
+from cStringIO import StringIO
+
+import chemfp
+from chemfp import search, fpb_io
+from chemfp.id_table import IdIndex
+from chemfp.commandline import fps2fpb
+
+from support import fullpath
+from test_api import CommonReaderAPI, CHEBI_TARGETS, CHEBI_QUERIES
+
+_tmpdir = tempfile.mkdtemp(prefix="test_fpb")
+
+def tearDownModule():
+    shutil.rmtree(_tmpdir)
+
+_cached_fpb_names = {}
+def _get_fpb_name(name, reorder=True):
+    key = (name, reorder)
+    try:
+        return _cached_fpb_names[key]
+    except KeyError:
+        pass
+    filename = os.path.join(_tmpdir, "%d_%s.fpb" % (len(_cached_fpb_names), reorder))
+    chemfp.load_fingerprints(name, reorder=reorder).save(filename)
+    _cached_fpb_names[key] = filename
+    return filename
+
+class TestFPBReader(unittest2.TestCase, CommonReaderAPI):
+    hit_order = staticmethod(lambda x: x)
+    def _open(self, name):
+        return chemfp.open(_get_fpb_name(name, reorder=False))
+
+
+class TestFPBRoundTrip(unittest2.TestCase):
+    def test_memory_mapped(self):
+        arena = chemfp.load_fingerprints(_get_fpb_name(CHEBI_TARGETS))
+        self.assertIsInstance(arena.arena, mmap.mmap)
+
+    def test_same_contents(self):
+        expected = chemfp.load_fingerprints(CHEBI_TARGETS)
+        arena = chemfp.open(_get_fpb_name(CHEBI_TARGETS))
+        self.assertEqual(arena.metadata.type, expected.metadata.type)
+        self.assertEqual(arena.metadata.sources, expected.metadata.sources)
+        self.assertEqual(arena.alignment, expected.alignment)
+        self.assertEqual(arena.storage_size, expected.storage_size)
+        self.assertEqual(arena.popcount_indices, expected.popcount_indices)
+        self.assertEqual(arena.ids, expected.ids)
+        self.assertEqual(list(arena), list(expected))
+
+    def test_unordered(self):
+        expected = chemfp.load_fingerprints(CHEBI_TARGETS, reorder=False)
+        arena = chemfp.open(_get_fpb_name(CHEBI_TARGETS, reorder=False))
+        self.assertEqual(arena.popcount_indices, "")
+        self.assertEqual(list(arena), list(expected))
+
+    def test_arena_is_aligned(self):
+        arena = chemfp.open(_get_fpb_name(CHEBI_TARGETS))
+        self.assertEqual(arena.start_padding % arena.alignment, 0)
+
+    def test_search(self):
+        expected = chemfp.load_fingerprints(CHEBI_TARGETS)
+        arena = chemfp.open(_get_fpb_name(CHEBI_TARGETS))
+        queries = chemfp.load_fingerprints(CHEBI_QUERIES)
+        expected_results = search.threshold_tanimoto_search_arena(queries, expected, 0.7)
+        results = search.threshold_tanimoto_search_arena(queries, arena, 0.7)
+        self.assertEqual([sorted(row.get_ids_and_scores()) for row in results],
+                         [sorted(row.get_ids_and_scores()) for row in expected_results])
+
+        expected_counts = search.count_tanimoto_hits_symmetric(expected, 0.6)
+        counts = search.count_tanimoto_hits_symmetric(arena, 0.6)
+        self.assertEqual(list(counts), list(expected_counts))
+
+    def test_save_subarena(self):
+        arena = chemfp.load_fingerprints(CHEBI_TARGETS)
+        filename = os.path.join(_tmpdir, "subarena.fpb")
+        arena[100:150].save(filename)
+        subarena = chemfp.open(filename)
+        self.assertEqual(len(subarena), 50)
+        self.assertEqual(list(subarena), list(arena[100:150]))
+        self.assertEqual(search.count_tanimoto_hits_fp(arena[120][1], subarena, 0.9),
+                         search.count_tanimoto_hits_fp(arena[120][1], arena[100:150], 0.9))
+
+    def test_save_empty(self):
+        arena = chemfp.load_fingerprints([], chemfp.Metadata(num_bits=32))
+        filename = os.path.join(_tmpdir, "empty.fpb")
+        arena.save(filename)
+        arena2 = chemfp.open(filename)
+        self.assertEqual(len(arena2), 0)
+        self.assertEqual(arena2.metadata.num_bits, 32)
+
+    def test_save_with_format(self):
+        arena = chemfp.load_fingerprints(CHEBI_TARGETS)
+        filename = os.path.join(_tmpdir, "no_extension")
+        arena.save(filename, "fpb")
+        self.assertEqual(list(chemfp.open(filename, "fpb")), list(arena))
+
+    def test_save_to_file_object(self):
+        arena = chemfp.load_fingerprints(CHEBI_TARGETS)
+        f = StringIO()
+        arena.save(f, "fpb")
+        arena2 = chemfp.open(StringIO(f.getvalue()), "fpb")
+        self.assertEqual(list(arena2), list(arena))
+
+    def test_reader_save(self):
+        filename = os.path.join(_tmpdir, "from_reader.fpb")
+        chemfp.open(CHEBI_TARGETS).save(filename)
+        self.assertEqual(list(chemfp.open(filename)), list(chemfp.load_fingerprints(CHEBI_TARGETS)))
+
+    def test_read_gzip(self):
+        filename = os.path.join(_tmpdir, "compressed.fpb.gz")
+        f = gzip.open(filename, "wb")
+        f.write(open(_get_fpb_name(CHEBI_TARGETS), "rb").read())
+        f.close()
+        self.assertEqual(list(chemfp.open(filename)), list(chemfp.load_fingerprints(CHEBI_TARGETS)))
+
+    def test_cannot_save_compressed(self):
+        arena = chemfp.load_fingerprints(CHEBI_TARGETS)
+        with self.assertRaisesRegexp(ValueError, "fpb output does not support compression"):
+            arena.save(os.path.join(_tmpdir, "output.fpb.gz"))
+
+    def test_save_id_with_newline(self):
+        arena = chemfp.load_fingerprints([("AB", "1234"), ("C\nD", "1324")], chemfp.Metadata(num_bytes=4))
+        with self.assertRaisesRegexp(ValueError, "Fingerprint ids must not contain a newline"):
+            arena.save(StringIO(), "fpb")
+
+
+class TestFPBIdIndex(unittest2.TestCase):
+    def test_has_id_index(self):
+        chunks = fpb_io._read_chunks(open(_get_fpb_name(CHEBI_TARGETS), "rb").read(), "x")
+        self.assertIn("IDIX", chunks)
+
+    def test_uses_saved_id_index(self):
+        arena = chemfp.open(_get_fpb_name(CHEBI_TARGETS))
+        self.assertIsInstance(arena._id_lookup.im_self, IdIndex)
+        self.assertIsInstance(arena._id_lookup.im_self.table, buffer)
+
+    def test_lookup(self):
+        expected = chemfp.load_fingerprints(CHEBI_TARGETS)
+        arena = chemfp.open(_get_fpb_name(CHEBI_TARGETS))
+        for i, id in enumerate(expected.ids):
+            self.assertEqual(arena.get_index_by_id(id), i)
+        self.assertEqual(arena.get_by_id("CHEBI:1895"), expected.get_by_id("CHEBI:1895"))
+        self.assertEqual(arena.get_fingerprint_by_id("CHEBI:1895"),
+                         expected.get_fingerprint_by_id("CHEBI:1895"))
+        self.assertEqual(arena.get_by_id("CHEBI:XYZZY"), None)
+
+    def test_unknown_hash_version(self):
+        content = open(_get_fpb_name(CHEBI_TARGETS), "rb").read()
+        start, end = fpb_io._read_chunks(content, "x")["IDIX"]
+        content = content[:start] + "\xff" + content[start+1:]
+        arena = chemfp.open(StringIO(content), "fpb")
+        self.assertEqual(arena._id_lookup, None)
+        self.assertEqual(arena.get_index_by_id(arena.ids[10]), 10)
+
+    def test_bad_table_size(self):
+        content = open(_get_fpb_name(CHEBI_TARGETS), "rb").read()
+        start, end = fpb_io._read_chunks(content, "x")["IDIX"]
+        content = content[:start+4] + "\x03" + content[start+5:]
+        with self.assertRaisesRegexp(chemfp.ParseError, "IDIX chunk .* invalid table size"):
+            chemfp.open(StringIO(content), "fpb")
+
+    def test_subarena_lookup(self):
+        arena = chemfp.open(_get_fpb_name(CHEBI_TARGETS))
+        subarena = arena[10:20]
+        self.assertEqual(subarena.get_index_by_id(arena.ids[15]), 5)
+        self.assertEqual(subarena.get_index_by_id(arena.ids[25]), None)
+
+
+class TestFPBErrors(unittest2.TestCase):
+    def _parse(self, content):
+        return chemfp.open(StringIO(content), "fpb")
+
+    def _get_content(self):
+        return open(_get_fpb_name(CHEBI_TARGETS), "rb").read()
+
+    def test_bad_signature(self):
+        with self.assertRaisesRegexp(chemfp.ParseError, "fpb signature"):
+            self._parse("#FPS1\n")
+
+    def test_missing_fend(self):
+        content = self._get_content()
+        with self.assertRaisesRegexp(chemfp.ParseError, "Missing FEND chunk"):
+            self._parse(content[:-12])
+
+    def test_truncated(self):
+        content = self._get_content()
+        with self.assertRaisesRegexp(chemfp.ParseError, "extends past the end of the file"):
+            self._parse(content[:1000])
+
+    def test_empty_file(self):
+        filename = os.path.join(_tmpdir, "empty_file.fpb")
+        open(filename, "wb").close()
+        with self.assertRaisesRegexp(chemfp.ParseError, "is empty"):
+            chemfp.open(filename)
+
+
+class TestFps2Fpb(unittest2.TestCase):
+    def test_convert(self):
+        filename = os.path.join(_tmpdir, "converted.fpb")
+        fps2fpb.main([CHEBI_TARGETS, "-o", filename])
+        arena = chemfp.open(filename)
+        self.assertEqual(list(arena), list(chemfp.load_fingerprints(CHEBI_TARGETS)))
+        self.assertTrue(arena.popcount_indices)
+
+    def test_convert_no_reorder(self):
+        filename = os.path.join(_tmpdir, "converted_no_reorder.fpb")
+        fps2fpb.main([CHEBI_TARGETS, "-o", filename, "--no-reorder"])
+        arena = chemfp.open(filename)
+        self.assertEqual(arena.popcount_indices, "")
+        self.assertEqual(list(arena), list(chemfp.open(CHEBI_TARGETS)))
+
+    def test_convert_alignment(self):
+        filename = os.path.join(_tmpdir, "converted_align64.fpb")
+        fps2fpb.main([CHEBI_TARGETS, "-o", filename, "--alignment", "64"])
+        arena = chemfp.open(filename)
+        self.assertEqual(arena.alignment, 64)
+        self.assertEqual(arena.storage_size, 64)
+        self.assertEqual(list(arena), list(chemfp.load_fingerprints(CHEBI_TARGETS)))
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -0,0 +1,220 @@
+from __future__ import absolute_import, with_statement
+
+import os
+import gzip
+import shutil
+import tempfile
+import unittest2
+from cStringIO import StringIO
+
+import chemfp
+from chemfp import fps_index, fps_io, ParseError
+
+from support import fullpath
+
+_tmpdir = tempfile.mkdtemp(prefix="test_fps_index")
+
+def tearDownModule():
+    shutil.rmtree(_tmpdir)
+
+def _copy(name, new_name=None):
+    filename = os.path.join(_tmpdir, new_name or name)
+    shutil.copy(fullpath(name), filename)
+    return filename
+
+def _make_multimember_gzip(filename, records_per_member):
+    lines = open(fullpath("queries.fps")).readlines()
+    header = [line for line in lines if line[:1] == "#"]
+    records = [line for line in lines if line[:1] != "#"]
+    outfile = open(filename, "wb")
+    for i in range(0, len(records), records_per_member):
+        f = StringIO()
+        g = gzip.GzipFile(fileobj=f, mode="wb")
+        if i == 0:
+            g.write("".join(header))
+        g.write("".join(records[i:i+records_per_member]))
+        g.close()
+        outfile.write(f.getvalue())
+    outfile.close()
+
+expected = list(chemfp.open(fullpath("queries.fps")))
+
+
+class IndexMixin(object):
+    def test_num_records(self):
+        index = fps_index.find_fps_index(self.filename)
+        self.assertEqual(index.num_records, len(expected))
+        self.assertEqual(list(index.ids), [id for (id, fp) in expected])
+
+    def test_get_by_id(self):
+        reader = chemfp.open(self.filename)
+        for i, (id, fp) in enumerate(expected):
+            self.assertEqual(reader.get_index_by_id(id), i)
+            self.assertEqual(reader.get_by_id(id), (id, fp))
+            self.assertEqual(reader.get_fingerprint_by_id(id), fp)
+
+    def test_get_by_missing_id(self):
+        reader = chemfp.open(self.filename)
+        self.assertEqual(reader.get_index_by_id("spam"), None)
+        self.assertEqual(reader.get_by_id("spam"), None)
+        self.assertEqual(reader.get_fingerprint_by_id("spam"), None)
+
+    def test_get_by_id_does_not_move_reader(self):
+        reader = chemfp.open(self.filename)
+        it = iter(reader)
+        self.assertEqual(next(it), expected[0])
+        self.assertEqual(reader.get_by_id(expected[50][0]), expected[50])
+        self.assertEqual(next(it), expected[1])
+
+    def test_seek(self):
+        reader = chemfp.open(self.filename)
+        for i in (0, 1, 13, 50, len(expected)-1, len(expected)):
+            reader.seek(i)
+            self.assertEqual(list(reader), expected[i:])
+
+    def test_seek_out_of_range(self):
+        reader = chemfp.open(self.filename)
+        with self.assertRaisesRegexp(IndexError, "out of range"):
+            reader.seek(-1)
+        with self.assertRaisesRegexp(IndexError, "out of range"):
+            reader.seek(len(expected)+1)
+
+    def test_iter_range(self):
+        reader = chemfp.open(self.filename)
+        self.assertEqual(list(reader.iter_range(10, 20)), expected[10:20])
+        self.assertEqual(list(reader.iter_range(90)), expected[90:])
+        self.assertEqual(list(reader.iter_range(20, 10)), [])
+        self.assertEqual(list(reader.iter_range(95, 200)), expected[95:])
+
+    def test_reset(self):
+        reader = chemfp.open(self.filename)
+        self.assertEqual(list(reader), expected)
+        reader.reset()
+        self.assertEqual(list(reader), expected)
+
+    def test_seek_closes_old_file(self):
+        reader = chemfp.open(self.filename)
+        first_infile = reader._infile
+        reader.seek(10)
+        self.assertTrue(first_infile.closed)
+        # Start the prefetch thread on the new file, then seek again
+        it = iter(reader)
+        self.assertEqual(next(it), expected[10])
+        self.assertEqual(next(it), expected[11])
+        second_infile = reader._infile
+        reader.seek(20)
+        self.assertTrue(second_infile.closed)
+        self.assertEqual(list(reader), expected[20:])
+
+    def test_search_after_seek(self):
+        reader = chemfp.open(self.filename)
+        reader.seek(40)
+        count = reader.count_tanimoto_hits_fp(expected[0][1], threshold=0.2)
+        arena = chemfp.load_fingerprints(expected[40:], reader.metadata)
+        self.assertEqual(count, arena.count_tanimoto_hits_fp(expected[0][1], threshold=0.2))
+
+class TestUncompressed(IndexMixin, unittest2.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.filename = _copy("queries.fps")
+        fps_index.build_fps_index(cls.filename)
+
+class TestSingleMemberGzip(IndexMixin, unittest2.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.filename = os.path.join(_tmpdir, "single.fps.gz")
+        _make_multimember_gzip(cls.filename, len(expected))
+        fps_index.build_fps_index(cls.filename)
+
+    def test_one_restart_point(self):
+        index = fps_index.find_fps_index(self.filename)
+        self.assertEqual(index._restart_points, [(0, 0)])
+
+    def test_member_larger_than_restart_interval(self):
+        destination = os.path.join(_tmpdir, "single_too_large.fpsidx")
+        with self.assertRaisesRegexp(ValueError, "gzip member at byte 0 decompresses to more than "
+                                     "the restart interval of 3000 bytes"):
+            fps_index.build_fps_index(self.filename, destination, restart_interval=3000)
+
+class TestMultiMemberGzip(IndexMixin, unittest2.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.filename = os.path.join(_tmpdir, "multi.fps.gz")
+        _make_multimember_gzip(cls.filename, 7)
+        fps_index.build_fps_index(cls.filename, restart_interval=3000)
+
+    def test_restart_points(self):
+        index = fps_index.find_fps_index(self.filename)
+        # Each member has 7 records of 266 bytes. The interval skips every other one.
+        self.assertEqual(len(index._restart_points), 8)
+        self.assertEqual(index._restart_points[0], (0, 0))
+        self.assertEqual(index._restart_points[1][1], 115 + 14*266)
+
+
+class TestIndexFile(unittest2.TestCase):
+    def test_default_filename(self):
+        filename = _copy("queries.fps", "default.fps")
+        self.assertEqual(fps_index.build_fps_index(filename), filename + ".fpsidx")
+        self.assertTrue(os.path.exists(filename + ".fpsidx"))
+        self.assertEqual(fps_index.get_fps_index_filename(filename), filename + ".fpsidx")
+
+    def test_explicit_filename(self):
+        filename = _copy("queries.fps", "explicit.fps")
+        index_filename = os.path.join(_tmpdir, "explicit.idx")
+        self.assertEqual(fps_index.build_fps_index(filename, index_filename), index_filename)
+        index = fps_index.open_fps_index(index_filename, filename)
+        self.assertEqual(index.num_records, len(expected))
+        self.assertEqual(fps_index.find_fps_index(filename), None)
+
+    def test_no_index(self):
+        reader = chemfp.open(_copy("queries.fps", "no_index.fps"))
+        with self.assertRaisesRegexp(TypeError, "does not have an up-to-date .fpsidx index"):
+            reader.get_by_id(expected[0][0])
+        with self.assertRaisesRegexp(TypeError, "does not have an up-to-date .fpsidx index"):
+            reader.seek(0)
+
+    def test_stale_index_is_ignored(self):
+        filename = _copy("queries.fps", "stale.fps")
+        fps_index.build_fps_index(filename)
+        self.assertNotEqual(fps_index.find_fps_index(filename), None)
+        with open(filename, "a") as outfile:
+            outfile.write("00" * 128 + "\tNEW\n")
+        self.assertEqual(fps_index.find_fps_index(filename), None)
+        self.assertEqual(chemfp.open(filename)._index, None)
+        with self.assertRaisesRegexp(ValueError, "out of date"):
+            fps_index.open_fps_index(filename + ".fpsidx")
+
+    def test_empty_file(self):
+        filename = os.path.join(_tmpdir, "empty.fps")
+        with open(filename, "w") as outfile:
+            outfile.write("#FPS1\n#num_bits=16\n")
+        fps_index.build_fps_index(filename)
+        reader = chemfp.open(filename)
+        self.assertEqual(reader.get_by_id("X"), None)
+        reader.seek(0)
+        self.assertEqual(list(reader), [])
+
+    def test_bad_fps_line(self):
+        filename = os.path.join(_tmpdir, "bad.fps")
+        with open(filename, "w") as outfile:
+            outfile.write("#FPS1\n#num_bits=16\nabcd\tA\nabc\tB\n")
+        with self.assertRaisesRegexp(fps_io.FPSParseError, "at line 4"):
+            fps_index.build_fps_index(filename)
+
+    def test_unsupported_compression(self):
+        with self.assertRaisesRegexp(ValueError, "Can only index uncompressed or gzip"):
+            fps_index.build_fps_index("spam.fps.bz2")
+
+    def test_not_an_fps_file(self):
+        with self.assertRaisesRegexp(ValueError, "Can only index FPS files"):
+            fps_index.build_fps_index("spam.fpb")
+
+    def test_bad_signature(self):
+        filename = _copy("queries.fps", "bad_signature.fps")
+        with open(filename + ".fpsidx", "wb") as outfile:
+            outfile.write("FPB1\r\n\0\0")
+        with self.assertRaisesRegexp(ParseError, "does not start with the fpsidx signature"):
+            fps_index.open_fps_index(filename + ".fpsidx")
+
+if __name__ == "__main__":
+    unittest2.main()
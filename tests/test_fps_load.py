@@ -0,0 +1,122 @@
+from __future__ import absolute_import, with_statement
+
+import unittest2
+import ctypes
+from cStringIO import StringIO
+
+import chemfp
+from chemfp import fps_io
+
+from support import fullpath
+
+def _load_with_python(source, **kwargs):
+    # Iterating over the (id, fingerprint) pairs uses the Python loader
+    reader = chemfp.open(source)
+    return chemfp.load_fingerprints(iter(reader), reader.metadata, **kwargs)
+
+def _fps(records, num_bits=16):
+    return "#FPS1\n#num_bits=%d\n" % (num_bits,) + "".join(records)
+
+
+class TestCLoader(unittest2.TestCase):
+    def _compare(self, source, **kwargs):
+        arena = chemfp.load_fingerprints(source, **kwargs)
+        expected = _load_with_python(source, **kwargs)
+        self.assertEqual(arena.ids, expected.ids)
+        self.assertEqual(list(arena), list(expected))
+        self.assertEqual(arena.popcount_indices, expected.popcount_indices)
+        self.assertEqual(arena.storage_size, expected.storage_size)
+        return arena
+
+    def test_reorder(self):
+        arena = self._compare(fullpath("queries.fps"))
+        self.assertEqual(len(arena), 100)
+        self.assertNotEqual(arena.popcount_indices, "")
+
+    def test_no_reorder(self):
+        arena = self._compare(fullpath("queries.fps"), reorder=False)
+        self.assertEqual(arena.popcount_indices, "")
+        self.assertEqual(list(arena), list(chemfp.open(fullpath("queries.fps"))))
+
+    def test_alignment(self):
+        for alignment in (1, 2, 4, 8, 16, 64):
+            arena = self._compare(fullpath("queries.fps"), alignment=alignment)
+            self.assertEqual(arena.storage_size % alignment, 0)
+
+    def test_gzip(self):
+        self._compare(fullpath("chebi_queries.fps.gz"))
+
+    def test_many_small_blocks(self):
+        reader = chemfp.open(fullpath("targets.fps"))
+        reader.block_size = 100
+        arena = chemfp.load_fingerprints(reader)
+        self.assertEqual(arena.ids, _load_with_python(fullpath("targets.fps")).ids)
+
+    def test_aligned_growth(self):
+        # Many small blocks make the arena grow, and maybe move, many times
+        for reorder in (True, False):
+            reader = chemfp.open(fullpath("targets.fps"))
+            reader.block_size = 100
+            arena = chemfp.load_fingerprints(reader, reorder=reorder, alignment=64)
+            expected = _load_with_python(fullpath("targets.fps"), reorder=reorder, alignment=64)
+            self.assertEqual(list(arena), list(expected))
+            self.assertEqual(arena.popcount_indices, expected.popcount_indices)
+            self.assertIs(type(arena.arena), str)
+            address = ctypes.cast(ctypes.c_char_p(arena.arena), ctypes.c_void_p).value
+            self.assertEqual((address + arena.start_padding) % 64, 0)
+            self.assertEqual(len(arena.arena) - arena.start_padding - arena.end_padding,
+                             len(arena) * arena.storage_size)
+
+    def test_crlf(self):
+        data = open(fullpath("queries.fps")).read().replace("\n", "\r\n")
+        arena = chemfp.load_fingerprints(StringIO(data))
+        self.assertEqual(arena.ids, _load_with_python(fullpath("queries.fps")).ids)
+
+    def test_extra_fields(self):
+        arena = chemfp.load_fingerprints(StringIO(_fps(["0100\tA\tspam\n", "ff00\tB\n"])),
+                                         reorder=False)
+        self.assertEqual(list(arena), [("A", "\x01\x00"), ("B", "\xff\x00")])
+
+    def test_padding_is_zero(self):
+        arena = chemfp.load_fingerprints(StringIO(_fps(["ffff\tA\n", "0f0f\tB\n"])),
+                                         alignment=8)
+        self.assertEqual(arena.storage_size, 8)
+        self.assertEqual(arena[0], ("B", "\x0f\x0f"))
+        self.assertEqual(str(buffer(arena.arena, arena.start_padding, 16)),
+                         "\x0f\x0f" + "\0"*6 + "\xff\xff" + "\0"*6)
+
+    def test_empty(self):
+        arena = chemfp.load_fingerprints(StringIO(_fps([])))
+        self.assertEqual(len(arena), 0)
+        self.assertEqual(list(arena.ids), [])
+
+    def test_id_lookup(self):
+        arena = chemfp.load_fingerprints(fullpath("queries.fps"))
+        self.assertEqual(arena.get_fingerprint_by_id(arena.ids[10]), arena[10][1])
+
+
+class TestCLoaderErrors(unittest2.TestCase):
+    def _check_error(self, records, lineno):
+        with self.assertRaisesRegexp(fps_io.FPSParseError, "at line %d of" % (lineno,)):
+            chemfp.load_fingerprints(StringIO(_fps(records)))
+
+    def test_bad_hex(self):
+        self._check_error(["0000\tA\n", "00g0\tB\n"], 4)
+
+    def test_wrong_length(self):
+        self._check_error(["0000\tA\n", "0000\tB\n", "000000\tC\n"], 5)
+
+    def test_missing_id(self):
+        self._check_error(["0000\n"], 3)
+
+    def test_missing_final_newline(self):
+        self._check_error(["0000\tA\n", "0000\tB"], 4)
+
+    def test_error_in_later_block(self):
+        reader = chemfp.open(StringIO(_fps(["0000\tA\n"] * 50 + ["000\tX\n"])))
+        reader.block_size = 20
+        with self.assertRaisesRegexp(fps_io.FPSParseError, "at line 53 of"):
+            chemfp.load_fingerprints(reader)
+
+if __name__ == "__main__":
+    unittest2.main()
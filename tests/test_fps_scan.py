@@ -0,0 +1,205 @@
+from __future__ import absolute_import, with_statement
+
+import os
+import gzip
+import time
+import shutil
+import threading
+import tempfile
+import unittest2
+
+import chemfp
+from chemfp import fps_search
+
+from support import fullpath
+
+_tmpdir = tempfile.mkdtemp(prefix="test_fps_scan")
+
+def tearDownModule():
+    shutil.rmtree(_tmpdir)
+
+def _make_fps(filename, num_copies, newline="\n", extra_line=""):
+    lines = open(fullpath("targets.fps")).readlines()
+    header = [line for line in lines if line[:1] == "#"]
+    records = [line for line in lines if line[:1] != "#"]
+    with open(filename, "wb") as outfile:
+        outfile.write("".join(header).replace("\n", newline))
+        for i in range(num_copies):
+            for record in records:
+                outfile.write(record.replace("\t", "\t%d-" % (i,), 1).replace("\n", newline))
+        outfile.write(extra_line)
+
+queries = chemfp.load_fingerprints(fullpath("queries.fps"))[:20].copy()
+
+def _sorted_hits(results):
+    return [sorted(result.get_ids_and_scores()) for result in results]
+
+
+class ScanMixin(object):
+    @classmethod
+    def setUpClass(cls):
+        cls.filename = os.path.join(_tmpdir, cls.__name__ + ".fps")
+        _make_fps(cls.filename, 10, cls.newline)
+        cls.targets = chemfp.load_fingerprints(cls.filename, reorder=False)
+
+    def setUp(self):
+        self._num_threads = chemfp.get_num_threads()
+        self._min_scan_range_size = fps_search.MIN_SCAN_RANGE_SIZE
+        chemfp.set_num_threads(3)
+        # Use many small ranges
+        fps_search.MIN_SCAN_RANGE_SIZE = 1000
+
+    def tearDown(self):
+        chemfp.set_num_threads(self._num_threads)
+        fps_search.MIN_SCAN_RANGE_SIZE = self._min_scan_range_size
+
+    def test_uses_ranges(self):
+        reader = chemfp.open(self.filename)
+        block_sources = reader._split_byte_ranges(12, 1000)
+        self.assertEqual(len(block_sources), 13)
+        self.assertEqual([fp for block_source in block_sources for block in block_source
+                                 for fp in block.splitlines(True)],
+                         [fp for block in chemfp.open(self.filename).iter_blocks()
+                                 for fp in block.splitlines(True)])
+        with self.assertRaisesRegexp(TypeError, "Already iterating|not at the start"):
+            reader.count_tanimoto_hits_arena(queries, 0.4)
+
+    def test_count(self):
+        counts = chemfp.open(self.filename).count_tanimoto_hits_arena(queries, 0.4)
+        self.assertEqual(list(counts), list(self.targets.count_tanimoto_hits_arena(queries, 0.4)))
+
+    def test_count_fp(self):
+        count = chemfp.open(self.filename).count_tanimoto_hits_fp(queries[0][1], 0.3)
+        self.assertEqual(count, self.targets.count_tanimoto_hits_fp(queries[0][1], 0.3))
+
+    def test_threshold(self):
+        results = chemfp.open(self.filename).threshold_tanimoto_search_arena(queries, 0.4)
+        expected = self.targets.threshold_tanimoto_search_arena(queries, 0.4)
+        self.assertEqual(_sorted_hits(results), _sorted_hits(expected))
+
+    def test_threshold_keeps_file_order(self):
+        results = chemfp.open(self.filename).threshold_tanimoto_search_arena(queries, 0.4)
+        positions = dict((id, i) for (i, id) in enumerate(self.targets.ids))
+        for result in results:
+            indices = [positions[id] for id in result.get_ids()]
+            self.assertEqual(indices, sorted(indices))
+
+    def test_threshold_fp(self):
+        result = chemfp.open(self.filename).threshold_tanimoto_search_fp(queries[1][1], 0.3)
+        expected = self.targets.threshold_tanimoto_search_fp(queries[1][1], 0.3)
+        self.assertEqual(sorted(result), sorted(expected.get_ids_and_scores()))
+
+    def test_knearest(self):
+        results = chemfp.open(self.filename).knearest_tanimoto_search_arena(queries, 5, 0.2)
+        # Use k=50 to get every hit tied with the 5th best one
+        expected = self.targets.knearest_tanimoto_search_arena(queries, 50, 0.2)
+        for result, expected_result in zip(results, expected):
+            self.assertEqual(len(result), min(5, len(expected_result)))
+            scores = result.get_scores()
+            self.assertEqual(scores, sorted(scores, reverse=True))
+            expected_hits = set(expected_result.get_ids_and_scores())
+            for hit in result:
+                self.assertIn(hit, expected_hits)
+            self.assertEqual(scores, [score for (id, score) in expected_result][:len(scores)])
+
+
+class TestScan(ScanMixin, unittest2.TestCase):
+    newline = "\n"
+
+class TestScanCRLF(ScanMixin, unittest2.TestCase):
+    newline = "\r\n"
+
+
+class TestScanErrors(unittest2.TestCase):
+    def setUp(self):
+        self._num_threads = chemfp.get_num_threads()
+        self._min_scan_range_size = fps_search.MIN_SCAN_RANGE_SIZE
+        chemfp.set_num_threads(3)
+        fps_search.MIN_SCAN_RANGE_SIZE = 1000
+        self.filename = os.path.join(_tmpdir, "bad.fps")
+        _make_fps(self.filename, 5, extra_line="12345\tspam\n")
+
+    def tearDown(self):
+        chemfp.set_num_threads(self._num_threads)
+        fps_search.MIN_SCAN_RANGE_SIZE = self._min_scan_range_size
+
+    def _get_lineno(self):
+        reader = chemfp.open(self.filename)
+        return reader._first_fp_lineno + 5*len(chemfp.load_fingerprints(fullpath("targets.fps")))
+
+    def test_count_error_lineno(self):
+        with self.assertRaisesRegexp(fps_search.FPSFormatError, "at line %d " % self._get_lineno()):
+            chemfp.open(self.filename).count_tanimoto_hits_arena(queries, 0.4)
+
+    def test_threshold_error_lineno(self):
+        with self.assertRaisesRegexp(fps_search.FPSFormatError, "at line %d " % self._get_lineno()):
+            chemfp.open(self.filename).threshold_tanimoto_search_arena(queries, 0.4)
+
+    def test_knearest_error_lineno(self):
+        with self.assertRaisesRegexp(fps_search.FPSFormatError, "at line %d " % self._get_lineno()):
+            chemfp.open(self.filename).knearest_tanimoto_search_arena(queries, 3, 0.4)
+
+
+class TestPrefetch(unittest2.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.filename = os.path.join(_tmpdir, "prefetch.fps.gz")
+        _make_fps(os.path.join(_tmpdir, "prefetch.fps"), 10)
+        data = open(os.path.join(_tmpdir, "prefetch.fps"), "rb").read()
+        outfile = gzip.open(cls.filename, "wb")
+        outfile.write(data)
+        outfile.close()
+        reader = chemfp.open(cls.filename)
+        reader.prefetch_blocks = 0
+        cls.expected = list(reader)
+
+    def test_prefetch(self):
+        reader = chemfp.open(self.filename)
+        reader.prefetch_blocks = 2
+        self.assertEqual(list(reader), self.expected)
+
+    def test_block_size(self):
+        for prefetch_blocks in (0, 3):
+            reader = chemfp.open(self.filename)
+            reader.block_size = 5000
+            reader.prefetch_blocks = prefetch_blocks
+            blocks = list(reader.iter_blocks())
+            for block in blocks[1:-1]:
+                self.assertTrue(5000 <= len(block) < 5000 + 300, len(block))
+            self.assertEqual("".join(blocks).count("\n"), len(self.expected))
+
+    def test_search_with_prefetch(self):
+        reader = chemfp.open(self.filename)
+        reader.block_size = 2000
+        counts = reader.count_tanimoto_hits_arena(queries, 0.4)
+        arena = chemfp.load_fingerprints(self.expected, reader.metadata)
+        self.assertEqual(list(counts), list(arena.count_tanimoto_hits_arena(queries, 0.4)))
+
+    def test_stop_early(self):
+        num_threads = threading.activeCount()
+        reader = chemfp.open(self.filename)
+        reader.block_size = 1000
+        reader.prefetch_blocks = 1
+        it = iter(reader)
+        self.assertEqual(next(it), self.expected[0])
+        self.assertEqual(next(it), self.expected[1])
+        del it
+        reader._block_reader = None
+        for i in range(100):
+            if threading.activeCount() == num_threads:
+                break
+            time.sleep(0.01)
+        self.assertEqual(threading.activeCount(), num_threads)
+
+    def test_read_error(self):
+        filename = os.path.join(_tmpdir, "truncated.fps.gz")
+        data = open(self.filename, "rb").read()
+        with open(filename, "wb") as outfile:
+            outfile.write(data[:len(data)//2])
+        reader = chemfp.open(filename)
+        reader.block_size = 1000
+        with self.assertRaises(IOError):
+            list(reader)
+
+if __name__ == "__main__":
+    unittest2.main()
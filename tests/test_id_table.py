@@ -0,0 +1,210 @@
+from __future__ import absolute_import, with_statement
+
+import array
+import pickle
+import unittest2
+from cStringIO import StringIO
+
+import chemfp
+from chemfp.id_table import IdIndex, IdTable, IdTableBuilder, make_id_block
+
+from support import fullpath
+
+class TestMakeIdBlock(unittest2.TestCase):
+    def test_block(self):
+        id_block, offsets = make_id_block(["A", "BC", "", "DEF"])
+        self.assertEqual(id_block, "A\nBC\n\nDEF\n")
+        self.assertEqual(list(offsets), [0, 2, 5, 6, 10])
+
+    def test_empty(self):
+        id_block, offsets = make_id_block([])
+        self.assertEqual(id_block, "")
+        self.assertEqual(list(offsets), [0])
+
+    def test_newline(self):
+        with self.assertRaisesRegexp(ValueError, "must not contain a newline"):
+            make_id_block(["A", "B\nC"])
+
+    def test_not_a_byte_string(self):
+        with self.assertRaisesRegexp(ValueError, "must be byte strings"):
+            make_id_block(["A", u"B"])
+
+
+class TestIdTable(unittest2.TestCase):
+    ids = ["A", "BC", "DEF", "", "GHIJ"]
+    def _make(self):
+        return IdTable.from_ids(self.ids)
+
+    def test_sequence(self):
+        table = self._make()
+        self.assertEqual(len(table), 5)
+        self.assertEqual(list(table), self.ids)
+        self.assertEqual(table[1], "BC")
+        self.assertEqual(table[-1], "GHIJ")
+        self.assertEqual(table[3], "")
+        with self.assertRaisesRegexp(IndexError, "id index out of range"):
+            table[5]
+        with self.assertRaisesRegexp(IndexError, "id index out of range"):
+            table[-6]
+
+    def test_equality(self):
+        table = self._make()
+        self.assertEqual(table, self.ids)
+        self.assertEqual(self.ids, table)
+        self.assertEqual(table, IdTable.from_ids(self.ids))
+        self.assertNotEqual(table, self.ids[:-1])
+        self.assertNotEqual(table, ["A", "BC", "DEF", "", "GHIj"])
+        self.assertFalse(table == "A\nBC\n")
+
+    def test_slices_share_the_id_block(self):
+        table = self._make()
+        subtable = table[1:4]
+        self.assertIsInstance(subtable, IdTable)
+        self.assertIs(subtable.id_block, table.id_block)
+        self.assertEqual(subtable, ["BC", "DEF", ""])
+        self.assertEqual(subtable[1:], ["DEF", ""])
+        self.assertEqual(table[4:2], [])
+        self.assertEqual(table[::2], ["A", "DEF", "GHIJ"])
+
+    def test_search_methods(self):
+        table = self._make()
+        self.assertIn("DEF", table)
+        self.assertNotIn("XYZ", table)
+        self.assertEqual(table.index("DEF"), 2)
+        self.assertEqual(table.count("A"), 1)
+        with self.assertRaisesRegexp(ValueError, "is not in the id table"):
+            table.index("XYZ")
+
+    def test_take(self):
+        table = self._make()
+        self.assertEqual(table.take([4, 0, 0, 2]), ["GHIJ", "A", "A", "DEF"])
+        self.assertEqual(table[1:].take([0, 3]), ["BC", "GHIJ"])
+        self.assertEqual(table.take([]), [])
+        with self.assertRaisesRegexp(IndexError, "id index out of range"):
+            table.take([5])
+
+    def test_get_id_block(self):
+        table = self._make()
+        self.assertEqual(table.get_id_block()[0], "A\nBC\nDEF\n\nGHIJ\n")
+        id_block, offsets = table[1:3].get_id_block()
+        self.assertEqual(id_block, "BC\nDEF\n")
+        self.assertEqual(list(array.array("I", offsets)), [0, 3, 7])
+
+    def test_pickle(self):
+        subtable = self._make()[2:]
+        self.assertEqual(pickle.loads(pickle.dumps(subtable)), ["DEF", "", "GHIJ"])
+
+
+class TestIdTableBuilder(unittest2.TestCase):
+    def test_table(self):
+        builder = IdTableBuilder()
+        for id in ["X", "Y", "Z"]:
+            builder.append(id)
+        ids = builder.get_ids()
+        self.assertIsInstance(ids, IdTable)
+        self.assertEqual(ids, ["X", "Y", "Z"])
+
+    def test_fallback_to_list(self):
+        builder = IdTableBuilder()
+        for id in ["X", u"Y", "Z\n"]:
+            builder.append(id)
+        ids = builder.get_ids()
+        self.assertIsInstance(ids, list)
+        self.assertEqual(ids, ["X", u"Y", "Z\n"])
+
+
+class TestArenaIds(unittest2.TestCase):
+    def test_loaded_arena_uses_id_table(self):
+        arena = chemfp.load_fingerprints(fullpath("queries.fps"))
+        self.assertIsInstance(arena.arena_ids, IdTable)
+        expected = [id for (id, fp) in chemfp.open(fullpath("queries.fps"))]
+        self.assertEqual(sorted(arena.ids), sorted(expected))
+
+    def test_reordered_ids_match_fingerprints(self):
+        expected = dict(chemfp.open(fullpath("queries.fps")))
+        arena = chemfp.load_fingerprints(fullpath("queries.fps"))
+        for id, fp in arena:
+            self.assertEqual(expected[id], fp)
+        subarena = arena.copy(indices=[10, 3, 7, 20], reorder=True)
+        self.assertIsInstance(subarena.arena_ids, IdTable)
+        for id, fp in subarena:
+            self.assertEqual(expected[id], fp)
+
+    def test_unusual_ids_use_a_list(self):
+        arena = chemfp.load_fingerprints([(u"A", "1234"), (u"B", "5678")],
+                                         chemfp.Metadata(num_bytes=4))
+        self.assertIsInstance(arena.arena_ids, list)
+        self.assertEqual(arena.get_index_by_id(u"B"), 1)
+
+    def test_fpb_ids_use_the_mapped_file(self):
+        arena = chemfp.load_fingerprints(fullpath("queries.fps"))
+        f = StringIO()
+        arena.save(f, "fpb")
+        arena2 = chemfp.open(StringIO(f.getvalue()), "fpb")
+        self.assertIsInstance(arena2.arena_ids, IdTable)
+        self.assertIsInstance(arena2.arena_ids.id_block, buffer)
+        self.assertEqual(arena2.ids, arena.ids)
+
+
+class TestIdIndex(unittest2.TestCase):
+    def test_lookup(self):
+        ids = ["ID%d" % i for i in range(1000)]
+        index = IdIndex.from_ids(ids)
+        self.assertEqual(len(index), 1000)
+        for i, id in enumerate(ids):
+            self.assertEqual(index.get(id), i)
+        self.assertEqual(index.get("ID1000"), None)
+        self.assertEqual(index.get("ID"), None)
+        self.assertEqual(index.get("ID10000", -1), -1)
+
+    def test_table_is_compact(self):
+        index = IdIndex.from_ids(["ID%d" % i for i in range(1000)])
+        self.assertEqual(len(index.table), 2048)
+
+    def test_empty(self):
+        index = IdIndex.from_ids([])
+        self.assertEqual(index.get("A"), None)
+        self.assertEqual(index.get(""), None)
+
+    def test_empty_id(self):
+        index = IdIndex.from_ids(["A", "", "B"])
+        self.assertEqual(index.get(""), 1)
+
+    def test_duplicates_use_last(self):
+        index = IdIndex.from_ids(["A", "B", "A", "C", "B"])
+        self.assertEqual(index.get("A"), 2)
+        self.assertEqual(index.get("B"), 4)
+        self.assertEqual(index.get("C"), 3)
+
+    def test_unicode_and_other_keys(self):
+        index = IdIndex.from_ids(["A", "B"])
+        self.assertEqual(index.get(u"B"), 1)
+        self.assertEqual(index.get(u"\N{SNOWMAN}"), None)
+        self.assertEqual(index.get(1), None)
+        self.assertIn("A", index)
+        self.assertNotIn("C", index)
+
+    def test_from_buffers(self):
+        id_block, offsets = make_id_block(["X", "YY", "ZZZ"])
+        index = IdIndex.from_id_block(3, buffer(id_block), buffer(offsets))
+        table = array.array("I", index.table).tostring()
+        index2 = IdIndex(3, id_block, offsets.tostring(), buffer(table))
+        self.assertEqual(index2.get("YY"), 1)
+        self.assertEqual(index2.get("ZZZ"), 2)
+
+    def test_from_id_table_slice(self):
+        table = IdTable.from_ids(["A", "B", "C", "D"])[1:3]
+        index = IdIndex.from_ids(table)
+        self.assertEqual(index.get("B"), 0)
+        self.assertEqual(index.get("C"), 1)
+        self.assertEqual(index.get("A"), None)
+        self.assertEqual(index.get("D"), None)
+
+    def test_bad_offsets(self):
+        with self.assertRaisesRegexp(ValueError, "offsets extend past the end of the id block"):
+            IdIndex.from_id_block(2, "A\n", array.array("I", [0, 2, 4]))
+        with self.assertRaisesRegexp(ValueError, "offsets is too small"):
+            IdIndex.from_id_block(3, "A\nB\n", array.array("I", [0, 2, 4]))
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -0,0 +1,89 @@
+from __future__ import absolute_import, with_statement
+
+import unittest2
+
+import chemfp
+import chemfp.search
+
+from support import fullpath
+
+queries = chemfp.load_fingerprints(fullpath("queries.fps"))
+targets = chemfp.load_fingerprints(fullpath("targets.fps"))
+
+def _sorted_rows(results):
+    return [sorted(result.get_indices_and_scores()) for result in results]
+
+def _collect(chunks):
+    starts = []
+    rows = []
+    for start, results in chunks:
+        starts.append(start)
+        rows.extend(_sorted_rows(results))
+    return starts, rows
+
+
+class TestIterThresholdSearch(unittest2.TestCase):
+    def test_same_as_arena_search(self):
+        expected = _sorted_rows(chemfp.search.threshold_tanimoto_search_arena(queries, targets, 0.4))
+        for chunk_rows in (1, 7, 100, 1000):
+            for prefetch_chunks in (0, 1, 3):
+                starts, rows = _collect(chemfp.search.iter_threshold_tanimoto_search_arena(
+                    queries, targets, 0.4, chunk_rows=chunk_rows, prefetch_chunks=prefetch_chunks))
+                self.assertEqual(starts, range(0, len(queries), chunk_rows))
+                self.assertEqual(rows, expected)
+
+    def test_chunk_sizes(self):
+        sizes = [len(results) for (start, results) in
+                 chemfp.search.iter_threshold_tanimoto_search_arena(queries, targets, 0.5, chunk_rows=30)]
+        self.assertEqual(sum(sizes), len(queries))
+        self.assertEqual(sizes[:-1], [30] * (len(sizes)-1))
+        self.assertLessEqual(sizes[-1], 30)
+
+    def test_target_ids(self):
+        for start, results in chemfp.search.iter_threshold_tanimoto_search_arena(
+                queries, targets, 0.5, chunk_rows=25):
+            self.assertIs(results.target_ids, targets.arena_ids)
+
+    def test_per_query_thresholds(self):
+        thresholds = [0.3 + (i % 5) * 0.1 for i in range(len(queries))]
+        expected = _sorted_rows(chemfp.search.threshold_tanimoto_search_arena(queries, targets, thresholds))
+        starts, rows = _collect(chemfp.search.iter_threshold_tanimoto_search_arena(
+            queries, targets, thresholds, chunk_rows=11))
+        self.assertEqual(rows, expected)
+
+    def test_max_score_and_score_type(self):
+        expected = _sorted_rows(chemfp.search.threshold_tanimoto_search_arena(
+            queries, targets, 0.4, max_score=0.8, interval="[)", score_type="float"))
+        starts, rows = _collect(chemfp.search.iter_threshold_tanimoto_search_arena(
+            queries, targets, 0.4, chunk_rows=20, max_score=0.8, interval="[)", score_type="float"))
+        self.assertEqual(rows, expected)
+
+    def test_empty_queries(self):
+        self.assertEqual(list(chemfp.search.iter_threshold_tanimoto_search_arena(queries[:0], targets)), [])
+
+    def test_stop_early(self):
+        chunks = chemfp.search.iter_threshold_tanimoto_search_arena(queries, targets, 0.4, chunk_rows=5)
+        start, results = next(chunks)
+        self.assertEqual(start, 0)
+        self.assertEqual(len(results), 5)
+        chunks.close()
+
+    def test_errors_are_raised_in_caller(self):
+        chunks = chemfp.search.iter_threshold_tanimoto_search_arena(
+            queries, targets, 0.4, chunk_rows=5, score_type="bad")
+        with self.assertRaisesRegexp(ValueError, "score_type must be one of"):
+            next(chunks)
+
+    def test_bad_parameters(self):
+        with self.assertRaisesRegexp(ValueError, "chunk_rows must be positive"):
+            chemfp.search.iter_threshold_tanimoto_search_arena(queries, targets, chunk_rows=0)
+        with self.assertRaisesRegexp(ValueError, "prefetch_chunks must not be negative"):
+            chemfp.search.iter_threshold_tanimoto_search_arena(queries, targets, prefetch_chunks=-1)
+        with self.assertRaisesRegexp(ValueError, "per-query thresholds cannot be used with max_score or interval"):
+            chemfp.search.iter_threshold_tanimoto_search_arena(
+                queries, targets, [0.5] * len(queries), max_score=0.9)
+        with self.assertRaises(ValueError):
+            chemfp.search.iter_threshold_tanimoto_search_arena(queries, targets, [0.5, 0.6])
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -0,0 +1,180 @@
+from __future__ import absolute_import, with_statement
+
+import os
+import ctypes
+import shutil
+import tempfile
+import unittest2
+
+import _chemfp
+import chemfp
+import chemfp.search
+from chemfp import bitops, lsh
+
+from support import fullpath
+
+targets = chemfp.load_fingerprints(fullpath("targets.fps"))
+queries = chemfp.load_fingerprints(fullpath("queries.fps"))[:30].copy()
+# Every fingerprint in the index must find itself
+self_queries = targets[20:50].copy(reorder=False)
+
+index = lsh.build_lsh_index(targets)
+
+def _recall(results, expected):
+    found = total = 0
+    for result, expected_result in zip(results, expected):
+        expected_ids = set(expected_result.get_ids())
+        found += len(expected_ids & set(result.get_ids()))
+        total += len(expected_ids)
+    return float(found) / total
+
+
+class TestKNearest(unittest2.TestCase):
+    def test_scores_are_exact(self):
+        results = index.knearest_tanimoto_search_arena(queries, k=5, threshold=0.0)
+        for (query_id, query_fp), result in zip(queries, results):
+            self.assertLessEqual(len(result), 5)
+            for target_id, score in result.get_ids_and_scores():
+                self.assertEqual(score, bitops.byte_tanimoto(
+                    query_fp, targets.get_fingerprint_by_id(target_id)))
+
+    def test_decreasing_scores(self):
+        results = index.knearest_tanimoto_search_arena(queries, k=10, threshold=0.0)
+        for result in results:
+            scores = result.get_scores()
+            self.assertEqual(list(scores), sorted(scores, reverse=True))
+
+    def test_threshold(self):
+        results = index.knearest_tanimoto_search_arena(queries, k=10, threshold=0.6)
+        for result in results:
+            for score in result.get_scores():
+                self.assertGreaterEqual(score, 0.6)
+
+    def test_finds_itself(self):
+        results = index.knearest_tanimoto_search_arena(self_queries, k=1, threshold=0.0)
+        for (query_id, query_fp), result in zip(self_queries, results):
+            self.assertEqual(len(result), 1)
+            self.assertEqual(result.get_scores()[0], 1.0)
+
+    def test_recall(self):
+        expected = chemfp.search.knearest_tanimoto_search_arena(self_queries, targets, 3, 0.5)
+        results = index.knearest_tanimoto_search_arena(self_queries, k=3, threshold=0.5)
+        self.assertGreater(_recall(results, expected), 0.8)
+
+    def test_fewer_probe_bands(self):
+        expected = chemfp.search.knearest_tanimoto_search_arena(self_queries, targets, 3, 0.3)
+        all_bands = index.knearest_tanimoto_search_arena(self_queries, k=3, threshold=0.3)
+        one_band = index.knearest_tanimoto_search_arena(self_queries, k=3, threshold=0.3,
+                                                        num_probe_bands=1)
+        self.assertGreaterEqual(_recall(all_bands, expected), _recall(one_band, expected))
+
+    def test_search_fp(self):
+        results = index.knearest_tanimoto_search_arena(queries, k=4, threshold=0.2)
+        for (query_id, query_fp), expected in zip(queries, results):
+            result = index.knearest_tanimoto_search_fp(query_fp, k=4, threshold=0.2)
+            self.assertEqual(result.get_ids_and_scores(), expected.get_ids_and_scores())
+
+    def test_k_zero(self):
+        results = index.knearest_tanimoto_search_arena(queries, k=0, threshold=0.0)
+        self.assertEqual(sum(len(result) for result in results), 0)
+
+    def test_subarena(self):
+        subtargets = targets[100:400]
+        subindex = lsh.build_lsh_index(subtargets)
+        results = subindex.knearest_tanimoto_search_arena(queries, k=3, threshold=0.0)
+        subtarget_ids = set(subtargets.ids)
+        for result in results:
+            self.assertTrue(set(result.get_ids()) <= subtarget_ids)
+
+    def test_threads_give_the_same_results(self):
+        num_threads = chemfp.get_num_threads()
+        try:
+            chemfp.set_num_threads(1)
+            index1 = lsh.build_lsh_index(targets, num_bands=8)
+            expected = index1.knearest_tanimoto_search_arena(queries, k=5, threshold=0.0)
+            chemfp.set_num_threads(max(2, chemfp.get_max_threads()))
+            index2 = lsh.build_lsh_index(targets, num_bands=8)
+            self.assertEqual(buffer(index1._entries)[:], buffer(index2._entries)[:])
+            results = index2.knearest_tanimoto_search_arena(queries, k=5, threshold=0.0)
+        finally:
+            chemfp.set_num_threads(num_threads)
+        for result, expected_result in zip(results, expected):
+            self.assertEqual(result.get_ids_and_scores(), expected_result.get_ids_and_scores())
+
+
+class TestBadArguments(unittest2.TestCase):
+    def test_bad_num_bands(self):
+        with self.assertRaisesRegexp(ValueError, "num_bands or rows_per_band is out of range"):
+            lsh.build_lsh_index(targets, num_bands=0)
+
+    def test_bad_rows_per_band(self):
+        with self.assertRaisesRegexp(ValueError, "num_bands or rows_per_band is out of range"):
+            lsh.build_lsh_index(targets, rows_per_band=65)
+
+    def test_bad_seed(self):
+        with self.assertRaisesRegexp(ValueError, "seed must be"):
+            lsh.build_lsh_index(targets, seed=-1)
+
+    def test_bad_num_probe_bands(self):
+        with self.assertRaisesRegexp(ValueError, "num_probe_bands must be between 1 and 32"):
+            index.knearest_tanimoto_search_arena(queries, num_probe_bands=33)
+
+    def test_different_sizes(self):
+        other = chemfp.load_fingerprints([("A", "\0"*8)], chemfp.Metadata(num_bits=64))
+        with self.assertRaisesRegexp(ValueError, "query_arena has 64 bits while target_arena has 1021 bits"):
+            index.knearest_tanimoto_search_arena(other)
+
+    def test_tables_too_small(self):
+        entries = (ctypes.c_uint32 * (2 * 32 * len(targets) - 1))()
+        with self.assertRaisesRegexp(ValueError, "LSH tables are too small for the arena"):
+            _chemfp.make_lsh_index(targets.num_bits, targets.start_padding, targets.end_padding,
+                                   targets.storage_size, targets.arena, targets.start, targets.end,
+                                   32, 4, 0, entries)
+
+    def test_read_only_tables(self):
+        entries = "\0" * (8 * 32 * len(targets))
+        with self.assertRaises(TypeError):
+            _chemfp.make_lsh_index(targets.num_bits, targets.start_padding, targets.end_padding,
+                                   targets.storage_size, targets.arena, targets.start, targets.end,
+                                   32, 4, 0, entries)
+
+
+class TestSaveAndLoad(unittest2.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, "targets.fpb.lsh")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_filename(self):
+        self.assertEqual(lsh.get_lsh_index_filename("targets.fpb"), "targets.fpb.lsh")
+
+    def test_round_trip(self):
+        index.save(self.filename)
+        loaded = lsh.load_lsh_index(self.filename, targets)
+        self.assertEqual(loaded.num_bands, index.num_bands)
+        self.assertEqual(loaded.rows_per_band, index.rows_per_band)
+        self.assertEqual(loaded.seed, index.seed)
+        expected = index.knearest_tanimoto_search_arena(queries, k=5, threshold=0.1)
+        results = loaded.knearest_tanimoto_search_arena(queries, k=5, threshold=0.1)
+        for result, expected_result in zip(results, expected):
+            self.assertEqual(result.get_ids_and_scores(), expected_result.get_ids_and_scores())
+
+    def test_different_arena(self):
+        index.save(self.filename)
+        with self.assertRaisesRegexp(ValueError, "is for 100 fingerprints, not 50"):
+            lsh.load_lsh_index(self.filename, targets[:50])
+        other = targets.copy(reorder=False)
+        shuffled = other.copy(indices=range(len(other))[::-1], reorder=False)
+        with self.assertRaisesRegexp(ValueError, "is for a different arena"):
+            lsh.load_lsh_index(self.filename, shuffled)
+
+    def test_not_an_index(self):
+        with open(self.filename, "wb") as outfile:
+            outfile.write("FPB1\r\n\0\0")
+        with self.assertRaisesRegexp(chemfp.ParseError, "does not start with the LSH index signature"):
+            lsh.load_lsh_index(self.filename, targets)
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -0,0 +1,176 @@
+from __future__ import absolute_import, with_statement
+
+import unittest2
+
+import chemfp
+import chemfp.search
+from chemfp import bitops
+
+from support import fullpath
+
+targets = chemfp.load_fingerprints(fullpath("targets.fps"))
+unsorted_targets = chemfp.load_fingerprints(fullpath("targets.fps"), reorder=False)
+
+def _make_queries():
+    # Include some targets so there are identical fingerprints
+    queries = chemfp.load_fingerprints(fullpath("queries.fps"))[:10]
+    records = list(queries) + [("T%d" % i, unsorted_targets[i][1]) for i in (0, 17, 50, 51)]
+    return chemfp.load_fingerprints(records, queries.metadata, reorder=False)
+
+queries = _make_queries()
+
+def _in_interval(score, min_score, max_score, interval):
+    if interval[0] == "[":
+        if score < min_score:
+            return False
+    elif score <= min_score:
+        return False
+    if interval[1] == "]":
+        return score <= max_score
+    return score < max_score
+
+def _hits(query_fp, targets, min_score, max_score, interval, skip=None):
+    return sorted((id, score) for (i, (id, fp)) in enumerate(targets)
+                      if i != skip
+                      for score in [bitops.byte_tanimoto(query_fp, fp)]
+                      if _in_interval(score, min_score, max_score, interval))
+
+def _best_scores(hits, k):
+    return sorted([score for (id, score) in hits], reverse=True)[:k]
+
+# (threshold, max_score, interval)
+RANGES = [(0.4, 0.8, "[]"), (0.4, 0.8, "()"), (0.5, 1.0, "[)"),
+          (0.0, 0.5, "(]"), (0.3, None, "()"), (0.6, 0.6, "[]")]
+
+def _max_score(max_score):
+    if max_score is None:
+        return float("inf")
+    return max_score
+
+
+class MaxScoreMixin(object):
+    def test_count_fp(self):
+        for threshold, max_score, interval in RANGES:
+            for query_id, query_fp in queries:
+                self.assertEqual(
+                    chemfp.search.count_tanimoto_hits_fp(query_fp, self.targets, threshold,
+                                                         max_score, interval),
+                    len(_hits(query_fp, self.targets, threshold, _max_score(max_score), interval)))
+
+    def test_count_arena(self):
+        for threshold, max_score, interval in RANGES:
+            counts = chemfp.search.count_tanimoto_hits_arena(queries, self.targets, threshold,
+                                                             max_score, interval)
+            self.assertEqual(list(counts),
+                             [len(_hits(fp, self.targets, threshold, _max_score(max_score), interval))
+                                  for (id, fp) in queries])
+
+    def test_threshold_fp(self):
+        query_fp = queries[11][1]
+        for threshold, max_score, interval in RANGES:
+            result = chemfp.search.threshold_tanimoto_search_fp(query_fp, self.targets, threshold,
+                                                                max_score, interval)
+            self.assertEqual(sorted(result.get_ids_and_scores()),
+                             _hits(query_fp, self.targets, threshold, _max_score(max_score), interval))
+
+    def test_threshold_arena(self):
+        for threshold, max_score, interval in RANGES:
+            results = chemfp.search.threshold_tanimoto_search_arena(queries, self.targets, threshold,
+                                                                    max_score, interval)
+            for (query_id, query_fp), result in zip(queries, results):
+                self.assertEqual(sorted(result.get_ids_and_scores()),
+                                 _hits(query_fp, self.targets, threshold, _max_score(max_score),
+                                       interval))
+
+    def test_knearest_arena(self):
+        for threshold, max_score, interval in RANGES:
+            results = chemfp.search.knearest_tanimoto_search_arena(queries, self.targets, 4, threshold,
+                                                                   max_score, interval)
+            for (query_id, query_fp), result in zip(queries, results):
+                self.assertEqual(list(result.get_scores()),
+                                 _best_scores(_hits(query_fp, self.targets, threshold,
+                                                    _max_score(max_score), interval), 4))
+
+    def test_knearest_excludes_identical(self):
+        # The identical fingerprints don't use up the k-nearest slots
+        results = chemfp.search.knearest_tanimoto_search_arena(queries, self.targets, 3, 0.0,
+                                                               1.0, "[)")
+        for (query_id, query_fp), result in zip(queries, results):
+            scores = list(result.get_scores())
+            self.assertEqual(len(scores), 3)
+            self.assertLess(scores[0], 1.0)
+            self.assertEqual(scores, _best_scores(_hits(query_fp, self.targets, 0.0, 1.0, "[)"), 3))
+        with_identical = chemfp.search.knearest_tanimoto_search_arena(queries, self.targets, 3, 0.0)
+        self.assertEqual(with_identical[-1].get_scores()[0], 1.0)
+
+    def test_symmetric(self):
+        for threshold, max_score, interval in RANGES:
+            counts = chemfp.search.count_tanimoto_hits_symmetric(
+                self.targets, threshold, batch_size=7, max_score=max_score, interval=interval)
+            results = chemfp.search.threshold_tanimoto_search_symmetric(
+                self.targets, threshold, batch_size=7, max_score=max_score, interval=interval)
+            knearest = chemfp.search.knearest_tanimoto_search_symmetric(
+                self.targets, 3, threshold, batch_size=7, max_score=max_score, interval=interval)
+            for i, (id, fp) in enumerate(self.targets):
+                expected = _hits(fp, self.targets, threshold, _max_score(max_score), interval, skip=i)
+                self.assertEqual(counts[i], len(expected))
+                self.assertEqual(sorted(results[i].get_ids_and_scores()), expected)
+                self.assertEqual(list(knearest[i].get_scores()), _best_scores(expected, 3))
+
+    def test_symmetric_upper_triangle(self):
+        results = chemfp.search.threshold_tanimoto_search_symmetric(
+            self.targets, 0.4, include_lower_triangle=False, max_score=0.9, interval="[)")
+        for i, (id, fp) in enumerate(self.targets):
+            expected = [hit for hit in _hits(fp, self.targets, 0.4, 0.9, "[)", skip=i)
+                            if self.targets.ids.index(hit[0]) > i]
+            self.assertEqual(sorted(results[i].get_ids_and_scores()), expected)
+        full = chemfp.search.threshold_tanimoto_search_symmetric(
+            self.targets, 0.4, max_score=0.9, interval="[)")
+        self.assertEqual(sum(map(len, full)), 2*sum(map(len, results)))
+
+    def test_tversky(self):
+        query_fp = queries[12][1]
+        result = chemfp.search.threshold_tversky_search_fp(query_fp, self.targets, 0.4, 1.0, 1.0,
+                                                           0.8, "(]")
+        self.assertEqual(sorted(result.get_ids_and_scores()),
+                         _hits(query_fp, self.targets, 0.4, 0.8, "(]"))
+
+    def test_dice(self):
+        query_fp = queries[3][1]
+        counts = chemfp.search.count_hits_fp(query_fp, self.targets, 0.4, "dice", 0.7, "[)")
+        expected = 0
+        for id, fp in self.targets:
+            a, b = bitops.byte_popcount(query_fp), bitops.byte_popcount(fp)
+            score = 2.0 * bitops.byte_intersect_popcount(query_fp, fp) / (a + b)
+            expected += _in_interval(score, 0.4, 0.7, "[)")
+        self.assertEqual(counts, expected)
+
+
+class TestSortedArena(MaxScoreMixin, unittest2.TestCase):
+    targets = targets
+
+class TestUnsortedArena(MaxScoreMixin, unittest2.TestCase):
+    targets = unsorted_targets
+
+
+class TestErrors(unittest2.TestCase):
+    def test_distance_metric(self):
+        with self.assertRaisesRegexp(ValueError, "only supported for similarity metrics"):
+            chemfp.search.count_hits_arena(queries, targets, 10, "hamming", max_score=20)
+        with self.assertRaisesRegexp(ValueError, "only supported for similarity metrics"):
+            chemfp.search.threshold_search_arena(queries, targets, 10, "euclidean", interval="()")
+
+    def test_bad_interval(self):
+        with self.assertRaisesRegexp(ValueError, "First interval character"):
+            chemfp.search.count_tanimoto_hits_arena(queries, targets, 0.5, 0.9, "<]")
+        with self.assertRaisesRegexp(ValueError, "Second interval character"):
+            chemfp.search.knearest_tanimoto_search_arena(queries, targets, 3, 0.5, 0.9, "[>")
+
+    def test_empty_range(self):
+        self.assertEqual(list(chemfp.search.count_tanimoto_hits_arena(queries, targets, 0.8, 0.5)),
+                         [0] * len(queries))
+        self.assertEqual(chemfp.search.count_tanimoto_hits_fp(queries[0][1], targets, 0.5, 0.5, "[)"),
+                         0)
+
+if __name__ == "__main__":
+    unittest2.main()
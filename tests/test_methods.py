@@ -2,12 +2,18 @@
 
 from __future__ import absolute_import, with_statement
 import unittest2
+import os
+import sys
+import json
+import shutil
+import tempfile
 from cStringIO import StringIO
 
 from support import fullpath
 
 import chemfp
 import chemfp.bitops
+import chemfp.search
 import _chemfp
 
 set_alignment_method = chemfp.bitops.set_alignment_method
@@ -23,7 +29,7 @@ available_methods = chemfp.bitops.get_methods()
 alignment_methods = chemfp.bitops.get_alignment_methods()
 
 
-all_methods = dict.fromkeys("LUT8-1 LUT8-4 LUT16-4 Lauradoux POPCNT Gillies ssse3".split())
+all_methods = dict.fromkeys("LUT8-1 LUT8-4 LUT16-4 Lauradoux POPCNT Gillies ssse3 avx2 avx512".split())
 
 class TestMethods(unittest2.TestCase):
     def test_no_duplicates(self):
@@ -44,7 +50,8 @@ class TestMethods(unittest2.TestCase):
         with self.assertRaisesRegexp(IndexError, "method index is out of range"):
             _chemfp.get_method_name(_chemfp.get_num_methods())
 
-all_alignments = dict.fromkeys("align1 align4 align8-small align8-large align-ssse3".split())
+all_alignments = dict.fromkeys(
+    "align1 align4 align8-small align8-large align-ssse3 align-avx2 align-avx512".split())
 
 class TestAlignments(unittest2.TestCase):
     def test_no_duplicates(self):
@@ -107,6 +114,31 @@ class TestAlignments(unittest2.TestCase):
         self.assertEquals(get_alignment_method("align-ssse3"), "ssse3")
         set_alignment_method("align-ssse3", method)
 
+    def test_cannot_use_avx_method_for_shorter_alignment(self):
+        msg = "Mismatch between popcount method and alignment type"
+        if "avx2" in available_methods:
+            for alignment in ("align1", "align4", "align8-small", "align8-large"):
+                with self.assertRaisesRegexp(ValueError, msg):
+                    set_alignment_method(alignment, "avx2")
+        if "avx512" in available_methods:
+            for alignment in ("align8-large", "align-avx2"):
+                with self.assertRaisesRegexp(ValueError, msg):
+                    set_alignment_method(alignment, "avx512")
+
+
+def _disable_avx():
+    # Make sure the AVX alignments aren't used, so the tests use the
+    # 8-byte aligned methods even when the arena is 32 or 64 byte aligned.
+    # Returns the old settings.
+    old = {}
+    for alignment in ("align-avx2", "align-avx512"):
+        old[alignment] = get_alignment_method(alignment)
+        set_alignment_method(alignment, "LUT8-1")
+    return old
+
+def _restore(old):
+    for alignment, method in old.items():
+        set_alignment_method(alignment, method)
 
 
 class TestAlign8SmallMethods(unittest2.TestCase):
@@ -114,10 +146,12 @@ class TestAlign8SmallMethods(unittest2.TestCase):
         self.small_method = get_alignment_method("align8-small")
         self.large_method = get_alignment_method("align8-large")
         self.ssse3_method = get_alignment_method("align-ssse3")
+        self.avx_methods = _disable_avx()
     def tearDown(self):
         set_alignment_method("align8-small", self.small_method)
         set_alignment_method("align8-large", self.large_method)
         set_alignment_method("align-ssse3", self.ssse3_method)
+        _restore(self.avx_methods)
         
     def _doit(self, method):
         for alignment in ("align8-small", "align8-large", "align-ssse3"):
@@ -159,9 +193,11 @@ class TestAlign8LargeMethods(unittest2.TestCase):
     def setUp(self):
         self.large_method = get_alignment_method("align8-large")
         self.ssse3_method = get_alignment_method("align-ssse3")
+        self.avx_methods = _disable_avx()
     def tearDown(self):
         set_alignment_method("align8-large", self.large_method)
         set_alignment_method("align-ssse3", self.ssse3_method)
+        _restore(self.avx_methods)
         
     def _doit(self, method, use_ssse3=False):
         set_alignment_method("align8-large", method)
@@ -209,7 +245,94 @@ class TestAlign8LargeMethods(unittest2.TestCase):
     @unittest2.skipIf("POPCNT" not in available_methods, "CPU does not implement POPCNT")
     def test_popcnt(self):
         self._doit("POPCNT")
-        
+
+
+def _random_arena(num_bits, alignment, n=200):
+    import random
+    rng = random.Random(num_bits)
+    num_bytes = (num_bits+7)//8
+    fps = []
+    for i in range(n):
+        # Vary the density so there are hits at different thresholds
+        value = rng.getrandbits(num_bits)
+        for j in range(rng.randrange(4)):
+            value &= rng.getrandbits(num_bits)
+        fp = ("%0*x" % (num_bytes*2, value)).decode("hex")[::-1]
+        fps.append(("ID%d" % i, fp))
+    return chemfp.load_fingerprints(fps, chemfp.Metadata(num_bits=num_bits),
+                                    alignment=alignment)
+
+class TestAVXMethods(unittest2.TestCase):
+    def setUp(self):
+        self._alignment_methods = chemfp.bitops.get_alignment_methods()
+    def tearDown(self):
+        for k,v in self._alignment_methods.items():
+            set_alignment_method(k, v)
+
+    def _doit(self, alignment, method, alignment_size):
+        for num_bits in (166, 256, 881, 1000, 1024, 2048, 4096):
+            arena = _random_arena(num_bits, alignment_size)
+            self.assertEquals(arena.alignment, alignment_size)
+            _disable_avx()
+            expected_counts = chemfp.search.count_tanimoto_hits_symmetric(arena, 0.3)
+            expected = chemfp.search.threshold_tanimoto_search_arena(arena, arena, 0.3)
+            set_alignment_method(alignment, method)
+            self.assertEquals(get_alignment_method(alignment), method)
+            # Use new arenas so the popcounts are computed with the AVX method
+            arena = _random_arena(num_bits, alignment_size)
+            self.assertEquals(list(chemfp.search.count_tanimoto_hits_symmetric(arena, 0.3)),
+                              list(expected_counts))
+            results = chemfp.search.threshold_tanimoto_search_arena(arena, arena, 0.3)
+            for result, expected_result in zip(results, expected):
+                self.assertEquals(result.get_ids_and_scores(), expected_result.get_ids_and_scores())
+
+    @unittest2.skipIf("avx2" not in available_methods, "CPU does not implement AVX2")
+    def test_avx2(self):
+        self._doit("align-avx2", "avx2", 32)
+
+    @unittest2.skipIf("avx2" not in available_methods, "CPU does not implement AVX2")
+    def test_avx2_with_64_byte_alignment(self):
+        self._doit("align-avx512", "avx2", 64)
+
+    @unittest2.skipIf("avx512" not in available_methods, "CPU does not implement AVX-512 VPOPCNTDQ")
+    def test_avx512(self):
+        self._doit("align-avx512", "avx512", 64)
+
+
+class TestFixedSizeMethods(unittest2.TestCase):
+    # The POPCNT and AVX-512 methods have unrolled versions for
+    # 166, 881, 1024, 2048 and 4096 bits
+    def setUp(self):
+        self._alignment_methods = chemfp.bitops.get_alignment_methods()
+    def tearDown(self):
+        for k,v in self._alignment_methods.items():
+            set_alignment_method(k, v)
+
+    @unittest2.skipIf("POPCNT" not in available_methods, "CPU does not implement POPCNT")
+    def test_popcnt(self):
+        _disable_avx()
+        for num_bits in (166, 881, 1024, 2048, 4096):
+            arena = _random_arena(num_bits, 8)
+            for alignment in ("align8-small", "align8-large"):
+                set_alignment_method(alignment, "LUT8-4")
+            expected = chemfp.search.threshold_tanimoto_search_arena(arena, arena, 0.2)
+            for alignment in ("align8-small", "align8-large"):
+                set_alignment_method(alignment, "POPCNT")
+            results = chemfp.search.threshold_tanimoto_search_arena(arena, arena, 0.2)
+            for result, expected_result in zip(results, expected):
+                self.assertEquals(result.get_ids_and_scores(), expected_result.get_ids_and_scores())
+
+    def test_byte_tanimoto(self):
+        # Compare the search scores to the general-purpose byte_tanimoto()
+        for num_bits in (166, 881, 1024, 2048, 4096):
+            arena = _random_arena(num_bits, chemfp.arena.get_optimal_alignment(num_bits), n=30)
+            results = chemfp.search.threshold_tanimoto_search_arena(arena, arena, 0.0)
+            for (query_id, query_fp), result in zip(arena, results):
+                scores = dict(result.get_ids_and_scores())
+                for target_id, target_fp in arena:
+                    self.assertEquals(scores[target_id],
+                                      chemfp.bitops.byte_tanimoto(query_fp, target_fp))
+
 
 class TestSelectFastestMethod(unittest2.TestCase):
     def setUp(self):
@@ -236,6 +359,86 @@ class TestSelectFastestMethod(unittest2.TestCase):
         best_methods2 = chemfp.bitops.get_alignment_methods()
         self.assertEquals(best_methods1, best_methods2) # This might fail if two methods have nearly identical timings
 
+class TestCalibration(unittest2.TestCase):
+    def setUp(self):
+        self._alignment_methods = chemfp.bitops.get_alignment_methods()
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, "subdir", "calibration.json")
+    def tearDown(self):
+        for k,v in self._alignment_methods.items():
+            set_alignment_method(k, v)
+        shutil.rmtree(self.dirname)
+
+    def _set_all(self, method):
+        for alignment in all_alignments:
+            set_alignment_method(alignment, method)
+
+    def test_save_and_load(self):
+        chemfp.bitops.save_calibration(self.filename)
+        self._set_all("LUT8-1")
+        self.assertTrue(chemfp.bitops.load_calibration(self.filename))
+        self.assertEquals(chemfp.bitops.get_alignment_methods(), self._alignment_methods)
+
+    def test_key(self):
+        key = chemfp.bitops.get_calibration_key()
+        self.assertIn(chemfp.__version__, key)
+        for method in available_methods:
+            self.assertIn(method, key)
+        chemfp.bitops.save_calibration(self.filename)
+        with open(self.filename) as f:
+            self.assertEquals(json.load(f).keys(), [key])
+
+    def test_missing_file(self):
+        self._set_all("LUT8-1")
+        self.assertFalse(chemfp.bitops.load_calibration(self.filename))
+        self.assertEquals(get_alignment_method("align8-large"), "LUT8-1")
+
+    def test_other_machines_are_kept(self):
+        os.mkdir(os.path.dirname(self.filename))
+        with open(self.filename, "w") as f:
+            json.dump({"chemfp/0.9 x86_64 Other CPU [LUT8-1]": {"align1": "LUT8-1"}}, f)
+        self.assertFalse(chemfp.bitops.load_calibration(self.filename))
+        chemfp.bitops.save_calibration(self.filename)
+        with open(self.filename) as f:
+            calibration = json.load(f)
+        self.assertEquals(sorted(calibration),
+                          sorted(["chemfp/0.9 x86_64 Other CPU [LUT8-1]",
+                                  chemfp.bitops.get_calibration_key()]))
+
+    def test_bad_file(self):
+        os.mkdir(os.path.dirname(self.filename))
+        with open(self.filename, "w") as f:
+            f.write("[This is not JSON")
+        with self.assertRaisesRegexp(ValueError, "Cannot parse calibration file"):
+            chemfp.bitops.load_calibration(self.filename)
+
+    def test_unknown_method(self):
+        os.mkdir(os.path.dirname(self.filename))
+        with open(self.filename, "w") as f:
+            json.dump({chemfp.bitops.get_calibration_key(): {"align1": "LUT8-1",
+                                                              "align4": "Spam"}}, f)
+        self._set_all("LUT8-1")
+        with self.assertRaisesRegexp(ValueError, "Unknown method u?'Spam'"):
+            chemfp.bitops.load_calibration(self.filename)
+
+    def test_environment_variable(self):
+        chemfp.bitops.save_calibration(self.filename)
+        self._set_all("LUT8-1")
+        chemfp.bitops.use_environment_variables({"CHEMFP-CALIBRATION": self.filename,
+                                                  "CHEMFP-ALIGN1": "LUT8-1"})
+        expected = dict(self._alignment_methods, align1="LUT8-1")
+        self.assertEquals(chemfp.bitops.get_alignment_methods(), expected)
+
+    def test_environment_variable_without_calibration(self):
+        old_stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            chemfp.bitops.use_environment_variables({"CHEMFP-CALIBRATION": self.filename})
+            msg = sys.stderr.getvalue()
+        finally:
+            sys.stderr = old_stderr
+        self.assertIn("No calibration for this machine", msg)
+
 # Tests based on coverage analysis
 class TestErrorConditions(unittest2.TestCase):
     def test_get_unknown_alignment(self):
@@ -0,0 +1,210 @@
+from __future__ import absolute_import, with_statement
+
+import math
+import unittest2
+
+import chemfp
+import chemfp.search
+from chemfp import bitops
+
+from support import fullpath
+
+queries = chemfp.load_fingerprints(fullpath("queries.fps"))[:20].copy()
+targets = chemfp.load_fingerprints(fullpath("targets.fps"))
+unsorted_targets = chemfp.load_fingerprints(fullpath("targets.fps"), reorder=False)
+
+def _dice(a, b, c):
+    if a + b == 0:
+        return 0.0
+    return (2.0 * c) / (a + b)
+
+def _cosine(a, b, c):
+    if a == 0 or b == 0:
+        return 0.0
+    return c / math.sqrt(float(a) * b)
+
+def _hamming(a, b, c):
+    return float(a + b - 2*c)
+
+def _euclidean(a, b, c):
+    return math.sqrt(a + b - 2*c)
+
+# (metric name, scoring function, threshold)
+METRICS = [("dice", _dice, 0.5), ("dice", _dice, 0.8),
+           ("cosine", _cosine, 0.4), ("cosine", _cosine, 0.75),
+           ("hamming", _hamming, 120), ("hamming", _hamming, 40),
+           ("euclidean", _euclidean, 11.0), ("euclidean", _euclidean, 6.5)]
+
+def _metric_hits(query_fp, targets, metric, score_func, threshold, skip=None):
+    is_distance = chemfp.search.Metric(metric).is_distance
+    a = bitops.byte_popcount(query_fp)
+    hits = []
+    for i, (id, fp) in enumerate(targets):
+        if i == skip:
+            continue
+        score = score_func(a, bitops.byte_popcount(fp), bitops.byte_intersect_popcount(query_fp, fp))
+        if is_distance:
+            if score <= threshold:
+                hits.append((id, score))
+        elif score >= threshold:
+            hits.append((id, score))
+    return sorted(hits)
+
+def _best_scores(metric, hits, k):
+    is_distance = chemfp.search.Metric(metric).is_distance
+    return sorted([score for (id, score) in hits], reverse=not is_distance)[:k]
+
+
+class TestMetric(unittest2.TestCase):
+    def test_names(self):
+        self.assertEqual(chemfp.search.get_metric_names(),
+                         ["tanimoto", "tversky", "dice", "cosine", "hamming", "euclidean"])
+
+    def test_is_distance(self):
+        self.assertEqual([chemfp.search.Metric(name).is_distance
+                              for name in chemfp.search.get_metric_names()],
+                         [False, False, False, False, True, True])
+
+    def test_repr(self):
+        self.assertEqual(repr(chemfp.search.Metric("dice")), "Metric('dice')")
+        self.assertEqual(repr(chemfp.search.Metric("tversky", 0.9, 0.1)),
+                         "Metric('tversky', alpha=0.9, beta=0.1)")
+
+    def test_unknown_metric(self):
+        with self.assertRaisesRegexp(ValueError, "Unknown metric 'spam'"):
+            chemfp.search.Metric("spam")
+        with self.assertRaisesRegexp(ValueError, "Unknown metric"):
+            chemfp.search.count_hits_arena(queries, targets, 0.5, "Dice")
+
+    def test_negative_weights(self):
+        with self.assertRaisesRegexp(ValueError, "alpha and beta must not be negative"):
+            chemfp.search.Metric("tversky", -0.5, 0.5)
+
+
+class ArenaMixin(object):
+    def test_count_fp(self):
+        for metric, score_func, threshold in METRICS:
+            for query_id, query_fp in queries:
+                self.assertEqual(
+                    chemfp.search.count_hits_fp(query_fp, self.targets, threshold, metric),
+                    len(_metric_hits(query_fp, self.targets, metric, score_func, threshold)))
+
+    def test_count_arena(self):
+        for metric, score_func, threshold in METRICS:
+            counts = chemfp.search.count_hits_arena(queries, self.targets, threshold, metric)
+            self.assertEqual(list(counts),
+                             [len(_metric_hits(fp, self.targets, metric, score_func, threshold))
+                                  for (id, fp) in queries])
+
+    def test_threshold_fp(self):
+        query_fp = queries[3][1]
+        for metric, score_func, threshold in METRICS:
+            result = chemfp.search.threshold_search_fp(query_fp, self.targets, threshold, metric)
+            self.assertEqual(sorted(result.get_ids_and_scores()),
+                             _metric_hits(query_fp, self.targets, metric, score_func, threshold))
+
+    def test_threshold_arena(self):
+        for metric, score_func, threshold in METRICS:
+            results = chemfp.search.threshold_search_arena(queries, self.targets, threshold, metric)
+            self.assertEqual(len(results), len(queries))
+            for (query_id, query_fp), result in zip(queries, results):
+                self.assertEqual(sorted(result.get_ids_and_scores()),
+                                 _metric_hits(query_fp, self.targets, metric, score_func, threshold))
+
+    def test_knearest_fp(self):
+        query_fp = queries[3][1]
+        for metric, score_func, threshold in METRICS:
+            result = chemfp.search.knearest_search_fp(query_fp, self.targets, 5, threshold, metric)
+            self.assertEqual(list(result.get_scores()),
+                             _best_scores(metric, _metric_hits(query_fp, self.targets, metric,
+                                                               score_func, threshold), 5))
+
+    def test_knearest_arena(self):
+        for metric, score_func, threshold in METRICS:
+            results = chemfp.search.knearest_search_arena(queries, self.targets, 5, threshold, metric)
+            for (query_id, query_fp), result in zip(queries, results):
+                self.assertEqual(list(result.get_scores()),
+                                 _best_scores(metric, _metric_hits(query_fp, self.targets, metric,
+                                                                   score_func, threshold), 5))
+
+    def test_knearest_distance_without_threshold(self):
+        for metric, score_func in (("hamming", _hamming), ("euclidean", _euclidean)):
+            results = chemfp.search.knearest_search_arena(queries, self.targets, 3, metric=metric)
+            for (query_id, query_fp), result in zip(queries, results):
+                self.assertEqual(list(result.get_scores()),
+                                 _best_scores(metric, _metric_hits(query_fp, self.targets, metric,
+                                                                   score_func, 1e10), 3))
+
+    def test_tanimoto_metric(self):
+        self.assertEqual(list(chemfp.search.count_hits_arena(queries, self.targets, 0.4)),
+                         list(chemfp.search.count_tanimoto_hits_arena(queries, self.targets, 0.4)))
+        results = chemfp.search.knearest_search_arena(queries, self.targets, 4, 0.3, "tanimoto")
+        expected = chemfp.search.knearest_tanimoto_search_arena(queries, self.targets, 4, 0.3)
+        for result, expected_result in zip(results, expected):
+            self.assertEqual(result.get_scores(), expected_result.get_scores())
+
+    def test_symmetric(self):
+        for metric, score_func, threshold in METRICS:
+            counts = chemfp.search.count_hits_symmetric(self.targets, threshold, metric, batch_size=7)
+            results = chemfp.search.threshold_search_symmetric(
+                self.targets, threshold, metric, batch_size=7)
+            knearest = chemfp.search.knearest_search_symmetric(
+                self.targets, 3, threshold, metric, batch_size=7)
+            for i, (id, fp) in enumerate(self.targets):
+                expected = _metric_hits(fp, self.targets, metric, score_func, threshold, skip=i)
+                self.assertEqual(counts[i], len(expected))
+                self.assertEqual(sorted(results[i].get_ids_and_scores()), expected)
+                self.assertEqual(list(knearest[i].get_scores()), _best_scores(metric, expected, 3))
+
+
+class TestSortedArena(ArenaMixin, unittest2.TestCase):
+    targets = targets
+
+class TestUnsortedArena(ArenaMixin, unittest2.TestCase):
+    targets = unsorted_targets
+
+
+class TestEmptyTargets(unittest2.TestCase):
+    # E1, E2 and T3 are all 1 away from the 1-bit query. T4 is 3 away.
+    fps = [("E1", "\x00\x00"), ("E2", "\x00\x00"), ("T3", "\x03\x00"), ("T4", "\x06\x00")]
+    arena = chemfp.load_fingerprints(fps, chemfp.Metadata(num_bits=16))
+    query_fp = "\x01\x00"
+    expected = [("E1", 1.0), ("E2", 1.0), ("T3", 1.0)]
+
+    def test_knearest_fp(self):
+        for metric in ("hamming", "euclidean"):
+            result = chemfp.search.knearest_search_fp(self.query_fp, self.arena, k=2,
+                                                      threshold=10, metric=metric)
+            self.assertEqual(list(result.get_scores()), [1.0, 1.0])
+            result = chemfp.search.knearest_search_fp(self.query_fp, self.arena, k=3,
+                                                      threshold=10, metric=metric)
+            self.assertEqual(sorted(result.get_ids_and_scores()), self.expected)
+
+    def test_knearest_arena(self):
+        queries = chemfp.load_fingerprints([("Q", self.query_fp)], chemfp.Metadata(num_bits=16))
+        for metric in ("hamming", "euclidean"):
+            results = chemfp.search.knearest_search_arena(queries, self.arena, k=3,
+                                                          threshold=10, metric=metric)
+            self.assertEqual(sorted(results[0].get_ids_and_scores()), self.expected)
+
+    def test_knearest_symmetric(self):
+        arena = chemfp.load_fingerprints(self.fps + [("Q", self.query_fp)],
+                                         chemfp.Metadata(num_bits=16))
+        for metric in ("hamming", "euclidean"):
+            results = chemfp.search.knearest_search_symmetric(arena, k=3, threshold=10,
+                                                              metric=metric)
+            result = results[arena.ids.index("Q")]
+            self.assertEqual(sorted(result.get_ids_and_scores()), self.expected)
+
+
+class TestErrors(unittest2.TestCase):
+    def test_negative_distance(self):
+        with self.assertRaisesRegexp(ValueError, "distance threshold must not be negative"):
+            chemfp.search.count_hits_arena(queries, targets, -1, "hamming")
+
+    def test_bad_similarity_threshold(self):
+        with self.assertRaisesRegexp(ValueError, "threshold"):
+            chemfp.search.threshold_search_arena(queries, targets, 1.1, "cosine")
+
+if __name__ == "__main__":
+    unittest2.main()
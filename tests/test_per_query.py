@@ -0,0 +1,125 @@
+from __future__ import absolute_import, with_statement
+
+import array
+import unittest2
+
+import chemfp
+import chemfp.search
+
+from support import fullpath
+
+queries = chemfp.load_fingerprints(fullpath("queries.fps"))[:30].copy()
+targets = chemfp.load_fingerprints(fullpath("targets.fps"))
+unsorted_targets = chemfp.load_fingerprints(fullpath("targets.fps"), reorder=False)
+
+THRESHOLDS = [(0.0, 0.1, 0.35, 0.5, 0.7, 0.9, 1.0)[i % 7] for i in range(len(queries))]
+KS = [(0, 1, 3, 5, 10)[i % 5] for i in range(len(queries))]
+
+def _sorted_hits(result):
+    return sorted(result.get_ids_and_scores())
+
+
+class PerQueryMixin(object):
+    def test_count(self):
+        counts = chemfp.search.count_tanimoto_hits_arena(queries, self.targets, THRESHOLDS)
+        for i, (query_id, query_fp) in enumerate(queries):
+            self.assertEqual(counts[i], chemfp.search.count_tanimoto_hits_fp(
+                query_fp, self.targets, THRESHOLDS[i]))
+
+    def test_threshold(self):
+        results = chemfp.search.threshold_tanimoto_search_arena(queries, self.targets, THRESHOLDS)
+        self.assertEqual(len(results), len(queries))
+        for i, (query_id, query_fp) in enumerate(queries):
+            expected = chemfp.search.threshold_tanimoto_search_fp(query_fp, self.targets, THRESHOLDS[i])
+            self.assertEqual(_sorted_hits(results[i]), _sorted_hits(expected))
+
+    def test_knearest_ks(self):
+        results = chemfp.search.knearest_tanimoto_search_arena(queries, self.targets, KS, 0.2)
+        for i, (query_id, query_fp) in enumerate(queries):
+            expected = chemfp.search.knearest_tanimoto_search_fp(query_fp, self.targets, KS[i], 0.2)
+            self.assertEqual(results[i].get_scores(), expected.get_scores())
+            self.assertLessEqual(len(results[i]), KS[i])
+
+    def test_knearest_thresholds(self):
+        results = chemfp.search.knearest_tanimoto_search_arena(queries, self.targets, 4, THRESHOLDS)
+        for i, (query_id, query_fp) in enumerate(queries):
+            expected = chemfp.search.knearest_tanimoto_search_fp(query_fp, self.targets, 4, THRESHOLDS[i])
+            self.assertEqual(results[i].get_scores(), expected.get_scores())
+
+    def test_knearest_both(self):
+        results = chemfp.search.knearest_tanimoto_search_arena(queries, self.targets, KS, THRESHOLDS)
+        for i, (query_id, query_fp) in enumerate(queries):
+            expected = chemfp.search.knearest_tanimoto_search_fp(query_fp, self.targets,
+                                                                  KS[i], THRESHOLDS[i])
+            self.assertEqual(results[i].get_scores(), expected.get_scores())
+
+    def test_array_input(self):
+        thresholds = array.array("d", THRESHOLDS)
+        counts = chemfp.search.count_tanimoto_hits_arena(queries, self.targets, thresholds)
+        self.assertEqual(list(counts),
+                         list(chemfp.search.count_tanimoto_hits_arena(queries, self.targets, THRESHOLDS)))
+
+    def test_same_as_scalar(self):
+        counts = chemfp.search.count_tanimoto_hits_arena(queries, self.targets, [0.4] * len(queries))
+        self.assertEqual(list(counts),
+                         list(chemfp.search.count_tanimoto_hits_arena(queries, self.targets, 0.4)))
+
+    def test_subarenas(self):
+        subqueries = queries[5:15]
+        subtargets = self.targets[10:80]
+        results = chemfp.search.threshold_tanimoto_search_arena(subqueries, subtargets, THRESHOLDS[5:15])
+        for i, (query_id, query_fp) in enumerate(subqueries):
+            expected = chemfp.search.threshold_tanimoto_search_fp(query_fp, subtargets, THRESHOLDS[5+i])
+            self.assertEqual(_sorted_hits(results[i]), _sorted_hits(expected))
+
+
+class TestSortedArena(PerQueryMixin, unittest2.TestCase):
+    targets = targets
+
+class TestUnsortedArena(PerQueryMixin, unittest2.TestCase):
+    targets = unsorted_targets
+
+
+class TestPerQueryThreads(unittest2.TestCase):
+    def setUp(self):
+        self._num_threads = chemfp.get_num_threads()
+
+    def tearDown(self):
+        chemfp.set_num_threads(self._num_threads)
+
+    def test_threads_give_the_same_results(self):
+        chemfp.set_num_threads(1)
+        expected = chemfp.search.knearest_tanimoto_search_arena(queries, targets, KS, THRESHOLDS)
+        chemfp.set_num_threads(max(2, chemfp.get_max_threads()))
+        results = chemfp.search.knearest_tanimoto_search_arena(queries, targets, KS, THRESHOLDS)
+        for result, expected_result in zip(results, expected):
+            self.assertEqual(result.get_ids_and_scores(), expected_result.get_ids_and_scores())
+
+
+class TestPerQueryErrors(unittest2.TestCase):
+    def test_wrong_number_of_thresholds(self):
+        with self.assertRaisesRegexp(ValueError, "threshold has 3 values but there are 30 queries"):
+            chemfp.search.threshold_tanimoto_search_arena(queries, targets, [0.1, 0.2, 0.3])
+
+    def test_wrong_number_of_ks(self):
+        with self.assertRaisesRegexp(ValueError, "k has 2 values but there are 30 queries"):
+            chemfp.search.knearest_tanimoto_search_arena(queries, targets, [1, 2])
+
+    def test_bad_threshold(self):
+        thresholds = [0.5] * len(queries)
+        thresholds[7] = 1.5
+        with self.assertRaisesRegexp(ValueError, "threshold must between 0.0 and 1.0"):
+            chemfp.search.count_tanimoto_hits_arena(queries, targets, thresholds)
+
+    def test_bad_k(self):
+        ks = [3] * len(queries)
+        ks[2] = -1
+        with self.assertRaisesRegexp(ValueError, "k must not be negative"):
+            chemfp.search.knearest_tanimoto_search_arena(queries, targets, ks)
+
+    def test_with_max_score(self):
+        with self.assertRaisesRegexp(ValueError, "per-query thresholds cannot be used with max_score"):
+            chemfp.search.threshold_tanimoto_search_arena(queries, targets, THRESHOLDS, max_score=0.9)
+
+if __name__ == "__main__":
+    unittest2.main()
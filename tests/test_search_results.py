@@ -5,10 +5,15 @@ import unittest2
 import random
 import re
 import array
+import struct
 
+import chemfp
+from chemfp import search
 from chemfp.search import SearchResults
 from chemfp.fps_search import FPSSearchResults, FPSSearchResult
 
+from support import fullpath
+
 try:
     next
 except NameError:
@@ -914,6 +919,275 @@ class TestRangeSearches(TestCase):
                     method(interval=interval)
                 
 
+class TestFloatRangeSearches(TestRangeSearches):
+    def _create(self):
+        results = SearchResults(4, score_type="float")
+        for i, score in enumerate((0.1, 0.9, 0.2, 0.3, 0.15, 1.0)):
+            results._add_hit(0, i, score)
+        for i, score in enumerate((1.0, 0.0, 0.5, 0.14, 0.28)):
+            results._add_hit(2, i, score)
+        for i, score in enumerate((neg_inf, 0.0001, pos_inf)):
+            results._add_hit(3, i, score)
+        return results
+
+def _float32(score):
+    return array.array("f", [score])[0]
+
+def _uint16(score):
+    return int(score * 65535 + 0.5) / 65535.0
+
+class TestScoreTypes(TestCase):
+    def test_default(self):
+        self.assertEquals(SearchResults(3).score_type, "double")
+
+    def test_bad_score_type(self):
+        with self.assertRaisesRegexp(ValueError, "score_type must be one of 'double', 'float' or 'uint16'"):
+            SearchResults(3, score_type="int")
+
+    def _create(self, score_type):
+        results = SearchResults(2, score_type=score_type)
+        for i, score in enumerate(random_scores):
+            results._add_hit(1, i, score)
+        return results
+
+    def test_float_scores(self):
+        results = self._create("float")
+        self.assertEquals(results.score_type, "float")
+        self.assertEquals(len(results[1]), len(random_scores))
+        self.assertListEquals(results[1].get_scores(), map(_float32, random_scores))
+        self.assertListEquals(results[1].get_indices(), range(len(random_scores)))
+        self.assertEquals(results[1].get_indices_and_scores()[3], (3, _float32(random_scores[3])))
+
+    def test_uint16_scores(self):
+        results = self._create("uint16")
+        self.assertEquals(results.score_type, "uint16")
+        self.assertListEquals(results[1].get_scores(), map(_uint16, random_scores))
+
+    def test_uint16_clamps_scores(self):
+        results = SearchResults(1, score_type="uint16")
+        results._add_hit(0, 0, -0.5)
+        results._add_hit(0, 1, 1.5)
+        self.assertListEquals(results[0].get_scores(), [0.0, 1.0])
+
+    def test_reorder(self):
+        for score_type, convert in (("float", _float32), ("uint16", _uint16)):
+            results = self._create(score_type)
+            expected = sorted(((i, convert(score)) for (i, score) in enumerate(random_scores)),
+                              key = lambda (index, score): (-score, index))
+            results.reorder_all("decreasing-score")
+            self.assertListEquals(results[1], expected)
+            results[1].reorder("increasing-index")
+            self.assertListEquals(results[1].get_indices(), range(len(random_scores)))
+            results[1].reorder("move-closest-first")
+            self.assertEquals(results[1].get_scores()[0], convert(max(random_scores)))
+
+    def test_limits_are_rounded(self):
+        # 0.7 isn't exact as a float or a uint16, but it should still match itself
+        for score_type in ("float", "uint16"):
+            results = SearchResults(1, score_type=score_type)
+            results._add_hit(0, 0, 0.7)
+            results._add_hit(0, 1, 1.0)
+            self.assertEquals(results.count_all(0.7), 2)
+            self.assertEquals(results[0].count(0.7, 0.7), 1)
+            self.assertEquals(results[0].count(0.7, interval="()"), 1)
+            self.assertEquals(results[0].count(max_score=1.0, interval="[)"), 1)
+            self.assertEquals(results[0].count(max_score=1.0000001, interval="[)"), 2)
+            self.assertEquals(results.count_all(0.0, 2.0), 2)
+            self.assertAlmostEqual(results[0].cumulative_score(0.7), 1.7, 4)
+
+    def test_clear_and_reuse(self):
+        for score_type in ("double", "float", "uint16"):
+            results = self._create(score_type)
+            results[1].clear()
+            self.assertEquals(len(results[1]), 0)
+            results._add_hit(1, 5, 1.0)
+            self.assertListEquals(results[1], [(5, 1.0)])
+
+
+class TestSearchScoreTypes(TestCase):
+    queries = chemfp.load_fingerprints(fullpath("queries.fps"))[:20]
+    targets = chemfp.load_fingerprints(fullpath("targets.fps"))
+
+    def _check_results(self, results, expected, convert):
+        self.assertEquals(len(results), len(expected))
+        for result, expected_result in zip(results, expected):
+            self.assertListEquals(sorted(result.get_indices_and_scores()),
+                                  [(i, convert(score)) for (i, score) in
+                                   sorted(expected_result.get_indices_and_scores())])
+
+    def test_threshold_search(self):
+        expected = search.threshold_tanimoto_search_arena(self.queries, self.targets, 0.4)
+        for score_type, convert in (("float", _float32), ("uint16", _uint16)):
+            results = search.threshold_tanimoto_search_arena(self.queries, self.targets, 0.4,
+                                                             score_type=score_type)
+            self.assertEquals(results.score_type, score_type)
+            self._check_results(results, expected, convert)
+            self.assertEquals(results.count_all(0.4), expected.count_all())
+
+            result = search.threshold_tanimoto_search_fp(self.queries[3][1], self.targets, 0.4,
+                                                         score_type=score_type)
+            self._check_results([result], [expected[3]], convert)
+
+    def test_knearest_search(self):
+        expected = search.knearest_tanimoto_search_arena(self.queries, self.targets, 5, 0.2)
+        for score_type, convert in (("float", _float32), ("uint16", _uint16)):
+            results = search.knearest_tanimoto_search_arena(self.queries, self.targets, 5, 0.2,
+                                                            score_type=score_type)
+            for result, expected_result in zip(results, expected):
+                self.assertListEquals(result.get_scores(), map(convert, expected_result.get_scores()))
+
+    def test_symmetric_search(self):
+        arena = self.targets
+        expected = search.threshold_tanimoto_search_symmetric(arena, 0.5)
+        for score_type, convert in (("float", _float32), ("uint16", _uint16)):
+            results = search.threshold_tanimoto_search_symmetric(arena, 0.5, score_type=score_type)
+            self._check_results(results, expected, convert)
+            upper = search.threshold_tanimoto_search_symmetric(
+                arena, 0.5, include_lower_triangle=False, score_type=score_type)
+            search.fill_lower_triangle(upper)
+            self._check_results(upper, expected, convert)
+
+    def test_metric_search(self):
+        expected = search.threshold_search_arena(self.queries, self.targets, 0.5, metric="dice")
+        results = search.threshold_search_arena(self.queries, self.targets, 0.5, metric="dice",
+                                                score_type="uint16")
+        self._check_results(results, expected, _uint16)
+        expected = search.knearest_search_arena(self.queries, self.targets, 3, metric="hamming")
+        results = search.knearest_search_arena(self.queries, self.targets, 3, metric="hamming",
+                                               score_type="float")
+        for result, expected_result in zip(results, expected):
+            self.assertListEquals(result.get_scores(), list(expected_result.get_scores()))
+
+    def test_uint16_distance_metric(self):
+        for metric in ("hamming", "euclidean"):
+            with self.assertRaisesRegexp(ValueError, "uint16 scores are only supported for similarity metrics"):
+                search.threshold_search_arena(self.queries, self.targets, 10, metric=metric,
+                                              score_type="uint16")
+
+    def test_bad_score_type(self):
+        with self.assertRaisesRegexp(ValueError, "score_type must be one of"):
+            search.threshold_tanimoto_search_arena(self.queries, self.targets, score_type="half")
+
+
+def _view_values(view):
+    if view.format == "q":
+        return list(struct.unpack("%dq" % len(view), str(buffer(view))))
+    return list(array.array(view.format, str(buffer(view))))
+
+class TestHitViews(TestCase):
+    targets = chemfp.load_fingerprints(fullpath("targets.fps"))
+
+    def _search(self, score_type="double"):
+        return search.threshold_tanimoto_search_symmetric(self.targets, 0.5, score_type=score_type)
+
+    def _get_row(self, results):
+        for i, result in enumerate(results):
+            if len(result) > 2:
+                return i
+        raise AssertionError("no row with enough hits")
+
+    def test_row_views(self):
+        results = self._search()
+        result = results[self._get_row(results)]
+        indices = result.get_indices_view()
+        scores = result.get_scores_view()
+        self.assertEquals(len(indices), len(result))
+        self.assertEquals((indices.format, indices.itemsize), ("i", array.array("i").itemsize))
+        self.assertEquals((scores.format, scores.itemsize), ("d", 8))
+        self.assertListEquals(_view_values(indices), list(result.get_indices()))
+        self.assertListEquals(_view_values(scores), list(result.get_scores()))
+        self.assertIs(indices.obj, results)
+
+    def test_memoryview(self):
+        results = self._search("float")
+        result = results[self._get_row(results)]
+        view = memoryview(result.get_scores_view())
+        self.assertEquals(view.format, "f")
+        self.assertEquals(view.itemsize, 4)
+        self.assertEquals(view.shape, (len(result),))
+        self.assertTrue(view.readonly)
+        self.assertEquals(view.tobytes(), array.array("f", result.get_scores()).tostring())
+
+    def test_uint16_scores(self):
+        results = self._search("uint16")
+        result = results[self._get_row(results)]
+        scores = result.get_scores_view()
+        self.assertEquals(scores.format, "H")
+        self.assertListEquals([x / 65535.0 for x in _view_values(scores)], list(result.get_scores()))
+
+    def test_empty_row(self):
+        results = SearchResults(2)
+        view = results[1].get_indices_view()
+        self.assertEquals(len(view), 0)
+        self.assertEquals(str(buffer(view)), "")
+        self.assertEquals(memoryview(view).tobytes(), "")
+
+    def test_view_sees_reorder(self):
+        results = self._search()
+        result = results[self._get_row(results)]
+        indices = result.get_indices_view()
+        result.reorder("decreasing-index")
+        self.assertListEquals(_view_values(indices), list(result.get_indices()))
+        self.assertListEquals(_view_values(indices), sorted(result.get_indices(), reverse=True))
+
+    def test_view_keeps_results_alive(self):
+        results = self._search()
+        result = results[self._get_row(results)]
+        expected = list(result.get_indices())
+        view = result.get_indices_view()
+        del results, result
+        self.assertListEquals(_view_values(view), expected)
+
+    def test_no_changes_while_exported(self):
+        results = self._search()
+        view = results[0].get_scores_view()
+        with self.assertRaisesRegexp(BufferError, "cannot change the hits while a hit view is in use"):
+            results.clear_all()
+        with self.assertRaisesRegexp(BufferError, "cannot change the hits"):
+            results[1].clear()
+        with self.assertRaisesRegexp(BufferError, "cannot change the hits"):
+            results._add_hit(0, 0, 1.0)
+        with self.assertRaisesRegexp(BufferError, "cannot change the hits"):
+            search.fill_lower_triangle(results)
+        del view
+        results.clear_all()
+        self.assertEquals(results.count_all(), 0)
+
+    def test_flat_views(self):
+        for score_type in ("double", "float", "uint16"):
+            results = self._search(score_type)
+            offsets, indices, scores = results.get_flat_views()
+            self.assertEquals(offsets.format, "q")
+            self.assertEquals(indices.format, "i")
+            self.assertEquals(scores.format, {"double": "d", "float": "f", "uint16": "H"}[score_type])
+            self.assertEquals(len(offsets), len(results) + 1)
+            self.assertEquals(len(indices), results.count_all())
+            self.assertEquals(len(scores), results.count_all())
+            offsets = _view_values(offsets)
+            indices = _view_values(indices)
+            scores = _view_values(scores)
+            self.assertEquals(offsets[0], 0)
+            for i, result in enumerate(results):
+                start, end = offsets[i], offsets[i+1]
+                self.assertListEquals(indices[start:end], list(result.get_indices()))
+                self.assertEquals(list(scores[start:end]),
+                                  list(_view_values(result.get_scores_view())))
+
+    def test_flat_views_are_copies(self):
+        results = self._search()
+        offsets, indices, scores = results.get_flat_views()
+        n = results.count_all()
+        results.clear_all()
+        self.assertEquals(len(indices), n)
+        self.assertEquals(_view_values(offsets)[-1], n)
+
+    def test_empty_flat_views(self):
+        offsets, indices, scores = SearchResults(3).get_flat_views()
+        self.assertEquals(_view_values(offsets), [0, 0, 0, 0])
+        self.assertEquals(len(indices), 0)
+        self.assertEquals(len(scores), 0)
+
+
 
 if __name__ == "__main__":
     unittest2.main()
@@ -0,0 +1,165 @@
+from __future__ import absolute_import, with_statement
+
+import os
+import pickle
+import unittest2
+import tempfile
+import shutil
+
+import chemfp
+from chemfp import search, shared_arena, futures
+
+from support import fullpath
+
+_tmpdir = tempfile.mkdtemp(prefix="test_shared_arena")
+
+def tearDownModule():
+    shutil.rmtree(_tmpdir)
+
+arena = chemfp.load_fingerprints(fullpath("queries.fps"))
+
+def _hits(results):
+    return [sorted(result.get_ids_and_scores()) for result in results]
+
+class TestPublishAndAttach(unittest2.TestCase):
+    def setUp(self):
+        self.filename = shared_arena.publish_arena(arena)
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def test_default_filename(self):
+        self.assertTrue(os.path.basename(self.filename).startswith("chemfp-"))
+        self.assertTrue(self.filename.endswith(".fpb"))
+        if os.path.isdir("/dev/shm"):
+            self.assertEqual(os.path.dirname(self.filename), "/dev/shm")
+
+    def test_explicit_filename(self):
+        filename = os.path.join(_tmpdir, "explicit.fpb")
+        self.assertEqual(shared_arena.publish_arena(arena, filename), filename)
+        shared = shared_arena.attach_arena(filename)
+        self.assertEqual(shared.filename, filename)
+        self.assertEqual(list(shared), list(arena))
+
+    def test_attach(self):
+        shared = shared_arena.attach_arena(self.filename)
+        self.assertTrue(isinstance(shared, shared_arena.SharedFingerprintArena))
+        self.assertEqual(shared.ids, arena.ids)
+        self.assertEqual(list(shared), list(arena))
+        self.assertEqual(shared.popcount_indices, arena.popcount_indices)
+
+    def test_attach_is_cached(self):
+        shared = shared_arena.attach_arena(self.filename)
+        self.assertTrue(shared_arena.attach_arena(self.filename) is shared)
+
+    def test_pickle_uses_filename(self):
+        shared = shared_arena.attach_arena(self.filename)
+        s = pickle.dumps(shared, 2)
+        self.assertTrue(len(s) < 200)
+        self.assertTrue(pickle.loads(s) is shared)
+
+
+class TestProcessPoolSearch(unittest2.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.filename = shared_arena.publish_arena(arena)
+        cls.shared = shared_arena.attach_arena(cls.filename)
+        cls.executor = futures.ProcessPoolExecutor(max_workers=2)
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.shutdown()
+        os.unlink(cls.filename)
+
+    def test_count(self):
+        expected = search.count_tanimoto_hits_symmetric(arena, 0.3)
+        counts = shared_arena.count_tanimoto_hits_symmetric(self.executor, self.shared, 0.3,
+                                                            batch_size=7)
+        self.assertEqual(list(counts), list(expected))
+
+    def test_count_default_batch_size(self):
+        expected = search.count_tanimoto_hits_symmetric(arena, 0.5)
+        counts = shared_arena.count_tanimoto_hits_symmetric(self.executor, self.shared, 0.5)
+        self.assertEqual(list(counts), list(expected))
+
+    def test_threshold(self):
+        expected = search.threshold_tanimoto_search_symmetric(arena, 0.3)
+        results = shared_arena.threshold_tanimoto_search_symmetric(self.executor, self.shared, 0.3,
+                                                                   batch_size=11)
+        self.assertEqual(_hits(results), _hits(expected))
+
+    def test_threshold_upper_triangle(self):
+        expected = search.threshold_tanimoto_search_symmetric(arena, 0.3,
+                                                              include_lower_triangle=False)
+        results = shared_arena.threshold_tanimoto_search_symmetric(
+            self.executor, self.shared, 0.3, include_lower_triangle=False, batch_size=11)
+        self.assertEqual(_hits(results), _hits(expected))
+
+    def test_bad_batch_size(self):
+        with self.assertRaisesRegexp(ValueError, "batch_size must be positive"):
+            shared_arena.count_tanimoto_hits_symmetric(self.executor, self.shared, batch_size=0)
+
+    def test_thread_pool(self):
+        expected = search.count_tanimoto_hits_symmetric(arena, 0.4)
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            counts = shared_arena.count_tanimoto_hits_symmetric(executor, arena, 0.4,
+                                                                batch_size=5)
+        self.assertEqual(list(counts), list(expected))
+
+    def test_repeated_counts(self):
+        # Each search uses new worker count files
+        for threshold in (0.3, 0.6, 0.3):
+            expected = search.count_tanimoto_hits_symmetric(arena, threshold)
+            counts = shared_arena.count_tanimoto_hits_symmetric(self.executor, self.shared,
+                                                                threshold, batch_size=13)
+            self.assertEqual(list(counts), list(expected))
+
+    def test_count_files_are_removed(self):
+        dirname = shared_arena._get_default_dir()
+        before = set(name for name in os.listdir(dirname) if name.startswith("chemfp-counts-"))
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            shared_arena.count_tanimoto_hits_symmetric(executor, arena, 0.4, batch_size=5)
+        after = set(name for name in os.listdir(dirname) if name.startswith("chemfp-counts-"))
+        self.assertEqual(after, before)
+        self.assertEqual(shared_arena._count_accumulators, {})
+
+    def test_thread_pool_threshold(self):
+        expected = search.threshold_tanimoto_search_symmetric(arena, 0.4)
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            results = shared_arena.threshold_tanimoto_search_symmetric(executor, arena, 0.4,
+                                                                       batch_size=5)
+        self.assertEqual(_hits(results), _hits(expected))
+
+    def test_empty_arena(self):
+        empty = arena.copy(indices=[])
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(list(shared_arena.count_tanimoto_hits_symmetric(executor, empty)), [])
+            self.assertEqual(len(shared_arena.threshold_tanimoto_search_symmetric(executor, empty)), 0)
+
+
+class TestAddFlatHits(unittest2.TestCase):
+    def test_add_rows(self):
+        expected = search.threshold_tanimoto_search_symmetric(arena, 0.4, include_lower_triangle=False)
+        block = search.SearchResults(10)
+        for row in range(10):
+            for index, score in expected[20+row].get_indices_and_scores():
+                block._add_hit(row, index, score)
+        results = search.SearchResults(len(arena))
+        results._add_flat_hits(20, *[str(buffer(view)) for view in block.get_flat_views()])
+        for row in range(len(arena)):
+            if 20 <= row < 30:
+                self.assertEqual(results[row].get_indices_and_scores(),
+                                 expected[row].get_indices_and_scores())
+            else:
+                self.assertEqual(len(results[row]), 0)
+
+    def test_bad_rows(self):
+        offsets = "\0" * 8 * 3
+        results = search.SearchResults(5)
+        with self.assertRaisesRegexp(IndexError, "the rows are out of range"):
+            results._add_flat_hits(4, offsets, "", "")
+        with self.assertRaisesRegexp(ValueError, "offsets must contain at least one 64-bit integer"):
+            results._add_flat_hits(0, "", "", "")
+        with self.assertRaisesRegexp(ValueError, "the offsets do not match the indices and scores"):
+            results._add_flat_hits(0, offsets, "\0" * 4, "\0" * 8)
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -3,7 +3,11 @@
 import unittest2
 from cStringIO import StringIO
 import array
+import ctypes
+import random
+import signal
 
+import _chemfp
 import chemfp
 from chemfp import search, bitops
 
@@ -253,6 +257,12 @@ class TestThreshold(unittest2.TestCase):
         
         
 
+    def test_partial_results_too_small(self):
+        results = search.SearchResults(5)
+        with self.assertRaisesRegexp(ValueError, "not enough space allocated for the results"):
+            search.partial_threshold_tanimoto_search_symmetric(results, fps, 0.5, 0, 10)
+
+
 class TestKNearest(unittest2.TestCase):
     def test_symmetric(self):
         # query[i] always matches target[i] so x[i] will always contain element[i]
@@ -284,5 +294,158 @@ class TestKNearest(unittest2.TestCase):
             y_row.sort()
             self.assertEquals(x_row, y_row, "Problem in %d" % i)
 
+def _float32(score):
+    return array.array("f", [score])[0]
+
+class TestCSR(unittest2.TestCase):
+    def _check_csr(self, arena, threshold, batch_size=100):
+        matrix = search.threshold_tanimoto_search_symmetric_csr(arena, threshold, batch_size)
+        expected = search.threshold_tanimoto_search_symmetric(arena, threshold)
+        N = len(arena)
+        self.assertEquals(len(matrix), N)
+        self.assertEquals(matrix.shape, (N, N))
+        self.assertEquals(len(matrix.indptr), N+1)
+        self.assertEquals(matrix.nnz, expected.count_all())
+        self.assertEquals(matrix.indptr[N], matrix.nnz)
+        for i in range(N):
+            indices = matrix.get_indices(i)
+            self.assertEquals(indices, sorted(indices))
+            expected_hits = sorted((j, _float32(score))
+                                   for (j, score) in expected[i].get_indices_and_scores())
+            self.assertEquals(matrix.get_indices_and_scores(i), expected_hits)
+        return matrix
+
+    def test_thresholds(self):
+        for threshold in (0.0, 0.1, 0.35, 0.6, 0.9, 1.0):
+            self._check_csr(fps, threshold)
+
+    def test_batch_size(self):
+        self._check_csr(fps, 0.4, batch_size=7)
+
+    def test_zeros(self):
+        matrix = self._check_csr(zeros, 0.0)
+        self.assertEquals(matrix.nnz, 30)
+        self.assertEquals(matrix.get_ids(0), ["B", "C", "D", "E", "F"])
+        self.assertEquals(matrix.get_scores(0), [0.0] * 5)
+        self._check_csr(zeros, 0.001)
+
+    def test_empty_arena(self):
+        matrix = search.threshold_tanimoto_search_symmetric_csr(fps[:0], 0.5)
+        self.assertEquals(len(matrix), 0)
+        self.assertEquals(matrix.nnz, 0)
+        self.assertEquals(list(matrix.indptr), [0])
+
+    def test_buffers(self):
+        matrix = search.threshold_tanimoto_search_symmetric_csr(fps, 0.5)
+        self.assertEquals(len(buffer(matrix.indptr)), 8 * (len(fps)+1))
+        self.assertEquals(len(buffer(matrix.indices)), 4 * matrix.nnz)
+        self.assertEquals(array.array("i", str(buffer(matrix.indices))).tolist(), matrix.indices[:])
+        self.assertEquals(array.array("f", str(buffer(matrix.scores))).tolist(), matrix.scores[:])
+
+    def test_iter_indices_and_scores(self):
+        matrix = search.threshold_tanimoto_search_symmetric_csr(fps, 0.5)
+        rows = list(matrix.iter_indices_and_scores())
+        self.assertEquals(len(rows), len(fps))
+        self.assertEquals(rows[5], matrix.get_indices_and_scores(5))
+
+    def test_bad_row(self):
+        matrix = search.threshold_tanimoto_search_symmetric_csr(fps, 0.5)
+        with self.assertRaisesRegexp(IndexError, "row index is out of range"):
+            matrix.get_indices(len(fps))
+
+    def test_counts_do_not_match(self):
+        # The upper-triangle pass checks that it doesn't overflow a row
+        N = len(fps)
+        indptr = (ctypes.c_longlong * (N+1))()
+        upper_counts = (ctypes.c_int * N)()
+        with self.assertRaisesRegexp(ValueError, "the hit counts do not match the CSR row sizes"):
+            _chemfp.threshold_tanimoto_arena_symmetric_csr(
+                0.5, fps.num_bits, fps.start_padding, fps.end_padding, fps.storage_size, fps.arena,
+                N, 0, N, fps.popcount_indices, indptr, upper_counts, (ctypes.c_int*0)(),
+                (ctypes.c_float*0)())
+
+
+def _random_arena(num_fingerprints, num_bytes, seed):
+    rng = random.Random(seed)
+    return chemfp.load_fingerprints(
+        [("ID%d" % i, "".join(chr(rng.randrange(256)) for j in range(num_bytes)))
+         for i in range(num_fingerprints)],
+        chemfp.Metadata(num_bits=num_bytes*8))
+
+class _Alarm(Exception):
+    pass
+
+class TestSingleParallelCall(unittest2.TestCase):
+    def setUp(self):
+        self._num_threads = chemfp.get_num_threads()
+
+    def tearDown(self):
+        chemfp.set_num_threads(self._num_threads)
+
+    def test_same_results_for_each_thread_count(self):
+        expected_counts = search.count_tanimoto_hits_arena(fps, fps, 0.4)
+        expected_hits = [sorted(result.get_indices_and_scores())
+                         for result in search.threshold_tanimoto_search_arena(fps, fps, 0.4)]
+        for i, hits in enumerate(expected_hits):
+            hits.remove((i, 1.0))
+        expected_knearest = [result.get_scores() for result in
+                             search.knearest_tanimoto_search_symmetric(fps, k=5, threshold=0.3)]
+        for num_threads in (1, 2, 4):
+            chemfp.set_num_threads(num_threads)
+            counts = search.count_tanimoto_hits_symmetric(fps, 0.4)
+            self.assertEquals([count+1 for count in counts], list(expected_counts))
+            results = search.threshold_tanimoto_search_symmetric(fps, 0.4)
+            self.assertEquals([sorted(result.get_indices_and_scores()) for result in results],
+                              expected_hits)
+            results = search.knearest_tanimoto_search_symmetric(fps, k=5, threshold=0.3)
+            self.assertEquals([result.get_scores() for result in results], expected_knearest)
+
+    def test_batch_size_is_still_checked(self):
+        with self.assertRaisesRegexp(ValueError, "batch_size must be positive"):
+            search.count_tanimoto_hits_symmetric(fps, 0.4, batch_size=0)
+        counts = search.count_tanimoto_hits_symmetric(fps, 0.4, batch_size=1)
+        self.assertEquals(list(counts), list(search.count_tanimoto_hits_symmetric(fps, 0.4)))
+
+    @unittest2.skipUnless(hasattr(signal, "setitimer"), "needs signal.setitimer")
+    def test_signal_interrupts_the_search(self):
+        arena = _random_arena(20000, 128, 1234)
+        def handler(signum, frame):
+            raise _Alarm()
+        old_handler = signal.signal(signal.SIGALRM, handler)
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 0.05)
+            with self.assertRaises(_Alarm):
+                search.count_tanimoto_hits_symmetric(arena, 0.01)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, old_handler)
+
+    @unittest2.skipUnless(hasattr(signal, "setitimer"), "needs signal.setitimer")
+    def test_signal_interrupts_the_csr_fill(self):
+        # Random fingerprints are about 0.33 similar, so there are few
+        # hits, but the fill still has to compare every pair.
+        arena = _random_arena(20000, 128, 1234)
+        N = len(arena)
+        counts = search.count_tanimoto_hits_symmetric(arena, 0.4)
+        indptr = (ctypes.c_longlong * (N+1))()
+        num_hits = _chemfp.make_csr_indptr(counts, indptr)
+        indices = (ctypes.c_int * num_hits)()
+        scores = (ctypes.c_float * num_hits)()
+        def handler(signum, frame):
+            raise _Alarm()
+        old_handler = signal.signal(signal.SIGALRM, handler)
+        try:
+            signal.setitimer(signal.ITIMER_REAL, 0.05)
+            with self.assertRaises(_Alarm):
+                _chemfp.threshold_tanimoto_arena_symmetric_csr(
+                    0.4, arena.num_bits,
+                    arena.start_padding, arena.end_padding, arena.storage_size, arena.arena,
+                    N, 0, N, arena.popcount_indices,
+                    indptr, counts, indices, scores)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, old_handler)
+
+
 if __name__ == "__main__":
     unittest2.main()
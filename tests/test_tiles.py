@@ -0,0 +1,106 @@
+from __future__ import absolute_import, with_statement
+
+import unittest2
+
+import chemfp
+import chemfp.search
+from chemfp import bitops
+
+from support import fullpath
+
+queries = chemfp.load_fingerprints(fullpath("queries.fps"))
+targets = chemfp.load_fingerprints(fullpath("targets.fps"))
+unsorted_targets = chemfp.load_fingerprints(fullpath("targets.fps"), reorder=False)
+
+def _search(func, *args):
+    # Get the results with and without tiling
+    tile_size = bitops.get_option("tile-size")
+    try:
+        bitops.set_option("tile-size", 0)
+        expected = func(*args)
+        # Use tiles with only a few targets in each
+        bitops.set_option("tile-size", 5 * targets.storage_size)
+        result = func(*args)
+    finally:
+        bitops.set_option("tile-size", tile_size)
+    return result, expected
+
+def _hits(results):
+    return [result.get_ids_and_scores() for result in results]
+
+
+class TilesMixin(object):
+    def test_count(self):
+        for threshold in (0.0, 0.2, 0.45, 0.8, 1.0):
+            result, expected = _search(chemfp.search.count_tanimoto_hits_arena,
+                                       queries, self.targets, threshold)
+            self.assertEqual(list(result), list(expected))
+
+    def test_threshold(self):
+        for threshold in (0.0, 0.3, 0.6, 0.9, 1.0):
+            result, expected = _search(chemfp.search.threshold_tanimoto_search_arena,
+                                       queries, self.targets, threshold)
+            # The hits are in the same order as the untiled search
+            self.assertEqual(_hits(result), _hits(expected))
+
+    def test_per_query_thresholds(self):
+        thresholds = [(0.0, 0.25, 0.5, 0.75, 1.0)[i % 5] for i in range(len(queries))]
+        result, expected = _search(chemfp.search.count_tanimoto_hits_arena,
+                                   queries, self.targets, thresholds)
+        self.assertEqual(list(result), list(expected))
+        result, expected = _search(chemfp.search.threshold_tanimoto_search_arena,
+                                   queries, self.targets, thresholds)
+        self.assertEqual(_hits(result), _hits(expected))
+
+    def test_subarenas(self):
+        result, expected = _search(chemfp.search.threshold_tanimoto_search_arena,
+                                   queries[10:30], self.targets[17:90], 0.4)
+        self.assertEqual(_hits(result), _hits(expected))
+        result, expected = _search(chemfp.search.count_tanimoto_hits_arena,
+                                   queries[:50], self.targets[3:], 0.3)
+        self.assertEqual(list(result), list(expected))
+
+    def test_empty_query(self):
+        empty_queries = chemfp.load_fingerprints(
+            [("empty", "\0" * targets.metadata.num_bytes), ("first", queries[0][1])],
+            queries.metadata)
+        for threshold in (0.0, 0.5):
+            result, expected = _search(chemfp.search.threshold_tanimoto_search_arena,
+                                       empty_queries, self.targets, threshold)
+            self.assertEqual(_hits(result), _hits(expected))
+            result, expected = _search(chemfp.search.count_tanimoto_hits_arena,
+                                       empty_queries, self.targets, threshold)
+            self.assertEqual(list(result), list(expected))
+
+class TestSortedArena(TilesMixin, unittest2.TestCase):
+    targets = targets
+
+class TestUnsortedArena(TilesMixin, unittest2.TestCase):
+    targets = unsorted_targets
+
+
+class TestTileThreads(unittest2.TestCase):
+    def setUp(self):
+        self._num_threads = chemfp.get_num_threads()
+
+    def tearDown(self):
+        chemfp.set_num_threads(self._num_threads)
+
+    def test_threads(self):
+        chemfp.set_num_threads(max(2, chemfp.get_max_threads()))
+        result, expected = _search(chemfp.search.threshold_tanimoto_search_arena,
+                                   queries, targets, 0.35)
+        self.assertEqual(_hits(result), _hits(expected))
+
+
+class TestTileSizeOption(unittest2.TestCase):
+    def test_default(self):
+        self.assertIn("tile-size", bitops.get_options())
+        self.assertEqual(bitops.get_option("tile-size"), 256*1024)
+
+    def test_negative(self):
+        with self.assertRaisesRegexp(ValueError, "Bad option value"):
+            bitops.set_option("tile-size", -1)
+
+if __name__ == "__main__":
+    unittest2.main()
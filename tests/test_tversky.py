@@ -0,0 +1,192 @@
+from __future__ import absolute_import, with_statement
+
+import unittest2
+
+import chemfp
+import chemfp.search
+from chemfp import bitops
+
+from support import fullpath
+
+queries = chemfp.load_fingerprints(fullpath("queries.fps"))[:20].copy()
+targets = chemfp.load_fingerprints(fullpath("targets.fps"))
+unsorted_targets = chemfp.load_fingerprints(fullpath("targets.fps"), reorder=False)
+
+WEIGHTS = [(1.0, 1.0, 0.4), (0.5, 0.5, 0.5), (0.9, 0.1, 0.6),
+           (1.0, 0.0, 0.8), (0.0, 1.0, 0.3), (2.0, 3.0, 0.2)]
+
+def _tversky_hits(query_fp, targets, threshold, alpha, beta, skip=None):
+    hits = []
+    for i, (id, fp) in enumerate(targets):
+        if i == skip:
+            continue
+        score = bitops.byte_tversky(query_fp, fp, alpha, beta)
+        if score >= threshold:
+            hits.append((id, score))
+    return sorted(hits)
+
+def _best_scores(hits, k):
+    return sorted([score for (id, score) in hits], reverse=True)[:k]
+
+
+class TestBitops(unittest2.TestCase):
+    def test_byte_tversky(self):
+        # a=8, b=8, c=4
+        self.assertEqual(bitops.byte_tversky("\xff\x00", "\x0f\x0f", 0.5, 0.5), 0.5)
+        self.assertEqual(bitops.byte_tversky("\xff\x00", "\x0f\x0f", 1.0, 0.0), 0.5)
+        self.assertEqual(bitops.byte_tversky("\x0f\x00", "\x0f\x0f", 1.0, 0.0), 1.0)
+        self.assertEqual(bitops.byte_tversky("\x00\x00", "\x00\x00", 1.0, 0.0), 0.0)
+
+    def test_defaults_are_tanimoto(self):
+        for (id1, fp1), (id2, fp2) in zip(queries, targets):
+            self.assertEqual(bitops.byte_tversky(fp1, fp2), bitops.byte_tanimoto(fp1, fp2))
+
+    def test_hex_tversky(self):
+        self.assertEqual(bitops.hex_tversky("ff00", "0f0f", 0.5, 0.5), 0.5)
+        self.assertEqual(bitops.hex_tversky("ff00", "0f0g", 0.5, 0.5), -1.0)
+
+    def test_negative_weights(self):
+        with self.assertRaisesRegexp(ValueError, "alpha and beta must not be negative"):
+            bitops.byte_tversky("\0", "\0", -0.1, 1.0)
+
+
+class ArenaMixin(object):
+    def test_count_fp(self):
+        for alpha, beta, threshold in WEIGHTS:
+            for query_id, query_fp in queries:
+                self.assertEqual(
+                    chemfp.search.count_tversky_hits_fp(query_fp, self.targets, threshold, alpha, beta),
+                    len(_tversky_hits(query_fp, self.targets, threshold, alpha, beta)))
+
+    def test_count_arena(self):
+        for alpha, beta, threshold in WEIGHTS:
+            counts = chemfp.search.count_tversky_hits_arena(queries, self.targets, threshold, alpha, beta)
+            self.assertEqual(list(counts),
+                             [len(_tversky_hits(fp, self.targets, threshold, alpha, beta))
+                                  for (id, fp) in queries])
+
+    def test_threshold_fp(self):
+        query_fp = queries[3][1]
+        for alpha, beta, threshold in WEIGHTS:
+            result = chemfp.search.threshold_tversky_search_fp(query_fp, self.targets, threshold, alpha, beta)
+            self.assertEqual(sorted(result.get_ids_and_scores()),
+                             _tversky_hits(query_fp, self.targets, threshold, alpha, beta))
+
+    def test_threshold_arena(self):
+        for alpha, beta, threshold in WEIGHTS:
+            results = chemfp.search.threshold_tversky_search_arena(
+                queries, self.targets, threshold, alpha, beta)
+            self.assertEqual(len(results), len(queries))
+            for (query_id, query_fp), result in zip(queries, results):
+                self.assertEqual(sorted(result.get_ids_and_scores()),
+                                 _tversky_hits(query_fp, self.targets, threshold, alpha, beta))
+
+    def test_knearest_fp(self):
+        query_fp = queries[3][1]
+        for alpha, beta, threshold in WEIGHTS:
+            result = chemfp.search.knearest_tversky_search_fp(
+                query_fp, self.targets, 5, threshold, alpha, beta)
+            self.assertEqual(list(result.get_scores()),
+                             _best_scores(_tversky_hits(query_fp, self.targets, threshold, alpha, beta), 5))
+
+    def test_knearest_arena(self):
+        for alpha, beta, threshold in WEIGHTS:
+            results = chemfp.search.knearest_tversky_search_arena(
+                queries, self.targets, 5, threshold, alpha, beta)
+            for (query_id, query_fp), result in zip(queries, results):
+                self.assertEqual(list(result.get_scores()),
+                                 _best_scores(_tversky_hits(query_fp, self.targets, threshold, alpha, beta), 5))
+
+    def test_same_as_tanimoto(self):
+        self.assertEqual(list(chemfp.search.count_tversky_hits_arena(queries, self.targets, 0.4)),
+                         list(chemfp.search.count_tanimoto_hits_arena(queries, self.targets, 0.4)))
+        results = chemfp.search.threshold_tversky_search_arena(queries, self.targets, 0.4)
+        expected = chemfp.search.threshold_tanimoto_search_arena(queries, self.targets, 0.4)
+        for result, expected_result in zip(results, expected):
+            self.assertEqual(sorted(result.get_ids_and_scores()),
+                             sorted(expected_result.get_ids_and_scores()))
+
+    def test_symmetric(self):
+        for alpha, beta, threshold in WEIGHTS:
+            counts = chemfp.search.count_tversky_hits_symmetric(
+                self.targets, threshold, alpha, beta, batch_size=7)
+            results = chemfp.search.threshold_tversky_search_symmetric(
+                self.targets, threshold, alpha, beta, batch_size=7)
+            knearest = chemfp.search.knearest_tversky_search_symmetric(
+                self.targets, 3, threshold, alpha, beta, batch_size=7)
+            for i, (id, fp) in enumerate(self.targets):
+                expected = _tversky_hits(fp, self.targets, threshold, alpha, beta, skip=i)
+                self.assertEqual(counts[i], len(expected))
+                self.assertEqual(sorted(results[i].get_ids_and_scores()), expected)
+                self.assertEqual(list(knearest[i].get_scores()), _best_scores(expected, 3))
+
+    def test_symmetric_is_asymmetric(self):
+        # With alpha=1, beta=0, a small fingerprint contained in a large
+        # one is a hit, but not the other way around.
+        results = chemfp.search.threshold_tversky_search_symmetric(self.targets, 0.7, 1.0, 0.0)
+        pairs = set((i, j) for i, result in enumerate(results) for j in result.get_indices())
+        self.assertTrue(pairs)
+        self.assertNotEqual(pairs, set((j, i) for (i, j) in pairs))
+
+
+class TestSortedArena(ArenaMixin, unittest2.TestCase):
+    targets = targets
+
+class TestUnsortedArena(ArenaMixin, unittest2.TestCase):
+    targets = unsorted_targets
+
+
+class TestErrors(unittest2.TestCase):
+    def test_negative_alpha(self):
+        with self.assertRaisesRegexp(ValueError, "alpha and beta must not be negative"):
+            chemfp.search.count_tversky_hits_arena(queries, targets, 0.4, -1.0, 1.0)
+
+    def test_negative_beta(self):
+        with self.assertRaisesRegexp(ValueError, "alpha and beta must not be negative"):
+            chemfp.search.threshold_tversky_search_arena(queries, targets, 0.4, 1.0, -1.0)
+
+    def test_bad_threshold(self):
+        with self.assertRaisesRegexp(ValueError, "threshold"):
+            chemfp.search.knearest_tversky_search_arena(queries, targets, 3, 1.1, 1.0, 1.0)
+
+
+class TestFPSReader(unittest2.TestCase):
+    def _open(self):
+        return chemfp.open(fullpath("targets.fps"))
+
+    def test_count(self):
+        for alpha, beta, threshold in WEIGHTS:
+            counts = self._open().count_tversky_hits_arena(queries, threshold, alpha, beta)
+            self.assertEqual(list(counts), list(chemfp.search.count_tversky_hits_arena(
+                queries, targets, threshold, alpha, beta)))
+
+    def test_count_fp(self):
+        count = self._open().count_tversky_hits_fp(queries[0][1], 0.3, 0.7, 0.3)
+        self.assertEqual(count, chemfp.search.count_tversky_hits_fp(queries[0][1], targets, 0.3, 0.7, 0.3))
+
+    def test_threshold(self):
+        for alpha, beta, threshold in WEIGHTS:
+            results = self._open().threshold_tversky_search_arena(queries, threshold, alpha, beta)
+            for (query_id, query_fp), result in zip(queries, results):
+                self.assertEqual(sorted(result.get_ids_and_scores()),
+                                 _tversky_hits(query_fp, targets, threshold, alpha, beta))
+
+    def test_threshold_fp(self):
+        result = self._open().threshold_tversky_search_fp(queries[1][1], 0.5, 0.9, 0.1)
+        self.assertEqual(sorted(result.get_ids_and_scores()),
+                         _tversky_hits(queries[1][1], targets, 0.5, 0.9, 0.1))
+
+    def test_knearest(self):
+        for alpha, beta, threshold in WEIGHTS:
+            results = self._open().knearest_tversky_search_arena(queries, 5, threshold, alpha, beta)
+            for (query_id, query_fp), result in zip(queries, results):
+                self.assertEqual(list(result.get_scores()),
+                                 _best_scores(_tversky_hits(query_fp, targets, threshold, alpha, beta), 5))
+
+    def test_knearest_fp(self):
+        result = self._open().knearest_tversky_search_fp(queries[2][1], 4, 0.2, 0.9, 0.1)
+        self.assertEqual(list(result.get_scores()),
+                         _best_scores(_tversky_hits(queries[2][1], targets, 0.2, 0.9, 0.1), 4))
+
+if __name__ == "__main__":
+    unittest2.main()